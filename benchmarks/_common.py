@@ -0,0 +1,30 @@
+"""
+Shared setup for the benchmark scripts: a Flask app on a throwaway SQLite file.
+"""
+
+import sqlite3
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import db
+
+
+def _wal(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+        dbapi_connection.execute('PRAGMA synchronous=NORMAL')
+        dbapi_connection.execute('PRAGMA busy_timeout=15000')
+
+
+def make_app(path, wal=False):
+    """App bound to the SQLite file `path`; wal=True opens it with the production pragmas."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    if wal:
+        with app.app_context():
+            # on this app's engine only, like main.py
+            event.listen(db.engine, 'connect', _wal)
+    return app
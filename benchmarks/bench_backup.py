@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark: writer latency while an online backup runs.
+
+Fills a throwaway WAL database with stock entries, then takes a snapshot
+with `copy_database` while a writer thread keeps committing one entry
+every 10ms, and reports the writer's worst commit time next to the one it
+sees with no backup running. The copy is checked with `check_integrity`.
+Run: python benchmarks/bench_backup.py [rows]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.backup import copy_database, check_integrity
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=15, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def populate(path, rows):
+    conn = connect(path)
+    conn.execute('CREATE TABLE entry (id INTEGER PRIMARY KEY, date TEXT, type TEXT, material TEXT, '
+                 'client TEXT, qty REAL, bill_no TEXT)')
+    conn.executemany('INSERT INTO entry (date, type, material, client, qty, bill_no) VALUES (?, ?, ?, ?, ?, ?)',
+                     (('2026-01-01', 'OUT', 'OPC', f'Client {i % 500:03d}', 1 + i % 5, f'B-{i}')
+                      for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def write_while(path, seconds=None, until=None):
+    """Commit an entry every 10ms for `seconds` or until `until` is set; returns commit times."""
+    conn = connect(path)
+    times = []
+    end = time.perf_counter() + (seconds or 0)
+    while (until is not None and not until.is_set()) or (until is None and time.perf_counter() < end):
+        start = time.perf_counter()
+        conn.execute("INSERT INTO entry (date, type, material, qty) VALUES ('2026-01-02', 'IN', 'OPC', 1)")
+        conn.commit()
+        times.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    conn.close()
+    return times
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        populate(path, rows)
+        print(f"{rows} entries, {os.path.getsize(path) / 1048576:.1f} MB")
+
+        idle = write_while(path, seconds=2)
+        print(f"no backup:      {len(idle):4d} commits, worst {max(idle) * 1000:6.1f} ms")
+
+        done = threading.Event()
+        during = []
+        writer = threading.Thread(target=lambda: during.extend(write_while(path, until=done)))
+        writer.start()
+        start = time.perf_counter()
+        copy_database(path, os.path.join(tmp, 'copy.db'))
+        elapsed = time.perf_counter() - start
+        done.set()
+        writer.join()
+        print(f"during backup:  {len(during):4d} commits, worst {max(during) * 1000:6.1f} ms "
+              f"(backup {elapsed:.2f}s)")
+        problems = check_integrity(os.path.join(tmp, 'copy.db'))
+        print('integrity:', 'ok' if not problems else problems)
+        assert not problems
+
+
+if __name__ == '__main__':
+    main()
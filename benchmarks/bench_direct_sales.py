@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark: direct sales per second from concurrent counters on WAL SQLite.
+
+Posts sales through `run_once` + `record_direct_sale` (what
+/api/v1/direct_sales runs per request) from 1, 2, 4 and 8 threads against
+a throwaway WAL database, resending every tenth request with the same
+Idempotency-Key the way a tablet retries after a dropped connection, and
+checks that the retries created nothing.
+Run: python benchmarks/bench_direct_sales.py [sales per thread]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _common import make_app
+from models import db, Client, Material, Entry, DirectSale
+import utils.journal  # noqa: F401  (registers the finance/journal flush hooks)
+import utils.period  # noqa: F401
+from utils.idempotency import run_once
+from utils.sales import record_direct_sale
+
+
+def populate(clients=50):
+    db.session.add(Material(name='OPC', code='M1', unit_price=10))
+    db.session.commit()
+    db.session.add(Entry(date='2026-01-01', time='08:00:00', type='IN', material='OPC', qty=10_000_000))
+    for i in range(clients):
+        db.session.add(Client(code=f'C{i:03d}', name=f'Counter Client {i:03d}'))
+    db.session.commit()
+
+
+def counter(app, worker, sales, errors):
+    with app.app_context():
+        for n in range(sales):
+            key = f"w{worker}-{n - 1 if n % 10 == 9 else n}"  # every tenth request is a retry
+            payload = {'client': f'C{n % 50:03d}', 'qty': 1 + n % 5}
+
+            def post():
+                result = record_direct_sale(payload['client'], [('OPC', payload['qty'], 10)],
+                                            paid_amount=payload['qty'] * 10, username='bench')
+                return 201, {'sale_id': result['sale'].id, 'bill_ref': result['bill_ref']}
+            try:
+                run_once(worker, 'direct_sales', key, payload, post)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(repr(e))
+
+
+def main():
+    per_thread = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for threads in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as tmp:
+            app = make_app(os.path.join(tmp, 'bench.db'), wal=True)
+            with app.app_context():
+                db.create_all()
+                populate()
+            errors = []
+            workers = [threading.Thread(target=counter, args=(app, w, per_thread, errors)) for w in range(threads)]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - start
+            with app.app_context():
+                created = DirectSale.query.count()
+                db.engine.dispose()
+            expected = threads * (per_thread - per_thread // 10)
+            print(f"{threads} counter(s): {threads * per_thread:5d} requests, {created:5d} sales "
+                  f"in {elapsed:6.2f}s  ({threads * per_thread / elapsed:7.1f} req/s)  errors: {len(errors)}")
+            assert created == expected, (created, expected, errors[:3])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark: full vs incremental integrity check.
+
+Fills a throwaway WAL database with stock entries, bookings with their
+BK- bills, payments allocated to those bills and invoiced direct sales,
+then times `verify_integrity` as a full check, as an incremental check
+after a handful of documents changed, and as a repair of a few figures
+knocked off with raw SQL (which an incremental check does not see, so the
+repair runs full).
+Run: python benchmarks/bench_integrity.py [entries]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from _common import make_app
+from models import (db, Client, Material, Entry, Booking, PendingBill, Payment, PaymentAllocation, DirectSale,
+                    Invoice)
+from utils.integrity import verify_integrity
+
+
+def populate(entries, documents):
+    now = datetime.now()
+    db.session.execute(Material.__table__.insert(), [
+        {'id': i + 1, 'code': f'M{i}', 'name': f'Material {i}', 'total': 0, 'total_in': 0, 'total_out': 0}
+        for i in range(20)])
+    db.session.execute(Client.__table__.insert(), [
+        {'id': i + 1, 'code': f'C{i:03d}', 'name': f'Client {i:03d}'} for i in range(500)])
+    db.session.execute(Entry.__table__.insert(), [
+        {'date': '2026-01-01', 'type': 'IN' if i % 3 == 0 else 'OUT', 'material_id': 1 + i % 20,
+         'material': f'Material {i % 20}', 'qty': 1 + i % 5, 'is_void': False, 'updated_at': now}
+        for i in range(entries)])
+    db.session.execute(text(
+        "UPDATE material SET total_in = (SELECT coalesce(sum(qty), 0) FROM entry "
+        "WHERE material_id = material.id AND type = 'IN'), total_out = (SELECT coalesce(sum(qty), 0) FROM entry "
+        "WHERE material_id = material.id AND type = 'OUT')"))
+    db.session.execute(text("UPDATE material SET total = total_in - total_out"))
+    db.session.execute(Booking.__table__.insert(), [
+        {'id': i + 1, 'client_id': 1 + i % 500, 'amount': 1000, 'paid_amount': 200, 'is_void': False,
+         'date_posted': now, 'updated_at': now} for i in range(documents)])
+    db.session.execute(Payment.__table__.insert(), [
+        {'id': i + 1, 'client_id': 1 + i % 500, 'amount': 300, 'is_void': False, 'date_posted': now,
+         'updated_at': now} for i in range(documents)])
+    db.session.execute(PaymentAllocation.__table__.insert(), [
+        {'payment_id': i + 1, 'pending_bill_id': i + 1, 'amount': 300, 'is_void': False, 'updated_at': now}
+        for i in range(documents)])
+    db.session.execute(PendingBill.__table__.insert(), [
+        {'id': i + 1, 'bill_no': f'BK-{i + 1}', 'client_code': f'C{i % 500:03d}', 'amount': 500, 'is_paid': False,
+         'is_void': False, 'updated_at': now} for i in range(documents)])
+    db.session.execute(Invoice.__table__.insert(), [
+        {'id': i + 1, 'invoice_no': f'INV-{i + 1}', 'total_amount': 100, 'balance': 60, 'status': 'PARTIAL',
+         'is_void': False, 'updated_at': now} for i in range(documents)])
+    db.session.execute(DirectSale.__table__.insert(), [
+        {'id': i + 1, 'client_id': 1 + i % 500, 'amount': 100, 'paid_amount': 40, 'invoice_id': i + 1,
+         'category': 'Credit Customer', 'is_void': False, 'date_posted': now, 'updated_at': now}
+        for i in range(documents)])
+    db.session.execute(PendingBill.__table__.insert(), [
+        {'bill_no': f'INV-{i + 1}', 'client_code': f'C{i % 500:03d}', 'amount': 60, 'is_paid': False,
+         'is_void': False, 'updated_at': now} for i in range(documents)])
+    db.session.commit()
+
+
+def timed(label, **kwargs):
+    start = time.perf_counter()
+    run = verify_integrity(**kwargs)
+    print(f"{label:<22} {time.perf_counter() - start:6.2f}s  {run.checked:7d} rows checked, {run.drift} off"
+          + (f", {run.repaired} repaired" if run.repair else ''))
+    return run
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    documents = entries // 20
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'), wal=True)
+        with app.app_context():
+            db.create_all()
+            populate(entries, documents)
+            print(f"{entries} entries, {documents} bookings, payments and sales")
+            timed('full check')
+            timed('incremental, nothing', incremental=True)
+            for booking in Booking.query.limit(10):
+                booking.paid_amount = 300
+            db.session.commit()
+            timed('incremental, 10 docs', incremental=True)
+            db.session.execute(text("UPDATE material SET total = total + 1 WHERE id <= 5"))
+            db.session.execute(text("UPDATE pending_bill SET amount = 0 WHERE id % 1000 = 0"))
+            db.session.commit()
+            timed('full repair', repair=True)
+            assert timed('full check after').drift == 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark: case-insensitive client lookups on DirectSale.
+
+Fills a throwaway SQLite database with 100k direct sales (by default) and
+times the old `func.lower(client_name) == name.lower()` predicate against
+the indexed `name_key` column for a batch of lookups.
+Run: python benchmarks/bench_name_key.py [rows] [lookups]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func
+
+from _common import make_app
+from models import db, DirectSale
+from utils.names import name_key
+
+
+def populate(rows, clients=2000, seed=42):
+    rnd = random.Random(seed)
+    names = [f"Client Traders {i:05d}" for i in range(clients)]
+    batch = []
+    for i in range(rows):
+        name = rnd.choice(names)
+        if rnd.random() < 0.3:
+            name = name.upper()
+        batch.append({'client_name': name, 'name_key': name_key(name), 'category': 'Credit',
+                      'amount': rnd.randint(100, 10000), 'paid_amount': 0})
+        if len(batch) == 10000:
+            db.session.execute(DirectSale.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(DirectSale.__table__.insert(), batch)
+    db.session.commit()
+    return names
+
+
+def timed(label, lookups, query):
+    start = time.perf_counter()
+    total = 0
+    for name in lookups:
+        total += query(name) or 0
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms  ({elapsed * 1000 / len(lookups):.3f} ms/lookup)")
+    return total
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'))
+        with app.app_context():
+            db.create_all()
+            print(f"Populating {rows} direct sales...")
+            names = populate(rows)
+            lookups = random.Random(7).sample(names, min(n_lookups, len(names)))
+
+            def by_lower(name):
+                return db.session.query(func.sum(DirectSale.amount))\
+                    .filter(func.lower(DirectSale.client_name) == name.lower()).scalar()
+
+            def by_key(name):
+                return db.session.query(func.sum(DirectSale.amount))\
+                    .filter(DirectSale.name_key == name_key(name)).scalar()
+
+            print(f"{len(lookups)} lookups:")
+            before = timed("func.lower(client_name)", lookups, by_lower)
+            after = timed("name_key (indexed)", lookups, by_key)
+            assert before == after, (before, after)
+
+
+if __name__ == '__main__':
+    main()
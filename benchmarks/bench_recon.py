@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Data Lab reconciliation scaling across worker processes.
+
+Builds a synthetic finance/dispatch pair (500k rows each by default) and
+times `reconcile_parallel` with 1, 2, 4, ... workers up to the core count.
+Run: python benchmarks/bench_recon.py [rows]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.recon import reconcile_parallel
+
+
+def synthetic_records(rows, clients=2000, seed=42):
+    """Return (fin_by_bill, inv_by_bill, directory) shaped like extract_records()."""
+    rnd = random.Random(seed)
+    names = [f"Client Traders {i:05d}" for i in range(clients)]
+    directory = {n.lower(): f"tmpc-{i + 1:06d}" for i, n in enumerate(names)}
+    materials = ['OPC', 'SRC', 'Slag', 'White', 'Fauji', 'Lucky', 'DG Khan', 'Bestway']
+
+    fin_by_bill = {}
+    inv_by_bill = {}
+    for i in range(rows):
+        bill = f"#{100000 + i}"
+        name = rnd.choice(names)
+        fin_by_bill.setdefault(bill, []).append({'client': name})
+        roll = rnd.random()
+        if roll < 0.80:
+            inv_name = name                      # GREEN
+        elif roll < 0.95:
+            inv_name = name.replace('Traders', 'Trd') + ' & Sons'   # YELLOW
+        else:
+            continue                             # finance only -> RED
+        inv_by_bill.setdefault(bill, []).append({
+            'client': inv_name, 'material': rnd.choice(materials), 'qty': float(rnd.randint(1, 500))})
+    # dispatch rows with no finance record -> RED
+    for i in range(rows // 20):
+        inv_by_bill.setdefault(f"#X{i}", []).append({'client': rnd.choice(names), 'material': 'OPC', 'qty': 10.0})
+    return fin_by_bill, inv_by_bill, directory
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    cores = os.cpu_count() or 1
+    print(f"Building synthetic data: {rows} finance rows, ~{rows} dispatch rows ...")
+    fin_by_bill, inv_by_bill, directory = synthetic_records(rows)
+
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= cores:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != cores:
+        worker_counts.append(cores)
+
+    print(f"{'workers':>8} {'seconds':>10} {'bills/s':>12} {'speedup':>8}")
+    baseline = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        bills, outcomes = reconcile_parallel(fin_by_bill, inv_by_bill, known={}, directory=directory, workers=workers)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>10.2f} {len(bills) / elapsed:>12.0f} {baseline / elapsed:>7.2f}x")
+
+    print(f"\n{len(bills)} bills, {len(outcomes)} outcomes per run")
+
+
+if __name__ == '__main__':
+    main()
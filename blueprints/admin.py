@@ -1,11 +1,18 @@
 """
 Admin module for monitoring and managing the application modules.
-Provides dashboard to view loaded modules and their configuration.
+Provides dashboard to view loaded modules and their configuration,
+the scheduled maintenance jobs (utils.maintenance) with their history,
+and the integrity check of derived figures (utils.integrity).
 """
 
-from flask import Blueprint, render_template, jsonify
+import json
+from flask import Blueprint, render_template, jsonify, request, redirect, url_for, flash
 from flask_login import login_required, current_user
+from models import db, MaintenanceJob, MaintenanceRun, SchedulerLease, IntegrityCheck, BackgroundJob
 from utils.module_loader import get_modules_info
+from utils.jobs import start_job
+from utils.maintenance import JOBS, job_states, run_job
+from utils.integrity import integrity_job, watermark
 from datetime import datetime
 
 # Module configuration
@@ -104,6 +111,125 @@ def api_health_check():
     })
 
 
+@admin_bp.route('/maintenance')
+@login_required
+def maintenance():
+    """Maintenance jobs with their cadence and last run, the scheduler leader and recent runs."""
+    runs = MaintenanceRun.query.order_by(MaintenanceRun.started_at.desc()).limit(50).all()
+    return render_template('admin_maintenance.html', jobs=job_states(), runs=runs,
+                           lease=db.session.get(SchedulerLease, 'maintenance'), now=datetime.now())
+
+
+@admin_bp.route('/maintenance/<name>', methods=['POST'])
+@login_required
+def maintenance_update(name):
+    """Change a job's cadence (minutes; blank restores the default) and switch it on or off."""
+    if name not in JOBS:
+        flash(f'No maintenance job named {name}.', 'danger')
+        return redirect(url_for('admin.maintenance'))
+    job = db.session.get(MaintenanceJob, name) or MaintenanceJob(name=name)
+    minutes = request.form.get('every', '').strip()
+    try:
+        job.every = int(minutes) * 60 if minutes else None
+    except ValueError:
+        flash('Cadence must be a whole number of minutes.', 'danger')
+        return redirect(url_for('admin.maintenance'))
+    if job.every is not None and job.every < 60:
+        flash('Cadence must be at least one minute.', 'danger')
+        return redirect(url_for('admin.maintenance'))
+    job.enabled = request.form.get('enabled') == 'on'
+    db.session.add(job)
+    db.session.commit()
+    flash(f'Maintenance job {name} updated.', 'success')
+    return redirect(url_for('admin.maintenance'))
+
+
+def _run_maintenance(job_id, name, trigger):
+    run = run_job(name, trigger)
+    if run.status == 'FAILED':
+        raise RuntimeError(run.message)
+    return f"{name}: {run.message}"
+
+
+@admin_bp.route('/maintenance/<name>/run', methods=['POST'])
+@login_required
+def maintenance_run(name):
+    """Run a maintenance job now, in the background; it is recorded like a scheduled run."""
+    state = next((s for s in job_states() if s.name == name), None)
+    if state is None:
+        flash(f'No maintenance job named {name}.', 'danger')
+    elif state.running:
+        flash(f'Maintenance job {name} is already running.', 'warning')
+    else:
+        start_job('maintenance', _run_maintenance, name, current_user.username, created_by=current_user.username)
+        flash(f'Maintenance job {name} started.', 'info')
+    return redirect(url_for('admin.maintenance'))
+
+
+@admin_bp.route('/api/maintenance')
+@login_required
+def api_maintenance():
+    """API endpoint for the maintenance jobs, leader and recent runs."""
+    lease = db.session.get(SchedulerLease, 'maintenance')
+    runs = MaintenanceRun.query.order_by(MaintenanceRun.started_at.desc()).limit(50)
+    return jsonify({
+        'success': True,
+        'timestamp': datetime.now().isoformat(),
+        'leader': lease.holder if lease else None,
+        'lease_expires_at': lease.expires_at.isoformat() if lease and lease.expires_at else None,
+        'jobs': [
+            {
+                'name': s.name,
+                'description': s.description,
+                'every': s.every,
+                'default_every': s.default_every,
+                'enabled': s.enabled,
+                'running': s.running,
+                'next_due': s.next_due.isoformat(),
+                'last_status': s.last.status if s.last else None,
+            }
+            for s in job_states()
+        ],
+        'runs': [
+            {
+                'id': r.id,
+                'job': r.job,
+                'trigger': r.trigger,
+                'status': r.status,
+                'message': r.message,
+                'worker': r.worker,
+                'started_at': r.started_at.isoformat() if r.started_at else None,
+                'finished_at': r.finished_at.isoformat() if r.finished_at else None,
+            }
+            for r in runs
+        ]
+    })
+
+
+@admin_bp.route('/integrity')
+@login_required
+def integrity():
+    """Integrity check runs, with the drifted rows of the latest one."""
+    runs = IntegrityCheck.query.order_by(IntegrityCheck.id.desc()).limit(20).all()
+    latest = next((r for r in runs if r.status == 'DONE'), None)
+    rows = json.loads(latest.details) if latest and latest.details else []
+    jobs = BackgroundJob.query.filter_by(kind='integrity').order_by(BackgroundJob.id.desc()).limit(5).all()
+    return render_template('admin_integrity.html', runs=runs, latest=latest, rows=rows, jobs=jobs,
+                           watermark=watermark())
+
+
+@admin_bp.route('/integrity', methods=['POST'])
+@login_required
+def integrity_run():
+    """Start an integrity check (optionally incremental, optionally repairing) in the background."""
+    repair = request.form.get('repair') == '1'
+    incremental = request.form.get('incremental') == '1'
+    start_job('integrity', integrity_job, repair, incremental, current_user.username,
+              created_by=current_user.username)
+    flash(f"Integrity {'repair' if repair else 'check'} started.", 'info')
+    return redirect(url_for('admin.integrity'))
+
+
 @admin_bp.context_processor
 def inject_admin_context():
     """Inject admin-specific data into all admin templates."""
@@ -1,21 +1,41 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from models import db, Client, PendingBill, Entry, ReconBasket
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, current_app
+from models import db, Client, Material, PendingBill, Entry, ReconBasket, ReconBillState, BackgroundJob
+from flask_login import current_user
+from sqlalchemy import func
+from utils.jobs import start_job, update_job
+from utils.links import LinkResolver
+from utils.names import name_key
+from utils.stock import delete_entries, post_entry_rows
+from utils.period import assert_open
+from utils.recon import (name_score, fingerprint, classify_unbilled, reconcile_partition,
+                         reconcile_parallel, group_unbilled, unbilled_key, UNBILLED_PREFIX)
 import pandas as pd
-from difflib import SequenceMatcher
 from datetime import datetime
 import io
+import os
 
 # Module configuration
 MODULE_CONFIG = {
     'name': 'Data Lab Module',
     'description': 'Data analysis and reconciliation module',
     'url_prefix': '/data_lab',
-    'enabled': True
+    'enabled': True,
+    'requires_login': True,
+    'allowed_roles': ['admin']
 }
 
 bp = Blueprint('data_lab', __name__)
 
 
+@bp.before_request
+def check_admin():
+    """Data Lab rewrites stock entries and pending bills: admins only."""
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    if current_user.role != 'admin':
+        abort(403)
+
+
 def read_table(file_storage):
     if not file_storage:
         return None
@@ -36,10 +56,191 @@ def read_table(file_storage):
             return None
 
 
-def name_score(a, b):
-    if not a or not b:
-        return 0
-    return int(SequenceMatcher(None, str(a).lower(), str(b).lower()).ratio() * 100)
+RECON_STATUSES = ['GREEN', 'YELLOW', 'RED', 'BLUE']
+BASKET_PAGE_SIZE = 50
+LEGACY_UNBILLED_KEY = ''  # ReconBillState key that once covered every unbilled dispatch row
+DATA_LAB_MARKER = 'Data Lab'  # nimbus_no on entries auto-applied from GREEN matches
+
+
+def _find_col(df, pred):
+    if df is None:
+        return None
+    for c in df.columns:
+        if pred(c.lower()):
+            return c
+    return None
+
+
+def _text(val):
+    if pd.isna(val):
+        return ''
+    if isinstance(val, float) and val.is_integer():
+        # numeric bill columns with blanks are read as floats (1001 -> 1001.0)
+        return str(int(val))
+    return str(val).strip()
+
+
+def _cell(row, col):
+    return _text(row[col]) if col else ''
+
+
+def extract_records(fin_df, inv_df):
+    """Group finance and dispatch rows by bill number.
+
+    Returns (fin_by_bill, inv_by_bill, unbilled) where every row is a plain
+    dict so the result can be fingerprinted and handed to worker processes.
+    """
+    fin_by_bill = {}
+    if fin_df is not None:
+        bill_col = _find_col(fin_df, lambda c: c == 'bill_no')
+        client_col = _find_col(fin_df, lambda c: 'client' in c)
+        if bill_col:
+            for bill, client in zip(fin_df[bill_col].tolist(), fin_df[client_col].tolist() if client_col else [''] * len(fin_df)):
+                bill, client = _text(bill), _text(client)
+                fin_by_bill.setdefault(bill, []).append({'client': client})
+
+    inv_by_bill = {}
+    unbilled = []
+    if inv_df is not None:
+        bill_col = _find_col(inv_df, lambda c: c == 'bill_no')
+        client_col = _find_col(inv_df, lambda c: 'client' in c)
+        material_col = _find_col(inv_df, lambda c: 'material' in c or 'item' in c)
+        qty_col = _find_col(inv_df, lambda c: 'qty' in c or 'quantity' in c)
+        date_col = _find_col(inv_df, lambda c: 'date' in c)
+        for _, r in inv_df.iterrows():
+            try:
+                qty = float(r[qty_col]) if qty_col else 0
+            except Exception:
+                qty = 0
+            if qty != qty:  # NaN
+                qty = 0
+            rec = {'client': _cell(r, client_col), 'material': _cell(r, material_col), 'qty': qty}
+            bill = _cell(r, bill_col)
+            if not bill or bill == 'nan':
+                # keyed by date, client and material (utils.recon.group_unbilled)
+                unbilled.append(dict(rec, date=_cell(r, date_col)))
+            else:
+                inv_by_bill.setdefault(bill, []).append(rec)
+
+    return fin_by_bill, inv_by_bill, unbilled
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def known_fingerprints():
+    return {s.bill_no: (s.fin_hash, s.inv_hash) for s in
+            db.session.query(ReconBillState.bill_no, ReconBillState.fin_hash, ReconBillState.inv_hash)}
+
+
+def client_directory():
+    """Lower-cased client name -> code map used for fuzzy suggestions."""
+    return {name.lower(): code for code, name in db.session.query(Client.code, Client.name) if name}
+
+
+def reconcile(fin_by_bill, inv_by_bill, unbilled, known, directory=None, workers=1, progress=None):
+    """Classify every bill whose fingerprint differs from `known`.
+
+    Returns ({bill: (fin_hash, inv_hash)}, outcomes). With workers > 1 the
+    bills are partitioned by bill_no hash across a process pool. Unbilled
+    dispatch rows are fingerprinted per date, client and material group, so
+    a partial upload leaves the reviewed groups it does not touch alone.
+    """
+    if workers > 1:
+        bills, outcomes = reconcile_parallel(fin_by_bill, inv_by_bill, known, directory,
+                                             workers=workers, progress=progress)
+    else:
+        items = [(bill, fin_by_bill.get(bill, []), inv_by_bill.get(bill, []))
+                 for bill in set(fin_by_bill) | set(inv_by_bill)]
+        bills, outcomes = reconcile_partition(items, known, directory)
+
+    if unbilled:
+        if LEGACY_UNBILLED_KEY in known:
+            # state from before unbilled rows were grouped: replace it and all its basket rows once
+            bills[LEGACY_UNBILLED_KEY] = None
+            known = {}
+        for key, rows in group_unbilled(unbilled).items():
+            hashes = (None, fingerprint(rows))
+            if known.get(key) != hashes:
+                bills[key] = hashes
+                outcomes.extend(classify_unbilled(rows))
+    return bills, outcomes
+
+
+def _delete_unbilled_rows(keys):
+    """Delete the BLUE basket rows of the unbilled groups `keys`."""
+    keys = set(keys)
+    ids = [id_ for id_, date, client, material in db.session.query(
+        ReconBasket.id, ReconBasket.inv_date, ReconBasket.inv_client, ReconBasket.inv_material)
+        .filter(ReconBasket.bill_no == '') if unbilled_key(date, client, material) in keys]
+    for chunk in _chunks(ids):
+        ReconBasket.query.filter(ReconBasket.id.in_(chunk)).delete(synchronize_session=False)
+
+
+def apply_outcomes(bills, outcomes, username='import'):
+    """Replace basket rows and auto-applied entries for `bills` with `outcomes`.
+
+    `bills` maps bill number -> (fin_hash, inv_hash) for every bill that was
+    re-classified; the stored fingerprints are refreshed in the same pass.
+    A None entry only drops that key's state and basket rows.
+    """
+    now = datetime.now()
+    _delete_unbilled_rows(bill for bill in bills if bill.startswith(UNBILLED_PREFIX))
+    for chunk in _chunks(bills):
+        ReconBasket.query.filter(ReconBasket.bill_no.in_(chunk)).delete(synchronize_session=False)
+        applied = Entry.query.filter(Entry.bill_no.in_(chunk), Entry.nimbus_no == DATA_LAB_MARKER)
+        assert_open(applied.with_entities(func.min(Entry.date)).scalar())
+        delete_entries(applied)
+        ReconBillState.query.filter(ReconBillState.bill_no.in_(chunk)).delete(synchronize_session=False)
+
+    basket_rows = []
+    green = []
+    bill_status = {}
+    for o in outcomes:
+        # a bill is only GREEN when every one of its rows matched
+        if o['status'] != 'GREEN' or o['bill_no'] not in bill_status:
+            bill_status[o['bill_no']] = o['status']
+        if o['status'] == 'GREEN':
+            green.append(o)
+        else:
+            basket_rows.append(dict(o, created_at=now))
+
+    if green:
+        # GREEN: auto-save to DB (create Entry and ensure pending bill exists)
+        green_bills = {o['bill_no'] for o in green}
+        existing = set()
+        for chunk in _chunks(green_bills):
+            existing.update(b for (b,) in db.session.query(PendingBill.bill_no).filter(PendingBill.bill_no.in_(chunk)))
+        clients = LinkResolver.load(Client)
+        materials = LinkResolver.load(Material)
+        entries = [{
+            'date': now.strftime('%Y-%m-%d'), 'time': now.strftime('%H:%M:%S'), 'type': 'OUT',
+            'material': o['inv_material'], 'client': o['fin_client'] or o['inv_client'], 'client_code': None,
+            'client_id': clients.resolve(name=o['fin_client'] or o['inv_client']),
+            'name_key': name_key(o['fin_client'] or o['inv_client']),
+            'material_id': materials.resolve(name=o['inv_material']),
+            'qty': o['inv_qty'], 'bill_no': o['bill_no'], 'nimbus_no': DATA_LAB_MARKER, 'created_by': username
+        } for o in green]
+        db.session.bulk_insert_mappings(Entry, entries)
+        post_entry_rows(entries)
+        new_bills = {}
+        for o in green:
+            if o['bill_no'] not in existing and o['bill_no'] not in new_bills:
+                new_bills[o['bill_no']] = {'bill_no': o['bill_no'], 'client_name': o['fin_client'], 'client_code': None,
+                                           'amount': 0, 'created_at': now.strftime('%Y-%m-%d %H:%M'), 'created_by': username}
+        if new_bills:
+            db.session.bulk_insert_mappings(PendingBill, list(new_bills.values()))
+
+    if basket_rows:
+        db.session.bulk_insert_mappings(ReconBasket, basket_rows)
+
+    db.session.bulk_insert_mappings(ReconBillState, [{
+        'bill_no': bill, 'fin_hash': fin_hash, 'inv_hash': inv_hash,
+        'status': 'BLUE' if bill.startswith(UNBILLED_PREFIX) else bill_status.get(bill), 'updated_at': now
+    } for bill, (fin_hash, inv_hash) in ((b, h) for b, h in bills.items() if h is not None)])
 
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -48,6 +249,7 @@ def upload():
         index_file = request.files.get('index_file')
         finance_file = request.files.get('finance_file')
         dispatch_file = request.files.get('dispatch_file')
+        incremental = request.form.get('mode', 'incremental') == 'incremental'
 
         ledger_df = read_table(index_file) if index_file else None
         fin_df = read_table(finance_file) if finance_file else None
@@ -56,7 +258,6 @@ def upload():
         ledger_map = {}
         if ledger_df is not None:
             # try to detect columns
-            cols = [c.lower() for c in ledger_df.columns]
             name_col = None
             code_col = None
             for c in ledger_df.columns:
@@ -77,109 +278,91 @@ def upload():
             if df is None:
                 return None
             df = df.copy()
-            df.columns = [c.strip() for c in df.columns]
+            df.columns = [str(c).strip() for c in df.columns]
             return df
 
         fin_df = norm(fin_df)
         inv_df = norm(inv_df)
 
-        # Build quick lookup by bill_no
-        fin_by_bill = {}
-        if fin_df is not None and 'bill_no' in [c.lower() for c in fin_df.columns]:
-            for _, r in fin_df.iterrows():
-                bill = str(r[[c for c in fin_df.columns if c.lower() == 'bill_no'][0]]).strip()
-                fin_by_bill.setdefault(bill, []).append(r)
-
-        inv_rows = []
-        if inv_df is not None:
-            for _, r in inv_df.iterrows():
-                inv_rows.append(r)
-
-        # Triangulate
-        for r in inv_rows:
-            # try extract bill_no and client
-            bill_col = [c for c in inv_df.columns if c.lower() == 'bill_no']
-            bill = ''
-            if bill_col:
-                bill = str(r[bill_col[0]]).strip()
-            inv_client_col = [c for c in inv_df.columns if 'client' in c.lower()]
-            inv_client = ''
-            if inv_client_col:
-                inv_client = str(r[inv_client_col[0]]).strip()
-            material_col = [c for c in inv_df.columns if 'material' in c.lower() or 'item' in c.lower()]
-            material = ''
-            if material_col:
-                material = str(r[material_col[0]]).strip()
-            qty_col = [c for c in inv_df.columns if 'qty' in c.lower() or 'quantity' in c.lower()]
-            qty = 0
-            if qty_col:
-                try:
-                    qty = float(r[qty_col[0]])
-                except Exception:
-                    qty = 0
-
-            if not bill or bill == 'nan' or bill.strip() == '':
-                # BLUE: unbilled dispatch
-                basket = ReconBasket(bill_no='', inv_date=None, inv_client=inv_client, inv_material=material, inv_qty=qty, status='BLUE', match_score=0)
-                db.session.add(basket)
-                continue
-
-            fin_list = fin_by_bill.get(bill, [])
-            if fin_list:
-                # match against first finance row
-                fin_r = fin_list[0]
-                fin_client_col = [c for c in fin_df.columns if 'client' in c.lower()]
-                fin_client = ''
-                if fin_client_col:
-                    fin_client = str(fin_r[fin_client_col[0]]).strip()
-                score = name_score(fin_client, inv_client)
-                if score >= 90:
-                    # GREEN: auto-save to DB (create Entry if not exists)
-                    entry = Entry(date=datetime.utcnow().date(), time=datetime.utcnow().time().isoformat(), type='OUT', material=material, client_name=fin_client or inv_client, client_code=None, qty=qty, bill_no=bill, created_by='import')
-                    db.session.add(entry)
-                    # ensure pending bill exists
-                    pending = PendingBill.query.filter_by(bill_no=bill).first()
-                    if not pending:
-                        pending = PendingBill(bill_no=bill, client_name=fin_client, client_code=None, amount=0, date=None)
-                        db.session.add(pending)
-                    # do not add to basket (auto-applied)
-                else:
-                    # YELLOW: conflict
-                    basket = ReconBasket(bill_no=bill, fin_client=fin_client, inv_client=inv_client, inv_material=material, inv_qty=qty, status='YELLOW', match_score=score)
-                    db.session.add(basket)
-            else:
-                # RED: waiting - exists in dispatch but not in finance
-                basket = ReconBasket(bill_no=bill, inv_client=inv_client, inv_material=material, inv_qty=qty, status='RED', match_score=0)
-                db.session.add(basket)
-
-        # Now check finance-only bills (in finance but not in dispatch)
-        if fin_df is not None:
-            for _, r in fin_df.iterrows():
-                bill = str(r[[c for c in fin_df.columns if c.lower() == 'bill_no'][0]]).strip()
-                if inv_df is None or bill not in [str(x[[c for c in inv_df.columns if c.lower() == 'bill_no'][0]]).strip() for _, x in inv_df.iterrows()]:
-                    # RED entry (finance only)
-                    client_col = [c for c in fin_df.columns if 'client' in c.lower()]
-                    fin_client = ''
-                    if client_col:
-                        fin_client = str(r[client_col[0]]).strip()
-                    basket = ReconBasket(bill_no=bill, fin_client=fin_client, status='RED', match_score=0)
-                    db.session.add(basket)
+        fin_by_bill, inv_by_bill, unbilled = extract_records(fin_df, inv_df)
+        total = len(set(fin_by_bill) | set(inv_by_bill)) + len(group_unbilled(unbilled))
 
+        if request.form.get('parallel'):
+            cpus = os.cpu_count() or 1
+            try:
+                workers = int(request.form.get('workers') or cpus)
+            except ValueError:
+                workers = cpus
+            # one process per core at most: the pool runs inside a web worker
+            workers = max(1, min(workers, cpus))
+            job_id = start_job('recon', _run_recon_job, fin_by_bill, inv_by_bill, unbilled, incremental, workers,
+                               current_user.username if current_user.is_authenticated else 'import',
+                               created_by=current_user.username if current_user.is_authenticated else None,
+                               total=total)
+            flash(f'Reconciliation of {total} bills started on {workers} workers.', 'info')
+            return redirect(url_for('data_lab.view_job', job_id=job_id))
+
+        known = known_fingerprints() if incremental else {}
+        # Triangulate only the bills whose rows changed since the last run
+        bills, outcomes = reconcile(fin_by_bill, inv_by_bill, unbilled, known, client_directory())
+
+        if not incremental:
+            # Full re-run: start from an empty basket instead of appending to it
+            ReconBasket.query.delete()
+            ReconBillState.query.delete()
+        apply_outcomes(bills, outcomes)
         db.session.commit()
-        flash('Files processed. Review the Recon Basket.', 'success')
+        flash(f'Files processed: {len(bills)} of {total} bills re-classified. Review the Recon Basket.', 'success')
         return redirect(url_for('data_lab.view_basket'))
 
     return render_template('data_lab.html')
 
 
+def _run_recon_job(job_id, fin_by_bill, inv_by_bill, unbilled, incremental, workers, username):
+    known = known_fingerprints() if incremental else {}
+    directory = client_directory()
+
+    def progress(done, parts):
+        update_job(job_id, done=done, total=parts, message=f'Classified {done}/{parts} partitions')
+
+    bills, outcomes = reconcile(fin_by_bill, inv_by_bill, unbilled, known, directory,
+                                workers=workers, progress=progress)
+    update_job(job_id, message=f'Saving {len(outcomes)} results')
+    if not incremental:
+        ReconBasket.query.delete()
+        ReconBillState.query.delete()
+    apply_outcomes(bills, outcomes, username)
+    db.session.commit()
+    return f'{len(bills)} bills re-classified on {workers} workers.'
+
+
+@bp.route('/jobs/<int:job_id>')
+def view_job(job_id):
+    job = BackgroundJob.query.get_or_404(job_id)
+    return render_template('data_lab_job.html', job=job)
+
+
 @bp.route('/basket')
 def view_basket():
-    groups = {}
-    for status in ['GREEN', 'YELLOW', 'RED', 'BLUE']:
-        groups[status] = ReconBasket.query.filter_by(status=status).all()
-    # also include any other statuses
-    others = ReconBasket.query.filter(~ReconBasket.status.in_(['GREEN', 'YELLOW', 'RED', 'BLUE'])).all()
-    return render_template('basket_view.html', groups=groups, others=others)
+    status = request.args.get('status', 'YELLOW').upper()
+    page = request.args.get('page', 1, type=int)
+
+    counts = dict(db.session.query(ReconBasket.status, func.count(ReconBasket.id)).group_by(ReconBasket.status).all())
+    tabs = [(s, counts.get(s, 0)) for s in RECON_STATUSES]
+    others_count = sum(c for s, c in counts.items() if s not in RECON_STATUSES)
+    tabs.append(('OTHER', others_count))
+
+    if status in RECON_STATUSES:
+        query = ReconBasket.query.filter(ReconBasket.status == status)
+    else:
+        # also include any other statuses
+        status = 'OTHER'
+        query = ReconBasket.query.filter(db.or_(ReconBasket.status == None, ~ReconBasket.status.in_(RECON_STATUSES)))
+
+    pagination = query.order_by(ReconBasket.bill_no.asc(), ReconBasket.id.asc()).paginate(
+        page=page, per_page=BASKET_PAGE_SIZE, error_out=False)
+    return render_template('basket_view.html', tabs=tabs, status=status,
+                           items=pagination.items, pagination=pagination)
 
 
 @bp.route('/correct_bill', methods=['POST'])
@@ -192,7 +375,8 @@ def correct_bill():
         return redirect(url_for('data_lab.view_basket'))
     # update PendingBill and Entry
     PendingBill.query.filter_by(bill_no=bill_no).update({'client_name': client.name, 'client_code': client.code})
-    Entry.query.filter_by(bill_no=bill_no).update({'client_name': client.name, 'client_code': client.code})
+    Entry.query.filter_by(bill_no=bill_no).update({'client': client.name, 'client_code': client.code,
+                                                   'client_id': client.id, 'name_key': name_key(client.name)})
     # remove basket entries for that bill
     ReconBasket.query.filter_by(bill_no=bill_no).delete()
     db.session.commit()
@@ -212,8 +396,11 @@ def legacy_import():
         flash('Pending bill not found', 'danger')
         return redirect(url_for('data_lab.view_basket'))
     # find baskets and entries with that bill and overwrite
+    client = Client.query.filter_by(code=pending.client_code).first()
     ReconBasket.query.filter_by(bill_no=bill_no).delete()
-    Entry.query.filter_by(bill_no=bill_no).update({'client_name': pending.client_name, 'client_code': pending.client_code})
+    Entry.query.filter_by(bill_no=bill_no).update({'client': pending.client_name, 'client_code': pending.client_code,
+                                                   'client_id': client.id if client else None,
+                                                   'name_key': name_key(pending.client_name)})
     db.session.commit()
     flash('Legacy import applied.', 'success')
     return redirect(url_for('data_lab.view_basket'))
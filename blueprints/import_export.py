@@ -4,7 +4,12 @@ import pandas as pd
 import io
 from datetime import datetime, date
 from sqlalchemy import func
-from models import db, Material, Entry, Client, PendingBill
+from models import db, Material, Entry, Client, PendingBill, BackgroundJob
+from utils.pending_bills import upsert_pending_bills, import_summary
+from utils.sequences import generate_client_code, generate_material_code
+from utils.names import name_key
+from utils.stock import delete_entries
+from utils.period import assert_open
 
 # Module configuration
 MODULE_CONFIG = {
@@ -16,30 +21,6 @@ MODULE_CONFIG = {
 
 import_export_bp = Blueprint('import_export', __name__)
 
-def generate_client_code():
-    """Generate next client code in format tmpc-000001"""
-    last_client = Client.query.filter(Client.code.like('tmpc-%')).order_by(Client.code.desc()).first()
-    if last_client and last_client.code:
-        try:
-            num = int(last_client.code.split('-')[1]) + 1
-        except:
-            num = 1
-    else:
-        num = 1
-    return f"tmpc-{num:06d}"
-
-def generate_material_code():
-    """Generate next material code in format tmpm-00001"""
-    last_material = Material.query.filter(Material.code.like('tmpm-%')).order_by(Material.code.desc()).first()
-    if last_material and last_material.code:
-        try:
-            num = int(last_material.code.split('-')[1]) + 1
-        except:
-            num = 1
-    else:
-        num = 1
-    return f"tmpm-{num:05d}"
-
 @import_export_bp.route('/import_export')
 @login_required
 def import_export_page():
@@ -170,6 +151,7 @@ def import_data_ajax():
     if not file or not file.filename:
         return jsonify({'success': False, 'error': 'No file provided'})
 
+    job_id = None
     try:
         if file.filename.endswith('.csv'):
             df = pd.read_csv(file)
@@ -177,9 +159,17 @@ def import_data_ajax():
             df = pd.read_excel(file)
         
         import_progress = {'current': 0, 'total': len(df), 'done': False}
+
+        # every row this import writes carries the job id, so the whole import can be voided later
+        job = BackgroundJob(kind='import', status='RUNNING', total=len(df), done=0,
+                            message=file.filename[:500], created_by=current_user.username)
+        db.session.add(job)
+        db.session.flush()
+        job_id = job.id
         
         if mode == 'daily' and import_date:
-            Entry.query.filter_by(date=import_date).delete()
+            assert_open(import_date)
+            delete_entries(Entry.query.filter_by(date=import_date))
 
         today_str = date.today().strftime('%Y-%m-%d')
         now_time_str = datetime.now().strftime('%H:%M:%S')
@@ -213,10 +203,8 @@ def import_data_ajax():
                     db.session.flush()
 
             if client_name and client_name != '':
-                # Clean up name for comparison
-                clean_name = client_name.strip().upper()
                 existing_client = Client.query.filter(
-                    (func.upper(Client.name) == clean_name) | 
+                    (Client.name_key == name_key(client_name)) | 
                     (Client.code == client_code if client_code else False)
                 ).first()
                 
@@ -252,7 +240,8 @@ def import_data_ajax():
                         amount=amount, 
                         reason="Auto-created from delivery",
                         created_at=row_date,
-                        created_by=str(row.get('Captured By', current_user.username))
+                        created_by=str(row.get('Captured By', current_user.username)),
+                        import_job_id=job_id
                     ))
                 elif amount > 0:
                     # Update amount if provided in import
@@ -266,17 +255,27 @@ def import_data_ajax():
                 qty=qty, 
                 bill_no=bill_no,
                 nimbus_no=str(row.get('nimbus_no', row.get('Nimbus No', ''))).strip() if pd.notna(row.get('nimbus_no')) or pd.notna(row.get('Nimbus No')) else None,
-                created_by=str(row.get('Captured By', row.get('CapturedBy', current_user.username))).strip()
+                created_by=str(row.get('Captured By', row.get('CapturedBy', current_user.username))).strip(),
+                import_job_id=job_id
             ))
             
             import_progress['current'] = i + 1
             if (i + 1) % 200 == 0:
                 db.session.commit()
         
+        job.status = 'DONE'
+        job.done = len(df)
+        job.finished_at = datetime.now()
         db.session.commit()
         import_progress['done'] = True
-        return jsonify({'success': True, 'rows': len(df)})
+        return jsonify({'success': True, 'rows': len(df), 'job_id': job_id})
     except Exception as e:
+        db.session.rollback()
+        if job_id:
+            # rows committed before the failure stay tagged with this job
+            BackgroundJob.query.filter_by(id=job_id).update(
+                {'status': 'FAILED', 'message': str(e)[:500], 'finished_at': datetime.now()}, synchronize_session=False)
+            db.session.commit()
         import_progress['done'] = True
         return jsonify({'success': False, 'error': str(e)})
 
@@ -295,59 +294,26 @@ def import_pending_bills():
             df = pd.read_excel(file)
 
         today_str = date.today().strftime('%Y-%m-%d')
-        count = 0
-        
-        for _, row in df.iterrows():
+        rows = []
+
+        for row in df.to_dict('records'):
             client_name = str(row.get('ClientName', '')).strip()
             if not client_name or client_name.lower() == 'nan':
                 continue
 
-            client_code = str(row.get('ClientCode', '')).strip()
-            if client_code.lower() == 'nan': client_code = None
-
-            bill_no = str(row.get('BillNo', row.get('bill_no', ''))).strip()
-            nimbus_no = str(row.get('NimbusNo', row.get('nimbus_no', ''))).strip()
             amount_val = row.get('Amount', 0)
-            amount = float(amount_val) if pd.notna(amount_val) and str(amount_val).strip() != '' else 0
-            reason = str(row.get('Reason', '')).strip()
-
-            # Auto-add/Verify Client
-            clean_name = client_name.upper()
-            client = Client.query.filter(
-                (func.upper(Client.name) == clean_name) | 
-                (Client.code == client_code if client_code else False)
-            ).first()
-
-            if not client:
-                if not client_code or client_code == 'nan': client_code = generate_client_code()
-                client = Client(name=client_name, code=client_code)
-                db.session.add(client)
-                db.session.flush()
-            
-            client_code = client.code
-            
-            # Sync client code back to the row if it was missing
-            if not row.get('ClientCode') or str(row.get('ClientCode')).lower() == 'nan':
-                client_code = client.code
-
-            # Check if bill already exists to avoid duplicates
-            existing_bill = PendingBill.query.filter_by(bill_no=bill_no, client_code=client_code).first()
-            if not existing_bill:
-                new_bill = PendingBill(
-                    client_code=client_code,
-                    client_name=client.name,
-                    bill_no=bill_no,
-                    nimbus_no=nimbus_no,
-                    amount=amount,
-                    reason=reason,
-                    created_at=today_str,
-                    created_by=current_user.username
-                )
-                db.session.add(new_bill)
-                count += 1
+            rows.append({
+                'client_code': str(row.get('ClientCode', '')).strip(),
+                'client_name': client_name,
+                'bill_no': str(row.get('BillNo', row.get('bill_no', ''))).strip(),
+                'nimbus_no': str(row.get('NimbusNo', row.get('nimbus_no', ''))).strip(),
+                'amount': float(amount_val) if pd.notna(amount_val) and str(amount_val).strip() != '' else 0,
+                'reason': str(row.get('Reason', '')).strip(),
+            })
 
+        result = upsert_pending_bills(rows, current_user.username, created_at=today_str)
         db.session.commit()
-        flash(f"Successfully imported {count} pending bills and updated clients.", "success")
+        flash(f"Successfully imported pending bills: {import_summary(result)}.", "success")
     except Exception as e:
         db.session.rollback()
         flash(f"Import Failed: {str(e)}", "danger")
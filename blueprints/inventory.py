@@ -1,8 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
 from datetime import date
-from sqlalchemy import func, case
 from models import db, Material, Entry
+from utils.stock import stock_as_of
 
 # Module configuration
 MODULE_CONFIG = {
@@ -17,39 +17,18 @@ inventory_bp = Blueprint('inventory', __name__)
 @inventory_bp.route('/stock_summary')
 @login_required
 def stock_summary():
-    sel_date = request.args.get('date', date.today().strftime('%Y-%m-%d'))
-    
-    prev_stats = db.session.query(
-        Entry.material,
-        func.sum(case((Entry.type == 'IN', Entry.qty), else_=-Entry.qty)).label('prev_net')
-    ).filter(Entry.date < sel_date, Entry.is_void == False).group_by(Entry.material).all()
-    prev_map = {row.material: float(row.prev_net or 0) for row in prev_stats}
-    
-    day_stats = db.session.query(
-        Entry.material,
-        func.sum(case((Entry.type == 'IN', Entry.qty), else_=0)).label('day_in'),
-        func.sum(case((Entry.type == 'OUT', Entry.qty), else_=0)).label('day_out')
-    ).filter(Entry.date == sel_date, Entry.is_void == False).group_by(Entry.material).all()
-    day_map = {row.material: {'in': float(row.day_in or 0), 'out': float(row.day_out or 0)} for row in day_stats}
-    
-    all_materials = set(prev_map.keys()) | set(day_map.keys())
-    for mat in Material.query.with_entities(Material.name).all():
-        all_materials.add(mat.name)
+    sel_date = request.args.get('as_of') or request.args.get('date', date.today().strftime('%Y-%m-%d'))
     
     stats = []
-    for mat_name in sorted(all_materials):
-        prev_net = prev_map.get(mat_name, 0)
-        day_in = day_map.get(mat_name, {}).get('in', 0)
-        day_out = day_map.get(mat_name, {}).get('out', 0)
-        effective_opening = prev_net + day_in
+    for name, day_in, day_out, closing in stock_as_of(sel_date):
         stats.append({
-            'name': mat_name,
-            'opening': int(effective_opening),
+            'name': name,
+            'opening': int(closing + day_out),
             'in': int(day_in),
             'out': int(day_out),
-            'closing': int(effective_opening - day_out)
+            'closing': int(closing)
         })
-        
+
     return render_template('stock_summary.html', stats=stats, sel_date=sel_date)
 
 @inventory_bp.route('/daily_transactions')
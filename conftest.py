@@ -0,0 +1,46 @@
+"""
+Shared pytest fixtures: a Flask app bound to a throwaway SQLite file, with
+the same flush hooks (links, stock, finance, journal) main.py registers.
+"""
+
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, Client, Material
+import utils.clients
+import utils.journal  # noqa: F401  (registers the stock, link, finance and journal flush hooks)
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    utils.clients._directory = None  # the process-wide client directory belongs to the previous test's database
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    client = Client(code='C1', name='Client One')
+    db.session.add(client)
+    db.session.commit()
+    return client
+
+
+@pytest.fixture
+def opc(app):
+    material = Material(code='M1', name='OPC')
+    db.session.add(material)
+    db.session.commit()
+    return material
@@ -2,15 +2,42 @@ import os
 import io
 import secrets
 import json
+import sqlite3
+import click
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, make_response
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 import logging
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime, date
-from sqlalchemy import func, case, text, or_, and_, exists, not_
+from datetime import datetime, date, timedelta
+from sqlalchemy import func, case, text, or_, and_, exists, event, select
+from sqlalchemy.exc import IntegrityError
 from types import SimpleNamespace
-from models import db, User, Client, Material, Entry, PendingBill, Booking, BookingItem, Payment, Invoice, BillCounter, DirectSale, DirectSaleItem, GRN, GRNItem, Delivery, DeliveryItem, Settings
+from models import db, User, Client, Material, Entry, PendingBill, Booking, BookingItem, Payment, Invoice, BillCounter, DirectSale, DirectSaleItem, GRN, GRNItem, Delivery, DeliveryItem, Settings, BackgroundJob, StockDaily, FinanceDaily, JournalLine, PeriodClose, PaymentAllocation
+from utils.jobs import job_as_dict, start_job
+from utils.pending_bills import upsert_pending_bills, import_summary
+from utils.names import name_key, backfill_name_keys
+from utils.clients import find_client, invalidate_clients
+from utils.stock import material_map, get_material, delete_entries, verify_stock, stock_as_of
+from utils.finance import day_range, posted_between, finance_totals, refresh_finance_daily, verify_finance
+from utils.journal import (verify_journal, refresh_journal, document_lines, client_totals, aging,
+                           client_balance as journal_balance, latest_snapshot, balance_as_of, take_balance_snapshots)
+from utils.ledger import booking_material_history
+from utils.allocation import allocate_payment, reverse_allocations, has_allocations, release_bills
+from utils.payments import post_payments, unlinked_reasons
+from utils.dispatch import dispatch_lines, booking_balances
+from utils.sales import record_direct_sale, SaleRejected
+from utils.idempotency import run_once
+from utils.voiding import bulk_void
+from utils.purge import purge, purge_size, purge_dates, reclaim_space, PURGE_TARGETS, TARGET_LABELS
+from utils.archive import (ensure_archive_schema, with_archive, archived_ids, archive_cutoff, archive_plan,
+                           archive_rows, archive_job, restore_document, RESTORE_TYPES)
+from utils.backup import backup_database, backup_job, list_backups, KEEP as KEEP_BACKUPS
+from utils.maintenance import start_scheduler, job_states, run_job, run_due_jobs, upgrade_database
+from utils.integrity import verify_integrity, summary as integrity_summary
+from utils.period import PeriodClosedError, latest_close, material_openings, stock_opening, close_period, assert_open
+from utils.links import backfill_links, link_client_rows, propagate_client_rename, propagate_material_rename
+from utils.sequences import generate_client_code, generate_material_code, reserve_codes, next_bill_no, peek_bill_no
 
 app = Flask(__name__)
 # Increase max content length to 16MB to handle large JSON imports
@@ -21,14 +48,44 @@ app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, 'instance', 'ahmed_cement.db')
+archive_path = os.path.join(basedir, 'instance', 'archive.db')
 
 if not os.path.exists(os.path.join(basedir, 'instance')):
     os.makedirs(os.path.join(basedir, 'instance'))
 
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# set MAINTENANCE_SCHEDULER=0 to keep this process from running scheduled maintenance
+app.config['MAINTENANCE_SCHEDULER'] = os.environ.get('MAINTENANCE_SCHEDULER', '1') != '0'
 db.init_app(app)
 
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL so counter tablets can read while a sale is written (NORMAL sync is crash-safe under WAL);
+    writers queue for up to 15s instead of failing with "database is locked".
+    Archived rows (utils.archive) live in archive.db, attached as schema `archive`."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=15000')
+        cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+        cursor.execute('PRAGMA archive.journal_mode=WAL')
+        cursor.close()
+
+
+with app.app_context():
+    # only the app's own engine: other engines in the process (benchmarks, tools) keep their own settings
+    event.listen(db.engine, 'connect', _sqlite_pragmas)
+
+
+@app.before_request
+def _start_maintenance_scheduler():
+    """Start this worker's maintenance scheduler on its first request (utils.maintenance elects one leader)."""
+    if app.config['MAINTENANCE_SCHEDULER']:
+        start_scheduler(app)
+
+
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
@@ -37,37 +94,9 @@ login_manager.init_app(app)
 logging.basicConfig(filename='errorlog.txt', level=logging.ERROR, 
                     format='%(asctime)s %(levelname)s: %(message)s')
 
-def generate_client_code():
-    """Generate next client code in format tmpc-000001"""
-    last_client = Client.query.filter(Client.code.like('tmpc-%')).order_by(
-        Client.code.desc()).first()
-    if last_client and last_client.code:
-        try:
-            num = int(last_client.code.split('-')[1]) + 1
-        except:
-            num = 1
-    else:
-        num = 1
-    return f"tmpc-{num:06d}"
-
-
-def generate_material_code():
-    """Generate next material code in format tmpm-00001"""
-    last_material = Material.query.filter(
-        Material.code.like('tmpm-%')).order_by(Material.code.desc()).first()
-    if last_material and last_material.code:
-        try:
-            num = int(last_material.code.split('-')[1]) + 1
-        except:
-            num = 1
-    else:
-        num = 1
-    return f"tmpm-{num:05d}"
-
-
-def get_next_bill_no():
-    """Reserved for future use. Auto-bill removed as per user request."""
-    return ""
+def get_next_bill_no(prefix=None):
+    """Reserve the next auto bill number (Settings.bill_prefix by default)."""
+    return next_bill_no(prefix)
 
 
 def save_photo(file):
@@ -129,6 +158,27 @@ def _ensure_model_columns():
         db.session.rollback()
 
 
+# indexes a model no longer declares; dropped so they stop constraining old databases
+RETIRED_INDEXES = ('uq_idempotency_key',)  # keys are unique per user now (uq_idempotency_key_user)
+
+
+def _ensure_model_indexes():
+    """Create any indexes declared in models but missing in the DB, and drop retired ones."""
+    for name in RETIRED_INDEXES:
+        try:
+            db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Could not drop index {name}: {str(e)}")
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                logging.error(f"Could not create index {index.name}: {str(e)}")
+
+
 with app.app_context():
     db.create_all()
     try:
@@ -141,6 +191,165 @@ with app.app_context():
     except Exception:
         pass
 
+    try:
+        _ensure_model_indexes()
+    except Exception:
+        pass
+
+    try:
+        ensure_archive_schema()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Archive schema check failed: {str(e)}")
+
+    # Once per database: fill the links and rollups older data lacks before
+    # serving anything. Later checks and snapshots scan the whole history, so
+    # they run from the CLI and the leader-elected maintenance jobs, not on boot.
+    try:
+        upgrade_database()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Database upgrade failed, retried on next start: {str(e)}")
+
+
+@app.cli.command('backfill-links')
+def backfill_links_command():
+    """Link transaction rows to clients/materials by id (safe to re-run)."""
+    backfill_name_keys()
+    for key, linked in backfill_links().items():
+        print(f"{key}: {linked} linked")
+
+
+@app.cli.command('verify-stock')
+@click.option('--repair', is_flag=True, help='Rewrite drifted totals from stock entries.')
+def verify_stock_command(repair):
+    """Check Material totals and stock_daily against the stock entries they are built from."""
+    drift = verify_stock(repair=repair)
+    for d in drift:
+        print(f"{d['name']}: total {d['total']} (in {d['total_in']}, out {d['total_out']}), "
+              f"entries say {d['expected']} (in {d['expected_in']}, out {d['expected_out']}), "
+              f"{d['days_off']} daily rows off")
+    print(f"{len(drift)} materials {'repaired' if repair else 'drifted'}")
+
+
+@app.cli.command('verify-finance')
+@click.option('--repair', is_flag=True, help='Rebuild finance_daily from bookings, payments and sales.')
+def verify_finance_command(repair):
+    """Check the finance_daily rollup against the documents it is built from."""
+    drift = verify_finance(repair=repair)
+    for d in drift:
+        day, client_id, kind, category = d['key']
+        print(f"{day} client {client_id} {kind} {category}: stored {d['stored']}, expected {d['expected']}")
+    print(f"{len(drift)} rows {'repaired' if repair else 'drifted'}")
+
+
+@app.cli.command('verify-journal')
+@click.option('--repair', is_flag=True, help='Post the lines missing from the journal.')
+def verify_journal_command(repair):
+    """Check the client journal against the bookings, payments and sales posted to it."""
+    drift = verify_journal(repair=repair)
+    for d in drift:
+        doc_type, doc_id, client_id, posted = d['key']
+        print(f"{doc_type} {doc_id} client {client_id} {posted}: missing debit {d['missing'][0]}, "
+              f"credit {d['missing'][1]}")
+    print(f"{len(drift)} documents {'posted' if repair else 'off'}")
+
+
+@app.cli.command('verify-integrity')
+@click.option('--repair', is_flag=True, help='Rewrite drifted figures, all in one transaction.')
+@click.option('--incremental', is_flag=True, help='Check only what changed since the last clean or repaired run.')
+def verify_integrity_command(repair, incremental):
+    """Check material totals, pending bill amounts and invoice balances against their documents."""
+    run = verify_integrity(repair=repair, incremental=incremental, created_by='cli')
+    for d in run.rows.to_dict('records'):
+        print(f"{d['check']} {d['id']} {d['field']}: stored {d['stored']}, expected {d['expected']}")
+    print(integrity_summary(run))
+
+
+@app.cli.command('snapshot-balances')
+@click.option('--date', 'day', default=None, help='Day to snapshot (YYYY-MM-DD); defaults to yesterday.')
+def snapshot_balances_command(day):
+    """Write every client's balance at the end of a day, for as-of queries."""
+    day = day or (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+    count = take_balance_snapshots(day)
+    db.session.commit()
+    print(f"{count} client balances snapshotted for {day}")
+
+
+@app.cli.command('close-period')
+@click.option('--date', 'day', required=True, help='Last day of the period to close (YYYY-MM-DD).')
+def close_period_command(day):
+    """Lock everything dated on or before a day and write the next period's opening balances."""
+    close_period(day, closed_by='cli')
+    print(f"Books closed through {day}")
+
+
+@app.cli.command('archive')
+@click.option('--before', default=None, help='Archive live documents dated on or before this day (YYYY-MM-DD); '
+                                             'never past the last close.')
+@click.option('--dry-run', is_flag=True, help='Only count what would be archived.')
+def archive_command(before, dry_run):
+    """Move voided and closed-period rows into instance/archive.db."""
+    cutoff = archive_cutoff(before)
+    moved = archive_plan(cutoff) if dry_run else archive_rows(cutoff)
+    print(f"Live documents through {cutoff or '(no closed period)'} and all voided ones "
+          f"{'would be' if dry_run else 'were'} archived:")
+    for name, n in moved.items():
+        print(f"  {name}: {n}")
+
+
+@app.cli.command('backup')
+@click.option('--keep', default=KEEP_BACKUPS, show_default=True, help='Snapshots to keep.')
+def backup_command(keep):
+    """Snapshot the database (and archive) online, verify the copies and rotate old snapshots."""
+    result = backup_database(keep)
+    for name, size in result['files'].items():
+        print(f"{name}: {size / 1048576:.1f} MB, integrity ok")
+    print(f"Snapshot {result['path']}" + (f"; removed {', '.join(result['removed'])}" if result['removed'] else ''))
+
+
+@app.cli.command('vacuum')
+def vacuum_command():
+    """Rebuild the database file with VACUUM and switch it to incremental auto-vacuum; blocks all writers meanwhile."""
+    print(f"Database {reclaim_space('full')}")
+
+
+@app.cli.command('restore-archived')
+@click.argument('doc_type', type=click.Choice(sorted(RESTORE_TYPES)))
+@click.argument('doc_id', type=int)
+def restore_archived_command(doc_type, doc_id):
+    """Move an archived document back into the live tables."""
+    for name, n in restore_document(doc_type, doc_id).items():
+        print(f"{name}: {n} restored")
+
+
+@app.cli.command('maintenance')
+@click.argument('job', required=False)
+@click.option('--due', is_flag=True, help='Run every enabled job that is due.')
+def maintenance_command(job, due):
+    """List the maintenance jobs, or run JOB (or the due ones) now."""
+    if job:
+        runs = [run_job(job, trigger='cli')]
+    elif due:
+        runs = run_due_jobs()
+    else:
+        for state in job_states():
+            last = f"{state.last.status} {state.last.started_at:%Y-%m-%d %H:%M}" if state.last else 'never run'
+            print(f"{state.name}: every {state.every // 60} min{'' if state.enabled else ' (disabled)'}, "
+                  f"{last}, next {state.next_due:%Y-%m-%d %H:%M}")
+        return
+    for run in runs:
+        print(f"{run.job}: {run.status} {run.message or ''}")
+
+
+@app.errorhandler(PeriodClosedError)
+def period_closed(e):
+    db.session.rollback()
+    if request.path.startswith('/api/') or request.is_json:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    flash(str(e), 'danger')
+    return redirect(request.referrer or url_for('index'))
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -155,12 +364,7 @@ def bookings_page():
     bookings = Booking.query.filter_by(is_void=False).order_by(Booking.date_posted.desc()).all()
     clients = Client.query.filter_by(is_active=True).order_by(Client.name.asc()).all()
     materials = Material.query.order_by(Material.name.asc()).all()
-    counter = BillCounter.query.first()
-    if not counter:
-        counter = BillCounter(count=1000)
-        db.session.add(counter)
-        db.session.commit()
-    next_auto = f"#{counter.count}"
+    next_auto = peek_bill_no()
     return render_template('bookings.html',
                            bookings=bookings,
                            clients=clients,
@@ -181,16 +385,8 @@ def add_booking():
 
     photo_path = save_photo(request.files.get('photo'))
 
-    # Find client by name or code
-    client = Client.query.filter((Client.name == client_name) | (Client.code == client_name)).first()
-    
-    if not client:
-        # Fallback for code searching in case client_name was passed as code
-        client = Client.query.filter(Client.code.ilike(f"%{client_name}%")).first()
-    
-    if not client:
-        # Try finding by name (case-insensitive)
-        client = Client.query.filter(Client.name.ilike(f"%{client_name}%")).first()
+    # Find client by code or name, falling back to the closest match
+    client = find_client(client_name, fuzzy=True)
 
     if not client:
         flash(f'Client "{client_name}" not found. Please add client first.', 'danger')
@@ -201,6 +397,7 @@ def add_booking():
 
     # Create the booking
     booking = Booking(client_name=client.name,
+                      client_id=client.id,
                       amount=amount,
                       paid_amount=paid_amount,
                       manual_bill_no=manual_bill_no,
@@ -256,18 +453,19 @@ def edit_booking(id):
     booking = Booking.query.get_or_404(id)
     
     old_bill_no = booking.manual_bill_no
-    old_client = Client.query.filter_by(name=booking.client_name).first()
+    old_client = db.session.get(Client, booking.client_id) if booking.client_id else None
     old_client_code = old_client.code if old_client else None
     old_pending_amount = max(0.0, (booking.amount or 0) - (booking.paid_amount or 0))
     
     client_code = request.form.get('client_code', '').strip()
     client_name_input = request.form.get('client_name', '').strip()
     
-    # Find client by name or code
-    client = Client.query.filter((Client.code == client_code) | (Client.name == client_name_input)).first()
+    # Find client by code or name
+    client = find_client(client_name_input, code=client_code)
     
     if client:
         booking.client_name = client.name
+        booking.client_id = client.id
     
     booking.amount = float(request.form.get('amount', 0) or 0)
     booking.paid_amount = float(request.form.get('paid_amount', 0) or 0)
@@ -296,23 +494,30 @@ def edit_booking(id):
     new_bill_no = booking.manual_bill_no
     new_bill_ref = new_bill_no if new_bill_no else f"BK-{id}"
     new_pending_amount = max(0.0, booking.amount - booking.paid_amount)
-    new_client = Client.query.filter_by(name=booking.client_name).first()
+    new_client = client or (db.session.get(Client, booking.client_id) if booking.client_id else None)
     new_client_code = new_client.code if new_client else None
 
     # Remove old pending bill if exists
     old_bill_ref = old_bill_no if old_bill_no else f"BK-{id}"
+    allocated_pb = None
     if old_bill_ref and old_client_code:
         old_pb = PendingBill.query.filter_by(bill_no=old_bill_ref, client_code=old_client_code).first()
         if old_pb:
             old_pb.amount -= old_pending_amount
             if old_pb.amount <= 0:
-                db.session.delete(old_pb)
+                if has_allocations(old_pb.id):
+                    # payments were split onto this bill: keep the row their allocations point at
+                    allocated_pb = old_pb
+                    old_pb.is_paid = True
+                else:
+                    db.session.delete(old_pb)
 
     # Add/update new pending bill
     if new_pending_amount > 0 and new_client_code:
         new_pb = PendingBill.query.filter_by(bill_no=new_bill_ref, client_code=new_client_code).first()
         if new_pb:
             new_pb.amount += new_pending_amount
+            new_pb.is_paid = new_pb.amount <= 0
             new_pb.client_name = booking.client_name
         else:
             db.session.add(PendingBill(
@@ -326,6 +531,10 @@ def edit_booking(id):
                 created_by=current_user.username
             ))
 
+    if allocated_pb is not None and allocated_pb.amount < 0:
+        # more was allocated than the booking now leaves unpaid
+        allocated_pb.amount = 0
+
     db.session.commit()
     flash('Booking updated', 'success')
     
@@ -337,19 +546,15 @@ def edit_booking(id):
 
 @app.route('/payments')
 @login_required
-def payments_page():
+def payments_page(bulk_report=None):
     payments = Payment.query.filter_by(is_void=False).order_by(Payment.date_posted.desc()).all()
     clients = Client.query.filter_by(is_active=True).order_by(Client.name.asc()).all()
-    counter = BillCounter.query.first()
-    if not counter:
-        counter = BillCounter(count=1000)
-        db.session.add(counter)
-        db.session.commit()
-    next_auto = f"#{counter.count}"
+    next_auto = peek_bill_no()
     return render_template('payments.html',
                            payments=payments,
                            clients=clients,
-                           next_auto=next_auto)
+                           next_auto=next_auto,
+                           bulk_report=bulk_report)
 
 
 @app.route('/add_payment', methods=['POST'])
@@ -361,16 +566,14 @@ def add_payment():
     manual_bill_no = request.form.get('manual_bill_no', '').strip()
     photo_path = save_photo(request.files.get('photo'))
 
-    # Find client by name or code
-    client = Client.query.filter((Client.name == client_name) | (Client.code == client_name)).first()
-    if not client:
-        # Fallback for code/name searching
-        client = Client.query.filter((Client.code.ilike(f"%{client_name}%")) | (Client.name.ilike(f"%{client_name}%"))).first()
+    # Find client by code or name, falling back to the closest match
+    client = find_client(client_name, fuzzy=True)
     
     if client:
         client_name = client.name
 
     payment = Payment(client_name=client_name,
+                      client_id=(client.id if client else None),
                       amount=amount,
                       method=method,
                       manual_bill_no=manual_bill_no,
@@ -378,73 +581,21 @@ def add_payment():
     db.session.add(payment)
     db.session.flush()
 
-    # Apply payment to matching pending bills when possible
-    remaining = float(amount)
-    applied = []
-
-    if client:
-        # Prefer matching by manual_bill_no when provided
-        if manual_bill_no:
-            filters = [
-                PendingBill.bill_no.ilike(manual_bill_no),
-                PendingBill.nimbus_no.ilike(manual_bill_no)
-            ]
-            # If input is numeric, also try matching with '#' prefix (e.g. input 1001 matches #1001)
-            if manual_bill_no.isdigit():
-                filters.append(PendingBill.bill_no.ilike(f"#{manual_bill_no}"))
-
-            pending_q = PendingBill.query.filter(
-                PendingBill.client_code == client.code,
-                PendingBill.is_paid == False,
-                or_(*filters)
-            ).order_by(PendingBill.id.asc()).all()
-        else:
-            # Otherwise apply to oldest unpaid bills for this client
-            pending_q = PendingBill.query.filter_by(client_code=client.code, is_paid=False).order_by(PendingBill.id.asc()).all()
-
-        for pb in pending_q:
-            if remaining <= 0:
-                break
-            if pb.is_paid:
-                continue
-            if remaining >= (pb.amount or 0):
-                remaining -= (pb.amount or 0)
-                applied.append((pb.bill_no, f'paid Rs.{pb.amount}'))
-                pb.amount = 0
-                pb.is_paid = True
-            else:
-                applied.append((pb.bill_no, f'partial Rs.{remaining:.2f}'))
-                pb.amount = (pb.amount or 0) - remaining
-                remaining = 0
+    # Apply payment to matching pending bills when possible: the typed bill, else the oldest unpaid
+    applied = allocate_payment(payment.id, amount, client.code if client else None, manual_bill_no or None)
+    remaining = float(amount) - sum(a for _, a, _ in applied)
 
     db.session.commit()
 
     msg = 'Payment received successfully'
     if applied:
-        details = ', '.join([f"{b}: {s}" for b, s in applied])
+        details = ', '.join([f"{b}: {'paid' if paid else 'partial'} Rs.{a:.2f}" for b, a, paid in applied])
         msg += f" — applied to: {details}"
     if remaining > 0 and amount > 0:
         msg += f" — Rs.{remaining:.2f} unapplied (advance)"
     
     if manual_bill_no and not applied and amount > 0:
-        # Diagnostic check
-        reason = "check number or client"
-        filters_global = [
-            PendingBill.bill_no.ilike(manual_bill_no),
-            PendingBill.nimbus_no.ilike(manual_bill_no)
-        ]
-        if manual_bill_no.isdigit():
-            filters_global.append(PendingBill.bill_no.ilike(f"#{manual_bill_no}"))
-        global_match = PendingBill.query.filter(or_(*filters_global)).first()
-        if global_match:
-            if not client:
-                 reason = f"Bill belongs to {global_match.client_name} (Client not identified)"
-            elif global_match.client_code != client.code:
-                reason = f"Bill belongs to {global_match.client_name}"
-            elif global_match.is_paid:
-                reason = "Bill is already paid"
-        else:
-            reason = "Bill number not found"
+        reason = unlinked_reasons([(manual_bill_no, client)])[0]
         flash(msg + f" (Warning: Could not link to Bill '{manual_bill_no}' - {reason})", 'warning')
     else:
         flash(msg, 'success')
@@ -453,6 +604,56 @@ def add_payment():
     return redirect(url_for('payments_page', download_bill=bill_ref))
 
 
+@app.route('/api/payments/bulk', methods=['POST'])
+@login_required
+def api_bulk_payments():
+    """Post a batch of payments in one transaction: {"payments": [{client_name, client_code, amount, method, bill_no}]}."""
+    data = request.get_json(silent=True)
+    rows = data.get('payments') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'error': 'payments must be a non-empty list'}), 400
+    report = post_payments([row if isinstance(row, dict) else {} for row in rows])
+    posted = sum(1 for r in report if r['status'] == 'posted')
+    return jsonify({'posted': posted, 'errors': len(report) - posted, 'rows': report})
+
+
+@app.route('/upload_payments', methods=['POST'])
+@login_required
+def upload_payments():
+    """CSV/Excel batch of payments with columns ClientCode, ClientName, Amount, Method, BillNo."""
+    import pandas as pd
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('No file selected', 'danger')
+        return redirect(url_for('payments_page'))
+
+    try:
+        if file.filename.endswith('.csv'):
+            df = pd.read_csv(file, dtype=str, keep_default_na=False)
+        else:
+            df = pd.read_excel(file, dtype=str).fillna('')
+    except Exception as e:
+        flash(f'Could not read file: {str(e)}', 'danger')
+        return redirect(url_for('payments_page'))
+
+    columns = {'clientcode': 'client_code', 'code': 'client_code', 'clientname': 'client_name',
+               'client': 'client_name', 'name': 'client_name', 'amount': 'amount', 'method': 'method',
+               'billno': 'bill_no', 'manualbillno': 'bill_no', 'bill': 'bill_no'}
+    df = df.rename(columns=lambda c: columns.get(str(c).strip().lower().replace('_', '').replace(' ', ''), c))
+    try:
+        report = post_payments(df.to_dict('records'))
+    except PeriodClosedError:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error posting payments: {str(e)}', 'danger')
+        return redirect(url_for('payments_page'))
+
+    posted = sum(1 for r in report if r['status'] == 'posted')
+    flash(f'Posted {posted} of {len(report)} payments', 'success' if posted == len(report) else 'warning')
+    return payments_page(bulk_report=report)
+
+
 @app.route('/edit_bill/Payment/<int:id>', methods=['POST'])
 @login_required
 def edit_payment(id):
@@ -461,11 +662,12 @@ def edit_payment(id):
     client_code = request.form.get('client_code', '').strip()
     client_name_input = request.form.get('client_name', '').strip()
     
-    # Find client by name or code
-    client = Client.query.filter((Client.code == client_code) | (Client.name == client_name_input)).first()
+    # Find client by code or name
+    client = find_client(client_name_input, code=client_code)
     
     if client:
         payment.client_name = client.name
+        payment.client_id = client.id
     
     payment.amount = float(request.form.get('amount', 0) or 0)
     payment.method = request.form.get('method', '')
@@ -475,6 +677,14 @@ def edit_payment(id):
     if new_photo:
         payment.photo_path = new_photo
 
+    # a different amount, client or bill re-applies the payment from scratch
+    if any(db.inspect(payment).attrs[attr].history.has_changes() for attr in ('amount', 'client_id', 'manual_bill_no')):
+        reverse_allocations([payment.id])
+        if not payment.is_void:
+            paid_client = db.session.get(Client, payment.client_id) if payment.client_id else None
+            allocate_payment(payment.id, payment.amount, paid_client.code if paid_client else None,
+                             payment.manual_bill_no or None)
+
     db.session.commit()
     flash('Payment updated', 'success')
     
@@ -494,12 +704,7 @@ def direct_sales_page():
     if 'Cash' not in categories:
         categories.insert(0, 'Cash')
     client_name_prefill = request.args.get('client_name', '').strip()
-    counter = BillCounter.query.first()
-    if not counter:
-        counter = BillCounter(count=1000)
-        db.session.add(counter)
-        db.session.commit()
-    next_auto = f"#{counter.count}"
+    next_auto = peek_bill_no()
     
     stats = {
         'billed': sum(1 for s in sales if s.category != 'Cash'),
@@ -522,306 +727,107 @@ def direct_sales_page():
 @app.route('/add_direct_sale', methods=['POST'])
 @login_required
 def add_direct_sale():
-  try:
     client_name = request.form.get('client_name', '').strip() or request.form.get('client_code', '').strip()
-    materials_list = request.form.getlist('product_name[]')
-    qtys = request.form.getlist('qty[]')
-    rates = request.form.getlist('unit_rate[]')
-    # amount = float(request.form.get('amount', 0) or 0) # Recalculated below
-    paid_amount = float(request.form.get('paid_amount', 0) or 0)
-    manual_bill_no = request.form.get('manual_bill_no', '').strip()
-    allow_negative_stock = request.form.get('allow_negative_stock') == 'on'
-
-    # Check for global setting
-    settings = Settings.query.first()
-    global_negative_stock_allowed = settings.allow_global_negative_stock if settings else False
-
-    photo_path = save_photo(request.files.get('photo'))
-
-    category_input = request.form.get('category', '').strip()
-
-    # Find client by name or code
-    client = Client.query.filter((Client.name == client_name) | (Client.code == client_name)).first()
-    if not client:
-        # Fallback for code/name searching
-        client = Client.query.filter((Client.code.ilike(f"%{client_name}%")) | (Client.name.ilike(f"%{client_name}%"))).first()
-    
-    if client:
-        client_name = client.name
-
-    # 1. Calculate Booking Balances
-    booking_balances = {}
-    if client:
-        for mat in set(materials_list):
-            if not mat: continue
-            booked = db.session.query(func.sum(BookingItem.qty)).join(Booking).filter(
-                Booking.client_name == client.name, 
-                BookingItem.material_name == mat, 
-                Booking.is_void == False
-            ).scalar() or 0
-            dispatched = db.session.query(func.sum(Entry.qty)).filter(
-                (Entry.client_code == client.code) | (Entry.client == client.name), 
-                Entry.material == mat, 
-                Entry.type == 'OUT',
-                Entry.is_void == False,
-                # Exclude Direct Sales that are NOT Booking Deliveries (i.e. Cash/Credit sales)
-                # This prevents regular sales from reducing the booking balance
-                not_(and_(Entry.nimbus_no == 'Direct Sale', Entry.client_category != 'Booking Delivery'))
-            ).scalar() or 0
-            booking_balances[mat] = max(0, booked - dispatched)
-
-    # 2. Process Items (Auto-Split Booking vs Sale)
-    processed_items = []
-    calculated_amount = 0
-
-    for mat, qty_val, rate_val in zip(materials_list, qtys, rates):
-        if not mat or not qty_val: continue
+    items = []
+    for mat, qty_val, rate_val in zip(request.form.getlist('product_name[]'), request.form.getlist('qty[]'),
+                                      request.form.getlist('unit_rate[]')):
+        if not mat or not qty_val:
+            continue
         try:
-            qty = float(qty_val)
-            rate = float(rate_val) if rate_val else 0
-        except ValueError: continue
-        
-        balance = booking_balances.get(mat, 0)
-        qty_booking = 0
-        qty_sale = qty
-
-        if balance > 0:
-            qty_booking = min(qty, balance)
-            qty_sale = qty - qty_booking
-            booking_balances[mat] -= qty_booking
-        
-        if qty_booking > 0:
-            processed_items.append({
-                'product_name': mat,
-                'qty': qty_booking,
-                'price_at_time': 0,
-                'is_booking': True
-            })
-        
-        if qty_sale > 0:
-            processed_items.append({
-                'product_name': mat,
-                'qty': qty_sale,
-                'price_at_time': rate,
-                'is_booking': False
-            })
-            calculated_amount += (qty_sale * rate)
-
-    # 3. Stock Validation (Only for non-booked items)
-    # Aggregate required quantities first to prevent cumulative overrun
-    required_stock = {}
-    for item in processed_items:
-        if not item['is_booking']:
-            mat = item['product_name']
-            required_stock[mat] = required_stock.get(mat, 0) + item['qty']
-            
-    for mat, req_qty in required_stock.items():
-        mat_obj = Material.query.filter_by(name=mat).first()
-        if mat_obj:
-            available = mat_obj.total or 0
-            if not allow_negative_stock and not global_negative_stock_allowed and available < req_qty:
-                raise ValueError(f"Insufficient stock for {mat}. Available: {available}, Required: {req_qty} (Non-booked). Enable 'Allow Negative Stock' or global setting to bypass.")
-
-    # 4. Determine Final Category & Amount
-    amount = calculated_amount
-    all_booking = all(item['is_booking'] for item in processed_items)
-    any_booking = any(item['is_booking'] for item in processed_items)
-    
-    if all_booking:
-        category = "Booking Delivery"
-    elif any_booking:
-        category = "Mixed Transaction"
-    else:
-        if category_input == 'Cash':
-            category = 'Cash'
-        elif paid_amount >= amount:
-            category = "Cash"
-        else:
-            category = "Credit Customer"
-            
-    # Validation: Unbilled Cash Sale must be fully paid
-    if category == 'Cash' and paid_amount < amount:
-        flash('Cash Sale must be fully paid. Transaction not complete.', 'danger')
-        return redirect(url_for('direct_sales_page'))
-
-    # Handle Cash category (Manual overrides)
-    if category.lower() == 'cash':
-        manual_client_name = request.form.get('manual_client_name', '').strip()
-        if manual_client_name:
-            client_name = manual_client_name
-    
-    # Force manual bill requirement for non-cash sales if not provided
-    if category != 'Cash' and not manual_bill_no and not create_invoice:
-        # We allow it but it will be auto-generated or marked as system bill
-        pass
-
-    create_invoice = bool(request.form.get('create_invoice'))
-    
-    hv = request.form.get('has_bill')
-    has_bill = True if hv is None else hv in ['on', '1', 'true', 'True']
-
-    pending_amount = max(0.0, amount - paid_amount)
+            items.append((mat, float(qty_val), float(rate_val) if rate_val else 0))
+        except ValueError:
+            continue
 
-    # Handle invoice creation
-    inv = None
-    invoice_no = None
-    if create_invoice:
-        if manual_bill_no:
-            invoice_no = manual_bill_no
-            is_manual = True
-        else:
-            # Invoice without manual bill no
-            invoice_no = f"INV-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            is_manual = False
+    try:
+        result = record_direct_sale(
+            client_name, items,
+            paid_amount=float(request.form.get('paid_amount', 0) or 0),
+            manual_bill_no=request.form.get('manual_bill_no', '').strip(),
+            category_input=request.form.get('category', '').strip(),
+            allow_negative_stock=request.form.get('allow_negative_stock') == 'on',
+            create_invoice=bool(request.form.get('create_invoice')),
+            track_as_cash=bool(request.form.get('track_as_cash')),
+            manual_client_name=request.form.get('manual_client_name', '').strip(),
+            photo_path=save_photo(request.files.get('photo')),
+            username=current_user.username)
+        db.session.commit()
+    except SaleRejected as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('direct_sales_page'))
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Direct Sale Error: {str(e)}")
+        flash(f"Error processing sale: {str(e)}", "danger")
+        return redirect(url_for('direct_sales_page'))
 
-        existing_global = Invoice.query.filter_by(invoice_no=invoice_no).first()
-        if existing_global and is_manual:
-            if client and existing_global.client_code != client.code:
-                flash(f'Invoice number "{invoice_no}" is already used by another client.', 'danger')
-                return redirect(url_for('direct_sales_page'))
+    msg = 'Direct sale added successfully'
+    if result['invoice']:
+        msg += f" — Invoice: {result['invoice'].invoice_no}"
+    flash(msg, 'success')
+    return redirect(url_for('direct_sales_page', download_bill=result['bill_ref']))
 
-        inv = Invoice.query.filter_by(invoice_no=invoice_no, client_code=(client.code if client else None)).first()
-        balance = max(0.0, amount - paid_amount)
-        status = 'PAID' if balance <= 0 else ('PARTIAL' if paid_amount > 0 else 'OPEN')
 
-        if inv:
-            inv.client_name = client.name if client else client_name
-            inv.total_amount = amount
-            inv.balance = balance
-            inv.is_cash = bool(request.form.get('track_as_cash'))
-            inv.status = status
-            inv.date = datetime.now().date()
+@app.route('/api/v1/direct_sales', methods=['POST'])
+@login_required
+def api_direct_sales():
+    """JSON direct sale. A retried request with the same Idempotency-Key header gets the first response back."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    items = []
+    for item in data.get('items') or []:
+        try:
+            qty = float(item.get('qty') or 0)
+            rate = float(item.get('rate') or 0)
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'error': f'Invalid item: {item}'}), 400
+        if item.get('material') and qty:
+            items.append((str(item['material']).strip(), qty, rate))
+    if not items:
+        return jsonify({'error': 'items must list at least one material with a qty'}), 400
+
+    def post_sale():
+        result = record_direct_sale(
+            str(data.get('client_name') or data.get('client_code') or '').strip(), items,
+            paid_amount=float(data.get('paid_amount') or 0),
+            manual_bill_no=str(data.get('manual_bill_no') or '').strip(),
+            category_input=str(data.get('category') or '').strip(),
+            allow_negative_stock=bool(data.get('allow_negative_stock')),
+            create_invoice=bool(data.get('create_invoice')),
+            track_as_cash=bool(data.get('track_as_cash')),
+            manual_client_name=str(data.get('manual_client_name') or '').strip(),
+            username=current_user.username)
+        sale = result['sale']
+        return 201, {'sale_id': sale.id, 'bill_ref': result['bill_ref'],
+                     'invoice_no': result['invoice'].invoice_no if result['invoice'] else None,
+                     'pending_bill_no': result['pending_bill_no'], 'category': sale.category,
+                     'client_name': sale.client_name, 'amount': sale.amount, 'paid_amount': sale.paid_amount,
+                     'items': [{'material': i['product_name'], 'qty': i['qty'], 'rate': i['price_at_time'],
+                                'booking': i['is_booking']} for i in result['items']]}
+
+    key = request.headers.get('Idempotency-Key', '').strip()
+    try:
+        if key:
+            status, body, replayed = run_once(current_user.id, 'direct_sales', key, data, post_sale)
         else:
-            inv = Invoice(client_code=(client.code if client else None),
-                          client_name=client.name if client else client_name,
-                          invoice_no=invoice_no,
-                          is_manual=is_manual,
-                          date=datetime.now().date(),
-                          total_amount=amount,
-                          balance=balance,
-                          status=status,
-                          is_cash=bool(request.form.get('track_as_cash')),
-                          created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
-                          created_by=current_user.username)
-            db.session.add(inv)
-            db.session.flush()
-
-    sale = DirectSale(client_name=client_name,
-                      amount=amount,
-                      paid_amount=paid_amount,
-                      manual_bill_no=manual_bill_no,
-                      photo_path=photo_path,
-                      category=category)
-    db.session.add(sale)
-    db.session.flush()
-
-    # Determine bill number for pending bill
-    pending_bill_no = manual_bill_no if manual_bill_no else (invoice_no if create_invoice else None)
-
-    # Auto-add to PendingBill if it has a manual bill no or is a tracked credit sale
-    # OR if it's an unregistered cash sale (to avoid orphan entries)
-    # UNBILLED cash sales are given a dummy bill number to show up in ledgers
-    if (manual_bill_no or (create_invoice and invoice_no)) or (pending_amount > 0) or (category and category.lower() in ['cash', 'booking delivery', 'mixed transaction']):
-        client_code = client.code if client else None
-        
-        # Determine bill number for the pending bill record
-        # If no bill exists for a cash sale, use a placeholder
-        pb_bill_no = pending_bill_no
-        if not pb_bill_no:
-            if category and category.lower() == 'cash':
-                pb_bill_no = f"CSH-{sale.id}"
-            else:
-                pb_bill_no = f"DS-{sale.id}"
-            
-        # Search by pb_bill_no if it exists
-        existing_pb = PendingBill.query.filter_by(bill_no=pb_bill_no, client_code=client_code).first() if pb_bill_no else None
-        if not existing_pb:
-            # Determine is_paid status.
-            # If amount is 0 (e.g. booking dispatch), keep as Unpaid so it appears in pending lists for tracking.
-            # Only mark as Paid if it was a real transaction (amount > 0) that was fully paid.
-            is_paid_status = (pending_amount <= 0 and amount > 0)
-
-            db.session.add(PendingBill(
-                client_code=client_code,
-                client_name=(client.name if client else client_name),
-                bill_no=pb_bill_no,
-                amount=pending_amount,
-                reason=f"Direct Sale: {materials_list[0] if materials_list else ''}",
-                is_cash=((category.lower() == 'cash') or bool(request.form.get('track_as_cash'))) if category else False,
-                is_manual=bool(manual_bill_no),
-                is_paid=is_paid_status,
-                created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
-                created_by=current_user.username
-            ))
-
-    if create_invoice and inv:
-        sale.invoice_id = inv.id
-
-    # Create DirectSaleItems and Entries
-    now = datetime.now()
-    for item in processed_items:
-        # Create Sale Item
-        dsi = DirectSaleItem(sale_id=sale.id,
-                           product_name=item['product_name'],
-                           qty=item['qty'],
-                           price_at_time=item['price_at_time'])
-        db.session.add(dsi)
-
-        # Create Entry
-        ledger_bill_ref = manual_bill_no if manual_bill_no else (inv.invoice_no if (create_invoice and inv) else "UNBILLED-" + str(sale.id))
-        
-        # Determine category per item for mixed transactions
-        item_category = category
-        if item['is_booking']:
-            item_category = 'Booking Delivery'
-        elif category == 'Mixed Transaction':
-            if paid_amount >= amount:
-                item_category = 'Cash'
-            else:
-                item_category = 'Credit Customer'
-        elif category == 'Booking Delivery': # Fallback if main cat is Booking but this item isn't (shouldn't happen with split logic)
-            item_category = 'Credit Customer'
-
-        entry = Entry(date=now.strftime('%Y-%m-%d'),
-                      time=now.strftime('%H:%M:%S'),
-                      type='OUT',
-                      material=item['product_name'],
-                      client=client_name,
-                      client_code=(client.code if client else None),
-                      qty=item['qty'],
-                      bill_no=ledger_bill_ref,
-                      nimbus_no='Direct Sale',
-                      created_by=current_user.username,
-                      client_category=item_category)
-        db.session.add(entry)
-        
-        # Update Material stock (reduce In Hand)
-        mat_obj = Material.query.filter_by(name=item['product_name']).first()
-        if mat_obj:
-            mat_obj.total = (mat_obj.total or 0) - item['qty']
-
-    db.session.commit()
-    msg = 'Direct sale added successfully'
-    if create_invoice and inv:
-        msg += f" — Invoice: {inv.invoice_no}"
-    flash(msg, 'success')
-  except Exception as e:
-    db.session.rollback()
-    logging.error(f"Direct Sale Error: {str(e)}")
-    flash(f"Error processing sale: {str(e)}", "danger")
-    return redirect(url_for('direct_sales_page'))
-    
-  # Success redirect
-  if manual_bill_no:
-      bill_ref = manual_bill_no
-  elif create_invoice and inv:
-      bill_ref = inv.invoice_no
-  elif sale.auto_bill_no:
-      bill_ref = sale.auto_bill_no
-  else:
-      bill_ref = f"CSH-{sale.id}" if category and category.lower() == 'cash' else f"DS-{sale.id}"
+            status, body = post_sale()
+            db.session.commit()
+            replayed = False
+    except PeriodClosedError:
+        raise
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 422
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Direct Sale API Error: {str(e)}")
+        return jsonify({'error': f'Error processing sale: {str(e)}'}), 500
 
-  return redirect(url_for('direct_sales_page', download_bill=bill_ref))
+    response = make_response(jsonify(body), status)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
 
 
 @app.route('/add_sale', methods=['POST'])
@@ -838,11 +844,12 @@ def edit_direct_sale(id):
     client_code = request.form.get('client_code', '').strip()
     client_name_input = request.form.get('client_name', '').strip()
     
-    # Find client by name or code
-    client = Client.query.filter((Client.code == client_code) | (Client.name == client_name_input)).first()
+    # Find client by code or name
+    client = find_client(client_name_input, code=client_code)
     
     if client:
         sale.client_name = client.name
+        sale.client_id = client.id
     
     sale.category = request.form.get('category', '')
     sale.amount = float(request.form.get('amount', 0) or 0)
@@ -886,11 +893,7 @@ def void_transaction(type, id):
     if type == 'Entry':
         entry = db.session.get(Entry, id)
         if entry and not entry.is_void:
-            entry.is_void = True
-            mat = Material.query.filter_by(name=entry.material).first()
-            if mat:
-                if entry.type == 'IN': mat.total = (mat.total or 0) - entry.qty
-                elif entry.type == 'OUT': mat.total = (mat.total or 0) + entry.qty
+            entry.is_void = True  # utils.stock gives the stock back on flush
             flash('Entry voided and stock reversed', 'success')
     
     elif type == 'DirectSale':
@@ -902,15 +905,10 @@ def void_transaction(type, id):
             if sale.manual_bill_no: refs.append(sale.manual_bill_no)
             if sale.auto_bill_no: refs.append(sale.auto_bill_no)
             
-            entries = Entry.query.filter(Entry.bill_no.in_(refs)).all()
-            for e in entries:
-                if not e.is_void:
-                    e.is_void = True
-                    mat = Material.query.filter_by(name=e.material).first()
-                    if mat:
-                        if e.type == 'IN': mat.total = (mat.total or 0) - e.qty
-                        elif e.type == 'OUT': mat.total = (mat.total or 0) + e.qty
+            for e in Entry.query.filter(Entry.bill_no.in_(refs), Entry.is_void == False):
+                e.is_void = True
             
+            release_bills(select(PendingBill.id).where(PendingBill.bill_no.in_(refs)))
             PendingBill.query.filter(PendingBill.bill_no.in_(refs)).update({'is_void': True}, synchronize_session=False)
             flash('Sale voided', 'success')
 
@@ -920,6 +918,7 @@ def void_transaction(type, id):
             bk.is_void = True
             refs = [f"BK-{bk.id}"]
             if bk.manual_bill_no: refs.append(bk.manual_bill_no)
+            release_bills(select(PendingBill.id).where(PendingBill.bill_no.in_(refs)))
             PendingBill.query.filter(PendingBill.bill_no.in_(refs)).update({'is_void': True}, synchronize_session=False)
             flash('Booking voided', 'success')
 
@@ -927,6 +926,7 @@ def void_transaction(type, id):
         pay = db.session.get(Payment, id)
         if pay and not pay.is_void:
             pay.is_void = True
+            reverse_allocations([pay.id])
             flash('Payment voided', 'success')
 
     db.session.commit()
@@ -982,13 +982,7 @@ def view_bill(bill_no):
         if not client and c_name: client = Client.query.filter_by(name=c_name).first()
 
         if client:
-            b_debit = db.session.query(func.sum(Booking.amount)).filter_by(client_name=client.name).scalar() or 0
-            b_credit = db.session.query(func.sum(Booking.paid_amount)).filter_by(client_name=client.name).scalar() or 0
-            p_credit = db.session.query(func.sum(Payment.amount)).filter_by(client_name=client.name).scalar() or 0
-            ds_debit = db.session.query(func.sum(DirectSale.amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-            ds_credit = db.session.query(func.sum(DirectSale.paid_amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-            
-            client_balance = (b_debit + ds_debit) - (b_credit + p_credit + ds_credit)
+            client_balance = journal_balance(client.id)
             
             effect = 0
             if booking: effect = (booking.amount or 0) - (booking.paid_amount or 0)
@@ -999,7 +993,7 @@ def view_bill(bill_no):
             previous_balance = client_balance - effect
             
             recent_deliveries = Entry.query.filter(
-                (Entry.client_code == client.code) | (Entry.client == client.name),
+                Entry.client_id == client.id,
                 Entry.type == 'OUT'
             ).order_by(Entry.date.desc(), Entry.time.desc()).limit(5).all()
 
@@ -1063,13 +1057,7 @@ def download_invoice(bill_no):
         if not client and c_name: client = Client.query.filter_by(name=c_name).first()
 
         if client:
-            b_debit = db.session.query(func.sum(Booking.amount)).filter_by(client_name=client.name).scalar() or 0
-            b_credit = db.session.query(func.sum(Booking.paid_amount)).filter_by(client_name=client.name).scalar() or 0
-            p_credit = db.session.query(func.sum(Payment.amount)).filter_by(client_name=client.name).scalar() or 0
-            ds_debit = db.session.query(func.sum(DirectSale.amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-            ds_credit = db.session.query(func.sum(DirectSale.paid_amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-            
-            client_balance = (b_debit + ds_debit) - (b_credit + p_credit + ds_credit)
+            client_balance = journal_balance(client.id)
             
             effect = 0
             if booking: effect = (booking.amount or 0) - (booking.paid_amount or 0)
@@ -1080,7 +1068,7 @@ def download_invoice(bill_no):
             previous_balance = client_balance - effect
             
             recent_deliveries = Entry.query.filter(
-                (Entry.client_code == client.code) | (Entry.client == client.name),
+                Entry.client_id == client.id,
                 Entry.type == 'OUT'
             ).order_by(Entry.date.desc(), Entry.time.desc()).limit(5).all()
 
@@ -1123,6 +1111,17 @@ def download_invoice(bill_no):
         return response
 
 
+def retire_pending_bill(pb):
+    """Delete a pending bill, or void it if payments were ever allocated to it. Returns True when voided."""
+    if has_allocations(pb.id):
+        # give the payments their money back, and keep the row their allocations point at
+        release_bills([pb.id])
+        pb.is_void = True
+        return True
+    db.session.delete(pb)
+    return False
+
+
 @app.route('/delete_bill/<string:type>/<int:id>')
 @login_required
 def delete_bill(type, id):
@@ -1135,12 +1134,16 @@ def delete_bill(type, id):
         bill = Booking.query.get(id)
         if bill:
             # Also remove associated pending bill
-            bill_no = bill.manual_bill_no
-            client = Client.query.filter_by(name=bill.client_name).first()
-            if client and bill_no:
-                PendingBill.query.filter_by(bill_no=bill_no, client_code=client.code).delete()
+            bill_no = bill.manual_bill_no or f"BK-{bill.id}"
+            client = db.session.get(Client, bill.client_id) if bill.client_id else None
+            if client:
+                for pb in PendingBill.query.filter_by(bill_no=bill_no, client_code=client.code):
+                    retire_pending_bill(pb)
     elif type == 'Payment':
         bill = Payment.query.get(id)
+        if bill:
+            # give back what it paid off its bills, as voiding does
+            reverse_allocations([bill.id])
 
     if bill:
         db.session.delete(bill)
@@ -1189,167 +1192,86 @@ def ledger_page():
 @login_required
 def financial_ledger(client_id):
     client = Client.query.get_or_404(client_id)
-    
+
+    # ?as_of=YYYY-MM-DD: the ledger as it stood at the end of that day. The balance
+    # brought forward comes from the last snapshot; only rows after it are listed.
+    # Without it the ledger starts from the openings of the last closed period.
+    as_of = request.args.get('as_of', '').strip() or None
+    opening_balance = None
+    posted_from = posted_until = None
+    if as_of:
+        try:
+            posted_until = day_range(as_of, as_of)[1]
+        except ValueError:
+            flash('Invalid as-of date.', 'warning')
+            return redirect(url_for('financial_ledger', client_id=client.id))
+    close = latest_close(as_of)
+    start_day = as_of or (close.close_date if close else None)
+    if start_day:
+        snapshot = latest_snapshot(client.id, start_day)
+        opening_balance = snapshot.balance if snapshot else 0
+        if snapshot:
+            posted_from = day_range(snapshot.date, snapshot.date)[1]
+
     # 1. Fetch Pending Bills
     pending_bills = PendingBill.query.filter_by(client_code=client.code, is_void=False).order_by(PendingBill.id.desc()).all()
     
-    # 2. Financial Ledger
-    bookings = Booking.query.filter_by(client_name=client.name).all()
-    payments = Payment.query.filter_by(client_name=client.name).all()
-    # Use case-insensitive match for Direct Sales to ensure we catch them all
-    direct_sales = DirectSale.query.filter(func.lower(DirectSale.client_name) == client.name.lower()).all()
+    # 2. Financial Ledger: the client's journal, one row per document
+    # (direct sales with no financial value are dispatches and post nothing)
+    lines = document_lines(client.id, posted_from, posted_until)
+    docs = {}
+    for model, doc_type in ((Booking, 'booking'), (Payment, 'payment'), (DirectSale, 'sale')):
+        ids = [line.doc_id for line in lines if line.doc_type == doc_type]
+        if ids:
+            docs.update({(doc_type, d.id): d for d in model.query.filter(model.id.in_(ids))})
 
-    # Financial History (Bookings, Payments, Direct Sales) - NO Material Entries
     financial_history = []
-    
-    for b in bookings:
-        if b.is_void: continue
-        debit = b.amount or 0
-        credit = b.paid_amount or 0
+    for doc_type, doc_id, posted, debit, credit in lines:
+        doc = docs.get((doc_type, doc_id))
+        if doc is None:
+            continue
+        if doc_type == 'booking':
+            description, bill_no, type_ = 'Booking', doc.manual_bill_no, 'Booking'
+        elif doc_type == 'payment':
+            description, bill_no, type_ = f'Payment ({doc.method or "Cash"})', doc.manual_bill_no, 'Payment'
+        else:
+            description, bill_no, type_ = 'Direct Sale', doc.manual_bill_no or doc.auto_bill_no, 'DirectSale'
         financial_history.append({
-            'date': b.date_posted,
-            'description': 'Booking',
-            'bill_no': b.manual_bill_no,
+            'date': posted,
+            'description': description,
+            'bill_no': bill_no,
             'debit': debit,
             'credit': credit,
-            'type': 'Booking',
-            'id': b.id
-        })
-    
-    for p in payments:
-        if p.is_void: continue
-        credit = p.amount or 0
-        financial_history.append({
-            'date': p.date_posted,
-            'description': f'Payment ({p.method or "Cash"})',
-            'bill_no': p.manual_bill_no,
-            'debit': 0,
-            'credit': credit,
-            'type': 'Payment',
-            'id': p.id
+            'type': type_,
+            'id': doc_id
         })
-    
-    for s in direct_sales:
-        if s.is_void: continue
-        debit = s.amount or 0
-        credit = s.paid_amount or 0
-        # A Direct Sale with no financial value is just a dispatch, not a financial event.
-        # It should only appear in the material ledger.
-        if debit > 0 or credit > 0:
-            financial_history.append({
-                'date': s.date_posted,
-                'description': 'Direct Sale',
-                'bill_no': s.manual_bill_no or s.auto_bill_no,
-                'debit': debit,
-                'credit': credit,
-                'type': 'DirectSale',
-                'id': s.id
-            })
-    
-    # Sort by date (oldest first)
-    financial_history.sort(key=lambda x: x['date'] or datetime.min)
-    
+
     # Calculate running balance
-    running_balance = 0
+    running_balance = opening_balance or 0
     for item in financial_history:
         running_balance += (item['debit'] - item['credit'])
         item['balance'] = running_balance
     
-    # 3. Material Ledger
-    deliveries = Entry.query.filter(
-        (Entry.client_code == client.code) | (Entry.client == client.name),
-        Entry.type == 'OUT'
-    ).order_by(Entry.date.asc(), Entry.time.asc()).all()
-
-    material_history = []
-    seen_material_bills = set()
-    
-    # Add Bookings to Material Ledger
-    bookings = Booking.query.filter_by(client_name=client.name).order_by(Booking.date_posted.asc()).all()
-    for b in bookings:
-        if b.is_void: continue
-        for item in b.items:
-            material_history.append({
-                'date': b.date_posted.strftime('%Y-%m-%d') if b.date_posted else (b.created_at[:10] if b.created_at else ''),
-                'material': item.material_name,
-                'qty_added': item.qty,
-                'qty_dispatched': 0,
-                'bill_no': b.manual_bill_no,
-                'nimbus_no': 'Booking',
-                'type': 'Booking'
-            })
-            
-    # Process Deliveries/Entries
-    for d in deliveries:
-        if d.is_void: continue
-        # Skip Direct Sales that are not Booking Deliveries (Standalone Sales)
-        # These are "Cash/Credit & Carry" and shouldn't clutter the Booking Ledger
-        if d.nimbus_no == 'Direct Sale' and d.client_category != 'Booking Delivery':
-            continue
-
-        material_history.append({
-            'date': d.date,
-            'material': d.material,
-            'qty_added': 0,
-            'qty_dispatched': d.qty,
-            'bill_no': d.bill_no or d.auto_bill_no,
-            'nimbus_no': d.nimbus_no,
-            'type': 'Dispatch'
-        })
-        if d.bill_no:
-            seen_material_bills.add(d.bill_no)
-        if d.auto_bill_no:
-            seen_material_bills.add(d.auto_bill_no)
-
-    for s in direct_sales:
-        if s.is_void: continue
-        bill_ref = s.manual_bill_no or s.auto_bill_no
-        if bill_ref not in seen_material_bills:
-            # Also skip standalone Direct Sales in this fallback loop
-            if s.category != 'Booking Customer':
-                continue
-
-            for item in s.items:
-                # Skip non-booked items (Price > 0) in mixed transactions
-                if item.price_at_time > 0:
-                    continue
-
-                material_history.append({
-                    'date': s.date_posted.strftime('%Y-%m-%d') if s.date_posted else '',
-                    'material': item.product_name,
-                    'qty_added': 0,
-                    'qty_dispatched': item.qty,
-                    'bill_no': bill_ref,
-                    'nimbus_no': 'Direct Sale',
-                    'type': 'Dispatch'
-                })
-
-    # Sort by date (oldest first)
-    # Sort by date, then by type priority (Booking/Add before Dispatch) to ensure balance doesn't dip
-    def mat_sort_key(x):
-        d = x['date'] or ''
-        t = x['type']
-        # Priority: Booking(0), Direct Sale(1), Dispatch(2)
-        p = 2 if t == 'Dispatch' else (0 if t == 'Booking' else 1)
-        return (d, p)
-    
-    material_history.sort(key=mat_sort_key)
-
-    # Running balance per material
-    mat_balances = {}
-    for item in material_history:
-        mat = item['material']
-        if mat not in mat_balances: mat_balances[mat] = 0
-        mat_balances[mat] += (item.get('qty_added', 0) - item.get('qty_dispatched', 0))
-        item['balance'] = mat_balances[mat]
+    # 3. Material Ledger: booked vs dispatched per material, from the last close
+    openings = {}
+    if close:
+        openings = {m: o.balance for m, o in material_openings(client.id, close.close_date).items()}
+    material_history = [{
+        'date': close.close_date, 'material': m, 'qty_added': 0, 'qty_dispatched': 0, 'balance': bal,
+        'bill_no': None, 'nimbus_no': 'Brought forward', 'type': 'Opening'
+    } for m, bal in sorted(openings.items())]
+    material_history += booking_material_history(client.id, after=close.close_date if close else None,
+                                                 until=as_of, openings=openings)
 
     # Calculate totals
     total_debit = sum(item['debit'] for item in financial_history)
     total_credit = sum(item['credit'] for item in financial_history)
-    total_balance = total_debit - total_credit
+    total_balance = (opening_balance or 0) + total_debit - total_credit
 
     return render_template('client_ledger.html',
                            client=client,
+                           as_of=as_of,
+                           opening_balance=opening_balance,
                            pending_bills=pending_bills,
                            financial_history=financial_history,
                            material_history=material_history,
@@ -1371,40 +1293,26 @@ def decision_ledger():
     clients = Client.query.filter_by(is_active=True).order_by(Client.name.asc()).all()
     client_financial_summary = []
 
+    totals = client_totals()
+    # lifetime figures, so archived bookings and entries count too
+    booking, item, entry = with_archive(Booking), with_archive(BookingItem), with_archive(Entry)
+
     for client in clients:
-        # Note: These sums need to filter is_void=False. 
-        b_debit = db.session.query(func.sum(Booking.amount)).filter_by(client_name=client.name).scalar() or 0
-        b_credit = db.session.query(func.sum(Booking.paid_amount)).filter_by(client_name=client.name).scalar() or 0
-        p_credit = db.session.query(func.sum(Payment.amount)).filter_by(client_name=client.name).scalar() or 0
-        ds_debit = db.session.query(func.sum(DirectSale.amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-        ds_credit = db.session.query(func.sum(DirectSale.paid_amount)).filter(func.lower(DirectSale.client_name) == client.name.lower()).scalar() or 0
-        
-        total_debit = b_debit + ds_debit
-        # Re-calculate with void filter
-        b_debit = db.session.query(func.sum(Booking.amount)).filter_by(client_name=client.name, is_void=False).scalar() or 0
-        b_credit = db.session.query(func.sum(Booking.paid_amount)).filter_by(client_name=client.name, is_void=False).scalar() or 0
-        p_credit = db.session.query(func.sum(Payment.amount)).filter_by(client_name=client.name, is_void=False).scalar() or 0
-        ds_debit = db.session.query(func.sum(DirectSale.amount)).filter(func.lower(DirectSale.client_name) == client.name.lower(), DirectSale.is_void==False).scalar() or 0
-        ds_credit = db.session.query(func.sum(DirectSale.paid_amount)).filter(func.lower(DirectSale.client_name) == client.name.lower(), DirectSale.is_void==False).scalar() or 0
-        
-        total_debit = b_debit + ds_debit
-        total_credit = b_credit + p_credit + ds_credit
+        total_debit, total_credit = totals.get(client.id, (0, 0))
         balance = total_debit - total_credit
 
         # --- Per-Client Material Summary ---
-        booked_res = db.session.query(BookingItem.material_name, func.sum(BookingItem.qty))\
-            .join(Booking).filter(Booking.client_name == client.name)\
-            .group_by(BookingItem.material_name).all()
+        booked_res = db.session.query(item.material_name, func.sum(item.qty))\
+            .join(booking, item.booking_id == booking.id).filter(booking.client_id == client.id)\
+            .group_by(item.material_name).all()
         booked_map = {r[0]: (r[1] or 0) for r in booked_res}
         
-        entries = Entry.query.filter(
-            (Entry.client_code == client.code) | (Entry.client == client.name),
-            Entry.type == 'OUT'
-        ).filter(Entry.is_void == False).all()
+        dispatched_res = db.session.query(entry.material, func.sum(entry.qty)).filter(
+            entry.client_id == client.id,
+            entry.type == 'OUT'
+        ).filter(entry.is_void == False).group_by(entry.material).all()
         
-        dispatched_map = {}
-        for e in entries:
-            dispatched_map[e.material] = dispatched_map.get(e.material, 0) + e.qty
+        dispatched_map = {r[0]: (r[1] or 0) for r in dispatched_res}
             
         materials_summary = []
         all_mats = set(booked_map.keys()) | set(dispatched_map.keys())
@@ -1433,18 +1341,17 @@ def decision_ledger():
 
     # --- Part 2: Overall Material Summary ---
     total_booked_q = db.session.query(
-        BookingItem.material_name, 
-        func.sum(BookingItem.qty).label('total_booked')
-    ).join(Booking).filter(Booking.is_void == False).group_by(BookingItem.material_name).all()
+        item.material_name, 
+        func.sum(item.qty).label('total_booked')
+    ).join(booking, item.booking_id == booking.id).filter(booking.is_void == False).group_by(item.material_name).all()
     total_booked_map = {r.material_name: r.total_booked for r in total_booked_q}
 
     all_dispatches = db.session.query(
-        Entry.material,
-        func.sum(Entry.qty).label('total_dispatched')
+        entry.material,
+        func.sum(entry.qty).label('total_dispatched')
     ).filter(
-        Entry.type == 'OUT', Entry.is_void == False
-    ).filter(
-    ).group_by(Entry.material).all()
+        entry.type == 'OUT', entry.is_void == False
+    ).group_by(entry.material).all()
     total_dispatched_map = {r.material: r.total_dispatched for r in all_dispatches}
 
     all_materials = set(total_booked_map.keys()) | set(total_dispatched_map.keys())
@@ -1468,9 +1375,13 @@ def decision_ledger():
 @login_required
 def material_ledger_page(mat_id):
     material = Material.query.get_or_404(mat_id)
-    
-    # Fetch all entries
-    entries = Entry.query.filter_by(material=material.name, is_void=False).all()
+
+    # Entries since the last closed period; its closing stock is brought forward
+    close = latest_close()
+    entries = Entry.query.filter_by(material_id=material.id, is_void=False)
+    if close:
+        entries = entries.filter(Entry.date > close.close_date)
+    entries = entries.all()
 
     # Helper to parse date for sorting
     def parse_entry_datetime(e):
@@ -1491,7 +1402,17 @@ def material_ledger_page(mat_id):
 
     history = []
     running_balance = 0
-    
+    if close:
+        running_balance = stock_opening(material.id, close.close_date)
+        history.append({
+            'date': datetime.strptime(close.close_date, '%Y-%m-%d').strftime('%d-%m-%Y'),
+            'item': 'Brought forward',
+            'bill_no': '',
+            'add': 0,
+            'delivered': 0,
+            'balance': running_balance
+        })
+
     for e in entries:
         qty_add = e.qty if e.type == 'IN' else 0
         qty_delivered = e.qty if e.type == 'OUT' else 0
@@ -1524,14 +1445,21 @@ def client_ledger(id):
     client = db.session.get(Client, id)
     if client:
         page = request.args.get('page', 1, type=int)
-        pagination = Entry.query.filter_by(client=client.name, is_void=False).order_by(
+        pagination = Entry.query.filter_by(client_id=client.id, is_void=False).order_by(
             Entry.date.desc()).paginate(page=page, per_page=10)
+        # per-material totals: openings of the last closed period plus the entries after it
+        close = latest_close()
         summary_query = db.session.query(
             Entry.material,
-            func.sum(Entry.qty).label('total')).filter_by(
-                client=client.name).group_by(Entry.material).all()
-        summary = {row.material: row.total for row in summary_query}
-        total_qty = db.session.query(func.sum(Entry.qty)).filter_by(client=client.name).scalar() or 0
+            func.sum(Entry.qty).label('total')).filter_by(client_id=client.id)
+        summary = {}
+        if close:
+            summary_query = summary_query.filter(Entry.date > close.close_date)
+            summary = {m: o.qty for m, o in material_openings(client.id, close.close_date).items() if o.qty}
+        for row in summary_query.group_by(Entry.material):
+            key = row.material or ''
+            summary[key] = summary.get(key, 0) + (row.total or 0)
+        total_qty = sum(summary.values())
 
         pending_photos = {
             b.bill_no: b.photo_url
@@ -1552,14 +1480,15 @@ def client_ledger(id):
 
 @app.route('/dispatching')
 @login_required
-def dispatching():
+def dispatching(dispatch_report=None):
     mats = Material.query.order_by(Material.name.asc()).all()
     cls = Client.query.filter(Client.is_active == True).order_by(Client.name.asc()).all()
     today = date.today().strftime('%Y-%m-%d')
     return render_template('dispatching.html',
                            materials=mats,
                            clients=cls,
-                           today_date=today)
+                           today_date=today,
+                           dispatch_report=dispatch_report)
 
 
 @app.route('/api/client_booking_status/<client_code>')
@@ -1568,9 +1497,18 @@ def api_client_booking_status(client_code):
     client = Client.query.filter_by(code=client_code).first()
     if not client:
         return jsonify([])
+    as_of = request.args.get('as_of')
+    if as_of:
+        try:
+            posted_until = day_range(as_of, as_of)[1]
+        except ValueError:
+            return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
 
     # Get bookings by client name (Booking model uses name)
-    bookings = Booking.query.filter_by(client_name=client.name, is_void=False).all()
+    bookings = Booking.query.filter_by(client_id=client.id, is_void=False)
+    if as_of:
+        bookings = bookings.filter(Booking.date_posted < posted_until)
+    bookings = bookings.all()
     booking_ids = [b.id for b in bookings]
     
     booked_totals = {}
@@ -1581,9 +1519,12 @@ def api_client_booking_status(client_code):
 
     # Get delivered totals from Entry (OUT)
     entries = Entry.query.filter(
-        (Entry.client_code == client_code) | (Entry.client == client.name),
+        Entry.client_id == client.id,
         Entry.type == 'OUT'
-    ).filter(Entry.is_void == False).all()
+    ).filter(Entry.is_void == False)
+    if as_of:
+        entries = entries.filter(Entry.date <= as_of)
+    entries = entries.all()
     
     delivered_totals = {}
     for e in entries:
@@ -1616,9 +1557,7 @@ def add_record():
     client_obj = None
     
     if client_name:
-        client_obj = Client.query.filter_by(name=client_name).first()
-        if not client_obj:
-            client_obj = Client.query.filter_by(code=client_name).first()
+        client_obj = find_client(client_name)
         if client_obj:
             client_code = client_obj.code
             client_name = client_obj.name
@@ -1637,18 +1576,10 @@ def add_record():
         except ValueError:
             req_qty = 0
             
-        booked = db.session.query(func.sum(BookingItem.qty))\
-            .join(Booking)\
-            .filter(Booking.client_name == client_obj.name)\
-            .filter(BookingItem.material_name == mat_name, Booking.is_void == False)\
-            .scalar() or 0
-            
-        dispatched = db.session.query(func.sum(Entry.qty))\
-            .filter((Entry.client_code == client_obj.code) | (Entry.client == client_obj.name))\
-            .filter(Entry.material == mat_name, Entry.is_void == False)\
-            .filter(Entry.type == 'OUT')\
-            .filter(not_(and_(Entry.nimbus_no == 'Direct Sale', Entry.client_category != 'Booking Delivery')))\
-            .scalar() or 0
+        mat_obj = get_material(mat_name)
+        mat_id = mat_obj.id if mat_obj else None
+
+        booked, dispatched = booking_balances({(client_obj.id, mat_id)}).get((client_obj.id, mat_id), (0, 0))
             
         remaining = booked - dispatched
         
@@ -1667,6 +1598,7 @@ def add_record():
                   material=request.form.get('material', ''),
                   client=client_name,
                   client_code=client_code,
+                  client_id=(client_obj.id if client_obj else None),
                   qty=float(request.form.get('qty', 0) or 0),
                   bill_no=request.form.get('bill_no', '').strip(),
                   nimbus_no=nimbus_no_val,
@@ -1674,16 +1606,12 @@ def add_record():
                   client_category=client_obj.category if client_obj else None)
     db.session.add(entry)
     db.session.flush()
-    
-    # Update Material stock (reduce In Hand)
-    mat_obj = Material.query.filter_by(name=entry.material).first()
-    if mat_obj:
-        mat_obj.total = (mat_obj.total or 0) - entry.qty
+
+    material_obj = get_material(entry.material)
 
     hv = request.form.get('has_bill')
     has_bill = True if hv is None else hv in ['on', '1', 'true', 'True']
 
-    material_obj = Material.query.filter_by(name=entry.material).first()
     unit_price = (material_obj.unit_price if material_obj else 0) or 0
     amount = float(entry.qty) * float(unit_price)
 
@@ -1709,11 +1637,7 @@ def add_record():
             is_manual = False
 
         existing_global = Invoice.query.filter_by(invoice_no=invoice_no).first()
-        if existing_global and not is_manual:
-            while Invoice.query.filter_by(invoice_no=invoice_no).first():
-                invoice_no = get_next_bill_no()
-            entry.auto_bill_no = invoice_no
-        elif existing_global and is_manual:
+        if existing_global:
             if existing_global.client_code != entry.client_code:
                 db.session.rollback()
                 flash(f'Invoice number "{invoice_no}" is already used by another client.', 'danger')
@@ -1750,6 +1674,52 @@ def add_record():
     return redirect(url_for('index'))
 
 
+def _dispatch_date(value):
+    """The dispatch date of a batch, or None when the user may not post on it."""
+    entry_date = value or datetime.now().strftime('%Y-%m-%d')
+    if current_user.role == 'user' and entry_date != datetime.now().strftime('%Y-%m-%d'):
+        return None
+    return entry_date
+
+
+@app.route('/api/dispatch/bulk', methods=['POST'])
+@login_required
+def api_bulk_dispatch():
+    """Dispatch many booking lines at once: {"date": ..., "lines": [{client, material, qty, bill_no, nimbus_no}]}."""
+    data = request.get_json(silent=True) or {}
+    lines = data.get('lines') if isinstance(data, dict) else None
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'lines must be a non-empty list'}), 400
+    entry_date = _dispatch_date(data.get('date'))
+    if not entry_date:
+        return jsonify({'error': 'Standard users cannot add back-dated records.'}), 403
+    report = dispatch_lines([line if isinstance(line, dict) else {} for line in lines], entry_date,
+                            current_user.username)
+    posted = sum(1 for r in report if r['status'] == 'posted')
+    return jsonify({'posted': posted, 'errors': len(report) - posted, 'lines': report})
+
+
+@app.route('/add_records', methods=['POST'])
+@login_required
+def add_records():
+    """Multi-line dispatch form: one "client, material, qty, bill no" per line."""
+    import csv
+    entry_date = _dispatch_date(request.form.get('date'))
+    if not entry_date:
+        flash('Permission Denied: Standard users cannot add back-dated records.', 'danger')
+        return redirect(url_for('dispatching'))
+    fields = ('client', 'material', 'qty', 'bill_no')
+    lines = [dict(zip(fields, (v.strip() for v in row)))
+             for row in csv.reader(request.form.get('lines', '').splitlines()) if any(v.strip() for v in row)]
+    if not lines:
+        flash('No dispatch lines entered', 'warning')
+        return redirect(url_for('dispatching'))
+    report = dispatch_lines(lines, entry_date, current_user.username)
+    posted = sum(1 for r in report if r['status'] == 'posted')
+    flash(f'Dispatched {posted} of {len(report)} lines', 'success' if posted == len(report) else 'warning')
+    return dispatching(dispatch_report=report)
+
+
 @app.route('/edit_entry/<int:id>', methods=['POST'])
 @login_required
 def edit_entry(id):
@@ -1764,8 +1734,6 @@ def edit_entry(id):
 
     old_bill_no = e.bill_no
     old_client_code = e.client_code
-    old_qty = e.qty
-    old_material = e.material
 
     e.date = request.form.get('date') or e.date
     e.time = request.form.get('time') or e.time
@@ -1774,12 +1742,11 @@ def edit_entry(id):
     
     client_input = request.form.get('client', '').strip()
     if client_input:
-        client_obj = Client.query.filter_by(name=client_input).first()
-        if not client_obj:
-            client_obj = Client.query.filter_by(code=client_input).first()
+        client_obj = find_client(client_input)
         if client_obj:
             e.client = client_obj.name
             e.client_code = client_obj.code
+            e.client_id = client_obj.id
         else:
             e.client = client_input
             e.client_code = None
@@ -1791,20 +1758,6 @@ def edit_entry(id):
     e.bill_no = request.form.get('bill_no', '').strip() or None
     e.nimbus_no = request.form.get('nimbus_no', '').strip() or None
 
-    # Update Material Totals if qty or material changed
-    if e.type == 'OUT' or e.type == 'IN':
-        # Revert old qty from old material
-        old_mat_obj = Material.query.filter_by(name=old_material).first()
-        if old_mat_obj:
-            if e.type == 'IN': old_mat_obj.total -= old_qty
-            else: old_mat_obj.total += old_qty
-            
-        # Apply new qty to new material
-        new_mat_obj = Material.query.filter_by(name=e.material).first()
-        if new_mat_obj:
-            if e.type == 'IN': new_mat_obj.total += e.qty
-            else: new_mat_obj.total -= e.qty
-
     # Synchronize PendingBill - REMOVED DANGEROUS LOGIC
     # We do NOT want to auto-update PendingBills for OUT entries here because
     # it risks overwriting Booking bills with partial dispatch amounts.
@@ -1836,13 +1789,8 @@ def delete_entry(id):
         return redirect(url_for('index'))
 
     if e.type == 'OUT' and e.bill_no:
-        PendingBill.query.filter_by(bill_no=e.bill_no, client_code=e.client_code).delete()
-
-    # Revert Material Stock
-    mat_obj = Material.query.filter_by(name=e.material).first()
-    if mat_obj:
-        if e.type == 'IN': mat_obj.total = (mat_obj.total or 0) - e.qty
-        elif e.type == 'OUT': mat_obj.total = (mat_obj.total or 0) + e.qty
+        for pb in PendingBill.query.filter_by(bill_no=e.bill_no, client_code=e.client_code):
+            retire_pending_bill(pb)
 
     d = e.date
     db.session.delete(e)
@@ -1866,97 +1814,101 @@ def tracking():
     page = request.args.get('page', 1, type=int)
     type_filter = request.args.get('type', '').strip()
     has_bill_filter = request.args.get('has_bill', '').strip()
+    include_archive = request.args.get('archive') == '1'
+    entry = with_archive(Entry, include_archive)
 
     has_filter = bool(s or end or cl or m or search or bill_no or category or type_filter or has_bill_filter in ['0', '1'])
 
     entries = []
+    archived = set()
     pagination = None
     summary = {}
     total_qty = 0
 
     if has_filter:
-        query = Entry.query
+        query = db.session.query(entry)
         if s:
-            query = query.filter(Entry.date >= s) # Show voided in tracking? Yes, but maybe filterable. For now show all.
+            query = query.filter(entry.date >= s) # Show voided in tracking? Yes, but maybe filterable. For now show all.
         if end:
-            query = query.filter(Entry.date <= end)
+            query = query.filter(entry.date <= end)
         if cl:
-            query = query.filter(Entry.client == cl)
+            query = query.filter(entry.client == cl)
         if m:
-            query = query.filter(Entry.material == m)
+            query = query.filter(entry.material == m)
         if bill_no:
-            query = query.filter(db.or_(Entry.bill_no.ilike(f'%{bill_no}%'), Entry.auto_bill_no.ilike(f'%{bill_no}%')))
+            query = query.filter(db.or_(entry.bill_no.ilike(f'%{bill_no}%'), entry.auto_bill_no.ilike(f'%{bill_no}%')))
         if category:
-            query = query.outerjoin(Client, Entry.client_code == Client.code).filter(
-                or_(Entry.client_category == category, Client.category == category)
+            query = query.outerjoin(Client, entry.client_code == Client.code).filter(
+                or_(entry.client_category == category, Client.category == category)
             )
         if type_filter:
-            query = query.filter(Entry.type == type_filter)
+            query = query.filter(entry.type == type_filter)
         if has_bill_filter == '1':
-            query = query.filter(db.or_(Entry.bill_no != None, Entry.auto_bill_no != None))\
-                         .filter(db.or_(Entry.bill_no != '', Entry.auto_bill_no != ''))\
-                         .filter(db.or_(Entry.bill_no == None, db.not_(Entry.bill_no.like('UNBILLED%'))))
+            query = query.filter(db.or_(entry.bill_no != None, entry.auto_bill_no != None))\
+                         .filter(db.or_(entry.bill_no != '', entry.auto_bill_no != ''))\
+                         .filter(db.or_(entry.bill_no == None, db.not_(entry.bill_no.like('UNBILLED%'))))
         if has_bill_filter == '0':
             query = query.filter(db.or_(
                 db.and_(
-                    db.or_(Entry.bill_no == None, Entry.bill_no == ''),
-                    db.or_(Entry.auto_bill_no == None, Entry.auto_bill_no == '')
+                    db.or_(entry.bill_no == None, entry.bill_no == ''),
+                    db.or_(entry.auto_bill_no == None, entry.auto_bill_no == '')
                 ),
-                Entry.bill_no.like('UNBILLED%')
+                entry.bill_no.like('UNBILLED%')
             ))
         if search:
             query = query.filter(
-                db.or_(Entry.material.ilike(f'%{search}%'),
-                       Entry.client.ilike(f'%{search}%'),
-                       Entry.client_code.ilike(f'%{search}%'),
-                       Entry.bill_no.ilike(f'%{search}%'),
-                       Entry.nimbus_no.ilike(f'%{search}%')))
+                db.or_(entry.material.ilike(f'%{search}%'),
+                       entry.client.ilike(f'%{search}%'),
+                       entry.client_code.ilike(f'%{search}%'),
+                       entry.bill_no.ilike(f'%{search}%'),
+                       entry.nimbus_no.ilike(f'%{search}%')))
 
-        pagination = query.order_by(Entry.date.desc(), Entry.time.desc()).paginate(page=page, per_page=15, error_out=False)
+        pagination = query.order_by(entry.date.desc(), entry.time.desc()).paginate(page=page, per_page=15, error_out=False)
         entries = pagination.items
+        archived = archived_ids(Entry, [e.id for e in entries]) if include_archive else set()
 
         # Summary calculation
         base_query = db.session.query(
-            Entry.material,
-            func.sum(case((Entry.type == 'IN', Entry.qty), else_=-Entry.qty)).label('net'))
+            entry.material,
+            func.sum(case((entry.type == 'IN', entry.qty), else_=-entry.qty)).label('net'))
 
         if category:
-            base_query = base_query.outerjoin(Client, Entry.client_code == Client.code).filter(
-                or_(Entry.client_category == category, Client.category == category)
+            base_query = base_query.outerjoin(Client, entry.client_code == Client.code).filter(
+                or_(entry.client_category == category, Client.category == category)
             )
         if s:
-            base_query = base_query.filter(Entry.date >= s)
+            base_query = base_query.filter(entry.date >= s)
         if end:
-            base_query = base_query.filter(Entry.date <= end)
+            base_query = base_query.filter(entry.date <= end)
         if cl:
-            base_query = base_query.filter(Entry.client == cl)
+            base_query = base_query.filter(entry.client == cl)
         if m:
-            base_query = base_query.filter(Entry.material == m)
+            base_query = base_query.filter(entry.material == m)
         if bill_no:
-            base_query = base_query.filter(db.or_(Entry.bill_no.ilike(f'%{bill_no}%'), Entry.auto_bill_no.ilike(f'%{bill_no}%')))
+            base_query = base_query.filter(db.or_(entry.bill_no.ilike(f'%{bill_no}%'), entry.auto_bill_no.ilike(f'%{bill_no}%')))
         if type_filter:
-            base_query = base_query.filter(Entry.type == type_filter)
+            base_query = base_query.filter(entry.type == type_filter)
         if has_bill_filter == '1':
-            base_query = base_query.filter(db.or_(Entry.bill_no != None, Entry.auto_bill_no != None))\
-                         .filter(db.or_(Entry.bill_no != '', Entry.auto_bill_no != ''))\
-                         .filter(db.or_(Entry.bill_no == None, db.not_(Entry.bill_no.like('UNBILLED%'))))
+            base_query = base_query.filter(db.or_(entry.bill_no != None, entry.auto_bill_no != None))\
+                         .filter(db.or_(entry.bill_no != '', entry.auto_bill_no != ''))\
+                         .filter(db.or_(entry.bill_no == None, db.not_(entry.bill_no.like('UNBILLED%'))))
         if has_bill_filter == '0':
             base_query = base_query.filter(db.or_(
                 db.and_(
-                    db.or_(Entry.bill_no == None, Entry.bill_no == ''),
-                    db.or_(Entry.auto_bill_no == None, Entry.auto_bill_no == '')
+                    db.or_(entry.bill_no == None, entry.bill_no == ''),
+                    db.or_(entry.auto_bill_no == None, entry.auto_bill_no == '')
                 ),
-                Entry.bill_no.like('UNBILLED%')
+                entry.bill_no.like('UNBILLED%')
             ))
         if search:
             base_query = base_query.filter(
-                db.or_(Entry.material.ilike(f'%{search}%'),
-                       Entry.client.ilike(f'%{search}%'),
-                       Entry.client_code.ilike(f'%{search}%'),
-                       Entry.bill_no.ilike(f'%{search}%'),
-                       Entry.nimbus_no.ilike(f'%{search}%')))
+                db.or_(entry.material.ilike(f'%{search}%'),
+                       entry.client.ilike(f'%{search}%'),
+                       entry.client_code.ilike(f'%{search}%'),
+                       entry.bill_no.ilike(f'%{search}%'),
+                       entry.nimbus_no.ilike(f'%{search}%')))
 
-        summary_query = base_query.group_by(Entry.material).all()
+        summary_query = base_query.group_by(entry.material).all()
         summary = {row.material: row.net for row in summary_query}
         total_qty = sum(summary.values()) if summary else 0
 
@@ -1986,7 +1938,9 @@ def tracking():
         has_filter=has_filter,
         pending_photos=pending_photos,
         type_filter=type_filter,
-        has_bill_filter=has_bill_filter)
+        has_bill_filter=has_bill_filter,
+        include_archive=include_archive,
+        archived=archived)
 
 
 @app.route('/unpaid_transactions')
@@ -2044,6 +1998,11 @@ def financial_details():
     
     if not start_date: start_date = date.today().strftime('%Y-%m-%d')
     if not end_date: end_date = date.today().strftime('%Y-%m-%d')
+    try:
+        day_range(start_date, end_date)
+    except ValueError:
+        flash('Invalid date range, showing today.', 'warning')
+        start_date = end_date = date.today().strftime('%Y-%m-%d')
     
     # Resolve client code to name if applicable
     if client_query and (client_query.lower().startswith('tmpc-') or client_query[0].isdigit()):
@@ -2055,8 +2014,7 @@ def financial_details():
     
     if type_filter == 'cash':
         # 1. Payments
-        q_pay = Payment.query.filter(func.date(Payment.date_posted) >= start_date, 
-                                   func.date(Payment.date_posted) <= end_date, Payment.is_void == False)
+        q_pay = Payment.query.filter(*posted_between(Payment.date_posted, start_date, end_date), Payment.is_void == False)
         if client_query:
             q_pay = q_pay.filter(Payment.client_name.ilike(f'%{client_query}%'))
         if min_price is not None: q_pay = q_pay.filter(Payment.amount >= min_price)
@@ -2072,8 +2030,7 @@ def financial_details():
             })
             
         # 2. Booking Advances
-        q_book = Booking.query.filter(func.date(Booking.date_posted) >= start_date,
-                                    func.date(Booking.date_posted) <= end_date,
+        q_book = Booking.query.filter(*posted_between(Booking.date_posted, start_date, end_date),
                                     Booking.paid_amount > 0, Booking.is_void == False)
         if client_query:
             q_book = q_book.filter(Booking.client_name.ilike(f'%{client_query}%'))
@@ -2090,8 +2047,7 @@ def financial_details():
             })
             
         # 3. Direct Sale Cash
-        q_sale = DirectSale.query.filter(func.date(DirectSale.date_posted) >= start_date,
-                                       func.date(DirectSale.date_posted) <= end_date,
+        q_sale = DirectSale.query.filter(*posted_between(DirectSale.date_posted, start_date, end_date),
                                        DirectSale.paid_amount > 0, DirectSale.is_void == False)
         if client_query:
             q_sale = q_sale.filter(DirectSale.client_name.ilike(f'%{client_query}%'))
@@ -2109,8 +2065,7 @@ def financial_details():
             
     elif type_filter == 'credit':
         # 1. Booking Credit
-        q_book = Booking.query.filter(func.date(Booking.date_posted) >= start_date,
-                                    func.date(Booking.date_posted) <= end_date,
+        q_book = Booking.query.filter(*posted_between(Booking.date_posted, start_date, end_date),
                                     (Booking.amount - Booking.paid_amount) > 0, Booking.is_void == False)
         if client_query:
             q_book = q_book.filter(Booking.client_name.ilike(f'%{client_query}%'))
@@ -2128,8 +2083,7 @@ def financial_details():
             })
             
         # 2. Direct Sale Credit
-        q_sale = DirectSale.query.filter(func.date(DirectSale.date_posted) >= start_date,
-                                       func.date(DirectSale.date_posted) <= end_date,
+        q_sale = DirectSale.query.filter(*posted_between(DirectSale.date_posted, start_date, end_date),
                                        (DirectSale.amount - DirectSale.paid_amount) > 0, DirectSale.is_void == False)
         if client_query:
             q_sale = q_sale.filter(DirectSale.client_name.ilike(f'%{client_query}%'))
@@ -2147,9 +2101,18 @@ def financial_details():
             })
 
     transactions.sort(key=lambda x: x['date'], reverse=True)
+
+    # unfiltered totals come straight from the daily rollup
+    range_total = None
+    if not client_query and min_price is None and max_price is None:
+        if type_filter == 'cash':
+            range_total = sum(cash for cash, _ in finance_totals(start_date, end_date).values())
+        elif type_filter == 'credit':
+            range_total = sum(credit for _, credit in finance_totals(start_date, end_date, kinds=['booking', 'sale']).values())
     
     return render_template('financial_details.html',
                            transactions=transactions,
+                           range_total=range_total,
                            type=type_filter,
                            start_date=start_date,
                            end_date=end_date,
@@ -2167,45 +2130,21 @@ def index():
     today_date = date.today()
     
     client_count = db.session.query(func.count(Client.id)).scalar() or 0
-    stats_query = db.session.query(
-        Entry.material,
-        func.sum(case((Entry.type == 'IN', Entry.qty), else_=0)).label('total_in'),
-        func.sum(case((Entry.type == 'OUT', Entry.qty), else_=0)).label('total_out') # Entry.is_void check needed? Yes.
-    ).group_by(Entry.material).all()
-    
-    stats = sorted([{
-        'name': row.material,
-        'in': int(row.total_in or 0),
-        'out': int(row.total_out or 0),
-        'stock': int((row.total_in or 0) - (row.total_out or 0))
-    } for row in stats_query], key=lambda x: x['name'])
-    
-    # Re-query stats with is_void=False
-    stats_query = db.session.query(
-        Entry.material,
-        func.sum(case((Entry.type == 'IN', Entry.qty), else_=0)).label('total_in'),
-        func.sum(case((Entry.type == 'OUT', Entry.qty), else_=0)).label('total_out')
-    ).filter(Entry.is_void == False).group_by(Entry.material).all()
-    
-    stats = sorted([{
-        'name': row.material,
-        'in': int(row.total_in or 0),
-        'out': int(row.total_out or 0),
-        'stock': int((row.total_in or 0) - (row.total_out or 0))
-    } for row in stats_query], key=lambda x: x['name'])
+    stats = [{
+        'name': m.name,
+        'in': int(m.total_in or 0),
+        'out': int(m.total_out or 0),
+        'stock': int(m.total or 0)
+    } for m in db.session.query(Material.name, Material.total, Material.total_in, Material.total_out)
+                           .order_by(Material.name)]
 
     total_stock = sum(s['stock'] for s in stats)
     
-    # Daily Cash Calculation
-    cash_payments = db.session.query(func.sum(Payment.amount)).filter(func.date(Payment.date_posted) == today_date, Payment.is_void == False).scalar() or 0
-    cash_bookings = db.session.query(func.sum(Booking.paid_amount)).filter(func.date(Booking.date_posted) == today_date, Booking.is_void == False).scalar() or 0
-    cash_sales = db.session.query(func.sum(DirectSale.paid_amount)).filter(func.date(DirectSale.date_posted) == today_date, DirectSale.is_void == False).scalar() or 0
-    daily_cash = cash_payments + cash_bookings + cash_sales
-    
-    # Daily Credit Calculation
-    credit_bookings = db.session.query(func.sum(Booking.amount - Booking.paid_amount)).filter(func.date(Booking.date_posted) == today_date, Booking.is_void == False).scalar() or 0
-    credit_sales = db.session.query(func.sum(DirectSale.amount - DirectSale.paid_amount)).filter(func.date(DirectSale.date_posted) == today_date, DirectSale.is_void == False).scalar() or 0
-    daily_credit = credit_bookings + credit_sales
+    # Daily cash/credit and sales breakdown, from the daily rollup
+    today_str = today_date.strftime('%Y-%m-%d')
+    day_totals = finance_totals(today_str, today_str, by_category=True)
+    daily_cash = sum(cash for cash, _ in day_totals.values())
+    daily_credit = sum(credit for (kind, _), (_, credit) in day_totals.items() if kind in ('booking', 'sale'))
     
     # Total Outstanding (Unpaid Bills)
     total_outstanding = db.session.query(func.sum(PendingBill.amount)).filter(PendingBill.is_paid == False, PendingBill.is_void == False).scalar() or 0
@@ -2214,16 +2153,14 @@ def index():
     sales_breakdown = {}
     
     # 1. Bookings
-    booking_total = db.session.query(func.sum(Booking.amount)).filter(func.date(Booking.date_posted) == today_date, Booking.is_void == False).scalar() or 0
+    booking_total = sum(cash + credit for (kind, _), (cash, credit) in day_totals.items() if kind == 'booking')
     if booking_total > 0:
         sales_breakdown['Bookings'] = booking_total
 
     # 2. Direct Sales
-    ds_query = db.session.query(DirectSale.category, func.sum(DirectSale.amount))\
-        .filter(func.date(DirectSale.date_posted) == today_date, DirectSale.is_void == False)\
-        .group_by(DirectSale.category).all()
-        
-    for cat, amt in ds_query:
+    ds_totals = [(category, cash + credit) for (kind, category), (cash, credit) in day_totals.items() if kind == 'sale']
+
+    for cat, amt in ds_totals:
         if amt > 0:
             cat_name = cat if cat else 'Direct Sale'
             if cat_name == 'Credit Customer': cat_name = 'Credit Sales'
@@ -2290,9 +2227,11 @@ def clients():
     inactive_pagination = inactive_query.order_by(Client.name.asc()).paginate(page=page_inactive, per_page=10)
 
     all_visible_clients = active_pagination.items + inactive_pagination.items
+    deliveries = with_archive(Entry)
     for c in all_visible_clients:
         c.total_bills = db.session.query(func.count(PendingBill.id)).filter_by(client_code=c.code).scalar() or 0
-        c.total_deliveries = db.session.query(func.sum(Entry.qty)).filter_by(client=c.name, type='OUT').scalar() or 0
+        c.total_deliveries = db.session.query(func.sum(deliveries.qty)).filter(
+            deliveries.client_id == c.id, deliveries.type == 'OUT').scalar() or 0
 
     active_clients_list = Client.query.filter(Client.is_active == True).order_by(Client.name.asc()).all()
     
@@ -2323,6 +2262,11 @@ def add_client():
                    address=request.form.get('address', ''),
                    category=request.form.get('category', 'General'))
     db.session.add(new_c)
+    db.session.flush()
+    linked = link_client_rows(new_c)
+    if any(linked.get(t) for t in ('booking', 'payment', 'direct_sale')):
+        refresh_finance_daily([None, new_c.id])
+        refresh_journal([None, new_c.id])
     db.session.commit()
     flash('Client Registered', 'success')
     return redirect(url_for('clients'))
@@ -2347,29 +2291,23 @@ def edit_client(id):
             flash(f'Client code "{new_code}" already exists', 'danger')
             return redirect(url_for('clients'))
 
+        c.name = new_name
+        c.code = new_code
+        c.phone = request.form.get('phone', '')
+        c.address = request.form.get('address', '')
+        c.category = request.form.get('category', 'General')
+
         if old_code != new_code or old_name != new_name:
             PendingBill.query.filter_by(client_code=old_code).update({
                 'client_code': new_code,
                 'client_name': new_name
             })
-            Entry.query.filter_by(client_code=old_code).update({
+            Invoice.query.filter_by(client_code=old_code).update({
                 'client_code': new_code,
-                'client': new_name
+                'client_name': new_name
             })
-            Entry.query.filter_by(client=old_name).update({'client': new_name})
-            
-            # Propagate name change to all related tables to prevent broken links
-            Booking.query.filter_by(client_name=old_name).update({'client_name': new_name})
-            DirectSale.query.filter_by(client_name=old_name).update({'client_name': new_name})
-            Payment.query.filter_by(client_name=old_name).update({'client_name': new_name})
-            Invoice.query.filter_by(client_name=old_name).update({'client_name': new_name})
-            Invoice.query.filter_by(client_code=old_code).update({'client_code': new_code})
-
-        c.name = new_name
-        c.code = new_code
-        c.phone = request.form.get('phone', '')
-        c.address = request.form.get('address', '')
-        c.category = request.form.get('category', 'General')
+            # Linked rows follow by client_id; names are only refreshed for display
+            propagate_client_rename(c)
 
         db.session.commit()
         flash('Client updated', 'success')
@@ -2409,9 +2347,11 @@ def transfer_client(id):
         flash('Cannot transfer to an inactive client', 'danger')
         return redirect(url_for('clients'))
 
-    entries_updated = Entry.query.filter_by(client_code=source_client.code).update({
+    entries_updated = Entry.query.filter_by(client_id=source_client.id).update({
         'client': target_client.name,
-        'client_code': target_client.code
+        'client_code': target_client.code,
+        'client_id': target_client.id,
+        'name_key': name_key(target_client.name)
     })
     bills_updated = PendingBill.query.filter_by(client_code=source_client.code).update({
         'client_name': target_client.name,
@@ -2442,9 +2382,11 @@ def reclaim_client(id):
     source_client.is_active = True
 
     entries_reclaimed = Entry.query.filter_by(
-        client_code=target_client.code, client=target_client.name).update({
+        client_id=target_client.id, client=target_client.name).update({
             'client': source_client.name,
-            'client_code': source_client.code
+            'client_code': source_client.code,
+            'client_id': source_client.id,
+            'name_key': name_key(source_client.name)
         })
     bills_reclaimed = PendingBill.query.filter_by(
         client_code=target_client.code, client_name=target_client.name).update({
@@ -2503,10 +2445,10 @@ def edit_material(id):
             flash(f'Material code "{new_code}" already exists', 'danger')
             return redirect(url_for('materials'))
         old_name = m.name
-        for e in Entry.query.filter_by(material=old_name).all():
-            e.material = new_name
         m.name = new_name
         m.code = new_code
+        if old_name != new_name:
+            propagate_material_rename(m)
         db.session.commit()
         flash('Brand Updated', 'info')
     return redirect(url_for('materials'))
@@ -2517,6 +2459,7 @@ def edit_material(id):
 def delete_material(id):
     m = db.session.get(Material, id)
     if m:
+        StockDaily.query.filter_by(material_id=m.id).delete()
         db.session.delete(m)
         db.session.commit()
         flash('Brand Removed', 'warning')
@@ -2571,6 +2514,12 @@ def pending_bills():
                            materials=materials)
 
 
+def duplicate_bill_message(bill_no):
+    if bill_no:
+        return f'Bill {bill_no} already exists for this client.'
+    return 'This client already has a bill without a number; give the new one a bill number.'
+
+
 @app.route('/add_pending_bill', methods=['POST'])
 @login_required
 def add_pending_bill():
@@ -2581,9 +2530,15 @@ def add_pending_bill():
         flash('Invalid Client Code.', 'danger')
         return redirect(url_for('pending_bills'))
 
+    bill_no = request.form.get('bill_no', '').strip()
+    # (bill_no, client_code) is unique, a blank bill number included
+    if PendingBill.query.filter_by(bill_no=bill_no, client_code=client_code).first():
+        flash(duplicate_bill_message(bill_no), 'warning')
+        return redirect(url_for('pending_bills'))
+
     bill = PendingBill(client_code=client_code,
                        client_name=client_obj.name,
-                       bill_no=request.form.get('bill_no', '').strip(),
+                       bill_no=bill_no,
                        nimbus_no=request.form.get('nimbus_no', '').strip(),
                        amount=float(request.form.get('amount') or 0),
                        reason=request.form.get('reason', '').strip(),
@@ -2591,7 +2546,13 @@ def add_pending_bill():
                        created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
                        created_by=current_user.username)
     db.session.add(bill)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # added by another request between the check and the insert
+        db.session.rollback()
+        flash(duplicate_bill_message(bill_no), 'warning')
+        return redirect(url_for('pending_bills'))
     flash('Pending bill added', 'success')
     return redirect(url_for('pending_bills'))
 
@@ -2611,9 +2572,16 @@ def edit_pending_bill(id):
             flash('Invalid Client Code.', 'danger')
             return redirect(url_for('pending_bills'))
 
+        bill_no = request.form.get('bill_no', '').strip()
+        if PendingBill.query.filter(PendingBill.bill_no == bill_no,
+                                    PendingBill.client_code == client_code,
+                                    PendingBill.id != bill.id).first():
+            flash(duplicate_bill_message(bill_no), 'warning')
+            return redirect(url_for('pending_bills'))
+
         bill.client_code = client_code
         bill.client_name = client_obj.name
-        bill.bill_no = request.form.get('bill_no', '').strip()
+        bill.bill_no = bill_no
         bill.nimbus_no = request.form.get('nimbus_no', '').strip()
         bill.amount = float(request.form.get('amount') or 0)
         bill.reason = request.form.get('reason', '').strip()
@@ -2622,11 +2590,18 @@ def edit_pending_bill(id):
         update_data = {
             'bill_no': bill.bill_no,
             'client': bill.client_name,
-            'client_code': bill.client_code
+            'client_code': bill.client_code,
+            'client_id': client_obj.id,
+            'name_key': name_key(client_obj.name)
         }
         Entry.query.filter_by(bill_no=old_bill_no, client_code=old_client_code).update(update_data)
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(duplicate_bill_message(bill_no), 'warning')
+            return redirect(url_for('pending_bills'))
         flash('Bill updated', 'success')
     return redirect(url_for('pending_bills'))
 
@@ -2641,9 +2616,11 @@ def delete_pending_bill(id):
             if bill_date != date.today().strftime('%Y-%m-%d'):
                 flash('Standard users cannot delete back-dated bills.', 'danger')
                 return redirect(url_for('pending_bills'))
-        db.session.delete(bill)
+        if retire_pending_bill(bill):
+            flash('Bill voided: payments were allocated to it and have been given back.', 'warning')
+        else:
+            flash('Bill deleted', 'warning')
         db.session.commit()
-        flash('Bill deleted', 'warning')
     return redirect(url_for('pending_bills'))
 
 
@@ -2701,8 +2678,8 @@ def import_pending_bills():
         else:
             df = pd.read_excel(file)
 
-        count = 0
-        for _, row in df.iterrows():
+        rows = []
+        for row in df.to_dict('records'):
             bill_no = str(row.get('BillNo', '')).strip() if pd.notna(row.get('BillNo')) else ''
             code = str(row.get('ClientCode', '')).strip() if pd.notna(row.get('ClientCode')) else ''
             name = str(row.get('ClientName', '')).strip() if pd.notna(row.get('ClientName')) else ''
@@ -2719,34 +2696,18 @@ def import_pending_bills():
             except:
                 amount = 0
 
-            reason = str(row.get('Reason', '')).strip() if pd.notna(row.get('Reason')) else ''
-            nimbus_no = str(row.get('NimbusNo', '')).strip() if pd.notna(row.get('NimbusNo')) else ''
-
-            client = None
-            if code and code != 'NA':
-                client = Client.query.filter_by(code=code).first()
-            if not client and name and name != 'Unknown':
-                client = Client.query.filter_by(name=name).first()
-            if not client:
-                new_code = code if code and code != 'NA' else generate_client_code()
-                client = Client(code=new_code, name=name, is_active=True)
-                db.session.add(client)
-                db.session.flush()
-
-            bill = PendingBill(
-                client_code=client.code,
-                client_name=client.name,
-                bill_no=bill_no,
-                amount=amount,
-                reason=reason,
-                nimbus_no=nimbus_no,
-                created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
-                created_by=current_user.username)
-            db.session.add(bill)
-            count += 1
+            rows.append({
+                'client_code': code,
+                'client_name': name,
+                'bill_no': bill_no,
+                'amount': amount,
+                'reason': str(row.get('Reason', '')).strip() if pd.notna(row.get('Reason')) else '',
+                'nimbus_no': str(row.get('NimbusNo', '')).strip() if pd.notna(row.get('NimbusNo')) else ''
+            })
 
+        result = upsert_pending_bills(rows, current_user.username)
         db.session.commit()
-        flash(f'Successfully imported {count} pending bills.', 'success')
+        flash(f"Successfully imported pending bills: {import_summary(result)}.", 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Import failed: {str(e)}', 'danger')
@@ -2764,36 +2725,18 @@ def confirm_import():
             return redirect(url_for('pending_bills'))
 
         imported_list = json.loads(data)
-        count = 0
-        for item in imported_list:
-            client = None
-            code = item.get('client_code', '').strip()
-            name = item.get('client_name', '').strip()
-
-            if code and code != 'NA':
-                client = Client.query.filter_by(code=code).first()
-            if not client and name:
-                client = Client.query.filter_by(name=name).first()
-            if not client:
-                new_code = code if code and code != 'NA' else generate_client_code()
-                client = Client(code=new_code, name=name, is_active=True)
-                db.session.add(client)
-                db.session.flush()
-
-            bill = PendingBill(
-                client_code=client.code,
-                client_name=client.name,
-                bill_no=item.get('bill_no'),
-                amount=item.get('amount', 0),
-                reason=item.get('reason', ''),
-                nimbus_no=item.get('nimbus_no', ''),
-                created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
-                created_by=current_user.username)
-            db.session.add(bill)
-            count += 1
-
+        rows = [{
+            'client_code': (item.get('client_code') or '').strip(),
+            'client_name': (item.get('client_name') or '').strip(),
+            'bill_no': item.get('bill_no'),
+            'amount': item.get('amount', 0),
+            'reason': item.get('reason', ''),
+            'nimbus_no': item.get('nimbus_no', '')
+        } for item in imported_list]
+
+        result = upsert_pending_bills(rows, current_user.username)
         db.session.commit()
-        flash(f'Successfully imported {count} pending bills.', 'success')
+        flash(f"Successfully imported pending bills: {import_summary(result)}.", 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Confirmation failed: {str(e)}', 'danger')
@@ -2814,6 +2757,60 @@ def api_clients_search():
     return jsonify([{'name': c.name, 'code': c.code, 'category': c.category} for c in clients])
 
 
+@app.route('/api/clients/<client_code>/balance')
+@login_required
+def api_client_balance(client_code):
+    client = Client.query.filter_by(code=client_code).first()
+    if not client:
+        return jsonify({'error': 'Client not found'}), 404
+    as_of = request.args.get('as_of') or date.today().strftime('%Y-%m-%d')
+    try:
+        day_range(as_of, as_of)
+    except ValueError:
+        return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
+    return jsonify({'code': client.code, 'name': client.name, 'as_of': as_of,
+                    'balance': balance_as_of(client.id, as_of)})
+
+
+@app.route('/api/aging')
+@login_required
+def api_aging():
+    """What each client owes, split by the age of the bills it sits on."""
+    as_of = request.args.get('as_of') or date.today().strftime('%Y-%m-%d')
+    try:
+        as_of_date = datetime.strptime(as_of, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
+    rows = aging(as_of_date)
+    clients = {c.id: c for c in Client.query.filter(Client.id.in_(list(rows)))} if rows else {}
+    return jsonify({'as_of': as_of, 'clients': [
+        dict(row, code=clients[cid].code, name=clients[cid].name)
+        for cid, row in rows.items() if cid in clients and row['balance'] > 0
+    ]})
+
+
+@app.route('/api/stock')
+@login_required
+def api_stock():
+    as_of = request.args.get('as_of') or date.today().strftime('%Y-%m-%d')
+    try:
+        day_range(as_of, as_of)
+    except ValueError:
+        return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
+    return jsonify({'as_of': as_of, 'materials': [
+        {'material': name, 'in': qty_in, 'out': qty_out, 'closing': closing}
+        for name, qty_in, qty_out, closing in stock_as_of(as_of)]})
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def api_job_status(job_id):
+    job = db.session.get(BackgroundJob, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_as_dict(job))
+
+
 @app.route('/api/check_bill/<path:bill_no>')
 @login_required
 def check_bill_api(bill_no):
@@ -2836,7 +2833,15 @@ def settings():
     settings_obj = Settings.query.first()
     if not settings_obj:
         settings_obj = Settings()
-    return render_template('settings.html', users=User.query.all(), settings=settings_obj)
+    closes = PeriodClose.query.order_by(PeriodClose.close_date.desc()).limit(5).all()
+    import_jobs = BackgroundJob.query.filter_by(kind='import').order_by(BackgroundJob.id.desc()).limit(5).all()
+    purge_jobs = BackgroundJob.query.filter_by(kind='purge').order_by(BackgroundJob.id.desc()).limit(3).all()
+    archive_jobs = BackgroundJob.query.filter_by(kind='archive').order_by(BackgroundJob.id.desc()).limit(3).all()
+    backup_jobs = BackgroundJob.query.filter_by(kind='backup').order_by(BackgroundJob.id.desc()).limit(3).all()
+    return render_template('settings.html', users=User.query.all(), settings=settings_obj, closes=closes,
+                           import_jobs=import_jobs, purge_jobs=purge_jobs, archive_jobs=archive_jobs,
+                           archive_cutoff=archive_cutoff(), restore_types=sorted(RESTORE_TYPES),
+                           backups=list_backups(), backup_jobs=backup_jobs, keep_backups=KEEP_BACKUPS)
 
 
 @app.route('/add_user', methods=['POST'])
@@ -2926,6 +2931,121 @@ def update_settings():
     flash('Settings updated successfully', 'success')
     return redirect(url_for('settings'))
 
+@app.route('/close_period', methods=['POST'])
+@login_required
+def close_period_route():
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('settings'))
+
+    day = request.form.get('close_date', '').strip()
+    try:
+        close_period(day, closed_by=current_user.username)
+        flash(f'Books closed through {day}. Earlier records are now locked.', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(f'Period close failed: {str(e)}', 'danger')
+    return redirect(url_for('settings'))
+
+
+@app.route('/bulk_void', methods=['POST'])
+@login_required
+def bulk_void_route():
+    """Void a selection of documents at once; action=preview (or JSON dry_run) only reports the effect."""
+    wants_json = request.is_json
+    if current_user.role != 'admin':
+        if wants_json:
+            return jsonify({'error': 'Only admin can void transactions'}), 403
+        flash('Only admin can void transactions', 'danger')
+        return redirect(url_for('settings'))
+
+    data = (request.get_json(silent=True) or {}) if wants_json else request.form
+    ids = data.get('ids') or []
+    if isinstance(ids, str):
+        ids = [i.strip() for i in ids.replace('\n', ',').split(',') if i.strip()]
+    dry_run = bool(data.get('dry_run', True)) if wants_json else request.form.get('action') != 'void'
+    try:
+        preview = bulk_void(data.get('doc_type', ''), dry_run=dry_run,
+                            ids=[int(i) for i in ids],
+                            date_from=(data.get('date_from') or '').strip() or None,
+                            date_to=(data.get('date_to') or '').strip() or None,
+                            import_job_id=int(data.get('import_job_id')) if data.get('import_job_id') else None,
+                            bill_pattern=(data.get('bill_pattern') or '').strip() or None)
+    except PeriodClosedError:
+        raise
+    except ValueError as e:
+        db.session.rollback()
+        if wants_json:
+            return jsonify({'error': str(e)}), 400
+        flash(f'Bulk void failed: {str(e)}', 'danger')
+        return redirect(url_for('settings'))
+
+    if wants_json:
+        return jsonify(preview)
+    stock = ', '.join(f"{s['material']} {s['stock_change']:+g}" for s in preview['stock'])
+    summary = (f"{preview['documents']} {preview['doc_type']} ({preview['first_date'] or '-'} to {preview['last_date'] or '-'})"
+               f", {preview['entries']} entries, {preview['pending_bills']} pending bills"
+               f" (Rs.{preview['pending_amount']:.2f})")
+    if preview['allocations']:
+        summary += f", {preview['allocations']} allocations (Rs.{preview['allocated_amount']:.2f}) returned to bills"
+    if preview['released_allocations']:
+        summary += (f", {preview['released_allocations']} allocations (Rs.{preview['released_amount']:.2f})"
+                    f" given back to their payments")
+    if stock:
+        summary += f"; stock back: {stock}"
+    if preview['applied']:
+        flash(f'Voided {summary}', 'success')
+    else:
+        flash(f'Preview — would void {summary}', 'info')
+    return redirect(url_for('settings'))
+
+
+@app.route('/archive', methods=['POST'])
+@login_required
+def archive_route():
+    """Move voided and closed-period rows into the archive as a background job."""
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('settings'))
+
+    cutoff = archive_cutoff(request.form.get('before', '').strip() or None)
+    job_id = start_job('archive', archive_job, cutoff, created_by=current_user.username,
+                       total=sum(archive_plan(cutoff).values()))
+    flash(f"Archiving started (job #{job_id}): voided records"
+          f"{f' and live records through {cutoff}' if cutoff else ''}.", 'info')
+    return redirect(url_for('settings'))
+
+
+@app.route('/backup', methods=['POST'])
+@login_required
+def backup_route():
+    """Take an online snapshot of the database as a background job."""
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('settings'))
+
+    job_id = start_job('backup', backup_job, created_by=current_user.username, total=100)
+    flash(f'Backup started (job #{job_id}). Progress is shown below.', 'info')
+    return redirect(url_for('settings'))
+
+
+@app.route('/restore_archived', methods=['POST'])
+@login_required
+def restore_archived():
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('settings'))
+
+    doc_type = request.form.get('doc_type', '')
+    try:
+        restored = restore_document(doc_type, int(request.form.get('doc_id') or 0))
+        flash('Restored ' + ', '.join(f'{n} {name}' for name, n in restored.items()), 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(f'Restore failed: {str(e)}', 'danger')
+    return redirect(request.referrer or url_for('settings'))
+
+
 @app.route('/delete_selected_data', methods=['POST'])
 @login_required
 def delete_selected_data():
@@ -2941,41 +3061,16 @@ def delete_selected_data():
         flash('No datasets selected for deletion', 'warning')
         return redirect(url_for('settings'))
 
-    try:
-        deleted_info = []
-        if 'clients' in targets:
-            Client.query.delete()
-            deleted_info.append('Clients')
-        if 'pending_bills' in targets:
-            PendingBill.query.delete()
-            deleted_info.append('Pending Bills')
-        if 'dispatching' in targets:
-            Entry.query.filter_by(type='OUT').delete()
-            deleted_info.append('Dispatching Entries')
-        if 'receiving' in targets:
-            Entry.query.filter_by(type='IN').delete()
-            deleted_info.append('Receiving Entries')
-        if 'materials' in targets:
-            Material.query.delete()
-            deleted_info.append('Materials')
-        if 'direct_sales' in targets:
-            DirectSaleItem.query.delete()
-            DirectSale.query.delete()
-            deleted_info.append('Direct Sales')
-        if 'payments' in targets:
-            Payment.query.delete()
-            deleted_info.append('Payments')
-        if 'bookings' in targets:
-            BookingItem.query.delete()
-            Booking.query.delete()
-            deleted_info.append('Bookings')
-
-        db.session.commit()
-        flash(f'Data Wiped: {", ".join(deleted_info)}', 'danger')
-    except Exception as e:
-        db.session.rollback()
-        flash(f'Wipe failed: {str(e)}', 'danger')
-
+    targets = [t for t in targets if t in PURGE_TARGETS]
+    if not targets:
+        flash('None of the selected datasets can be wiped.', 'danger')
+        return redirect(url_for('settings'))
+    assert_open(purge_dates(targets)[0])  # the chunked deletes bypass the period lock
+    # a full VACUUM would block every request while it runs; that one is CLI only (flask vacuum)
+    reclaim = 'incremental' if request.form.get('reclaim') == 'incremental' else None
+    # deleted in short id-ordered chunks in the background, so counters keep working meanwhile
+    job_id = start_job('purge', purge, targets, reclaim, created_by=current_user.username, total=purge_size(targets))
+    flash(f'Wipe started (job #{job_id}): {", ".join(TARGET_LABELS[t] for t in targets)}. Progress is shown below.', 'warning')
     return redirect(url_for('settings'))
 
 
@@ -2995,10 +3090,10 @@ def generate_dummy_data():
     import random
     
     # 1. Ensure 20 Materials
-    for i in range(1, 21):
-        name = f"Cement Brand {i}"
-        if not Material.query.filter_by(name=name).first():
-            db.session.add(Material(name=name, code=generate_material_code()))
+    existing_names = {m.name for m in Material.query.with_entities(Material.name)}
+    missing = [f"Cement Brand {i}" for i in range(1, 21) if f"Cement Brand {i}" not in existing_names]
+    for name, code in zip(missing, reserve_codes('material', len(missing))):
+        db.session.add(Material(name=name, code=code))
     db.session.commit()
     materials = Material.query.all()
     
@@ -3006,10 +3101,11 @@ def generate_dummy_data():
     current_count = Client.query.count()
     cats = ['General', 'Credit Customer', 'Booking Customer', 'Walking-Customer']
     if current_count < 500:
-        for i in range(current_count, 500):
+        codes = reserve_codes('client', 500 - current_count)
+        for i, code in zip(range(current_count, 500), codes):
             db.session.add(Client(
                 name=f"Client {i+1}",
-                code=generate_client_code(),
+                code=code,
                 category=random.choice(cats),
                 phone=f"0300-{random.randint(1000000, 9999999)}",
                 is_active=True
@@ -3053,7 +3149,6 @@ def generate_dummy_data():
                 disp_q = int(q * random.uniform(0.1, 1.0))
                 if disp_q > 0:
                     db.session.add(Entry(date=date.today().strftime('%Y-%m-%d'), time="12:00:00", type='OUT', material=m.name, client=client.name, client_code=client.code, qty=disp_q, bill_no=bill_no, nimbus_no="Auto Dispatch", client_category="Booking Delivery", created_by='admin'))
-                    m.total = (m.total or 0) - disp_q
 
     # 4. Direct Sales (Random Cash/Credit/Unbilled)
     for _ in range(50):
@@ -3073,7 +3168,6 @@ def generate_dummy_data():
         db.session.add(DirectSaleItem(sale_id=ds.id, product_name=m.name, qty=qty, price_at_time=rate))
         
         db.session.add(Entry(date=date.today().strftime('%Y-%m-%d'), time="12:00:00", type='OUT', material=m.name, client=client.name, client_code=client.code, qty=qty, bill_no=bill_no, nimbus_no="Direct Sale", client_category=sale_type, created_by='admin'))
-        m.total = (m.total or 0) - qty
         
         if amt > paid:
             db.session.add(PendingBill(client_code=client.code, client_name=client.name, bill_no=bill_no, amount=amt-paid, reason="Auto Sale", created_at=datetime.now().strftime('%Y-%m-%d %H:%M'), created_by='admin'))
@@ -3085,6 +3179,26 @@ def generate_dummy_data():
 
 # ==================== GRN ROUTES ====================
 
+def grn_entries(grn_obj):
+    """Query of the receiving entries a GRN posted, or None when they cannot be told apart.
+
+    GRNs carry an auto bill number on their entries. Legacy ones without it
+    are matched on supplier, bill number and date, and only when those
+    entries are exactly the GRN's items.
+    """
+    if grn_obj.auto_bill_no:
+        return Entry.query.filter_by(type='IN', auto_bill_no=grn_obj.auto_bill_no)
+    if not grn_obj.date_posted:
+        return None
+    query = Entry.query.filter(Entry.type == 'IN', or_(Entry.auto_bill_no.is_(None), Entry.auto_bill_no == ''),
+                               Entry.client == grn_obj.supplier, Entry.bill_no == (grn_obj.manual_bill_no or ''),
+                               Entry.date == grn_obj.date_posted.strftime('%Y-%m-%d'))
+    found = sorted((e.material, float(e.qty or 0)) for e in query.filter(or_(Entry.is_void == False,
+                                                                             Entry.is_void.is_(None))))
+    items = sorted((i.mat_name, float(i.qty or 0)) for i in grn_obj.items if i.mat_name and i.qty)
+    return query if found == items else None
+
+
 @app.route('/grn', methods=['GET', 'POST'])
 @login_required
 def grn():
@@ -3112,11 +3226,7 @@ def grn():
                     price_val = float(price) if price else 0
                     item = GRNItem(grn_id=new_grn.id, mat_name=name, qty=qty_val, price_at_time=price_val)
                     db.session.add(item)
-                    
-                    mat = Material.query.filter_by(name=name).first()
-                    if mat:
-                        mat.total += qty_val
-                    
+
                     entry = Entry(
                         date=datetime.now().strftime('%Y-%m-%d'),
                         time=datetime.now().strftime('%H:%M:%S'),
@@ -3137,10 +3247,13 @@ def grn():
             grn_id = request.form.get('id')
             grn_obj = GRN.query.get(grn_id)
             if grn_obj:
-                for item in grn_obj.items:
-                    mat = Material.query.filter_by(name=item.mat_name).first()
-                    if mat:
-                        mat.total -= item.qty
+                # the receiving entries go with the GRN, and take its stock with them
+                entries = grn_entries(grn_obj)
+                if entries is None:
+                    flash('Cannot delete this GRN: its receiving entries could not be matched. '
+                          'Void or delete them from the stock history first.', 'danger')
+                    return redirect(url_for('grn'))
+                delete_entries(entries)
                 db.session.delete(grn_obj)
                 db.session.commit()
                 flash('GRN deleted successfully!', 'success')
@@ -3162,6 +3275,18 @@ try:
 except ImportError:
     pass  # Blueprints not available
 
+try:
+    from blueprints import data_lab
+    app.register_blueprint(data_lab.bp, url_prefix=data_lab.MODULE_CONFIG['url_prefix'])
+except ImportError:
+    pass
+
+try:
+    from blueprints import admin
+    app.register_blueprint(admin.admin_bp, url_prefix=admin.MODULE_CONFIG['url_prefix'])
+except ImportError:
+    pass
+
 
 # ==================== MAIN ====================
 
@@ -3170,6 +3295,7 @@ if __name__ == '__main__':
         db.create_all()
         _ensure_user_password_column()
         _ensure_model_columns()
+        _ensure_model_indexes()
         
         if not User.query.filter_by(username='admin').first():
             db.session.add(
@@ -22,6 +22,7 @@ class Client(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(50), unique=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of name
     phone = db.Column(db.String(20))
     address = db.Column(db.String(200))
     category = db.Column(db.String(50), default='General')
@@ -35,20 +36,27 @@ class Material(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(50), unique=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of name
     unit_price = db.Column(db.Float, default=0)
-    total = db.Column(db.Float, default=0)
+    total = db.Column(db.Float, default=0)  # stock in hand; written only by utils.stock
+    total_in = db.Column(db.Float, default=0)
+    total_out = db.Column(db.Float, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
 
 
 class Entry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.String(20))
+    date = db.Column(db.String(20), index=True)
     time = db.Column(db.String(20))
     type = db.Column(db.String(10))  # 'IN' or 'OUT'
-    material = db.Column(db.String(100))
-    client = db.Column(db.String(100))
+    material = db.Column(db.String(100))  # display name, linked by material_id
+    client = db.Column(db.String(100))  # display name, linked by client_id
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of client
     client_code = db.Column(db.String(50))
     client_category = db.Column(db.String(50))
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), index=True)
     qty = db.Column(db.Float, default=0)
     bill_no = db.Column(db.String(50))
     auto_bill_no = db.Column(db.String(50))
@@ -57,9 +65,86 @@ class Entry(db.Model):
     created_by = db.Column(db.String(80))
     created_at = db.Column(db.DateTime, default=datetime.now)
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
+    import_job_id = db.Column(db.Integer, index=True)  # BackgroundJob of the file import that created it
+
+
+class StockDaily(db.Model):
+    """Per-material stock movement for one day and the stock left at its end; kept by utils.stock."""
+    __table_args__ = (db.Index('uq_stock_daily_material_date', 'material_id', 'date', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
+    date = db.Column(db.String(20), nullable=False)
+    qty_in = db.Column(db.Float, nullable=False, default=0)
+    qty_out = db.Column(db.Float, nullable=False, default=0)
+    closing = db.Column(db.Float, nullable=False, default=0)
+
+
+class FinanceDaily(db.Model):
+    """Cash taken and credit given per day, client and document kind; kept by utils.finance."""
+    __table_args__ = (
+        db.Index('ix_finance_daily_key', 'date', 'client_id', 'kind', 'category'),
+        db.Index('ix_finance_daily_client_date', 'client_id', 'date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.String(10), nullable=False)  # YYYY-MM-DD of date_posted
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))  # NULL for walk-in customers
+    kind = db.Column(db.String(20), nullable=False)  # 'booking', 'payment' or 'sale'
+    category = db.Column(db.String(50), nullable=False, default='')  # DirectSale.category for sales
+    cash = db.Column(db.Float, nullable=False, default=0)
+    credit = db.Column(db.Float, nullable=False, default=0)
+
+
+class ClientBalanceSnapshot(db.Model):
+    """A client's balance (debits less credits) at the end of `date`; kept current by utils.journal."""
+    __table_args__ = (db.Index('uq_client_balance_snapshot_client_date', 'client_id', 'date', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    date = db.Column(db.String(10), nullable=False)
+    balance = db.Column(db.Float, nullable=False, default=0)
+
+
+class JournalLine(db.Model):
+    """Append-only client posting of a booking, payment or sale; see utils.journal"""
+    __table_args__ = (
+        db.Index('ix_journal_line_client_date', 'client_id', 'date'),
+        db.Index('ix_journal_line_doc', 'doc_type', 'doc_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.DateTime, nullable=False)  # the document's date_posted
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
+    doc_type = db.Column(db.String(20), nullable=False)  # 'booking', 'payment', 'sale'
+    doc_id = db.Column(db.Integer, nullable=False)
+    debit = db.Column(db.Float, nullable=False, default=0)  # billed to the client
+    credit = db.Column(db.Float, nullable=False, default=0)  # paid by the client
+    posted_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class PeriodClose(db.Model):
+    """A closed period: nothing dated on or before `close_date` may change (see utils.period)."""
+    id = db.Column(db.Integer, primary_key=True)
+    close_date = db.Column(db.String(10), unique=True, nullable=False)
+    closed_by = db.Column(db.String(80))
+    closed_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class ClientMaterialOpening(db.Model):
+    """Per client and material at a period close: booking balance left and qty of stock entries so far."""
+    __table_args__ = (db.Index('uq_client_material_opening', 'close_date', 'client_id', 'material', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    close_date = db.Column(db.String(10), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    material = db.Column(db.String(100), nullable=False)
+    balance = db.Column(db.Float, nullable=False, default=0)
+    qty = db.Column(db.Float, nullable=False, default=0)
 
 
 class PendingBill(db.Model):
+    __table_args__ = (
+        db.Index('uq_pending_bill_bill_client', 'bill_no', 'client_code', unique=True),
+        db.Index('ix_pending_bill_client_open', 'client_code', 'is_paid', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     client_code = db.Column(db.String(50))
     client_name = db.Column(db.String(100))
@@ -74,37 +159,57 @@ class PendingBill(db.Model):
     created_at = db.Column(db.String(50))
     created_by = db.Column(db.String(80))
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
+    import_job_id = db.Column(db.Integer, index=True)  # BackgroundJob of the file import that created it
+
+
+class PaymentAllocation(db.Model):
+    """The part of a payment applied to a pending bill; voided (not deleted) when the payment is reversed"""
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=False, index=True)
+    pending_bill_id = db.Column(db.Integer, db.ForeignKey('pending_bill.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    is_void = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
 
 
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    client_name = db.Column(db.String(100))
+    client_name = db.Column(db.String(100))  # display name, linked by client_id
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of client_name
     amount = db.Column(db.Float, default=0)
     paid_amount = db.Column(db.Float, default=0)
     manual_bill_no = db.Column(db.String(50))
     photo_path = db.Column(db.String(200))
-    date_posted = db.Column(db.DateTime, default=datetime.now)
+    date_posted = db.Column(db.DateTime, default=datetime.now, index=True)
     items = db.relationship('BookingItem', backref='booking', lazy=True, cascade='all, delete-orphan')
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
 
 
 class BookingItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), nullable=False)
     material_name = db.Column(db.String(100))
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), index=True)
     qty = db.Column(db.Float, default=0)
     price_at_time = db.Column(db.Float, default=0)
 
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    client_name = db.Column(db.String(100))
+    client_name = db.Column(db.String(100))  # display name, linked by client_id
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of client_name
     amount = db.Column(db.Float, default=0)
     method = db.Column(db.String(50))  # 'Cash', 'Bank Transfer', 'Cheque', etc.
     manual_bill_no = db.Column(db.String(50))
     photo_path = db.Column(db.String(200))
-    date_posted = db.Column(db.DateTime, default=datetime.now)
+    date_posted = db.Column(db.DateTime, default=datetime.now, index=True)
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
 
 
 class Invoice(db.Model):
@@ -121,6 +226,7 @@ class Invoice(db.Model):
     created_at = db.Column(db.String(50))
     created_by = db.Column(db.String(80))
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
     
     # Relationships
     entries = db.relationship('Entry', backref='invoice', lazy=True)
@@ -128,13 +234,31 @@ class Invoice(db.Model):
 
 
 class BillCounter(db.Model):
+    """Next number to hand out for a bill/invoice prefix (see utils.sequences)."""
+    __table_args__ = (db.Index('uq_bill_counter_prefix', 'prefix', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     count = db.Column(db.Integer, default=1000)
+    prefix = db.Column(db.String(10))
+
+
+class CodeSequence(db.Model):
+    """Last number handed out for each generated code series (tmpc-, tmpm-)."""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CacheVersion(db.Model):
+    """Change counter for a cached table; workers reload their copy when it moves."""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
 
 
 class DirectSale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    client_name = db.Column(db.String(100))
+    client_name = db.Column(db.String(100))  # display name, linked by client_id
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
+    name_key = db.Column(db.String(100), index=True)  # utils.names.name_key of client_name
     category = db.Column(db.String(50))
     amount = db.Column(db.Float, default=0)
     paid_amount = db.Column(db.Float, default=0)
@@ -142,15 +266,17 @@ class DirectSale(db.Model):
     auto_bill_no = db.Column(db.String(50))
     photo_path = db.Column(db.String(200))
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=True)
-    date_posted = db.Column(db.DateTime, default=datetime.now)
+    date_posted = db.Column(db.DateTime, default=datetime.now, index=True)
     items = db.relationship('DirectSaleItem', backref='direct_sale', lazy=True, cascade='all, delete-orphan')
     is_void = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)  # utils.integrity
 
 
 class DirectSaleItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sale_id = db.Column(db.Integer, db.ForeignKey('direct_sale.id'), nullable=False)
     product_name = db.Column(db.String(100))
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), index=True)
     qty = db.Column(db.Float, default=0)
     price_at_time = db.Column(db.Float, default=0)
 
@@ -171,6 +297,7 @@ class GRNItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     grn_id = db.Column(db.Integer, db.ForeignKey('grn.id'), nullable=False)
     mat_name = db.Column(db.String(100))
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), index=True)
     qty = db.Column(db.Float, default=0)
     price_at_time = db.Column(db.Float, default=0)
 
@@ -190,6 +317,7 @@ class DeliveryItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     delivery_id = db.Column(db.Integer, db.ForeignKey('delivery.id'), nullable=False)
     product = db.Column(db.String(100))
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), index=True)
     qty = db.Column(db.Float, default=0)
 
 
@@ -204,4 +332,101 @@ class Settings(db.Model):
     tax_rate = db.Column(db.Float, default=0)
     invoice_prefix = db.Column(db.String(10), default='INV-')
     bill_prefix = db.Column(db.String(10), default='#')
-    allow_global_negative_stock = db.Column(db.Boolean, default=False, nullable=False)
\ No newline at end of file
+    allow_global_negative_stock = db.Column(db.Boolean, default=False, nullable=False)
+
+class ReconBasket(db.Model):
+    """Data Lab reconciliation rows waiting for review"""
+    __table_args__ = (
+        db.Index('ix_recon_basket_status_bill', 'status', 'bill_no'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    bill_no = db.Column(db.String(50))
+    fin_client = db.Column(db.String(100))
+    inv_client = db.Column(db.String(100))
+    inv_material = db.Column(db.String(100))
+    inv_qty = db.Column(db.Float, default=0)
+    inv_date = db.Column(db.String(20))
+    status = db.Column(db.String(10))  # 'GREEN', 'YELLOW', 'RED', 'BLUE'
+    match_score = db.Column(db.Integer, default=0)
+    suggested_code = db.Column(db.String(50))  # closest Client directory match
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class ReconBillState(db.Model):
+    """Fingerprint of the finance/dispatch rows last reconciled for a bill"""
+    id = db.Column(db.Integer, primary_key=True)
+    bill_no = db.Column(db.String(50), unique=True, nullable=False)
+    fin_hash = db.Column(db.String(40))
+    inv_hash = db.Column(db.String(40))
+    status = db.Column(db.String(10))
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class BackgroundJob(db.Model):
+    """Progress record for long-running work started from a request"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50))
+    status = db.Column(db.String(20), default='PENDING')  # 'PENDING', 'RUNNING', 'DONE', 'FAILED'
+    total = db.Column(db.Integer, default=0)
+    done = db.Column(db.Integer, default=0)
+    message = db.Column(db.String(500))
+    created_by = db.Column(db.String(80))
+    started_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+
+class IdempotencyKey(db.Model):
+    """The response sent for a client-chosen request key, so a retried POST is answered instead of repeated"""
+    __table_args__ = (db.Index('uq_idempotency_key_user', 'user_id', 'endpoint', 'key', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    endpoint = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text)  # JSON body
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class MaintenanceJob(db.Model):
+    """Cadence override and on/off switch for a registered maintenance job (utils.maintenance)"""
+    name = db.Column(db.String(50), primary_key=True)
+    every = db.Column(db.Integer)  # seconds between runs; None keeps the registered default
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+    first_run = db.Column(db.DateTime)  # when a job that has never run is first due
+
+
+class MaintenanceRun(db.Model):
+    """One run of a maintenance job"""
+    __table_args__ = (db.Index('ix_maintenance_run_job', 'job', 'started_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(50), nullable=False)
+    trigger = db.Column(db.String(20))  # 'schedule' or the admin who ran it
+    status = db.Column(db.String(20), default='RUNNING')  # 'RUNNING', 'DONE', 'FAILED'
+    message = db.Column(db.String(500))
+    worker = db.Column(db.String(100))
+    started_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+
+class SchedulerLease(db.Model):
+    """The worker process currently running a scheduler; it renews expires_at every tick"""
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime)
+
+
+class IntegrityCheck(db.Model):
+    """One run of utils.integrity; the last clean or repaired run is the watermark for incremental checks"""
+    id = db.Column(db.Integer, primary_key=True)
+    mode = db.Column(db.String(20))  # 'full' or 'incremental'
+    repair = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), default='RUNNING')  # 'RUNNING', 'DONE', 'FAILED'
+    checked = db.Column(db.Integer, default=0)  # rows compared
+    drift = db.Column(db.Integer, default=0)
+    repaired = db.Column(db.Integer, default=0)
+    details = db.Column(db.Text)  # JSON list of the first drifted rows
+    created_by = db.Column(db.String(80))
+    started_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
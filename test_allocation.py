@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests for payment allocation (utils.allocation): oldest-first splits,
+bill-number targeting, reversal and releasing bills before they are voided.
+Run: python -m pytest test_allocation.py
+"""
+
+from datetime import datetime
+
+import pytest
+
+from models import db, PendingBill, Payment, PaymentAllocation
+from utils.allocation import allocate_payment, reverse_allocations, release_bills, has_allocations
+
+
+@pytest.fixture
+def bills(client):
+    rows = [PendingBill(client_code='C1', client_name='Client One', bill_no=no, amount=amount)
+            for no, amount in (('B1', 100), ('B2', 50), ('B3', 70))]
+    db.session.add_all(rows)
+    db.session.commit()
+    return rows
+
+
+def pay(amount):
+    payment = Payment(client_name='Client One', amount=amount, date_posted=datetime(2026, 3, 2))
+    db.session.add(payment)
+    db.session.flush()
+    return payment
+
+
+def amounts():
+    return [(b.bill_no, b.amount, b.is_paid) for b in PendingBill.query.order_by(PendingBill.id)]
+
+
+def live_allocations():
+    return sorted((a.payment_id, a.pending_bill_id, a.amount)
+                  for a in PaymentAllocation.query.filter_by(is_void=False))
+
+
+def test_allocates_oldest_bill_first(bills):
+    payment = pay(120)
+    assert allocate_payment(payment.id, 120, 'C1') == [('B1', 100, True), ('B2', 20, False)]
+    db.session.commit()
+    db.session.expire_all()
+    assert amounts() == [('B1', 0, True), ('B2', 30, False), ('B3', 70, False)]
+    assert live_allocations() == [(payment.id, bills[0].id, 100), (payment.id, bills[1].id, 20)]
+
+
+def test_overpayment_leaves_an_advance(bills):
+    payment = pay(500)
+    applied = allocate_payment(payment.id, 500, 'C1')
+    assert sum(a for _, a, _ in applied) == 220
+    assert all(paid for _, _, paid in applied)
+
+
+def test_bill_number_limits_allocation(bills):
+    payment = pay(30)
+    assert allocate_payment(payment.id, 30, 'C1', bill_no='B3') == [('B3', 30, False)]
+    assert allocate_payment(pay(10).id, 10, 'C1', bill_no='B9') == []
+
+
+def test_reverse_allocations_puts_the_money_back(bills):
+    first, second = pay(120), pay(40)
+    allocate_payment(first.id, 120, 'C1')
+    allocate_payment(second.id, 40, 'C1')
+    db.session.commit()
+
+    assert reverse_allocations([first.id]) == 2
+    db.session.commit()
+    db.session.expire_all()
+    assert amounts() == [('B1', 100, False), ('B2', 20, False), ('B3', 60, False)]
+    assert live_allocations() == [(second.id, bills[1].id, 30), (second.id, bills[2].id, 10)]
+    assert reverse_allocations([first.id]) == 0  # already reversed
+
+
+def test_release_bills_hands_allocations_back_to_payments(bills):
+    payment = pay(120)
+    allocate_payment(payment.id, 120, 'C1')
+    db.session.commit()
+
+    assert release_bills([bills[0].id]) == 1
+    db.session.commit()
+    db.session.expire_all()
+    assert amounts()[0] == ('B1', 100, False)
+    assert live_allocations() == [(payment.id, bills[1].id, 20)]
+    assert has_allocations(bills[0].id)  # the voided row still records the split
+    assert not has_allocations(bills[2].id)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Tests for the archive (utils.archive): what moves to archive.db, figures
+that read hot and archived rows together staying the same, and restores.
+Run: python -m pytest test_archive.py
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, select, func
+
+from models import db, Booking, BookingItem, Payment, Entry
+from utils.archive import (archive_rows, archive_plan, archive_table, ensure_archive_schema, restore_document,
+                           with_archive)
+from utils.finance import verify_finance
+from utils.journal import client_totals, verify_journal
+from utils.period import close_period
+from utils.stock import verify_stock
+
+
+@pytest.fixture
+def archived(app, tmp_path, client, opc):
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.execute('ATTACH DATABASE ? AS archive', (str(tmp_path / 'archive.db'),))
+
+    event.listen(db.engine, 'connect', attach)
+    db.session.remove()
+    db.engine.dispose()
+    assert ensure_archive_schema()
+
+    old = Booking(client_name='Client One', amount=500, date_posted=datetime(2026, 1, 10, 10, 0))
+    old.items.append(BookingItem(material_name='OPC', qty=50, price_at_time=10))
+    new = Booking(client_name='Client One', amount=300, date_posted=datetime(2026, 2, 10, 10, 0))
+    new.items.append(BookingItem(material_name='OPC', qty=30, price_at_time=10))
+    db.session.add_all([
+        old,
+        new,
+        Payment(client_name='Client One', amount=100, date_posted=datetime(2026, 2, 11, 10, 0), is_void=True),
+        Payment(client_name='Client One', amount=200, date_posted=datetime(2026, 2, 12, 10, 0)),
+        Entry(date='2026-01-12', type='OUT', client='Client One', material='OPC', qty=10),
+        Entry(date='2026-02-12', type='OUT', client='Client One', material='OPC', qty=5),
+    ])
+    db.session.commit()
+    close_period('2026-01-31')
+    return old.id
+
+
+def archived_count(model):
+    return db.session.execute(select(func.count()).select_from(archive_table(model))).scalar()
+
+
+def test_archive_moves_voided_and_closed_rows(archived, client):
+    totals = client_totals()
+    assert archive_plan('2026-01-31') == {'Entry': 1, 'Booking': 1, 'Payment': 1, 'DirectSale': 0, 'PendingBill': 0}
+    assert archive_rows('2026-01-31') == {'Entry': 1, 'Booking': 1, 'Payment': 1, 'DirectSale': 0, 'PendingBill': 0}
+    assert [b.amount for b in Booking.query] == [300]
+    assert [p.amount for p in Payment.query] == [200]
+    assert [e.qty for e in Entry.query] == [5]
+    assert (archived_count(Booking), archived_count(BookingItem), archived_count(Payment)) == (1, 1, 1)
+    assert db.session.query(func.count()).select_from(with_archive(Entry)).scalar() == 2
+    assert verify_stock() == []
+    assert verify_finance() == []
+    assert verify_journal() == []
+    assert client_totals() == totals
+
+
+def test_only_closed_periods_are_archived(archived):
+    with pytest.raises(ValueError):
+        archive_rows('2026-02-28')
+
+
+def test_restore_brings_a_document_back(archived):
+    archive_rows('2026-01-31')
+    assert restore_document('Booking', archived) == {'Booking': 1}
+    assert sorted(b.amount for b in Booking.query) == [300, 500]
+    assert sorted(i.qty for i in BookingItem.query) == [30, 50]
+    assert archived_count(Booking) == archived_count(BookingItem) == 0
+    with pytest.raises(ValueError):
+        restore_document('Booking', archived)
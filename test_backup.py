@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Tests for the online backup (utils.backup): verified snapshot copies,
+same-second snapshot names and rotation.
+Run: python -m pytest test_backup.py
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+
+from utils.backup import backup_database, list_backups, new_snapshot_folder, rotate_backups
+
+TAKEN = datetime(2026, 3, 2, 10, 0, 0)
+
+
+def test_backup_copies_the_database(client):
+    result = backup_database()
+    copy = os.path.join(result['path'], 'test.db')
+    assert list(result['files']) == ['test.db']
+    assert not [f for f in os.listdir(result['path']) if f.endswith('.partial')]
+    conn = sqlite3.connect(copy)
+    try:
+        assert conn.execute("SELECT code FROM client").fetchall() == [('C1',)]
+    finally:
+        conn.close()
+
+
+def test_snapshots_in_the_same_second_get_a_suffix(app):
+    names = [os.path.basename(new_snapshot_folder(TAKEN)) for _ in range(3)]
+    assert names == ['20260302-100000', '20260302-100000-01', '20260302-100000-02']
+    listed = list_backups()
+    assert [b['name'] for b in listed] == list(reversed(names))
+    assert {b['created'] for b in listed} == {TAKEN}
+
+
+def test_back_to_back_backups_both_succeed(client):
+    first, second = backup_database(), backup_database()
+    assert first['name'] != second['name']
+    assert len(list_backups()) == 2
+
+
+def test_rotation_keeps_the_newest(app):
+    for second in range(4):
+        new_snapshot_folder(TAKEN.replace(second=second))
+    assert rotate_backups(keep=2) == ['20260302-100001', '20260302-100000']
+    assert [b['name'] for b in list_backups()] == ['20260302-100003', '20260302-100002']
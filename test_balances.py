@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Tests for client balances (utils.journal): as-of balances and the
+snapshots they start from, which are kept from journal lines only.
+Run: python -m pytest test_balances.py
+"""
+
+from datetime import datetime
+
+from models import db, Booking, Payment, ClientBalanceSnapshot
+from utils.journal import (take_balance_snapshots, balance_as_of, latest_snapshot, client_balance,
+                           verify_journal, reverse_deleted)
+from sqlalchemy import text
+
+
+def post(model, day, **fields):
+    doc = model(client_name='Client One', date_posted=datetime.strptime(day, '%Y-%m-%d').replace(hour=10), **fields)
+    db.session.add(doc)
+    db.session.commit()
+    return doc
+
+
+def snapshots():
+    return [(s.date, s.balance) for s in ClientBalanceSnapshot.query.order_by(ClientBalanceSnapshot.date)]
+
+
+def test_balance_as_of_reads_snapshot_and_later_lines(client):
+    post(Booking, '2026-01-10', amount=1000, paid_amount=100)
+    post(Payment, '2026-01-20', amount=300)
+    assert take_balance_snapshots('2026-01-31') == 1
+    db.session.commit()
+    post(Payment, '2026-02-05', amount=200)
+
+    assert snapshots() == [('2026-01-31', 600)]
+    assert balance_as_of(client.id, '2026-01-15') == 900
+    assert balance_as_of(client.id, '2026-01-31') == 600
+    assert balance_as_of(client.id, '2026-02-28') == 400 == client_balance(client.id)
+
+
+def test_back_dated_postings_shift_later_snapshots(client):
+    post(Booking, '2026-01-10', amount=1000, paid_amount=0)
+    take_balance_snapshots('2026-01-31')
+    take_balance_snapshots('2026-02-28')
+    db.session.commit()
+
+    payment = post(Payment, '2026-01-20', amount=250)
+    assert snapshots() == [('2026-01-31', 750), ('2026-02-28', 750)]
+    payment.date_posted = datetime(2026, 2, 10)
+    db.session.commit()
+    assert snapshots() == [('2026-01-31', 1000), ('2026-02-28', 750)]
+    assert latest_snapshot(client.id, '2026-02-15').date == '2026-01-31'
+    assert balance_as_of(client.id, '2026-02-15') == 750
+
+
+def test_snapshots_follow_journal_repair_and_reversal(client):
+    post(Booking, '2026-01-10', amount=1000, paid_amount=0)
+    post(Payment, '2026-01-12', amount=400)
+    take_balance_snapshots('2026-01-31')
+    db.session.commit()
+
+    db.session.execute(text("DELETE FROM payment"))  # bypasses the flush hooks
+    assert reverse_deleted('payment') == 1
+    db.session.commit()
+    assert snapshots() == [('2026-01-31', 1000)]
+
+    db.session.execute(text("UPDATE booking SET amount = 1200"))
+    db.session.commit()
+    verify_journal(repair=True)
+    assert snapshots() == [('2026-01-31', 1200)]
+    assert balance_as_of(client.id, '2026-01-31') == 1200
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Tests for typed-client resolution (utils.clients): exact and fuzzy
+lookups through the cached directory and its reload when clients change.
+Run: python -m pytest test_clients.py
+"""
+
+from models import db, Client
+from utils.clients import client_directory, find_client, find_clients
+
+
+def test_exact_lookups(client):
+    assert find_client('C1') == client
+    assert find_client('Client One') == client
+    assert find_client('  client   ONE ') == client
+    assert find_client('c1') == client
+    assert find_client('Someone', code='C1') == client
+    assert find_client('Nobody') is None
+    assert find_client('') is None
+
+
+def test_fuzzy_lookups_rank_prefixes_and_active_clients(client):
+    db.session.add_all([Client(code='C2', name='Client Onerous', is_active=False),
+                        Client(code='C3', name='Big Client One Traders')])
+    db.session.commit()
+    assert find_client('client on') is None
+    assert find_client('client on', fuzzy=True) == client
+    assert find_client('one traders', fuzzy=True).code == 'C3'
+    assert find_client('Clinet One', fuzzy=True) == client
+
+
+def test_directory_reloads_only_when_clients_change(client):
+    directory = client_directory()
+    assert client_directory() is directory
+    db.session.add(Client(code='C2', name='Client Two'))
+    db.session.commit()
+    assert client_directory() is not directory
+    assert find_client('Client Two').code == 'C2'
+    client.name = 'Client Uno'
+    db.session.commit()
+    assert find_client('Client Uno') == client
+    assert find_client('Client One') is None
+
+
+def test_find_clients_resolves_many_at_once(client):
+    found = find_clients([('Client One', None), ('x', 'C1'), ('Nobody', None), ('client on', None)], fuzzy=True)
+    assert found == {('Client One', None): client, ('x', 'C1'): client, ('Nobody', None): None,
+                     ('client on', None): client}
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Tests for incremental Data Lab reconciliation (blueprints.data_lab):
+only bills and unbilled groups whose rows changed since the last upload
+are re-classified and their basket rows replaced.
+Run: python -m pytest test_data_lab.py
+"""
+
+from models import db, Entry, ReconBasket, ReconBillState
+from blueprints.data_lab import reconcile, apply_outcomes, known_fingerprints
+
+FIN = {'B1': [{'client': 'Client One'}], 'B2': [{'client': 'Client One'}]}
+INV = {'B1': [{'client': 'Client One', 'material': 'OPC', 'qty': 10}]}
+UNBILLED = [{'date': '2026-03-01', 'client': 'Client One', 'material': 'OPC', 'qty': 5},
+            {'date': '2026-03-02', 'client': 'Client One', 'material': 'OPC', 'qty': 7}]
+
+
+def upload(fin, inv, unbilled):
+    bills, outcomes = reconcile(fin, inv, unbilled, known_fingerprints())
+    apply_outcomes(bills, outcomes)
+    db.session.commit()
+    return bills
+
+
+def basket():
+    return sorted((r.bill_no, r.status, r.inv_qty) for r in ReconBasket.query)
+
+
+def test_first_upload_classifies_everything(client, opc):
+    bills = upload(FIN, INV, UNBILLED)
+    assert {b for b in bills if not b.startswith('~')} == {'B1', 'B2'}
+    assert len(bills) == 4  # two bills and two unbilled groups
+    assert [(e.bill_no, e.qty, e.client_id) for e in Entry.query] == [('B1', 10, client.id)]
+    assert basket() == [('', 'BLUE', 5), ('', 'BLUE', 7), ('B2', 'RED', 0)]
+    assert ReconBillState.query.count() == 4
+
+
+def test_unchanged_upload_touches_nothing(client, opc):
+    upload(FIN, INV, UNBILLED)
+    assert upload(FIN, INV, UNBILLED) == {}
+    assert Entry.query.count() == 1
+    assert len(basket()) == 3
+
+
+def test_only_changed_bills_and_groups_are_redone(client, opc):
+    upload(FIN, INV, UNBILLED)
+    inv = dict(INV, B2=[{'client': 'Someone Else', 'material': 'OPC', 'qty': 4}])
+    unbilled = [UNBILLED[0], dict(UNBILLED[1], qty=8)]
+    bills = upload(FIN, inv, unbilled)
+    assert {b for b in bills if not b.startswith('~')} == {'B2'}
+    assert len(bills) == 2
+    assert basket() == [('', 'BLUE', 5), ('', 'BLUE', 8), ('B2', 'YELLOW', 4)]
+    assert Entry.query.count() == 1
+    assert ReconBillState.query.filter_by(bill_no='B2').one().status == 'YELLOW'
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Tests for multi-line booking dispatch (utils.dispatch): lines checked in
+order against what is left of the booking, rejected lines skipped and
+stock moved for the posted ones.
+Run: python -m pytest test_dispatch.py
+"""
+
+from datetime import datetime
+
+import pytest
+
+from models import db, Booking, BookingItem, Entry
+from utils.dispatch import dispatch_lines, booking_balances
+from utils.period import PeriodClosedError, close_period
+
+
+@pytest.fixture
+def booked(client, opc):
+    booking = Booking(client_name='Client One', amount=1000, date_posted=datetime(2026, 3, 1, 10, 0))
+    booking.items.append(BookingItem(material_name='OPC', qty=100, price_at_time=10))
+    db.session.add(booking)
+    db.session.commit()
+    return booking
+
+
+def test_lines_draw_down_the_booking_in_order(booked, client, opc):
+    report = dispatch_lines([
+        {'client': 'Client One', 'material': 'OPC', 'qty': 60, 'bill_no': 'D1'},
+        {'client': 'client one', 'material': 'OPC', 'qty': '50'},
+        {'client': 'Client One', 'material': 'OPC', 'qty': '40', 'bill_no': 'D2'},
+        {'client': 'Walk-in', 'material': 'OPC', 'qty': 1},
+        {'client': 'Client One', 'material': 'Slag', 'qty': 1},
+        {'client': 'Client One', 'material': 'OPC', 'qty': 'ten'},
+    ], '2026-03-02', 'loader')
+    assert [(r['status'], r.get('remaining')) for r in report] == \
+        [('posted', 40), ('error', None), ('posted', 0), ('error', None), ('error', None), ('error', None)]
+    assert report[1]['error'] == 'Cannot dispatch 50.0 bags. Only 40.0 bags available from booking.'
+    assert report[3]['error'].startswith("Unknown client 'Walk-in'")
+    assert report[4]['error'] == "Unknown material 'Slag'"
+    assert [(e.bill_no, e.qty, e.client_id, e.material_id) for e in Entry.query.order_by(Entry.id)] == \
+        [('D1', 60, client.id, opc.id), ('D2', 40, client.id, opc.id)]
+    db.session.refresh(opc)
+    assert (opc.total, opc.total_out) == (-100, 100)
+    assert booking_balances({(client.id, opc.id)}) == {(client.id, opc.id): (100, 100)}
+
+
+def test_closed_days_are_refused(booked):
+    close_period('2026-03-05')
+    with pytest.raises(PeriodClosedError):
+        dispatch_lines([{'client': 'Client One', 'material': 'OPC', 'qty': 1}], '2026-03-02', 'loader')
+    assert Entry.query.count() == 0
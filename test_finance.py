@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for the finance_daily rollup kept by utils.finance and its
+verify_finance repair.
+Run: python -m pytest test_finance.py
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, Booking, Payment, DirectSale
+from utils.finance import verify_finance, finance_totals
+
+DAY = '2026-03-02'
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+def test_documents_keep_finance_daily(client):
+    booking = Booking(client_name='Client One', amount=1000, paid_amount=200, date_posted=POSTED)
+    payment = Payment(client_name='Client One', amount=300, date_posted=POSTED)
+    sale = DirectSale(client_name='Client One', amount=500, paid_amount=500, category='Cash', date_posted=POSTED)
+    db.session.add_all([booking, payment, sale])
+    db.session.commit()
+    assert booking.client_id == client.id  # linked by utils.links before the rollup reads it
+    assert finance_totals(DAY, DAY) == {'booking': (200, 800), 'payment': (300, 0), 'sale': (500, 0)}
+    assert finance_totals(DAY, DAY, by_category=True)[('sale', 'Cash')] == (500, 0)
+
+    payment.amount = 350
+    booking.is_void = True
+    db.session.commit()
+    assert finance_totals(DAY, DAY) == {'booking': (0, 0), 'payment': (350, 0), 'sale': (500, 0)}
+
+    payment.date_posted = datetime(2026, 3, 3)
+    db.session.delete(sale)
+    db.session.commit()
+    assert finance_totals(DAY, DAY) == {'booking': (0, 0), 'payment': (0, 0), 'sale': (0, 0)}
+    assert finance_totals('2026-03-03', '2026-03-03') == {'payment': (350, 0)}
+    assert verify_finance() == []
+
+
+def test_verify_finance_repairs_drift(client):
+    db.session.add(Payment(client_name='Client One', amount=300, date_posted=POSTED))
+    db.session.add(Booking(client_name='Client One', amount=900, paid_amount=100, date_posted=POSTED))
+    db.session.commit()
+    db.session.execute(text("DELETE FROM finance_daily WHERE kind = 'payment'"))
+    db.session.execute(text("UPDATE finance_daily SET credit = 1"))
+    db.session.commit()
+
+    drift = verify_finance()
+    assert sorted((d['key'][2], d['stored'], d['expected']) for d in drift) == [
+        ('booking', (100, 1), (100, 800)), ('payment', (0, 0), (300, 0))]
+
+    verify_finance(repair=True)
+    assert finance_totals(DAY, DAY) == {'booking': (100, 800), 'payment': (300, 0)}
+    assert verify_finance() == []
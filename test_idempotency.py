@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for idempotent JSON writes (utils.idempotency.run_once): replays,
+per-user and per-endpoint keys, and refused payload mismatches.
+Run: python -m pytest test_idempotency.py
+"""
+
+import pytest
+
+from models import db, IdempotencyKey
+from utils.idempotency import run_once
+
+
+def handler(calls, body):
+    def run():
+        calls.append(body)
+        return 201, {'n': len(calls), **body}
+    return run
+
+
+def test_retry_replays_the_stored_response(app):
+    calls = []
+    first = run_once(1, 'direct_sales', 'k1', {'qty': 5}, handler(calls, {'qty': 5}))
+    again = run_once(1, 'direct_sales', 'k1', {'qty': 5}, handler(calls, {'qty': 5}))
+    assert first == (201, {'n': 1, 'qty': 5}, False)
+    assert again == (201, {'n': 1, 'qty': 5}, True)
+    assert len(calls) == 1
+
+
+def test_keys_are_scoped_by_user_and_endpoint(app):
+    calls = []
+    run_once(1, 'direct_sales', 'k1', {'qty': 5}, handler(calls, {'user': 1}))
+    other_user = run_once(2, 'direct_sales', 'k1', {'qty': 5}, handler(calls, {'user': 2}))
+    other_endpoint = run_once(1, 'payments', 'k1', {'qty': 5}, handler(calls, {'endpoint': 'payments'}))
+    assert other_user == (201, {'n': 2, 'user': 2}, False)
+    assert other_endpoint == (201, {'n': 3, 'endpoint': 'payments'}, False)
+    assert IdempotencyKey.query.count() == 3
+
+
+def test_payload_mismatch_is_refused_not_replayed(app):
+    calls = []
+    run_once(1, 'direct_sales', 'k1', {'qty': 5}, handler(calls, {}))
+    status, body, replayed = run_once(1, 'direct_sales', 'k1', {'qty': 6}, handler(calls, {}))
+    assert (status, replayed) == (422, False)
+    assert 'different request' in body['error']
+    assert len(calls) == 1
+
+
+def test_failed_request_releases_its_key(app):
+    def fail():
+        raise ValueError('out of stock')
+
+    with pytest.raises(ValueError):
+        run_once(1, 'direct_sales', 'k1', {'qty': 5}, fail)
+    db.session.rollback()
+    assert run_once(1, 'direct_sales', 'k1', {'qty': 5}, handler([], {}))[2] is False
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Tests for the integrity check (utils.integrity): drift found in material
+totals and pending bill amounts, repairs, and incremental runs.
+Run: python -m pytest test_integrity.py
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from models import db, Booking, Entry, Material, Payment, PendingBill, PaymentAllocation
+from utils.allocation import allocate_payment
+from utils.integrity import verify_integrity
+
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+@pytest.fixture
+def books(client, opc):
+    booking = Booking(client_name='Client One', amount=1000, paid_amount=200, date_posted=POSTED)
+    db.session.add(booking)
+    db.session.add(Entry(date='2026-03-02', type='IN', material='OPC', qty=50))
+    db.session.flush()
+    db.session.add(PendingBill(client_code='C1', client_name='Client One', bill_no=f'BK-{booking.id}', amount=800))
+    db.session.commit()
+    return booking
+
+
+def drift(run):
+    return sorted((r.check, r.field, r.stored, r.expected) for r in run.rows.itertuples())
+
+
+def test_clean_books_have_no_drift(books):
+    run = verify_integrity()
+    assert (run.mode, run.status, run.drift) == ('full', 'DONE', 0)
+    assert run.checked > 0
+
+
+def test_drift_is_reported_and_repaired(books):
+    db.session.execute(text("UPDATE material SET total = 7"))
+    db.session.execute(text("UPDATE pending_bill SET amount = 500"))
+    db.session.commit()
+    run = verify_integrity()
+    assert drift(run) == [('material', 'total', 7, 50), ('pending_bill', 'amount', 500, 800)]
+    assert Material.query.one().total == 7
+
+    run = verify_integrity(repair=True)
+    assert (run.drift, run.repaired) == (2, 2)
+    assert Material.query.one().total == 50
+    assert PendingBill.query.one().amount == 800
+    assert verify_integrity().drift == 0
+
+
+def test_allocations_of_deleted_payments_are_given_back(books):
+    payment = Payment(client_name='Client One', amount=300, date_posted=POSTED)
+    db.session.add(payment)
+    db.session.flush()
+    allocate_payment(payment.id, 300, 'C1')
+    db.session.commit()
+    assert PendingBill.query.one().amount == 500
+    db.session.execute(text("DELETE FROM payment"))
+    db.session.commit()
+    run = verify_integrity(repair=True)
+    assert drift(run) == [('allocation', 'is_void', False, True), ('pending_bill', 'amount', 500, 800)]
+    assert PendingBill.query.one().amount == 800
+    assert PaymentAllocation.query.filter_by(is_void=False).count() == 0
+
+
+def test_incremental_runs_check_only_recent_writes(books):
+    assert verify_integrity().mode == 'full'
+    run = verify_integrity(incremental=True)
+    assert (run.mode, run.checked) == ('incremental', 0)
+    db.session.add(Entry(date='2026-03-03', type='OUT', material='OPC', qty=5))
+    db.session.commit()
+    db.session.execute(text("UPDATE material SET total = 1"))
+    db.session.commit()
+    run = verify_integrity(incremental=True)
+    assert run.mode == 'incremental'
+    assert drift(run) == [('material', 'total', 1, 45)]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Tests for the append-only client journal (utils.journal): postings
+and verify_journal repair.
+Run: python -m pytest test_journal.py
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, Booking, Payment, JournalLine
+from utils.journal import verify_journal, client_totals, document_lines
+
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+def test_journal_is_append_only(client):
+    booking = Booking(client_name='Client One', amount=1000, paid_amount=200, date_posted=POSTED)
+    payment = Payment(client_name='Client One', amount=300, date_posted=POSTED)
+    db.session.add_all([booking, payment])
+    db.session.commit()
+    assert client_totals() == {client.id: (1000, 500)}
+    lines = [(line.id, line.debit, line.credit) for line in JournalLine.query.order_by(JournalLine.id)]
+
+    payment.amount = 400
+    db.session.commit()
+    db.session.delete(booking)
+    db.session.commit()
+
+    # edits and deletes post differences; the earlier lines are untouched
+    assert [(line.id, line.debit, line.credit)
+            for line in JournalLine.query.order_by(JournalLine.id)][:len(lines)] == lines
+    assert JournalLine.query.count() == len(lines) + 2
+    assert client_totals() == {client.id: (0, 400)}
+    assert [(d[0], d[3], d[4]) for d in document_lines(client.id)] == [('payment', 0, 400)]
+    assert verify_journal() == []
+
+
+def test_verify_journal_repairs_drift_once(client):
+    db.session.add(Payment(client_name='Client One', amount=300, date_posted=POSTED))
+    db.session.add(Booking(client_name='Client One', amount=800, paid_amount=0, date_posted=POSTED))
+    db.session.commit()
+    # writes that bypass the flush hooks
+    db.session.execute(text("UPDATE payment SET amount = 250"))
+    db.session.execute(text("DELETE FROM booking"))
+    db.session.commit()
+
+    drift = verify_journal()
+    assert sorted((d['key'][0], d['missing']) for d in drift) == [('booking', (-800, 0)), ('payment', (0, -50))]
+
+    verify_journal(repair=True)
+    assert client_totals() == {client.id: (0, 250)}
+    assert verify_journal() == []
+    posted = JournalLine.query.count()
+    verify_journal(repair=True)
+    assert JournalLine.query.count() == posted  # nothing left to correct: a second repair posts nothing
+
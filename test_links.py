@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Tests for integer client/material links (utils.links): ids filled on
+flush, relinks on rename, backfill of bulk-written rows and renames
+propagated to linked rows.
+Run: python -m pytest test_links.py
+"""
+
+from datetime import datetime
+
+from models import db, Client, Entry, Booking, BookingItem, Payment
+from utils.links import backfill_links, link_client_rows, propagate_client_rename
+
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+def test_flush_links_by_name_and_code(client, opc):
+    booking = Booking(client_name='Client One', amount=100, date_posted=POSTED)
+    booking.items.append(BookingItem(material_name='OPC', qty=2, price_at_time=50))
+    entry = Entry(date='2026-03-02', type='OUT', client='Someone', client_code='C1', material='OPC', qty=1)
+    walk_in = Payment(client_name='Walk-in', amount=10, date_posted=POSTED)
+    db.session.add_all([booking, entry, walk_in])
+    db.session.commit()
+    assert booking.client_id == client.id
+    assert booking.items[0].material_id == opc.id
+    assert (entry.client_id, entry.material_id) == (client.id, opc.id)
+    assert walk_in.client_id is None
+
+
+def test_renamed_client_name_moves_the_link(client):
+    other = Client(code='C2', name='Client Two')
+    db.session.add(other)
+    payment = Payment(client_name='Client One', amount=10, date_posted=POSTED)
+    db.session.add(payment)
+    db.session.commit()
+    payment.client_name = 'Client Two'
+    db.session.commit()
+    assert payment.client_id == other.id
+
+
+def test_backfill_links_rows_written_in_bulk(client, opc):
+    db.session.execute(Entry.__table__.insert(), [
+        {'date': '2026-03-02', 'type': 'OUT', 'client': 'Client One', 'material': 'OPC', 'qty': 1},
+        {'date': '2026-03-02', 'type': 'IN', 'client': 'Supplier', 'material': 'OPC', 'qty': 1},
+    ])
+    db.session.commit()
+    result = backfill_links(batch_size=1)
+    assert result['entry.client_id'] == 1
+    assert result['entry.material_id'] == 2
+    assert [(e.client_id, e.material_id) for e in Entry.query.order_by(Entry.id)] == \
+        [(client.id, opc.id), (None, opc.id)]
+    assert backfill_links()['entry.material_id'] == 0
+
+
+def test_new_client_picks_up_its_rows_and_renames_follow(app):
+    payment = Payment(client_name='later client', amount=10, date_posted=POSTED)
+    db.session.add(payment)
+    db.session.commit()
+    assert payment.client_id is None
+    client = Client(code='C9', name='Later Client')
+    db.session.add(client)
+    db.session.flush()
+    assert link_client_rows(client)['payment'] == 1
+    client.name = 'Renamed Client'
+    propagate_client_rename(client)
+    db.session.commit()
+    db.session.refresh(payment)
+    assert (payment.client_id, payment.client_name, payment.name_key) == (client.id, 'Renamed Client', 'renamed client')
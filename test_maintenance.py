@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests for scheduled maintenance (utils.maintenance): the atomic run
+claim, first runs of new jobs, and the one-time database upgrade.
+Run: python -m pytest test_maintenance.py
+"""
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import text
+
+from models import db, MaintenanceRun, JournalLine, Booking, Material
+import utils.maintenance as maintenance
+from utils.maintenance import _claim_run, run_job, run_due_jobs, job_states, upgrade_database
+
+
+@pytest.fixture
+def jobs(app, monkeypatch):
+    calls = []
+    registry = {'tidy': SimpleNamespace(name='tidy', func=lambda: calls.append(1) or 'tidied', every=3600,
+                                        description='')}
+    monkeypatch.setattr(maintenance, 'JOBS', registry)
+    return calls
+
+
+def test_claim_is_exclusive_while_running(jobs):
+    first = _claim_run('tidy', 'schedule')
+    assert first is not None
+    assert _claim_run('tidy', 'admin') is None
+    with pytest.raises(ValueError, match='already running'):
+        run_job('tidy', 'admin')
+
+    # a RUNNING row older than STALE_AFTER no longer blocks
+    MaintenanceRun.query.filter_by(id=first).update(
+        {'started_at': datetime.now() - maintenance.STALE_AFTER - timedelta(minutes=1)})
+    db.session.commit()
+    assert run_job('tidy', 'admin').status == 'DONE'
+    assert jobs == [1]
+
+
+def test_new_jobs_are_first_due_one_cadence_later(jobs):
+    now = datetime(2026, 3, 2, 12, 0)
+    assert run_due_jobs(now) == []
+    state = job_states(now)[0]
+    assert (state.due, state.next_due) == (False, now + timedelta(hours=1))
+
+    runs = run_due_jobs(now + timedelta(hours=1, minutes=1))
+    assert [r.message for r in runs] == ['tidied']
+    assert jobs == [1]
+
+
+def test_upgrade_runs_once_and_fills_rollups(client, opc):
+    db.session.execute(text("INSERT INTO booking (client_name, amount, paid_amount, date_posted, is_void) "
+                            "VALUES ('Client One', 500, 100, '2026-01-05 10:00:00', 0)"))
+    db.session.execute(text("INSERT INTO entry (date, type, material, qty, is_void) "
+                            "VALUES ('2026-01-05', 'IN', 'OPC', 40, 0)"))
+    db.session.commit()
+
+    assert upgrade_database() is True
+    db.session.expire_all()
+    assert Booking.query.one().client_id == client.id
+    assert db.session.get(Material, opc.id).total == 40
+    assert [(line.debit, line.credit) for line in JournalLine.query] == [(500, 100)]
+    assert db.session.execute(text('PRAGMA auto_vacuum')).scalar() == 2  # incremental
+
+    assert upgrade_database() is False
+    assert JournalLine.query.count() == 1
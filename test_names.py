@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Tests for normalized name keys (utils.names): the key itself, keys kept
+on flush, the backfill for old rows and lookups through the key.
+Run: python -m pytest test_names.py
+"""
+
+from datetime import datetime
+
+from models import db, Client, Payment
+from utils.links import LinkResolver
+from utils.names import name_key, backfill_name_keys
+
+
+def test_name_key_normalizes_case_and_spaces():
+    assert name_key('  Ali   TRADERS ') == 'ali traders'
+    assert name_key('Straße') == name_key('STRASSE')
+    assert name_key('   ') is None
+    assert name_key(None) is None
+
+
+def test_keys_are_kept_on_flush(client):
+    assert client.name_key == 'client one'
+    payment = Payment(client_name='CLIENT  one', amount=10, date_posted=datetime(2026, 3, 2))
+    db.session.add(payment)
+    db.session.commit()
+    assert (payment.name_key, payment.client_id) == ('client one', client.id)
+    client.name = 'Client Uno'
+    db.session.commit()
+    assert client.name_key == 'client uno'
+
+
+def test_backfill_keys_old_rows(app):
+    db.session.execute(Client.__table__.insert(), [{'code': 'C1', 'name': 'Old  Client'}, {'code': 'C2', 'name': 'Two'}])
+    db.session.execute(Payment.__table__.insert(), [{'client_name': None, 'amount': 10}])
+    db.session.commit()
+    result = backfill_name_keys(batch_size=1)
+    assert (result['client'], result['payment']) == (2, 0)
+    assert Client.query.filter_by(name_key='old client').one().code == 'C1'
+    assert backfill_name_keys()['client'] == 0
+
+
+def test_resolver_falls_back_to_the_key(client):
+    resolver = LinkResolver.load(Client)
+    assert resolver.resolve(name='Client One') == client.id
+    assert resolver.resolve(name=' client ONE') == client.id
+    assert resolver.resolve(code='C1', name='Someone Else') == client.id
+    assert resolver.resolve(name='Nobody') is None
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for bulk payment posting (utils.payments): per-row validation,
+client matching, allocation and the reasons a typed bill did not link.
+Run: python -m pytest test_payments.py
+"""
+
+import pytest
+
+from models import db, Client, PendingBill, Payment
+from utils.journal import client_totals
+from utils.payments import post_payments
+
+
+@pytest.fixture
+def bills(client):
+    db.session.add(Client(code='C2', name='Client Two'))
+    db.session.add_all([
+        PendingBill(client_code='C1', client_name='Client One', bill_no='B1', amount=100),
+        PendingBill(client_code='C1', client_name='Client One', bill_no='B2', amount=50, nimbus_no='N2'),
+        PendingBill(client_code='C2', client_name='Client Two', bill_no='B3', amount=70),
+    ])
+    db.session.commit()
+
+
+def test_rows_post_allocate_and_report(bills, client):
+    report = post_payments([
+        {'client_code': 'C1', 'amount': '1,20'},
+        {'client_name': 'client two', 'amount': 30, 'bill_no': 'B3'},
+        {'client_name': '', 'amount': 10},
+        {'client_name': 'Client One', 'amount': 'abc'},
+        {'client_name': 'Client One', 'amount': -5},
+    ])
+    assert [r['status'] for r in report] == ['posted', 'posted', 'error', 'error', 'error']
+    assert [r['row'] for r in report] == [1, 2, 3, 4, 5]
+    assert report[0]['applied'] == [{'bill_no': 'B1', 'amount': 100, 'paid': True},
+                                    {'bill_no': 'B2', 'amount': 20, 'paid': False}]
+    assert report[0]['unapplied'] == 0
+    assert report[1]['applied'] == [{'bill_no': 'B3', 'amount': 30, 'paid': False}]
+    assert report[2]['error'] == 'Client is required'
+    assert Payment.query.count() == 2
+    assert client_totals()[client.id] == (0, 120)
+
+
+def test_unlinked_bills_say_why(bills):
+    report = post_payments([
+        {'client_code': 'C1', 'amount': 10, 'bill_no': '9999'},
+        {'client_code': 'C1', 'amount': 10, 'bill_no': 'B3'},
+        {'client_name': 'Stranger', 'amount': 10, 'bill_no': 'n2'},
+    ])
+    assert all(r['status'] == 'posted' for r in report)
+    assert report[0]['warning'] == "Could not link to Bill '9999' - Bill number not found"
+    assert report[1]['warning'] == "Could not link to Bill 'B3' - Bill belongs to Client Two"
+    assert report[2]['warning'].startswith('Client not identified; ')
+    assert report[2]['unapplied'] == 10
+    assert PendingBill.query.filter_by(bill_no='B2').one().amount == 50
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Tests for the set-based pending bill import (utils.pending_bills): client
+resolution, upsert counts and paid bills left alone, with and without the
+(bill_no, client_code) unique index.
+Run: python -m pytest test_pending_bills.py
+"""
+
+import pytest
+from sqlalchemy import text
+
+from models import db, Client, PendingBill
+from utils.pending_bills import upsert_pending_bills, PENDING_BILL_UNIQUE_INDEX
+
+ROWS = [
+    {'client_code': 'C1', 'client_name': 'Client One', 'bill_no': 'B1', 'amount': 100, 'nimbus_no': 'N1'},
+    {'client_code': 'nan', 'client_name': ' client one ', 'bill_no': 'B2', 'amount': 200},
+    {'client_code': '', 'client_name': 'New Trader', 'bill_no': 'B3', 'amount': 300},
+]
+
+
+@pytest.fixture(params=['unique index', 'legacy'])
+def imported(request, client):
+    if request.param == 'legacy':
+        db.session.execute(text(f'DROP INDEX {PENDING_BILL_UNIQUE_INDEX}'))
+    result = upsert_pending_bills([dict(r) for r in ROWS], created_by='test')
+    db.session.commit()
+    return result
+
+
+def bills():
+    return {b.bill_no: (b.client_code, b.amount, b.nimbus_no) for b in PendingBill.query}
+
+
+def test_first_import_inserts_and_creates_missing_clients(imported):
+    assert imported == {'rows': 3, 'inserted': 3, 'updated': 0, 'skipped': 0, 'clients_created': 1}
+    trader = Client.query.filter_by(name='New Trader').one()
+    assert bills() == {'B1': ('C1', 100, 'N1'), 'B2': ('C1', 200, ''), 'B3': (trader.code, 300, '')}
+
+
+def test_reimport_updates_unpaid_and_skips_paid_bills(imported):
+    PendingBill.query.filter_by(bill_no='B2').update({'is_paid': True})
+    db.session.commit()
+    rows = [dict(r, amount=r['amount'] + 1, nimbus_no='') for r in ROWS]
+    rows.append({'client_code': 'C1', 'client_name': 'Client One', 'bill_no': 'B4', 'amount': 400})
+    result = upsert_pending_bills(rows, created_by='test')
+    db.session.commit()
+    assert result == {'rows': 4, 'inserted': 1, 'updated': 2, 'skipped': 1, 'clients_created': 0}
+    current = bills()
+    assert current['B1'] == ('C1', 101, 'N1')  # an empty nimbus_no keeps the stored one
+    assert current['B2'] == ('C1', 200, '')
+    assert current['B3'][1] == 301
+    assert PendingBill.query.count() == 4
+
+
+def test_repeated_rows_collapse_to_the_last(client):
+    rows = [dict(ROWS[0]), dict(ROWS[0], amount=150)]
+    result = upsert_pending_bills(rows, created_by='test')
+    db.session.commit()
+    assert result['inserted'] == 1
+    assert bills() == {'B1': ('C1', 150, 'N1')}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tests for the period close (utils.period): the date lock on closed
+periods and the opening balances a close writes.
+Run: python -m pytest test_period.py
+"""
+
+from datetime import datetime
+
+import pytest
+
+from models import db, Booking, Payment, Entry, ClientBalanceSnapshot, ClientMaterialOpening
+from utils.period import PeriodClosedError, close_period, closed_through, assert_open
+
+CLOSED = datetime(2026, 1, 10, 10, 0)
+OPEN = datetime(2026, 2, 10, 10, 0)
+
+
+@pytest.fixture
+def closed(client, opc):
+    db.session.add_all([
+        Booking(client_name='Client One', amount=1000, paid_amount=100, date_posted=CLOSED),
+        Payment(client_name='Client One', amount=300, date_posted=CLOSED),
+        Entry(date='2026-01-12', type='OUT', client='Client One', material='OPC', qty=10),
+    ])
+    db.session.commit()
+    return close_period('2026-01-31', closed_by='test')
+
+
+def test_close_writes_opening_balances(closed, client):
+    assert closed_through() == '2026-01-31'
+    assert [(s.date, s.balance) for s in ClientBalanceSnapshot.query] == [('2026-01-31', 600)]
+    assert [(o.client_id, o.material, o.qty) for o in ClientMaterialOpening.query] == [(client.id, 'OPC', 10)]
+
+
+def test_writes_in_a_closed_period_are_rejected(closed):
+    db.session.add(Payment(client_name='Client One', amount=50, date_posted=CLOSED))
+    with pytest.raises(PeriodClosedError):
+        db.session.commit()
+    db.session.rollback()
+
+    payment = Payment.query.one()
+    payment.amount = 400
+    with pytest.raises(PeriodClosedError):
+        db.session.commit()
+    db.session.rollback()
+
+    db.session.delete(Entry.query.one())
+    with pytest.raises(PeriodClosedError):
+        db.session.commit()
+    db.session.rollback()
+    assert Payment.query.one().amount == 300
+    assert Entry.query.count() == 1
+
+
+def test_documents_cannot_move_into_a_closed_period(closed):
+    payment = Payment(client_name='Client One', amount=50, date_posted=OPEN)
+    db.session.add(payment)
+    db.session.commit()
+    payment.date_posted = CLOSED
+    with pytest.raises(PeriodClosedError):
+        db.session.commit()
+    db.session.rollback()
+    assert db.session.get(Payment, payment.id).date_posted == OPEN
+
+
+def test_close_dates_must_move_forward(closed):
+    with pytest.raises(PeriodClosedError):
+        close_period('2026-01-15')
+    with pytest.raises(ValueError):
+        close_period('9999-01-01')
+    with pytest.raises(PeriodClosedError):
+        assert_open('2026-01-31')
+    assert_open('2026-02-01', None)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Tests for the batched data wipe (utils.purge): chunked deletes, journal
+reversal of wiped documents, the period lock and the reclaim options.
+Run: python -m pytest test_purge.py
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from models import db, BackgroundJob, Payment
+from utils.journal import client_totals, reverse_deleted, verify_journal
+from utils.period import PeriodClosedError, close_period
+from utils.purge import purge, purge_dates, purge_size
+
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+def _job():
+    job = BackgroundJob(kind='purge', status='RUNNING', total=0, done=0)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def _payments(*amounts, posted=POSTED):
+    db.session.add_all([Payment(client_name='Client One', amount=a, date_posted=posted) for a in amounts])
+    db.session.commit()
+
+
+def test_reverse_deleted_nets_wiped_documents_once(client):
+    _payments(100, 300)
+    db.session.execute(text("DELETE FROM payment WHERE amount = 300"))
+    assert reverse_deleted('payment') == 1
+    db.session.commit()
+    assert client_totals() == {client.id: (0, 100)}
+    assert verify_journal() == []
+    assert reverse_deleted('payment') == 0
+
+
+def test_purge_wipes_in_chunks_and_reverses_the_journal(client):
+    _payments(100, 200, 300)
+    assert purge_size(['payments']) == 4  # three payments and their finance_daily row
+    job_id = _job()
+    message = purge(job_id, ['payments'], chunk_size=2)
+    assert Payment.query.count() == 0
+    assert db.session.get(BackgroundJob, job_id).done == 4
+    assert '3 journal lines reversed' in message
+    assert client_totals() == {client.id: (0, 0)}
+    assert verify_journal() == []
+
+
+def test_purge_refuses_closed_periods(client):
+    _payments(100, posted=datetime(2026, 1, 5))
+    _payments(200)
+    assert purge_dates(['payments']) == ('2026-01-05', '2026-03-02')
+    close_period('2026-01-31')
+    with pytest.raises(PeriodClosedError):
+        purge(_job(), ['payments'])
+    db.session.rollback()
+    assert Payment.query.count() == 2
+
+
+def test_purge_leaves_full_vacuum_to_the_cli(client):
+    _payments(100)
+    with pytest.raises(ValueError):
+        purge(_job(), ['payments'], reclaim='full')
+    assert Payment.query.count() == 1
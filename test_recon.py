@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for the reconciliation engine (utils.recon): fingerprint skipping,
+bill partitioning and the parallel run matching the serial one.
+Run: python -m pytest test_recon.py
+"""
+
+from utils.recon import reconcile_partition, partition_bills, reconcile_parallel, fingerprint, ClientMatcher
+
+FIN = {f'B{i}': [{'client': 'Client One'}] for i in range(20)}
+INV = {f'B{i}': [{'client': 'Client One' if i % 3 else 'Clint One', 'material': 'OPC', 'qty': i}]
+       for i in range(0, 30, 2)}
+
+
+def items():
+    return [(bill, FIN.get(bill, []), INV.get(bill, [])) for bill in sorted(set(FIN) | set(INV))]
+
+
+def test_known_fingerprints_are_skipped():
+    changed, outcomes = reconcile_partition(items())
+    assert set(changed) == set(FIN) | set(INV)
+    known = dict(changed)
+    known['B4'] = (fingerprint(FIN['B4']), 'stale')
+    again, again_outcomes = reconcile_partition(items(), known)
+    assert list(again) == ['B4']
+    assert [o['bill_no'] for o in again_outcomes] == ['B4']
+
+
+def test_partitions_are_stable_and_carry_their_known_hashes():
+    known = {'B1': ('a', 'b'), 'B2': ('c', 'd')}
+    parts = partition_bills(FIN, INV, 4, known)
+    again = partition_bills(FIN, INV, 4, known)
+    assert [sorted(b for b, _, _ in p) for p, _ in parts] == [sorted(b for b, _, _ in p) for p, _ in again]
+    bills = [b for p, _ in parts for b, _, _ in p]
+    assert sorted(bills) == sorted(set(FIN) | set(INV))
+    for part, part_known in parts:
+        assert part_known == {b: known[b] for b, _, _ in part if b in known}
+
+
+def test_parallel_run_matches_the_serial_one():
+    serial_changed, serial = reconcile_partition(items())
+    progress = []
+    for workers in (1, 2):
+        changed, outcomes = reconcile_parallel(FIN, INV, workers=workers,
+                                               progress=lambda done, total: progress.append((done, total)))
+        assert changed == serial_changed
+        key = lambda o: (o['bill_no'], o['status'], o['inv_qty'])
+        assert sorted(outcomes, key=key) == sorted(serial, key=key)
+    assert progress[-1][0] == progress[-1][1]
+
+
+def test_matcher_suggests_close_names():
+    matcher = ClientMatcher({'client one': 'C1', 'other trader': 'C2'})
+    assert matcher.suggest('Client One') == 'C1'
+    assert matcher.suggest('Clint One') == 'C1'
+    assert matcher.suggest('Nobody') is None
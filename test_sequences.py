@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Tests for generated codes and bill numbers (utils.sequences): blocks of
+consecutive numbers, seeding from what is already in use and rollbacks
+handing numbers back.
+Run: python -m pytest test_sequences.py
+"""
+
+from models import db, Client, BillCounter, Settings
+from utils.sequences import (reserve_codes, generate_client_code, generate_material_code, reserve_bill_numbers,
+                             next_bill_no, peek_bill_no)
+
+
+def test_blocks_are_consecutive(app):
+    assert reserve_codes('client', 3) == ['tmpc-000001', 'tmpc-000002', 'tmpc-000003']
+    assert generate_client_code() == 'tmpc-000004'
+    assert generate_material_code() == 'tmpm-00001'
+    assert reserve_codes('client', 0) == []
+
+
+def test_sequence_starts_after_codes_in_use(app):
+    db.session.add(Client(code='tmpc-000041', name='Imported'))
+    db.session.commit()
+    assert reserve_codes('client', 2) == ['tmpc-000042', 'tmpc-000043']
+
+
+def test_hand_typed_codes_ahead_of_the_sequence_are_skipped(app):
+    assert generate_client_code() == 'tmpc-000001'
+    db.session.add(Client(code='tmpc-000003', name='Typed'))
+    db.session.commit()
+    assert reserve_codes('client', 2) == ['tmpc-000004', 'tmpc-000005']
+
+
+def test_rollback_hands_the_codes_back(app):
+    generate_client_code()
+    db.session.commit()
+    assert generate_client_code() == 'tmpc-000002'
+    db.session.rollback()
+    assert generate_client_code() == 'tmpc-000002'
+
+
+def test_bill_numbers_count_per_prefix(app):
+    assert peek_bill_no() == '#1000'
+    assert next_bill_no() == '#1000'
+    assert reserve_bill_numbers(3, 'DS-') == ['DS-1000', 'DS-1001', 'DS-1002']
+    assert next_bill_no() == '#1001'
+    assert peek_bill_no('DS-') == 'DS-1003'
+    assert peek_bill_no('DS-') == 'DS-1003'
+
+
+def test_bill_prefix_comes_from_settings(app):
+    db.session.add(Settings(bill_prefix='INV-'))
+    db.session.commit()
+    assert next_bill_no() == 'INV-1000'
+
+
+def test_new_prefixes_continue_the_legacy_counter(app):
+    db.session.add(BillCounter(prefix=None, count=1500))
+    db.session.commit()
+    assert peek_bill_no() == '#1500'
+    assert reserve_bill_numbers(2) == ['#1500', '#1501']
+    assert next_bill_no('BK-') == 'BK-1500'
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Tests for the stock rollups kept by utils.stock: material lookups,
+Material totals written only by stock entries and batched per commit,
+the stock_daily rollup, and their verify_stock repair.
+Run: python -m pytest test_stock.py
+"""
+
+from sqlalchemy import event, text
+
+from models import db, Entry, Material, StockDaily
+from utils.stock import verify_stock, delete_entries, material_map, post_entry_rows
+
+
+def stock(material):
+    db.session.refresh(material)
+    return material.total, material.total_in, material.total_out
+
+
+def daily(material):
+    return [(d.date, d.qty_in, d.qty_out, d.closing)
+            for d in StockDaily.query.filter_by(material_id=material.id).order_by(StockDaily.date)]
+
+
+def test_material_map_loads_each_name_once_per_transaction(opc):
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        assert material_map(['OPC', ' opc ', 'Slag']) == {'OPC': opc, ' opc ': opc, 'Slag': None}
+        loads = len(statements)
+        assert material_map(['OPC', 'Slag']) == {'OPC': opc, 'Slag': None}
+        assert len(statements) == loads
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+
+def test_bulk_rows_update_each_material_once(opc):
+    rows = [{'date': '2026-03-02', 'type': t, 'material': 'OPC', 'material_id': opc.id, 'qty': q}
+            for t, q in (('IN', 100), ('OUT', 10), ('OUT', 20), ('IN', 5))]
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        db.session.bulk_insert_mappings(Entry, rows)
+        post_entry_rows(rows)
+        db.session.commit()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert len([s for s in statements if s.startswith('UPDATE material')]) == 1
+    assert stock(opc) == (75, 105, 30)
+
+    post_entry_rows(rows[1:2], sign=-1)
+    Entry.query.filter_by(qty=10).delete()
+    db.session.commit()
+    assert stock(opc) == (85, 105, 20)
+    assert verify_stock() == []
+
+
+def test_entries_move_material_totals(opc):
+    db.session.add(Entry(date='2026-03-01', type='IN', material='OPC', qty=100))
+    out = Entry(date='2026-03-02', type='OUT', material='OPC', qty=30)
+    db.session.add(out)
+    db.session.commit()
+    assert stock(opc) == (70, 100, 30)
+
+    out.qty = 40
+    db.session.commit()
+    assert stock(opc) == (60, 100, 40)
+
+    out.is_void = True
+    db.session.commit()
+    assert stock(opc) == (100, 100, 0)
+
+    delete_entries(Entry.query.filter_by(type='IN'))
+    db.session.commit()
+    assert stock(opc) == (0, 0, 0)
+
+
+def test_renaming_an_entry_moves_its_qty(opc):
+    db.session.add(Material(code='M2', name='SRC'))
+    entry = Entry(date='2026-03-01', type='IN', material='OPC', qty=10)
+    db.session.add(entry)
+    db.session.commit()
+
+    entry.material = 'SRC'
+    db.session.commit()
+    assert stock(opc) == (0, 0, 0)
+    assert stock(Material.query.filter_by(name='SRC').one()) == (10, 10, 0)
+
+
+def test_verify_stock_repairs_totals(opc):
+    db.session.add(Entry(date='2026-03-02', type='IN', material='OPC', qty=50))
+    db.session.commit()
+    db.session.execute(text("UPDATE material SET total = 7, total_in = 7"))
+    db.session.commit()
+
+    drift = verify_stock()
+    assert [(d['name'], d['total'], d['expected']) for d in drift] == [('OPC', 7, 50)]
+    assert stock(opc) == (7, 7, 0)  # a check alone changes nothing
+
+    verify_stock(repair=True)
+    assert stock(opc) == (50, 50, 0)
+    assert verify_stock() == []
+
+
+def test_stock_daily_rolls_closings_forward(opc):
+    db.session.add(Entry(date='2026-03-01', type='IN', material='OPC', qty=100))
+    db.session.add(Entry(date='2026-03-02', type='OUT', material='OPC', qty=30))
+    db.session.commit()
+    assert daily(opc) == [('2026-03-01', 100, 0, 100), ('2026-03-02', 0, 30, 70)]
+
+    # a back-dated entry moves the closing of every later day
+    db.session.add(Entry(date='2026-02-28', type='IN', material='OPC', qty=5))
+    db.session.commit()
+    assert [d[3] for d in daily(opc)] == [5, 105, 75]
+
+    delete_entries(Entry.query.filter_by(date='2026-02-28'))
+    db.session.commit()
+    assert [d[3] for d in daily(opc)] == [0, 100, 70]
+    assert verify_stock() == []
+
+
+def test_verify_stock_rebuilds_stock_daily(opc):
+    db.session.add(Entry(date='2026-03-02', type='IN', material='OPC', qty=50))
+    db.session.commit()
+    db.session.execute(text("DELETE FROM stock_daily"))
+    db.session.commit()
+
+    assert [d['days_off'] for d in verify_stock()] == [1]
+    verify_stock(repair=True)
+    assert daily(opc) == [('2026-03-02', 50, 0, 50)]
+    assert verify_stock() == []
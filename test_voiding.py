@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for bulk void (utils.voiding): the dry-run preview against what a
+real run applies, allocations on voided bills, and bill pattern matching.
+Run: python -m pytest test_voiding.py
+"""
+
+from datetime import datetime
+
+import pytest
+
+from models import db, Booking, Payment, PendingBill, PaymentAllocation
+from utils.allocation import allocate_payment
+from utils.journal import client_totals, verify_journal
+from utils.voiding import bulk_void, select_documents
+
+POSTED = datetime(2026, 3, 2, 10, 0)
+
+
+def book(amount, bill_no=None):
+    booking = Booking(client_name='Client One', amount=amount, paid_amount=0, manual_bill_no=bill_no,
+                      date_posted=POSTED)
+    db.session.add(booking)
+    db.session.flush()
+    db.session.add(PendingBill(client_code='C1', client_name='Client One', amount=amount,
+                               bill_no=bill_no or f"BK-{booking.id}"))
+    return booking
+
+
+@pytest.fixture
+def paid_bookings(client):
+    first, second = book(100), book(200)
+    payment = Payment(client_name='Client One', amount=150, date_posted=POSTED)
+    db.session.add(payment)
+    db.session.flush()
+    allocate_payment(payment.id, 150, 'C1')
+    db.session.commit()
+    return first, second, payment
+
+
+def test_preview_matches_what_is_applied(paid_bookings):
+    first, second, payment = paid_bookings
+    preview = bulk_void('Booking', dry_run=True, ids=[first.id])
+    assert (preview['documents'], preview['amount'], preview['pending_bills']) == (1, 100, 1)
+    assert (preview['released_allocations'], preview['released_amount']) == (1, 100)
+    assert not preview['applied']
+    assert PaymentAllocation.query.filter_by(is_void=False).count() == 2  # a preview writes nothing
+
+    applied = bulk_void('Booking', dry_run=False, ids=[first.id])
+    assert applied['applied']
+    assert {k: v for k, v in applied.items() if k != 'applied'} == {k: v for k, v in preview.items() if k != 'applied'}
+    db.session.expire_all()
+    assert db.session.get(Booking, first.id).is_void
+    bill = PendingBill.query.filter_by(bill_no=f"BK-{first.id}").one()
+    assert (bill.is_void, bill.amount) == (True, 100)
+    # the 100 the payment had on the voided bill is unallocated again; its split on the other bill stays
+    assert [(a.pending_bill_id, a.amount) for a in PaymentAllocation.query.filter_by(is_void=False)] == [
+        (PendingBill.query.filter_by(bill_no=f"BK-{second.id}").one().id, 50)]
+    assert client_totals()[paid_bookings[2].client_id] == (200, 150)
+    assert verify_journal() == []
+
+
+def test_voiding_payments_gives_bills_back(paid_bookings):
+    first, second, payment = paid_bookings
+    preview = bulk_void('Payment', dry_run=False, ids=[payment.id])
+    assert (preview['allocations'], preview['allocated_amount']) == (2, 150)
+    db.session.expire_all()
+    assert sorted(b.amount for b in PendingBill.query) == [100, 200]
+    assert PaymentAllocation.query.filter_by(is_void=False).count() == 0
+
+
+def test_bill_pattern_treats_like_wildcards_literally(client):
+    for bill_no in ('BK_12', 'BKX12', 'BK%1', 'BK\\1'):
+        book(10, bill_no)
+    db.session.commit()
+
+    def matched(pattern):
+        return sorted(b.manual_bill_no for b in select_documents('Booking', bill_pattern=pattern))
+
+    assert matched('BK_12') == ['BK_12']
+    assert matched('BK%1') == ['BK%1']
+    assert matched('BK\\1') == ['BK\\1']
+    assert matched('BK?12') == ['BKX12', 'BK_12']
+    assert matched('BK*') == ['BK%1', 'BKX12', 'BK\\1', 'BK_12']
+
+
+def test_selection_is_required(client):
+    with pytest.raises(ValueError):
+        bulk_void('Booking', dry_run=True)
@@ -0,0 +1,134 @@
+"""
+Payment allocation to pending bills.
+
+A payment settles a client's open pending bills oldest first, or only the
+bills matching the bill number typed with it. The splits are computed in
+SQL with a running total over the open bills (`SUM(amount) OVER (ORDER BY
+id)`), written to `payment_allocation` with one INSERT ... SELECT, and
+taken off the bills with one UPDATE. The query count does not depend on
+how many bills the client has open.
+
+Each allocation row records which payment paid how much of which bill, so
+voiding, deleting or editing a payment puts exactly that amount back with
+`reverse_allocations` and marks the rows void. A bill that allocations
+point at is never deleted (`has_allocations`): it is settled, or voided
+after `release_bills` has handed what the payments paid on it back to
+them, so the payment's split stays traceable.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, func, literal, or_, and_, Select
+
+from models import db, PendingBill, PaymentAllocation
+
+PAID_TOLERANCE = 1e-6
+
+
+def bill_filter(bill_no):
+    """Pending bills whose bill or nimbus number matches `bill_no` (1001 also matches #1001)."""
+    pb = PendingBill.__table__
+    filters = [pb.c.bill_no.ilike(bill_no), pb.c.nimbus_no.ilike(bill_no)]
+    if bill_no.isdigit():
+        filters.append(pb.c.bill_no.ilike(f"#{bill_no}"))
+    return or_(*filters)
+
+
+def allocate_payment(payment_id, amount, client_code, bill_no=None):
+    """Apply `amount` of a payment to the client's open bills, oldest first.
+
+    With `bill_no` only matching bills are considered. Returns
+    [(bill_no, applied, now_paid)] in bill order; whatever is not in it
+    stayed unapplied (an advance). Three statements, flushed but not committed.
+    """
+    if not client_code or not amount or amount <= 0:
+        return []
+    db.session.flush()
+    pb = PendingBill.__table__
+    alloc = PaymentAllocation.__table__
+
+    open_bills = and_(pb.c.client_code == client_code, pb.c.is_paid == False,
+                      func.coalesce(pb.c.is_void, False) == False,
+                      pb.c.amount > 0)
+    if bill_no:
+        open_bills = and_(open_bills, bill_filter(bill_no))
+    candidates = select(pb.c.id, pb.c.amount, func.sum(pb.c.amount).over(order_by=pb.c.id).label('running'))\
+        .where(open_bills).subquery()
+    before = candidates.c.running - candidates.c.amount
+    # each bill takes what is left of the payment after the bills before it, up to its own amount
+    splits = select(literal(payment_id), candidates.c.id, func.min(candidates.c.amount, literal(amount) - before),
+                    literal(datetime.now()))\
+        .where(before < amount - PAID_TOLERANCE)
+    db.session.execute(insert(alloc).from_select(['payment_id', 'pending_bill_id', 'amount', 'created_at'], splits))
+
+    _apply(pb, alloc, [payment_id], sign=-1)
+
+    rows = db.session.execute(
+        select(pb.c.bill_no, alloc.c.amount, pb.c.is_paid)
+        .join(alloc, alloc.c.pending_bill_id == pb.c.id)
+        .where(alloc.c.payment_id == payment_id, alloc.c.is_void == False)
+        .order_by(pb.c.id)).all()
+    return [(bill, applied, bool(paid)) for bill, applied, paid in rows]
+
+
+def _apply(pb, alloc, payment_ids, sign):
+    """Move the live allocations of `payment_ids` off (sign=-1) or back onto (sign=1) their bills."""
+    allocated = select(func.sum(alloc.c.amount))\
+        .where(alloc.c.pending_bill_id == pb.c.id, alloc.c.payment_id.in_(payment_ids), alloc.c.is_void == False)\
+        .scalar_subquery()
+    new_amount = func.coalesce(pb.c.amount, 0) + sign * allocated
+    db.session.execute(
+        update(pb)
+        .where(pb.c.id.in_(select(alloc.c.pending_bill_id)
+                           .where(alloc.c.payment_id.in_(payment_ids), alloc.c.is_void == False)))
+        .values(amount=new_amount, is_paid=new_amount <= PAID_TOLERANCE))
+
+
+def has_allocations(bill_id):
+    """Whether any payment was ever allocated to the pending bill `bill_id`."""
+    return db.session.query(select(PaymentAllocation.id).where(PaymentAllocation.pending_bill_id == bill_id)
+                            .exists()).scalar()
+
+
+def reverse_allocations(payment_ids):
+    """Give back everything `payment_ids` (ids or a select of ids) paid off their bills and void the allocation rows.
+
+    Two statements, whatever the number of payments or bills; not committed.
+    Returns the number of allocations reversed.
+    """
+    if not isinstance(payment_ids, Select):
+        payment_ids = list(payment_ids)
+        if not payment_ids:
+            return 0
+    db.session.flush()
+    pb = PendingBill.__table__
+    alloc = PaymentAllocation.__table__
+    _apply(pb, alloc, payment_ids, sign=1)
+    return db.session.execute(
+        update(alloc).where(alloc.c.payment_id.in_(payment_ids), alloc.c.is_void == False).values(is_void=True)).rowcount
+
+
+
+def release_bills(bill_ids):
+    """Take the live allocations off the pending bills `bill_ids` (ids or a select of ids) before they are voided.
+
+    The amounts go back onto the bills and the allocation rows are voided,
+    so the payments count that money as unallocated again. Two statements;
+    not committed. Returns the number of allocations released.
+    """
+    if isinstance(bill_ids, Select):
+        bill_ids = bill_ids.correlate(None)  # a select of pending_bill ids must not bind to the UPDATE below
+    else:
+        bill_ids = list(bill_ids)
+        if not bill_ids:
+            return 0
+    db.session.flush()
+    pb = PendingBill.__table__
+    alloc = PaymentAllocation.__table__
+    live = and_(alloc.c.pending_bill_id.in_(bill_ids), alloc.c.is_void == False)
+    released = select(func.sum(alloc.c.amount))\
+        .where(alloc.c.pending_bill_id == pb.c.id, alloc.c.is_void == False).scalar_subquery()
+    new_amount = func.coalesce(pb.c.amount, 0) + released
+    db.session.execute(
+        update(pb).where(pb.c.id.in_(select(alloc.c.pending_bill_id).where(live)))
+        .values(amount=new_amount, is_paid=new_amount <= PAID_TOLERANCE))
+    return db.session.execute(update(alloc).where(live).values(is_void=True)).rowcount
@@ -0,0 +1,330 @@
+"""
+Archive.
+
+Voided documents and the documents of long-closed periods are moved out of
+the hot tables into `archive.db`, a second SQLite file attached to every
+connection as schema `archive` (see the connect listener in main). Each
+archived table mirrors its hot table column for column, without the unique
+indexes, and rows keep their ids.
+
+`archive_rows` moves, in chunks:
+
+- voided entries, bookings, payments and direct sales from any period, and
+  voided pending bills no live allocation points at;
+- live entries, bookings, payments and direct sales dated on or before the
+  cutoff: the latest period close, and no later than ARCHIVE_AFTER_DAYS ago
+  unless an earlier or later `before` is given (never past the close).
+
+Bookings, sales and payments take their items and allocations with them.
+Figures that add up whole history (stock totals, the finance rollup, the
+journal, booking balances) read `with_archive(model)`, hot rows UNION ALL
+archived rows, so moving a row changes no figure and needs no stock,
+finance or journal update. Reports list hot rows only unless asked to
+include the archive. `restore_document` moves an archived document, with
+its items and the entries and pending bills filed under its bill refs,
+back into the hot tables; if it still qualifies, the next run archives it
+again.
+
+SQLite commits an attached database separately under WAL, so a move
+copies in one transaction and deletes in the next. A crash in between
+leaves a row in both; `ensure_archive_schema` drops such archive copies
+at startup, which keeps the hot copy. The row holding a table's highest id
+is never archived, so SQLite cannot hand that id out again. Archived rows
+stay as they were archived: later client or material renames do not reach
+them.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import MetaData, Table, Column, Index, select, union_all, and_, or_, exists, text, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.util import ClauseAdapter
+
+from models import (db, Entry, Booking, BookingItem, Payment, PaymentAllocation, DirectSale, DirectSaleItem,
+                    PendingBill)
+from utils.finance import day_range
+from utils.jobs import update_job
+from utils.period import closed_through
+
+ARCHIVE_SCHEMA = 'archive'
+ARCHIVE_AFTER_DAYS = 730
+CHUNK_SIZE = 500
+
+# document model -> (child model, column pointing at the document) moved with it
+ARCHIVE_DOCS = {
+    Entry: (),
+    Booking: ((BookingItem, 'booking_id'),),
+    Payment: ((PaymentAllocation, 'payment_id'),),
+    DirectSale: ((DirectSaleItem, 'sale_id'),),
+    PendingBill: (),
+}
+
+RESTORE_TYPES = {model.__name__: model for model in ARCHIVE_DOCS}
+
+ARCHIVED_MODELS = list(ARCHIVE_DOCS) + [child for children in ARCHIVE_DOCS.values() for child, _ in children]
+
+_metadata = MetaData(schema=ARCHIVE_SCHEMA)
+_ready = set()  # engine urls whose archive schema is in place
+
+
+def archive_table(model):
+    """The archive schema's copy of `model`'s table."""
+    hot = model.__table__
+    key = f'{ARCHIVE_SCHEMA}.{hot.name}'
+    if key not in _metadata.tables:
+        Table(hot.name, _metadata,
+              *(Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False) for c in hot.columns),
+              *(Index(ix.name, *(c.name for c in ix.columns)) for ix in hot.indexes))
+    return _metadata.tables[key]
+
+
+def archive_attached():
+    return any(row[1] == ARCHIVE_SCHEMA for row in db.session.execute(text('PRAGMA database_list')))
+
+
+def ensure_archive_schema():
+    """Create missing archive tables and columns and drop archive copies of rows that are hot again.
+
+    Returns False when no archive database is attached.
+    """
+    if not archive_attached():
+        return False
+    tables = [archive_table(model) for model in ARCHIVED_MODELS]
+    _metadata.create_all(db.engine, tables=tables)
+    dialect = db.engine.dialect
+    for model, cold in zip(ARCHIVED_MODELS, tables):
+        have = {row[1] for row in db.session.execute(text(f"PRAGMA {ARCHIVE_SCHEMA}.table_info('{cold.name}')"))}
+        for col in cold.columns:
+            if col.name not in have:
+                db.session.execute(text(f'ALTER TABLE {ARCHIVE_SCHEMA}.{cold.name} '
+                                        f'ADD COLUMN {col.name} {col.type.compile(dialect)}'))
+        hot = model.__table__
+        db.session.execute(cold.delete().where(cold.c.id.in_(select(hot.c.id))))
+    db.session.commit()
+    _ready.add(str(db.engine.url))
+    return True
+
+
+def archive_ready():
+    return str(db.engine.url) in _ready
+
+
+def with_archive(model, include=True):
+    """`model`, or with include=True an alias of it over its hot rows UNION ALL its archived rows."""
+    if not include or not archive_ready():
+        return model
+    hot = model.__table__
+    cold = archive_table(model)
+    rows = union_all(select(*hot.columns), select(*(cold.c[c.name] for c in hot.columns)))
+    return aliased(model, rows.subquery(f'{hot.name}_all'), adapt_on_names=True)
+
+
+def archived_ids(model, ids):
+    """The ids among `ids` whose rows are in the archive."""
+    if not ids or not archive_ready():
+        return set()
+    cold = archive_table(model)
+    return {i for (i,) in db.session.execute(select(cold.c.id).where(cold.c.id.in_(ids)))}
+
+
+def archive_cutoff(before=None, today=None):
+    """The last day whose live documents may be archived ('YYYY-MM-DD'), or None."""
+    closed = closed_through()
+    if not closed:
+        return None
+    if not before:
+        before = ((today or datetime.now()) - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d')
+    return min(closed, before)
+
+
+def _archivable(model, cutoff):
+    """Condition on `model` for the rows `archive_rows` moves."""
+    condition = model.is_void == True
+    if model is PendingBill:
+        live = exists().where(PaymentAllocation.pending_bill_id == PendingBill.id, PaymentAllocation.is_void == False)
+        return and_(condition, ~live)
+    if cutoff:
+        if model is Entry:
+            condition = or_(condition, and_(Entry.date.like('____-__-__'), Entry.date <= cutoff))
+        else:
+            condition = or_(condition, model.date_posted < day_range(cutoff, cutoff)[1])
+    return condition
+
+
+def _held_ids(model):
+    """Ids that stay hot so no table loses the row holding its highest id."""
+    held = {db.session.query(func.max(model.id)).scalar()}
+    for child, fk in ARCHIVE_DOCS[model]:
+        held.add(db.session.query(getattr(child, fk)).filter(
+            child.id == db.session.query(func.max(child.id)).scalar_subquery()).scalar())
+    return {i for i in held if i is not None}
+
+
+def archive_plan(cutoff):
+    """{model name: rows archive_rows would move} for `cutoff`."""
+    plan = {}
+    for model in ARCHIVE_DOCS:
+        q = model.query.filter(_archivable(model, cutoff), model.id.notin_(_held_ids(model)))
+        plan[model.__name__] = q.count()
+    return plan
+
+
+def _steps(model, ids, src):
+    """[(model, condition on its table in `src`)] for `model` rows `ids` and their children, children first."""
+    steps = [(child, getattr(src(child).c, fk).in_(ids)) for child, fk in ARCHIVE_DOCS[model]]
+    return steps + [(model, src(model).c.id.in_(ids))]
+
+
+def _copy(steps, src, dst, replace=False):
+    for model, where in steps:
+        names = [c.name for c in model.__table__.columns]
+        insert = dst(model).insert()
+        if replace:
+            insert = insert.prefix_with('OR REPLACE')
+        db.session.execute(insert.from_select(names, select(*(src(model).c[n] for n in names)).where(where)))
+
+
+def _delete(steps, src):
+    for model, where in steps:
+        db.session.execute(src(model).delete().where(where))
+
+
+def _hot(model):
+    return model.__table__
+
+
+def archive_rows(cutoff=None, chunk_size=CHUNK_SIZE, progress=None):
+    """Move the voided rows and the live rows dated on or before `cutoff` into the archive.
+
+    Returns {model name: documents moved}. `progress(n)` gets the running
+    total after each chunk.
+    """
+    if not ensure_archive_schema():
+        raise ValueError('No archive database is attached.')
+    if cutoff and cutoff > (closed_through() or ''):
+        raise ValueError('Only closed periods can be archived.')
+    moved = {}
+    total = 0
+    for model in ARCHIVE_DOCS:
+        condition = _archivable(model, cutoff)
+        held = _held_ids(model)
+        moved[model.__name__] = 0
+        last_id = 0
+        while True:
+            ids = [i for (i,) in db.session.query(model.id).filter(condition, model.id > last_id,
+                                                                   model.id.notin_(held))
+                   .order_by(model.id).limit(chunk_size)]
+            if not ids:
+                break
+            steps = _steps(model, ids, _hot)
+            _copy(steps, _hot, archive_table, replace=True)
+            db.session.commit()
+            _delete(steps, _hot)
+            db.session.commit()
+            last_id = ids[-1]
+            moved[model.__name__] += len(ids)
+            total += len(ids)
+            if progress:
+                progress(total)
+    return moved
+
+
+def archive_job(job_id, cutoff=None):
+    """Job body for `utils.jobs.start_job`: archive_rows with progress. Returns the job message."""
+    moved = archive_rows(cutoff, progress=lambda n: update_job(job_id, done=n))
+    if not any(moved.values()):
+        return 'Nothing to archive'
+    return 'Archived ' + ', '.join(f'{n} {name}' for name, n in moved.items() if n)
+
+
+def _bill_refs(model, doc):
+    """Bill refs an archived sale or booking filed its entries and pending bills under."""
+    from utils.voiding import BILL_COLUMNS, GENERATED_REFS
+    refs = {prefix + str(doc.id) for prefix in GENERATED_REFS.get(model, ())}
+    refs.update(getattr(doc, col) for col in BILL_COLUMNS.get(model, ()) if getattr(doc, col))
+    return refs
+
+
+def restore_document(doc_type, doc_id):
+    """Move an archived document, its items and the entries and bills under its bill refs back to the hot tables.
+
+    Returns {model name: rows restored}; raises ValueError when the
+    document is not archived or a restored row would clash with a hot one.
+    """
+    model = RESTORE_TYPES.get(doc_type)
+    if model is None:
+        raise ValueError(f"Cannot restore {doc_type}.")
+    if not archive_ready():
+        raise ValueError('No archive database is attached.')
+    cold = archive_table(model)
+    doc = db.session.execute(select(cold).where(cold.c.id == doc_id)).first()
+    if doc is None:
+        raise ValueError(f"{doc_type} #{doc_id} is not in the archive.")
+
+    related = []
+    refs = _bill_refs(model, doc) if model in (Booking, DirectSale) else set()
+    if refs:
+        bills = archive_table(PendingBill)
+        related.append((PendingBill, [i for (i,) in db.session.execute(
+            select(bills.c.id).where(bills.c.bill_no.in_(refs)))]))
+    if refs and model is DirectSale:
+        entries = archive_table(Entry)
+        related.append((Entry, [i for (i,) in db.session.execute(
+            select(entries.c.id).where(entries.c.bill_no.in_(refs)))]))
+
+    steps = [step for m, ids in [(model, [doc_id])] + related if ids for step in _steps(m, ids, archive_table)]
+    try:
+        _copy(steps, archive_table, _hot)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ValueError(f"Cannot restore {doc_type} #{doc_id}: a live row uses the same bill number.")
+    _delete(steps, archive_table)
+    db.session.commit()
+    return {m.__name__: len(ids) for m, ids in [(model, [doc_id])] + related if ids}
+
+
+def _archived_where(model, condition):
+    """(archive table, `condition` rewritten against it or None) for a condition written against `model`."""
+    cold = archive_table(model)
+    return cold, ClauseAdapter(cold, adapt_on_names=True).traverse(condition) if condition is not None else None
+
+
+def count_archived(model, condition=None):
+    """Archived rows of `model` matching `condition` (written against the hot model)."""
+    if model not in ARCHIVED_MODELS or not archive_ready():
+        return 0
+    cold, where = _archived_where(model, condition)
+    q = select(func.count()).select_from(cold)
+    return db.session.execute(q.where(where) if where is not None else q).scalar()
+
+
+def archived_dates(model, attr, condition=None):
+    """(earliest, latest) `attr` of the archived rows of `model` matching `condition`, or (None, None)."""
+    if model not in ARCHIVED_MODELS or not archive_ready():
+        return None, None
+    cold, where = _archived_where(model, condition)
+    q = select(func.min(cold.c[attr]), func.max(cold.c[attr]))
+    return tuple(db.session.execute(q.where(where) if where is not None else q).one())
+
+
+def purge_archived(model, condition=None):
+    """Delete archived rows of `model` matching `condition` (written against the hot model), for data wipes.
+
+    Archived entries give their stock back the way `delete_entries` does.
+    Returns rows deleted; does not commit.
+    """
+    if model not in ARCHIVED_MODELS or not archive_ready():
+        return 0
+    from utils.stock import entry_movements, _queue_entries
+    cold, where = _archived_where(model, condition)
+    if model is Entry:
+        archived = aliased(Entry, cold, adapt_on_names=True)
+        q = db.session.query(archived)
+        if where is not None:
+            q = q.filter(where)
+        _queue_entries(entry_movements(q, archived), sign=-1)
+    delete = cold.delete()
+    if where is not None:
+        delete = delete.where(where)
+    return db.session.execute(delete).rowcount
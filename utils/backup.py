@@ -0,0 +1,173 @@
+"""
+Online backup.
+
+`backup_database` copies every database file of the app's connection (the
+main database and the attached archive) into a timestamped snapshot folder
+under `backups/` next to the main database, with SQLite's online backup
+API: PAGES_PER_STEP pages per step with a short pause between steps. The
+source is read inside one read transaction, so under WAL the copy is a
+consistent snapshot and writers carry on while it runs; a backup that let
+go of the source between steps would start over every time a writer
+committed.
+
+Each file is written under a .partial name, checked with
+`PRAGMA integrity_check` and only then renamed, so a snapshot folder holds
+verified copies only. Folders are named after the second they were
+taken; a second snapshot within the same second (a scheduled backup
+racing the settings button) gets a -NN suffix instead of failing. The
+newest KEEP snapshots are kept.
+"""
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db
+from utils.jobs import update_job
+
+BACKUP_DIR = 'backups'
+KEEP = 7
+PAGES_PER_STEP = 256
+PAUSE = 0.005  # seconds between steps
+PARTIAL = '.partial'
+STAMP = '%Y%m%d-%H%M%S'
+
+
+def database_files():
+    """[(schema name, file path)] of the databases attached to the app's connection, main first."""
+    return [(name, path) for _, name, path in db.session.execute(text('PRAGMA database_list')) if path]
+
+
+def backup_root():
+    return os.path.join(os.path.dirname(database_files()[0][1]), BACKUP_DIR)
+
+
+def copy_database(source, target, pages=PAGES_PER_STEP, pause=PAUSE, progress=None):
+    """Copy the database file `source` to `target` page by page without blocking writers.
+
+    `progress(copied, total)` is called after every step, in pages.
+    """
+    src = sqlite3.connect(source, timeout=15)
+    dst = sqlite3.connect(target)
+    try:
+        # pin one snapshot for the whole copy
+        src.execute('BEGIN')
+        src.execute('SELECT count(*) FROM sqlite_master').fetchone()
+
+        def step(status, remaining, total):
+            if progress:
+                progress(total - remaining, total)
+            if remaining and pause:
+                time.sleep(pause)
+
+        src.backup(dst, pages=pages, progress=step)
+        src.rollback()
+    finally:
+        dst.close()
+        src.close()
+
+
+def check_integrity(path):
+    """Problems `PRAGMA integrity_check` finds in the database file at `path`; [] when it is sound."""
+    conn = sqlite3.connect(path)
+    try:
+        rows = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        return [str(e)]
+    finally:
+        conn.close()
+    return [] if rows == ['ok'] else rows
+
+
+def list_backups():
+    """[{'name', 'path', 'created', 'size', 'files'}] of the snapshots on disk, newest first."""
+    root = backup_root()
+    if not os.path.isdir(root):
+        return []
+    snapshots = []
+    for name in sorted(os.listdir(root), reverse=True):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            continue
+        files = sorted(f for f in os.listdir(path) if not f.endswith(PARTIAL))
+        try:
+            created = datetime.strptime(name[:15], STAMP)
+        except ValueError:
+            continue
+        snapshots.append({'name': name, 'path': path, 'created': created, 'files': files,
+                          'size': sum(os.path.getsize(os.path.join(path, f)) for f in files)})
+    return snapshots
+
+
+def rotate_backups(keep=KEEP):
+    """Delete all but the newest `keep` snapshots. Returns the names deleted."""
+    removed = [s['name'] for s in list_backups()[max(keep, 1):]]
+    for name in removed:
+        shutil.rmtree(os.path.join(backup_root(), name), ignore_errors=True)
+    return removed
+
+
+def new_snapshot_folder(now=None):
+    """Create and return an empty snapshot folder named after `now`, suffixed -01, -02, ... when taken."""
+    stamp = (now or datetime.now()).strftime(STAMP)
+    root = backup_root()
+    os.makedirs(root, exist_ok=True)
+    for n in range(100):
+        folder = os.path.join(root, f"{stamp}-{n:02d}" if n else stamp)
+        try:
+            os.mkdir(folder)
+            return folder
+        except FileExistsError:
+            continue
+    raise ValueError(f"Too many backups taken at {stamp}")
+
+
+def backup_database(keep=KEEP, progress=None):
+    """Snapshot every attached database, verify each copy and rotate old snapshots.
+
+    `progress(done, 100)` reports percent over all files, by size. Returns
+    {'name', 'path', 'files': {file: bytes}, 'removed': [...]}; raises
+    ValueError (and keeps nothing) when a copy fails its integrity check.
+    """
+    files = database_files()
+    folder = new_snapshot_folder()
+    sizes = {path: os.path.getsize(path) for _, path in files}
+    total_bytes = sum(sizes.values()) or 1
+    done_bytes = 0
+    copied = {}
+    try:
+        for name, path in files:
+            target = os.path.join(folder, os.path.basename(path))
+
+            def step(pages, pages_total, base=done_bytes, size=sizes[path]):
+                if progress and pages_total:
+                    progress(int((base + size * pages / pages_total) * 100 / total_bytes), 100)
+
+            copy_database(path, target + PARTIAL, progress=step)
+            problems = check_integrity(target + PARTIAL)
+            if problems:
+                raise ValueError(f"Backup of {name} failed its integrity check: {'; '.join(problems[:3])}")
+            os.replace(target + PARTIAL, target)
+            copied[os.path.basename(path)] = os.path.getsize(target)
+            done_bytes += sizes[path]
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    return {'name': os.path.basename(folder), 'path': folder, 'files': copied, 'removed': rotate_backups(keep)}
+
+
+def backup_job(job_id, keep=KEEP):
+    """Job body for `utils.jobs.start_job`: backup_database with progress in percent. Returns the job message."""
+    last = [0]
+
+    def progress(done, total):
+        if done - last[0] >= 5 or done == total:
+            last[0] = done
+            update_job(job_id, done=done, total=total)
+
+    result = backup_database(keep, progress)
+    size = sum(result['files'].values())
+    return f"Backup {result['name']}: {len(result['files'])} file(s), {size / 1048576:.1f} MB, integrity ok"
@@ -0,0 +1,150 @@
+"""
+Client resolution for form posts.
+
+Every write endpoint turns the typed client (a code or a name) into a
+`Client` through `find_client`. Lookups are served from a per-process
+directory of code/name/name_key maps, so exact hits cost a dict probe
+plus a primary-key get. The directory is rebuilt when the shared
+`cache_version` row for clients moves; any flush that touches a Client
+bumps it, which invalidates the copy held by every worker.
+"""
+import threading
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from models import db, Client
+from utils.names import name_key
+from utils.recon import ClientMatcher
+
+CLIENT_CACHE = 'client'
+
+_directory = None
+_lock = threading.Lock()
+
+
+class ClientDirectory:
+    """In-memory snapshot of the client table at one cache version."""
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.by_code = {}
+        self.by_code_key = {}
+        self.by_name = {}
+        self.by_key = {}
+        self.clients = {}
+        for id_, code, name, is_active in rows:
+            key = name_key(name)
+            self.clients[id_] = (code, name, key, bool(is_active))
+            if code:
+                self.by_code.setdefault(code, id_)
+                self.by_code_key.setdefault(name_key(code), id_)
+            if name:
+                self.by_name.setdefault(name, id_)
+            if key:
+                self.by_key.setdefault(key, id_)
+        self._matcher = None
+
+    def exact(self, value):
+        """Code, then name, then name_key, then case-insensitive code."""
+        if not value:
+            return None
+        for index, probe in ((self.by_code, value), (self.by_name, value),
+                             (self.by_key, name_key(value)), (self.by_code_key, name_key(value))):
+            if probe in index:
+                return index[probe]
+        return None
+
+    def fuzzy(self, value):
+        """Best partial match for `value`, or None.
+
+        Ranked: name starts with the text, then name or code contains it,
+        then the closest spelling (difflib ratio >= 0.8). Within a rank
+        active clients and shorter names win.
+        """
+        key = name_key(value)
+        if not key:
+            return None
+        ranked = []
+        for id_, (code, name, name_k, active) in self.clients.items():
+            code_k = name_key(code) or ''
+            name_k = name_k or ''
+            if name_k.startswith(key):
+                rank = 0
+            elif key in name_k or key in code_k:
+                rank = 1
+            else:
+                continue
+            ranked.append((rank, not active, len(name_k), name_k, id_))
+        if ranked:
+            return min(ranked)[-1]
+        if self._matcher is None:
+            self._matcher = ClientMatcher({k: id_ for k, id_ in self.by_key.items()})
+        return self._matcher.suggest(key)
+
+
+def _current_version(conn=None):
+    return (conn or db.session).execute(
+        text("SELECT version FROM cache_version WHERE name = :name"), {'name': CLIENT_CACHE}).scalar() or 0
+
+
+def client_directory():
+    """This process's client directory, reloaded if another writer changed clients."""
+    global _directory
+    version = _current_version()
+    directory = _directory
+    if directory is None or directory.version != version:
+        with _lock:
+            rows = db.session.query(Client.id, Client.code, Client.name, Client.is_active).all()
+            directory = _directory = ClientDirectory(rows, version)
+    return directory
+
+
+def invalidate_clients(conn=None):
+    """Move the shared client version so every worker drops its directory."""
+    conn = conn or db.session
+    params = {'name': CLIENT_CACHE}
+    conn.execute(text("INSERT OR IGNORE INTO cache_version (name, version) VALUES (:name, 0)"), params)
+    conn.execute(text("UPDATE cache_version SET version = version + 1 WHERE name = :name"), params)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_client_write(session, flush_context):
+    if any(isinstance(obj, Client) for obj in (*session.new, *session.dirty, *session.deleted)):
+        invalidate_clients(session.connection())
+
+
+def find_client(value=None, code=None, fuzzy=False):
+    """Resolve a typed client to a `Client`.
+
+    `code` is tried first when given, then `value` as a code or name
+    (exact, then name_key). With `fuzzy=True` a ranked partial match is
+    used when nothing matches exactly. Returns None when nothing matches.
+    """
+    directory = client_directory()
+    client_id = directory.exact(code) if code else None
+    if client_id is None:
+        client_id = directory.exact(value)
+    if client_id is None and fuzzy:
+        client_id = directory.fuzzy(value)
+    return db.session.get(Client, client_id) if client_id is not None else None
+
+
+def find_clients(values, fuzzy=False):
+    """Resolve many typed clients at once: {(value, code): Client or None}.
+
+    `values` holds (value, code) pairs resolved like `find_client`; the
+    directory is read once and the matched clients load in one query.
+    """
+    directory = client_directory()
+    ids = {}
+    for value, code in set(values):
+        client_id = directory.exact(code) if code else None
+        if client_id is None:
+            client_id = directory.exact(value)
+        if client_id is None and fuzzy:
+            client_id = directory.fuzzy(value)
+        ids[(value, code)] = client_id
+    wanted = {i for i in ids.values() if i is not None}
+    clients = {c.id: c for c in Client.query.filter(Client.id.in_(wanted))} if wanted else {}
+    return {key: clients.get(client_id) for key, client_id in ids.items()}
@@ -0,0 +1,119 @@
+"""
+Multi-line booking dispatch.
+
+A loader's sheet of truck dispatches (client, material, qty, bill) is
+checked and posted as one batch: clients and materials resolve from the
+client directory and `material_map`, booked and already-dispatched qty
+for every (client, material) on the sheet come from two grouped queries,
+and the accepted lines go in with one bulk insert whose stock is queued
+through `post_entry_rows`, so the commit writes one material update. Lines
+are checked in order against what is left of the booking, so two lines
+for the same booking cannot overdraw it together. Rejected lines are
+reported and skipped; the rest post.
+"""
+from datetime import datetime
+
+from sqlalchemy import func, not_, and_
+
+from models import db, Booking, BookingItem, Entry
+from utils.archive import with_archive
+from utils.clients import find_clients
+from utils.names import name_key
+from utils.period import assert_open
+from utils.stock import material_map, post_entry_rows
+
+
+def booking_balances(pairs):
+    """{(client_id, material_id): (booked, dispatched)} for `pairs`, in two grouped queries (archive included)."""
+    client_ids = {c for c, _ in pairs}
+    material_ids = {m for _, m in pairs}
+    if not client_ids or not material_ids:
+        return {}
+    booking, item, entry = with_archive(Booking), with_archive(BookingItem), with_archive(Entry)
+    booked = dict(((c, m), qty or 0) for c, m, qty in db.session.query(
+        booking.client_id, item.material_id, func.sum(item.qty))
+        .join(booking, item.booking_id == booking.id)
+        .filter(booking.client_id.in_(client_ids), item.material_id.in_(material_ids),
+                booking.is_void == False)
+        .group_by(booking.client_id, item.material_id))
+    dispatched = dict(((c, m), qty or 0) for c, m, qty in db.session.query(
+        entry.client_id, entry.material_id, func.sum(entry.qty))
+        .filter(entry.client_id.in_(client_ids), entry.material_id.in_(material_ids),
+                entry.is_void == False, entry.type == 'OUT')
+        .filter(not_(and_(entry.nimbus_no == 'Direct Sale', entry.client_category != 'Booking Delivery')))
+        .group_by(entry.client_id, entry.material_id))
+    return {pair: (booked.get(pair, 0), dispatched.get(pair, 0)) for pair in pairs}
+
+
+def _qty(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(str(value or '').replace(',', '').strip())
+
+
+def dispatch_lines(lines, entry_date, username):
+    """Post booking dispatches for `lines` dated `entry_date` and report on each line.
+
+    `lines` are dicts with client, material, qty, bill_no and optionally
+    nimbus_no. Returns one dict per line, in order: line (1-based), status
+    ('posted' or 'error') and client, material, qty, remaining (booking
+    left after it) or error. Commits once.
+    """
+    assert_open(entry_date)
+    now = datetime.now()
+    parsed = []
+    for n, line in enumerate(lines, 1):
+        client = str(line.get('client') or '').strip()
+        material = str(line.get('material') or '').strip()
+        try:
+            qty = _qty(line.get('qty'))
+        except ValueError:
+            qty = None
+        parsed.append((n, client, material, qty, line.get('qty'), str(line.get('bill_no') or '').strip(),
+                       str(line.get('nimbus_no') or '').strip()))
+
+    clients = find_clients([(client, None) for _, client, *_ in parsed if client])
+    materials = material_map([material for _, _, material, *_ in parsed if material])
+    pairs = {(clients[(c, None)].id, materials[m].id) for _, c, m, *_ in parsed
+             if c and m and clients[(c, None)] and materials[m]}
+    balances = {pair: booked - dispatched for pair, (booked, dispatched) in booking_balances(pairs).items()}
+
+    report = []
+    rows = []
+    for n, client_name, material_name, qty, raw_qty, bill_no, nimbus_no in parsed:
+        client = clients.get((client_name, None)) if client_name else None
+        material = materials.get(material_name) if material_name else None
+        error = None
+        if not client:
+            error = f"Unknown client '{client_name}': use the Direct Sale form for cash customers"
+        elif not material:
+            error = f"Unknown material '{material_name}'"
+        elif qty is None or qty != qty or qty <= 0:
+            error = f"Invalid qty '{raw_qty if raw_qty is not None else ''}'"
+        elif getattr(client, 'require_manual_invoice', False) and not bill_no:
+            error = 'Manual invoice required for this client.'
+        if error:
+            report.append({'line': n, 'status': 'error', 'error': error})
+            continue
+
+        pair = (client.id, material.id)
+        remaining = balances.get(pair, 0)
+        if qty > remaining:
+            report.append({'line': n, 'status': 'error',
+                           'error': f"Cannot dispatch {qty} bags. Only {remaining} bags available from booking."})
+            continue
+        balances[pair] = remaining - qty
+        rows.append({'date': entry_date, 'time': now.strftime('%H:%M:%S'), 'type': 'OUT',
+                     'material': material.name, 'material_id': material.id,
+                     'client': client.name, 'client_code': client.code, 'client_id': client.id,
+                     'name_key': name_key(client.name), 'client_category': client.category,
+                     'qty': qty, 'bill_no': bill_no, 'nimbus_no': nimbus_no or 'Booking Delivery',
+                     'created_by': username, 'created_at': now, 'is_void': False})
+        report.append({'line': n, 'status': 'posted', 'client': client.name, 'material': material.name,
+                       'qty': qty, 'remaining': balances[pair]})
+
+    if rows:
+        db.session.bulk_insert_mappings(Entry, rows)
+        post_entry_rows(rows)
+    db.session.commit()
+    return report
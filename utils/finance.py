@@ -0,0 +1,222 @@
+"""
+Daily financial rollup.
+
+`finance_daily` holds, per day, client and document kind, the cash taken
+and the credit given: a payment is all cash, a booking or direct sale is
+its paid amount in cash and the rest in credit (direct sales also keep
+their category). Dashboards and range totals sum this narrow table
+instead of filtering Booking, Payment and DirectSale by `date(date_posted)`.
+
+The rollup is kept on flush: every insert, edit, void and delete of a
+booking, payment or sale queues the difference it makes, and the deltas
+are written once on commit. This runs after `utils.links` has filled in
+`client_id` for the same flush. `verify_finance` rebuilds the figures
+from the documents to detect (and repair) drift, and
+`refresh_finance_daily` re-derives the rows of clients whose documents
+were moved with bulk updates.
+
+This table answers "how much cash and credit per day"; client balances,
+including as-of balances and their snapshots, come from the journal
+(`utils.journal`) only.
+"""
+import logging
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, func, or_, text, literal, false
+from sqlalchemy.orm import Session, attributes
+
+from models import db, Booking, Payment, DirectSale, FinanceDaily
+from utils.stock import track_old_values
+from utils.links import previous_value, was_relinked  # its after_flush fills client_id before ours reads it
+
+FINANCE_DELTAS = 'finance_deltas'
+
+# model -> kind, attributes that decide its figures
+FINANCE_SOURCES = {
+    Booking: ('booking', ('amount', 'paid_amount', 'date_posted', 'client_id', 'is_void')),
+    Payment: ('payment', ('amount', 'date_posted', 'client_id', 'is_void')),
+    DirectSale: ('sale', ('amount', 'paid_amount', 'date_posted', 'client_id', 'is_void', 'category')),
+}
+
+for _model, (_, _fields) in FINANCE_SOURCES.items():
+    track_old_values(_model, _fields)
+
+DRIFT_TOLERANCE = 1e-6
+
+
+def day_range(start, end):
+    """datetime bounds [start 00:00, day after end 00:00) for 'YYYY-MM-DD' dates; keeps date_posted indexable."""
+    lo = datetime.combine(datetime.strptime(start, '%Y-%m-%d').date(), time.min)
+    hi = datetime.combine(datetime.strptime(end, '%Y-%m-%d').date() + timedelta(days=1), time.min)
+    return lo, hi
+
+
+def posted_between(column, start, end):
+    lo, hi = day_range(start, end)
+    return [column >= lo, column < hi]
+
+
+def _figures(obj, kind, old=False):
+    """(date, client_id, kind, category, cash, credit) for a document, or None when it counts for nothing."""
+    def value(attr):
+        return previous_value(obj, attr) if old else getattr(obj, attr)
+
+    if value('is_void') or value('date_posted') is None:
+        return None
+    amount = value('amount') or 0
+    if kind == 'payment':
+        cash, credit, category = amount, 0, ''
+    else:
+        cash = value('paid_amount') or 0
+        credit = amount - cash
+        category = (value('category') or '') if kind == 'sale' else ''
+    if not (cash or credit):
+        return None
+    return value('date_posted').strftime('%Y-%m-%d'), value('client_id'), kind, category, cash, credit
+
+
+def _queue(session, figures, sign):
+    if figures is None:
+        return
+    deltas = session.info.setdefault(FINANCE_DELTAS, {})
+    key = figures[:4]
+    cash, credit = deltas.get(key, (0, 0))
+    deltas[key] = (cash + sign * figures[4], credit + sign * figures[5])
+
+
+@event.listens_for(Session, 'after_flush')
+def _post_finance_after_flush(session, flush_context):
+    # new/dirty/deleted and attribute history still describe this flush here
+    for objs, is_new in ((session.new, True), (session.dirty, False), (session.deleted, None)):
+        for obj in objs:
+            source = FINANCE_SOURCES.get(type(obj))
+            if not source:
+                continue
+            kind, fields = source
+            if is_new:
+                _queue(session, _figures(obj, kind), 1)
+            elif is_new is None:
+                _queue(session, _figures(obj, kind, old=True), -1)
+            elif was_relinked(obj) or any(attributes.get_history(obj, f).has_changes() for f in fields):
+                _queue(session, _figures(obj, kind, old=True), -1)
+                _queue(session, _figures(obj, kind), 1)
+
+
+def apply_finance_deltas(session):
+    session.flush()
+    deltas = session.info.pop(FINANCE_DELTAS, {})
+    params = [{'day': day, 'cid': cid, 'kind': kind, 'category': category, 'cash': d[0], 'credit': d[1]}
+              for (day, cid, kind, category), d in deltas.items() if d[0] or d[1]]
+    for p in params:
+        # client_id IS :cid so walk-in rows (NULL client) match as well
+        updated = session.execute(text(
+            "UPDATE finance_daily SET cash = cash + :cash, credit = credit + :credit "
+            "WHERE date = :day AND client_id IS :cid AND kind = :kind AND category = :category"), p).rowcount
+        if not updated:
+            session.execute(text(
+                "INSERT INTO finance_daily (date, client_id, kind, category, cash, credit) "
+                "VALUES (:day, :cid, :kind, :category, :cash, :credit)"), p)
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_on_commit(session):
+    apply_finance_deltas(session)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _reset_transaction_state(session, *args):
+    session.info.pop(FINANCE_DELTAS, None)
+
+
+def finance_totals(start, end, kinds=None, client_ids=None, by_category=False):
+    """{(kind, category) or kind: (cash, credit)} over days start..end ('YYYY-MM-DD', inclusive)."""
+    cols = [FinanceDaily.kind] + ([FinanceDaily.category] if by_category else [])
+    q = db.session.query(*cols, func.sum(FinanceDaily.cash), func.sum(FinanceDaily.credit))\
+        .filter(FinanceDaily.date >= start, FinanceDaily.date <= end)
+    if kinds:
+        q = q.filter(FinanceDaily.kind.in_(kinds))
+    if client_ids is not None:
+        q = q.filter(FinanceDaily.client_id.in_(client_ids))
+    result = {}
+    for row in q.group_by(*cols):
+        key = tuple(row[:len(cols)]) if by_category else row[0]
+        result[key] = (row[-2] or 0, row[-1] or 0)
+    return result
+
+
+def _expected_rows(client_ids=None):
+    """{(date, client_id, kind, category): (cash, credit)} rebuilt from the documents, archived ones included."""
+    from utils.archive import with_archive
+    expected = {}
+    for source, (kind, _) in FINANCE_SOURCES.items():
+        model = with_archive(source)
+        day = func.date(model.date_posted)
+        if kind == 'payment':
+            cash, credit = func.coalesce(model.amount, 0), literal(0)
+        else:
+            cash = func.coalesce(model.paid_amount, 0)
+            credit = func.coalesce(model.amount, 0) - cash
+        group = [day, model.client_id] + ([func.coalesce(model.category, '')] if kind == 'sale' else [])
+        q = db.session.query(*group, func.sum(cash), func.sum(credit))\
+            .filter(model.is_void == False, model.date_posted.isnot(None))
+        if client_ids is not None:
+            q = q.filter(_client_filter(model.client_id, client_ids))
+        for row in q.group_by(*group):
+            cash_sum, credit_sum = row[-2] or 0, row[-1] or 0
+            if cash_sum or credit_sum:
+                category = row[2] if kind == 'sale' else ''
+                expected[(row[0], row[1], kind, category)] = (cash_sum, credit_sum)
+    return expected
+
+
+def _client_filter(column, client_ids):
+    ids = [c for c in client_ids if c is not None]
+    clauses = [column.in_(ids)] if ids else []
+    if None in client_ids:
+        clauses.append(column.is_(None))
+    return or_(*clauses) if clauses else false()
+
+
+def _rewrite(expected, client_ids=None):
+    q = FinanceDaily.query
+    if client_ids is not None:
+        q = q.filter(_client_filter(FinanceDaily.client_id, client_ids))
+    q.delete(synchronize_session=False)
+    rows = [{'date': k[0], 'client_id': k[1], 'kind': k[2], 'category': k[3], 'cash': v[0], 'credit': v[1]}
+            for k, v in expected.items()]
+    if rows:
+        db.session.execute(FinanceDaily.__table__.insert(), rows)
+
+
+def refresh_finance_daily(client_ids):
+    """Re-derive the rollup rows of `client_ids` (None for walk-ins) after a bulk client_id move."""
+    client_ids = set(client_ids)
+    _rewrite(_expected_rows(client_ids), client_ids)
+
+
+def verify_finance(repair=False):
+    """Compare finance_daily with the bookings, payments and sales it is built from.
+
+    Returns the (date, client_id, kind, category) keys that are off, with
+    stored and expected (cash, credit); repair=True rebuilds the table and commits.
+    """
+    expected = _expected_rows()
+    stored = {}
+    for row in db.session.query(FinanceDaily.date, FinanceDaily.client_id, FinanceDaily.kind,
+                                FinanceDaily.category, FinanceDaily.cash, FinanceDaily.credit):
+        key = tuple(row[:4])
+        cash, credit = stored.get(key, (0, 0))
+        stored[key] = (cash + row[4], credit + row[5])
+
+    drift = []
+    for key in sorted(set(expected) | set(stored), key=lambda k: (k[0], k[1] or 0, k[2], k[3])):
+        have, want = stored.get(key, (0, 0)), expected.get(key, (0, 0))
+        if any(abs(h - w) > DRIFT_TOLERANCE for h, w in zip(have, want)):
+            drift.append({'key': key, 'stored': have, 'expected': want})
+
+    if repair and drift:
+        _rewrite(expected)
+        db.session.commit()
+        logging.warning(f"Rebuilt finance_daily ({len(drift)} day/client rows were off)")
+    return drift
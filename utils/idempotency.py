@@ -0,0 +1,60 @@
+"""
+Idempotency keys for JSON write endpoints.
+
+A client sends an `Idempotency-Key` header with a POST and sends the same
+key again when it retries. Keys belong to the user and endpoint that sent
+them, so one user's key never answers another's request. `run_once`
+claims the key by inserting its `idempotency_key` row before doing any
+work, in the same transaction as the work itself: the unique (user_id,
+endpoint, key) index makes a concurrent retry wait for the first request
+and then fail its insert, and a request that fails rolls its claim back
+with everything else. A retry of a committed request gets the stored
+response; the same key with a different body is refused, and that refusal
+is not a replay.
+"""
+import hashlib
+import json
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+
+
+def request_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _replay(user_id, endpoint, key, digest):
+    stored = IdempotencyKey.query.filter_by(user_id=user_id, endpoint=endpoint, key=key).first()
+    if stored is None:
+        return None
+    if stored.request_hash != digest:
+        return 422, {'error': 'Idempotency-Key was already used with a different request'}, False
+    return stored.status_code, json.loads(stored.response), True
+
+
+def run_once(user_id, endpoint, key, payload, handler):
+    """Run `handler()` -> (status, body) once per (user_id, endpoint, key) and commit.
+
+    Returns (status, body, replayed). Exceptions from the handler propagate
+    uncommitted; the caller rolls back.
+    """
+    digest = request_hash(payload)
+    replay = _replay(user_id, endpoint, key, digest)
+    if replay:
+        return replay
+
+    claim = IdempotencyKey(user_id=user_id, endpoint=endpoint, key=key, request_hash=digest)
+    db.session.add(claim)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # a concurrent request with this key committed first
+        db.session.rollback()
+        return _replay(user_id, endpoint, key, digest)
+
+    status, body = handler()
+    claim.status_code = status
+    claim.response = json.dumps(body, default=str)
+    db.session.commit()
+    return status, body, False
@@ -0,0 +1,407 @@
+"""
+Integrity check of the denormalised figures.
+
+Material totals, pending bill amounts and invoice balances are kept up to
+date by whichever route changes the documents behind them; a route that
+forgets (a direct sale on an existing bill number does not add to the
+bill, a second sale on an invoice overwrites its totals) or a raw SQL
+delete leaves them off. `verify_integrity` reads
+each table with one query into a pandas frame, recomputes every figure
+with grouped sums and diffs it against the stored one:
+
+- Material total, total_in, total_out: the non-void stock entries, live
+  and archived (stock_daily is `utils.stock.verify_stock`'s job);
+- PendingBill amount: the unpaid part of the live bookings and direct
+  sales filed under its bill number, less the live allocations of live
+  payments. A generated number (BK-/DS-/CSH-<id>) belongs to that one
+  document; a manual or invoice number to the documents of the bill's
+  client that carry it. Allocations whose payment was deleted or voided
+  are given back. A bill whose documents are all gone or void should be
+  void; a bill no document carries (an imported one) only gets its
+  dangling allocations back;
+- Invoice total_amount, balance, status: the live direct sales on it
+  (invoices of stock entries are priced at entry time and not checked);
+- live stock entries of a deleted or voided direct sale (UNBILLED-<id>)
+  are reported but not repaired: whether those bags left is for a person
+  to decide.
+
+repair=True rewrites every drifted figure in one transaction, opened with
+BEGIN IMMEDIATE so that no write lands between reading the documents and
+rewriting the figures. A check without repair reads one snapshot.
+
+Every run is recorded as an `IntegrityCheck`. incremental=True checks
+only what rows written after the watermark (the start of the last run that
+came out clean or was repaired) feed into, found through their
+`updated_at`; deletes leave no timestamp, so bills and allocations left
+dangling by one are looked up on every run. Without a watermark, or when
+more than SCOPE_LIMIT rows changed, the check is a full one.
+"""
+import logging
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, text, update, bindparam, or_, exists, func, cast, Integer
+
+from models import (db, Material, Entry, PendingBill, PaymentAllocation, Payment, Booking, DirectSale, Invoice,
+                    Client, IntegrityCheck)
+from utils.archive import with_archive, archive_table, archive_ready
+from utils.jobs import update_job
+from utils.stock import DRIFT_TOLERANCE, material_map
+from utils.voiding import GENERATED_REFS
+
+DETAIL_ROWS = 200  # drifted rows kept on the run record
+SCOPE_LIMIT = 5000  # changed keys above which an incremental check becomes a full one
+
+BILL_REF = r'^(?:BK|DS|CSH)-\d+$'  # generated bill numbers, owned by one booking or sale
+SALE_ENTRY_REF = 'UNBILLED-'
+
+
+def _frame(stmt, columns):
+    # Core rows: the ORM result machinery costs more than the query on big extracts
+    return pd.DataFrame(db.session.connection().execute(stmt).all(), columns=columns)
+
+
+def _live(column):
+    return func.coalesce(column, False) == False
+
+
+def _doc_exists(model, doc_id):
+    """Condition: a live (non-void) row of `model`, hot or archived, has id `doc_id`."""
+    tables = [model.__table__] + ([archive_table(model)] if archive_ready() else [])
+    return or_(*(exists().where(t.c.id == doc_id, _live(t.c.is_void)) for t in tables))
+
+
+def _ref_id(column, prefix):
+    return cast(func.substr(column, len(prefix) + 1), Integer)
+
+
+def _diff(check, frame, fields):
+    """Drift rows ({check, id, field, stored, expected}) for `fields` {stored column: expected column} of `frame`."""
+    parts = []
+    for field, want in fields.items():
+        have = frame[field]
+        if pd.api.types.is_numeric_dtype(frame[want]) and not pd.api.types.is_bool_dtype(frame[want]):
+            have = pd.to_numeric(have, errors='coerce')
+            off = have.isna() | ((have - frame[want]).abs() > DRIFT_TOLERANCE)
+        else:
+            off = have.fillna(False if pd.api.types.is_bool_dtype(frame[want]) else '') != frame[want]
+        if off.any():
+            parts.append(pd.DataFrame({'check': check, 'id': frame['id'][off], 'field': field,
+                                       'stored': frame[field][off].astype(object),
+                                       'expected': frame[want][off].astype(object)}))
+    if not parts:
+        return pd.DataFrame(columns=['check', 'id', 'field', 'stored', 'expected'])
+    return pd.concat(parts, ignore_index=True)
+
+
+def _rewrite(model, frame, values):
+    """UPDATE `model` SET {column: frame column} for each row of `frame`, in one executemany. Returns rows."""
+    if frame.empty:
+        return 0
+    table = model.__table__
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('_id')).values(
+            **{column: bindparam(f'_{column}') for column in values}),
+        [{'_id': int(row['id']), **{f'_{column}': row[source] for column, source in values.items()}}
+         for row in frame[['id', *values.values()]].astype(object).to_dict('records')])
+    return len(frame)
+
+
+# ---- materials ----
+
+def check_materials(since=None):
+    """Material totals against the non-void entries."""
+    materials = _frame(select(Material.id, Material.name, Material.total, Material.total_in, Material.total_out),
+                       ['id', 'name', 'total', 'total_in', 'total_out'])
+    entry = with_archive(Entry)
+    stmt = select(entry.material_id, entry.material, entry.type, func.sum(entry.qty))\
+        .where(_live(entry.is_void)).group_by(entry.material_id, entry.material, entry.type)
+    stmts = [stmt]
+    if since is not None:
+        touched = {i for (i,) in db.session.query(Material.id).filter(Material.updated_at > since)}
+        # no DISTINCT: with it the planner walks the material_id index instead of the updated_at range
+        changed = set(db.session.query(Entry.material_id, Entry.material).filter(Entry.updated_at > since))
+        touched |= {mid for mid, _ in changed if mid}
+        names = material_map([name for mid, name in changed if not mid and name])
+        touched |= {m.id for m in names.values() if m}
+        if len(touched) <= SCOPE_LIMIT:
+            materials = materials[materials['id'].isin(touched)]
+            # two statements, so each can use the material_id index
+            stmts = [stmt.where(entry.material_id.in_(touched)), stmt.where(entry.material_id.is_(None))]
+    # summed per (material, name, type) in SQL; names only matter for entries not linked yet
+    entries = pd.concat([_frame(s, ['material_id', 'material', 'type', 'qty']) for s in stmts], ignore_index=True)
+
+    unlinked = entries['material_id'].isna()
+    if unlinked.any():
+        names = material_map(entries.loc[unlinked, 'material'].dropna().unique())
+        entries.loc[unlinked, 'material_id'] = entries.loc[unlinked, 'material'].map(
+            {name: m.id for name, m in names.items() if m})
+    qty = entries['qty'].fillna(0).astype(float)
+    entries['qty_in'] = np.where(entries['type'] == 'IN', qty, 0.0)
+    entries['qty_out'] = np.where(entries['type'] == 'OUT', qty, 0.0)
+    sums = entries.dropna(subset=['material_id']).groupby('material_id')[['qty_in', 'qty_out']].sum()
+    sums.index = sums.index.astype(int)
+
+    expected = materials.join(sums, on='id')
+    expected[['qty_in', 'qty_out']] = expected[['qty_in', 'qty_out']].fillna(0.0)
+    expected['qty_total'] = expected['qty_in'] - expected['qty_out']
+    fields = {'total': 'qty_total', 'total_in': 'qty_in', 'total_out': 'qty_out'}
+    drift = _diff('material', expected, fields)
+
+    def repair():
+        return _rewrite(Material, expected[expected['id'].isin(drift['id'])], fields)
+
+    return SimpleNamespace(checked=len(materials), drift=drift, repair=repair)
+
+
+# ---- pending bills ----
+
+def _bill_scope(since):
+    """Ids of the bills written since `since` or fed by a booking, sale, payment or allocation written since."""
+    ids = {i for (i,) in db.session.query(PendingBill.id).filter(PendingBill.updated_at > since)}
+    ids |= {i for (i,) in db.session.query(PaymentAllocation.pending_bill_id).filter(or_(
+        PaymentAllocation.updated_at > since,
+        PaymentAllocation.payment_id.in_(select(Payment.id).where(Payment.updated_at > since))))}
+    refs = set()
+    for doc_id, manual in db.session.query(Booking.id, Booking.manual_bill_no).filter(Booking.updated_at > since):
+        refs |= {f'BK-{doc_id}', manual}
+    for doc_id, manual, invoice_no in db.session.query(DirectSale.id, DirectSale.manual_bill_no, Invoice.invoice_no)\
+            .outerjoin(Invoice, Invoice.id == DirectSale.invoice_id).filter(DirectSale.updated_at > since):
+        refs |= {f'DS-{doc_id}', f'CSH-{doc_id}', manual, invoice_no}
+    refs.discard(None)
+    refs.discard('')
+    if refs:
+        ids |= {i for (i,) in db.session.query(PendingBill.id).filter(PendingBill.bill_no.in_(refs))}
+    return ids
+
+
+def _dangling_bills():
+    """Ids of live bills with a live allocation of a deleted or voided payment, or a generated number whose
+    booking or sale is gone or void."""
+    pb = PendingBill
+    ids = {i for (i,) in db.session.query(PaymentAllocation.pending_bill_id).filter(
+        PaymentAllocation.is_void == False, ~_doc_exists(Payment, PaymentAllocation.payment_id))}
+    for model, prefixes in GENERATED_REFS.items():
+        for prefix in prefixes:
+            ids |= {i for (i,) in db.session.query(pb.id).filter(
+                _live(pb.is_void), pb.bill_no.like(f'{prefix}%'), ~_doc_exists(model, _ref_id(pb.bill_no, prefix)))}
+    return ids
+
+
+def _bill_documents(bill_nos=None):
+    """Frame of the bookings and direct sales with their bill ref, client code, unpaid amount and live flag."""
+    booking = with_archive(Booking)
+    stmt = select(booking.id, Client.code, booking.manual_bill_no, booking.amount, booking.paid_amount,
+                  booking.is_void).outerjoin(Client, Client.id == booking.client_id)
+    if bill_nos is not None:
+        ids = [int(n[3:]) for n in bill_nos if n.startswith('BK-') and n[3:].isdigit()]
+        stmt = stmt.where(or_(booking.manual_bill_no.in_(bill_nos), booking.id.in_(ids)))
+    bookings = _frame(stmt, ['id', 'code', 'manual', 'amount', 'paid', 'is_void'])
+    bookings['ref'] = bookings['manual'].where(bookings['manual'].fillna('') != '',
+                                               'BK-' + bookings['id'].astype(str))
+
+    sale = with_archive(DirectSale)
+    stmt = select(sale.id, Client.code, sale.manual_bill_no, Invoice.invoice_no, sale.category, sale.amount,
+                  sale.paid_amount, sale.is_void)\
+        .outerjoin(Client, Client.id == sale.client_id).outerjoin(Invoice, Invoice.id == sale.invoice_id)
+    if bill_nos is not None:
+        ids = [int(n.split('-', 1)[1]) for n in bill_nos
+               if n.startswith(('DS-', 'CSH-')) and n.split('-', 1)[1].isdigit()]
+        stmt = stmt.where(or_(sale.manual_bill_no.in_(bill_nos), Invoice.invoice_no.in_(bill_nos), sale.id.in_(ids)))
+    sales = _frame(stmt, ['id', 'code', 'manual', 'invoice_no', 'category', 'amount', 'paid', 'is_void'])
+    generated = np.where(sales['category'].fillna('').str.lower() == 'cash', 'CSH-', 'DS-')
+    sales['ref'] = sales['manual'].where(sales['manual'].fillna('') != '', sales['invoice_no'])
+    sales['ref'] = sales['ref'].where(sales['ref'].fillna('') != '', pd.Series(generated, index=sales.index)
+                                      + sales['id'].astype(str))
+
+    docs = pd.concat([bookings, sales], ignore_index=True)[['ref', 'code', 'amount', 'paid', 'is_void']]
+    docs['live'] = ~docs['is_void'].fillna(False).astype(bool)
+    docs['unpaid'] = (docs['amount'].fillna(0).astype(float) - docs['paid'].fillna(0).astype(float)).clip(lower=0)
+    docs['unpaid'] = docs['unpaid'].where(docs['live'], 0.0)
+    return docs
+
+
+def _bill_key(frame, ref, code):
+    # a generated number belongs to its document whichever client the bill is filed under
+    generated = frame[ref].fillna('').str.match(BILL_REF)
+    return frame[ref].fillna('') + '|' + frame[code].fillna('').where(~generated, '*')
+
+
+def check_bills(since=None):
+    """Pending bill amounts against their documents and allocations."""
+    pb = PendingBill
+    stmt = select(pb.id, pb.bill_no, pb.client_code, pb.amount, pb.is_paid).where(_live(pb.is_void))
+    scope = None
+    if since is not None:
+        scope = _bill_scope(since) | _dangling_bills()
+        if len(scope) > SCOPE_LIMIT:
+            scope = None
+        else:
+            stmt = stmt.where(pb.id.in_(scope))
+    bills = _frame(stmt, ['id', 'bill_no', 'client_code', 'amount', 'is_paid'])
+    bill_nos = None if scope is None else sorted(set(bills['bill_no'].dropna()))
+
+    docs = _bill_documents(bill_nos)
+    docs['key'] = _bill_key(docs, 'ref', 'code')
+    owners = docs.groupby('key').agg(unpaid=('unpaid', 'sum'), live=('live', 'sum'))
+
+    alloc = with_archive(PaymentAllocation)
+    stmt = select(alloc.id, alloc.pending_bill_id, alloc.amount, _doc_exists(Payment, alloc.payment_id))\
+        .where(alloc.is_void == False)
+    if scope is not None:
+        stmt = stmt.where(alloc.pending_bill_id.in_(scope))
+    allocs = _frame(stmt, ['id', 'bill_id', 'amount', 'payment_live'])
+    allocs['amount'] = allocs['amount'].fillna(0).astype(float)
+    allocs['payment_live'] = allocs['payment_live'].astype(bool)
+    applied = allocs[allocs['payment_live']].groupby('bill_id')['amount'].sum()
+    dangling = allocs[~allocs['payment_live']].groupby('bill_id')['amount'].sum()
+
+    bills['key'] = _bill_key(bills, 'bill_no', 'client_code')
+    bills = bills.join(owners, on='key')
+    bills['applied'] = bills['id'].map(applied).fillna(0.0)
+    bills['dangling'] = bills['id'].map(dangling).fillna(0.0)
+    stored = pd.to_numeric(bills['amount'], errors='coerce').fillna(0.0)
+    owned = bills['live'].notna()
+    generated = bills['bill_no'].fillna('').str.match(BILL_REF)
+    bills['want_amount'] = np.where(owned, (bills['unpaid'] - bills['applied']).clip(lower=0),
+                                    stored + bills['dangling'])
+    bills['want_void'] = (owned & (bills['live'] == 0)) | (~owned & generated)
+    paid = bills['is_paid'].fillna(False).astype(bool)
+    settled = bills['want_amount'] <= DRIFT_TOLERANCE
+    # allocation marks a bill paid when it reaches zero; giving an allocation back reopens it
+    bills['want_paid'] = np.where(bills['dangling'] > DRIFT_TOLERANCE, settled,
+                                  paid | (settled & (bills['applied'] > DRIFT_TOLERANCE)))
+    bills['want_paid'] = bills['want_paid'].astype(bool)
+    bills['is_void'] = False
+
+    voided = bills[bills['want_void']]
+    kept = bills[~bills['want_void']]
+    drift = pd.concat([_diff('pending_bill', voided, {'is_void': 'want_void'}),
+                       _diff('pending_bill', kept, {'amount': 'want_amount', 'is_paid': 'want_paid'})],
+                      ignore_index=True)
+    dangling_ids = allocs.loc[~allocs['payment_live'] & allocs['bill_id'].isin(bills['id']), 'id']
+    if len(dangling_ids):
+        drift = pd.concat([drift, pd.DataFrame({'check': 'allocation', 'id': dangling_ids, 'field': 'is_void',
+                                                'stored': False, 'expected': True})], ignore_index=True)
+
+    def repair():
+        off = drift.loc[drift['check'] == 'pending_bill', 'id']
+        repaired = _rewrite(PendingBill, voided[voided['id'].isin(off)], {'is_void': 'want_void'})
+        repaired += _rewrite(PendingBill, kept[kept['id'].isin(off)],
+                             {'amount': 'want_amount', 'is_paid': 'want_paid'})
+        if len(dangling_ids):
+            table = PaymentAllocation.__table__
+            db.session.execute(update(table).where(table.c.id == bindparam('_id')).values(is_void=True),
+                               [{'_id': int(i)} for i in dangling_ids])
+        return repaired + len(dangling_ids)
+
+    return SimpleNamespace(checked=len(bills), drift=drift, repair=repair)
+
+
+# ---- invoices ----
+
+def check_invoices(since=None):
+    """Invoice totals, balances and status against the live direct sales on them."""
+    stmt = select(Invoice.id, Invoice.total_amount, Invoice.balance, Invoice.status).where(_live(Invoice.is_void))
+    sale = with_archive(DirectSale)
+    sale_stmt = select(sale.invoice_id, sale.amount, sale.paid_amount).where(
+        sale.invoice_id.isnot(None), _live(sale.is_void))
+    if since is not None:
+        scope = {i for (i,) in db.session.query(Invoice.id).filter(Invoice.updated_at > since)}
+        scope |= {i for (i,) in db.session.query(DirectSale.invoice_id).filter(
+            DirectSale.updated_at > since, DirectSale.invoice_id.isnot(None))}
+        if len(scope) <= SCOPE_LIMIT:
+            stmt = stmt.where(Invoice.id.in_(scope))
+            sale_stmt = sale_stmt.where(sale.invoice_id.in_(scope))
+    invoices = _frame(stmt, ['id', 'total_amount', 'balance', 'status'])
+    sales = _frame(sale_stmt, ['invoice_id', 'amount', 'paid'])
+    entry = with_archive(Entry)
+    priced = {i for (i,) in db.session.execute(select(entry.invoice_id).where(entry.invoice_id.isnot(None)).distinct())}
+
+    sales['amount'] = sales['amount'].fillna(0).astype(float)
+    sales['paid'] = sales['paid'].fillna(0).astype(float)
+    sales['unpaid'] = (sales['amount'] - sales['paid']).clip(lower=0)
+    sums = sales.groupby('invoice_id')[['amount', 'paid', 'unpaid']].sum()
+    sums.index = sums.index.astype(int)
+    invoices = invoices[~invoices['id'].isin(priced)].join(sums, on='id', how='inner')
+    invoices['want_status'] = np.select(
+        [invoices['unpaid'] <= DRIFT_TOLERANCE, invoices['paid'] > DRIFT_TOLERANCE], ['PAID', 'PARTIAL'], 'OPEN')
+    fields = {'total_amount': 'amount', 'balance': 'unpaid', 'status': 'want_status'}
+    drift = _diff('invoice', invoices, fields)
+
+    def repair():
+        return _rewrite(Invoice, invoices[invoices['id'].isin(drift['id'])], fields)
+
+    return SimpleNamespace(checked=len(invoices), drift=drift, repair=repair)
+
+
+# ---- stock entries of missing sales (reported only) ----
+
+def check_sale_entries(since=None):
+    """Live entries filed under UNBILLED-<id> whose direct sale is gone or void."""
+    stmt = select(Entry.id).where(_live(Entry.is_void), Entry.bill_no.like(f'{SALE_ENTRY_REF}%'),
+                                  ~_doc_exists(DirectSale, _ref_id(Entry.bill_no, SALE_ENTRY_REF)))
+    orphans = _frame(stmt, ['id'])
+    drift = pd.DataFrame({'check': 'sale_entry', 'id': orphans['id'], 'field': 'is_void',
+                          'stored': False, 'expected': True})
+    return SimpleNamespace(checked=len(orphans), drift=drift, repair=lambda: 0)
+
+
+CHECKS = (check_materials, check_bills, check_invoices, check_sale_entries)
+
+
+def watermark():
+    """Start of the last run that came out clean or was repaired; incremental checks start there."""
+    return db.session.query(func.max(IntegrityCheck.started_at)).filter(
+        IntegrityCheck.status == 'DONE', or_(IntegrityCheck.drift == 0, IntegrityCheck.repair == True)).scalar()
+
+
+def verify_integrity(repair=False, incremental=False, created_by=None):
+    """Recompute the derived figures, diff them against the stored ones and, with repair=True, rewrite them.
+
+    Returns the finished IntegrityCheck; its `rows` attribute holds the drift
+    DataFrame (check, id, field, stored, expected) of this run.
+    """
+    since = watermark() if incremental else None
+    run = IntegrityCheck(mode='incremental' if since else 'full', repair=repair, created_by=created_by)
+    db.session.add(run)
+    db.session.commit()
+    run_id = run.id
+    try:
+        db.session.execute(text('BEGIN IMMEDIATE' if repair else 'BEGIN'))
+        results = [check(since) for check in CHECKS]
+        drift = pd.concat([r.drift for r in results], ignore_index=True)
+        repaired = sum(r.repair() for r in results) if repair and len(drift) else 0
+        if not repair:
+            db.session.rollback()  # let go of the read snapshot
+        db.session.execute(update(IntegrityCheck.__table__).where(IntegrityCheck.id == run_id).values(
+            status='DONE', checked=sum(r.checked for r in results), drift=len(drift), repaired=repaired,
+            details=drift.head(DETAIL_ROWS).to_json(orient='records'), finished_at=datetime.now()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        IntegrityCheck.query.filter_by(id=run_id).update(
+            {'status': 'FAILED', 'details': str(e)[:500], 'finished_at': datetime.now()},
+            synchronize_session=False)
+        db.session.commit()
+        raise
+    if repaired:
+        logging.warning(f"Integrity check repaired {repaired} rows")
+    run = db.session.get(IntegrityCheck, run_id)
+    run.rows = drift
+    return run
+
+
+def integrity_job(job_id, repair=False, incremental=False, created_by=None):
+    """Job body for `utils.jobs.start_job`: verify_integrity. Returns the job message."""
+    update_job(job_id, total=1)
+    run = verify_integrity(repair, incremental, created_by)
+    update_job(job_id, done=1)
+    return summary(run)
+
+
+def summary(run):
+    message = f"{run.mode.capitalize()} check: {run.checked} rows checked, {run.drift} off"
+    return message + (f", {run.repaired} repaired" if run.repair else '')
@@ -0,0 +1,61 @@
+"""
+Background job helpers.
+
+Long-running work is started from a request, runs in a daemon thread with
+its own app context and reports progress through a `BackgroundJob` row
+that pages can poll via `/api/jobs/<id>`.
+"""
+import logging
+import threading
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, BackgroundJob
+
+
+def update_job(job_id, **fields):
+    """Write progress fields (done, total, message, ...) and commit them."""
+    BackgroundJob.query.filter_by(id=job_id).update(fields, synchronize_session=False)
+    db.session.commit()
+
+
+def start_job(kind, target, *args, created_by=None, total=0):
+    """Create a job record and run `target(job_id, *args)` in a thread.
+
+    The return value of `target` is stored as the job message.
+    """
+    job = BackgroundJob(kind=kind, status='PENDING', total=total, done=0, created_by=created_by)
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+    app = current_app._get_current_object()
+
+    def runner():
+        with app.app_context():
+            try:
+                update_job(job_id, status='RUNNING')
+                message = target(job_id, *args)
+                update_job(job_id, status='DONE', message=(message or '')[:500], finished_at=datetime.now())
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Job {job_id} ({kind}) failed: {str(e)}")
+                update_job(job_id, status='FAILED', message=str(e)[:500], finished_at=datetime.now())
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=runner, name=f"job-{job_id}", daemon=True).start()
+    return job_id
+
+
+def job_as_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'total': job.total or 0,
+        'done': job.done or 0,
+        'message': job.message,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,339 @@
+"""
+Client journal.
+
+Every booking, payment and direct sale posts to `journal_line`: debit is
+what the client was billed (booking or sale amount), credit what they paid
+(the paid part of a booking or sale, or the payment). Lines are never
+updated or deleted. An edit, void or delete posts the difference as a new
+line, so summing a document's lines gives its current figures and summing
+a client's lines gives their balance.
+
+Postings are collected on flush (after `utils.links` has filled client_id)
+and written once on commit, netted per document, client and date.
+`verify_journal` compares the journal with the documents and, with
+repair=True, posts the missing difference. That is also how existing data
+is backfilled. Repair runs from `flask verify-journal --repair` and the
+'rollups' maintenance job, which only the lease holder runs; never at
+startup, where every worker would post the same difference.
+`refresh_journal` does the same for clients whose documents were moved
+with bulk updates.
+
+Ledgers, balances and aging read this table with range scans on
+(client_id, date). It is the only source of client balances:
+`client_balance_snapshot` rows are sums of journal lines, `balance_as_of`
+adds the lines after the latest snapshot, and every line posted (on
+commit, by repair or by `reverse_deleted`) shifts the later snapshots of
+its client in the same transaction, so they never go stale.
+
+Only the client side is posted: there is no contra (cash or sales)
+account, and invoices and pending bills, which restate bookings and sales
+already posted here, post nothing.
+"""
+import logging
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, func, literal, select, exists, or_, and_, update
+from sqlalchemy.orm import Session, attributes
+
+from models import db, JournalLine, ClientBalanceSnapshot
+from utils.finance import FINANCE_SOURCES, DRIFT_TOLERANCE, _client_filter, day_range
+from utils.links import previous_value, was_relinked
+
+JOURNAL_LINES = 'journal_lines'
+
+AGING_BUCKETS = (30, 60, 90)
+
+
+def _posting(obj, kind, old=False):
+    """(date_posted, client_id, debit, credit) for a document, or None when it posts nothing."""
+    def value(attr):
+        return previous_value(obj, attr) if old else getattr(obj, attr)
+
+    if value('is_void') or value('date_posted') is None:
+        return None
+    amount = value('amount') or 0
+    if kind == 'payment':
+        debit, credit = 0, amount
+    else:
+        debit, credit = amount, value('paid_amount') or 0
+    if not (debit or credit):
+        return None
+    return value('date_posted'), value('client_id'), debit, credit
+
+
+def _queue(lines, kind, doc_id, posting, sign):
+    if posting is None:
+        return
+    key = (kind, doc_id, posting[1], posting[0])
+    debit, credit = lines.get(key, (0, 0))
+    lines[key] = (debit + sign * posting[2], credit + sign * posting[3])
+
+
+@event.listens_for(Session, 'after_flush')
+def _post_journal_after_flush(session, flush_context):
+    lines = session.info.setdefault(JOURNAL_LINES, {})
+    for objs, is_new in ((session.new, True), (session.dirty, False), (session.deleted, None)):
+        for obj in objs:
+            source = FINANCE_SOURCES.get(type(obj))
+            if not source:
+                continue
+            kind, fields = source
+            if is_new:
+                _queue(lines, kind, obj.id, _posting(obj, kind), 1)
+            elif is_new is None:
+                _queue(lines, kind, obj.id, _posting(obj, kind, old=True), -1)
+            elif was_relinked(obj) or any(attributes.get_history(obj, f).has_changes() for f in fields):
+                _queue(lines, kind, obj.id, _posting(obj, kind, old=True), -1)
+                _queue(lines, kind, obj.id, _posting(obj, kind), 1)
+
+
+def _insert_lines(session, lines):
+    rows = [{'doc_type': kind, 'doc_id': doc_id, 'client_id': cid, 'date': day,
+             'debit': d[0], 'credit': d[1], 'posted_at': datetime.now()}
+            for (kind, doc_id, cid, day), d in lines.items()
+            if abs(d[0]) > DRIFT_TOLERANCE or abs(d[1]) > DRIFT_TOLERANCE]
+    if rows:
+        last_id = _last_line_id(session)
+        session.execute(JournalLine.__table__.insert(), rows)
+        _shift_snapshots(session, last_id)
+    return len(rows)
+
+
+def _last_line_id(session):
+    return session.execute(select(func.max(JournalLine.id))).scalar() or 0
+
+
+def _shift_snapshots(session, after_id):
+    """Add the lines posted after `after_id` to every snapshot of their client on or after their date."""
+    jl = JournalLine.__table__
+    snap = ClientBalanceSnapshot.__table__
+    posted = and_(jl.c.id > after_id, jl.c.client_id == snap.c.client_id, func.date(jl.c.date) <= snap.c.date)
+    session.execute(update(snap).where(exists().where(posted))
+                    .values(balance=snap.c.balance + select(func.sum(jl.c.debit - jl.c.credit))
+                            .where(posted).scalar_subquery()))
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_on_commit(session):
+    session.flush()
+    _insert_lines(session, session.info.pop(JOURNAL_LINES, {}))
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _reset_transaction_state(session, *args):
+    session.info.pop(JOURNAL_LINES, None)
+
+
+def _expected_lines(client_ids=None):
+    """{(doc_type, doc_id, client_id, date): (debit, credit)} from the documents, archived ones included."""
+    from utils.archive import with_archive
+    expected = {}
+    for source, (kind, _) in FINANCE_SOURCES.items():
+        model = with_archive(source)
+        if kind == 'payment':
+            debit, credit = literal(0), func.coalesce(model.amount, 0)
+        else:
+            debit, credit = func.coalesce(model.amount, 0), func.coalesce(model.paid_amount, 0)
+        q = db.session.query(model.id, model.client_id, model.date_posted, debit, credit)\
+            .filter(model.is_void == False, model.date_posted.isnot(None))
+        if client_ids is not None:
+            q = q.filter(_client_filter(model.client_id, client_ids))
+        for doc_id, cid, day, d, c in q:
+            if d or c:
+                expected[(kind, doc_id, cid, day)] = (d, c)
+    return expected
+
+
+def _journal_sums(client_ids=None):
+    q = db.session.query(JournalLine.doc_type, JournalLine.doc_id, JournalLine.client_id, JournalLine.date,
+                         func.sum(JournalLine.debit), func.sum(JournalLine.credit))
+    if client_ids is not None:
+        q = q.filter(_client_filter(JournalLine.client_id, client_ids))
+    return {tuple(row[:4]): (row[4] or 0, row[5] or 0)
+            for row in q.group_by(JournalLine.doc_type, JournalLine.doc_id, JournalLine.client_id, JournalLine.date)}
+
+
+def _differences(client_ids=None):
+    expected = _expected_lines(client_ids)
+    stored = _journal_sums(client_ids)
+    diff = {}
+    for key in set(expected) | set(stored):
+        want, have = expected.get(key, (0, 0)), stored.get(key, (0, 0))
+        if any(abs(w - h) > DRIFT_TOLERANCE for w, h in zip(want, have)):
+            diff[key] = (want[0] - have[0], want[1] - have[1])
+    return diff
+
+
+def refresh_journal(client_ids):
+    """Post the lines that bring the journal of `client_ids` (None for walk-ins) in line after a bulk client_id move."""
+    return _insert_lines(db.session, _differences(set(client_ids)))
+
+
+def verify_journal(repair=False):
+    """Compare the journal with the bookings, payments and sales it is posted from.
+
+    Returns one dict per (doc_type, doc_id, client_id, date) whose lines do
+    not add up to the document; repair=True posts the differences and commits.
+    """
+    diff = _differences()
+    drift = [{'key': key, 'missing': d}
+             for key, d in sorted(diff.items(), key=lambda i: (i[0][0], i[0][1], i[0][2] or 0, i[0][3]))]
+    if repair and diff:
+        _insert_lines(db.session, diff)
+        db.session.commit()
+        logging.warning(f"Posted {len(diff)} correcting journal lines")
+    return drift
+
+
+def reverse_deleted(doc_type):
+    """Post the lines that bring every deleted `doc_type` document's lines to zero, in one INSERT ... SELECT.
+
+    For rows removed with Core deletes (the settings wipe), which the flush
+    hooks never see; the lines themselves are never deleted. Returns the
+    number of lines posted; not committed.
+    """
+    from utils.archive import archive_table, archive_ready
+    source = next(model for model, (kind, _) in FINANCE_SOURCES.items() if kind == doc_type)
+    tables = [source.__table__] + ([archive_table(source)] if archive_ready() else [])
+    jl = JournalLine.__table__
+    debit, credit = func.sum(jl.c.debit), func.sum(jl.c.credit)
+    last_id = _last_line_id(db.session)
+    lines = select(jl.c.doc_type, jl.c.doc_id, jl.c.client_id, jl.c.date, -debit, -credit, literal(datetime.now()))\
+        .where(jl.c.doc_type == doc_type, *(~exists().where(t.c.id == jl.c.doc_id) for t in tables))\
+        .group_by(jl.c.doc_type, jl.c.doc_id, jl.c.client_id, jl.c.date)\
+        .having(or_(func.abs(debit) > DRIFT_TOLERANCE, func.abs(credit) > DRIFT_TOLERANCE))
+    posted = db.session.execute(jl.insert().from_select(
+        ['doc_type', 'doc_id', 'client_id', 'date', 'debit', 'credit', 'posted_at'], lines)).rowcount
+    if posted:
+        _shift_snapshots(db.session, last_id)
+    return posted
+
+
+def client_balance(client_id, until=None):
+    """Debits less credits of the client's lines dated before `until` (a datetime; all lines if None)."""
+    q = db.session.query(func.sum(JournalLine.debit - JournalLine.credit)).filter(JournalLine.client_id == client_id)
+    if until is not None:
+        q = q.filter(JournalLine.date < until)
+    return q.scalar() or 0
+
+
+def client_totals(client_ids=None):
+    """{client_id: (debit, credit)} over all lines, in one grouped scan."""
+    q = db.session.query(JournalLine.client_id, func.sum(JournalLine.debit), func.sum(JournalLine.credit))\
+        .filter(JournalLine.client_id.isnot(None))
+    if client_ids is not None:
+        q = q.filter(JournalLine.client_id.in_(client_ids))
+    return {cid: (d or 0, c or 0) for cid, d, c in q.group_by(JournalLine.client_id)}
+
+
+def document_lines(client_id, start=None, end=None):
+    """[(doc_type, doc_id, date, debit, credit)] for the client's documents dated in [start, end), oldest first.
+
+    Lines of one document on one date are summed; a document moved to
+    another date or voided nets to zero on the old date and is left out.
+    """
+    debit, credit = func.sum(JournalLine.debit), func.sum(JournalLine.credit)
+    q = db.session.query(JournalLine.doc_type, JournalLine.doc_id, JournalLine.date, debit, credit)\
+        .filter(JournalLine.client_id == client_id)
+    if start is not None:
+        q = q.filter(JournalLine.date >= start)
+    if end is not None:
+        q = q.filter(JournalLine.date < end)
+    q = q.group_by(JournalLine.doc_type, JournalLine.doc_id, JournalLine.date)\
+        .having(func.abs(debit) + func.abs(credit) > DRIFT_TOLERANCE)
+    return q.order_by(JournalLine.date, JournalLine.doc_type, JournalLine.doc_id).all()
+
+
+def take_balance_snapshots(day, client_ids=None):
+    """Write every client's balance at the end of `day` ('YYYY-MM-DD'), replacing that day's snapshots.
+
+    Starts from each client's previous snapshot and adds the journal lines after it.
+    Returns the number of snapshots written; the caller commits.
+    """
+    snap = ClientBalanceSnapshot
+    prior = db.session.query(snap.client_id, func.max(snap.date).label('date')).filter(snap.date < day)
+    if client_ids is not None:
+        prior = prior.filter(snap.client_id.in_(client_ids))
+    prior = prior.group_by(snap.client_id).subquery()
+
+    balances = dict(db.session.query(snap.client_id, snap.balance)
+                    .join(prior, and_(snap.client_id == prior.c.client_id, snap.date == prior.c.date)))
+    tail = db.session.query(JournalLine.client_id, func.sum(JournalLine.debit - JournalLine.credit))\
+        .outerjoin(prior, prior.c.client_id == JournalLine.client_id)\
+        .filter(JournalLine.client_id.isnot(None), JournalLine.date < day_range(day, day)[1],
+                func.date(JournalLine.date) > func.coalesce(prior.c.date, ''))
+    if client_ids is not None:
+        tail = tail.filter(JournalLine.client_id.in_(client_ids))
+    for cid, bal in tail.group_by(JournalLine.client_id):
+        balances[cid] = balances.get(cid, 0) + (bal or 0)
+
+    stale = ClientBalanceSnapshot.query.filter(ClientBalanceSnapshot.date == day)
+    if client_ids is not None:
+        stale = stale.filter(ClientBalanceSnapshot.client_id.in_(client_ids))
+    stale.delete(synchronize_session=False)
+    if balances:
+        db.session.execute(ClientBalanceSnapshot.__table__.insert(),
+                           [{'client_id': cid, 'date': day, 'balance': bal} for cid, bal in balances.items()])
+    return len(balances)
+
+
+def ensure_month_end_snapshot(today=None):
+    """Snapshot balances at the end of last month unless that was already done. Returns the day or None."""
+    today = today or datetime.now().date()
+    day = (today.replace(day=1) - timedelta(days=1)).strftime('%Y-%m-%d')
+    if db.session.query(ClientBalanceSnapshot.id).filter_by(date=day).first():
+        return None
+    take_balance_snapshots(day)
+    db.session.commit()
+    return day
+
+
+def latest_snapshot(client_id, day):
+    """The client's last snapshot on or before `day`, or None."""
+    return ClientBalanceSnapshot.query.filter(ClientBalanceSnapshot.client_id == client_id,
+                                              ClientBalanceSnapshot.date <= day)\
+        .order_by(ClientBalanceSnapshot.date.desc()).first()
+
+
+def balance_as_of(client_id, day):
+    """Client balance at the end of `day`: latest snapshot plus the journal lines after it."""
+    snapshot = latest_snapshot(client_id, day)
+    q = db.session.query(func.sum(JournalLine.debit - JournalLine.credit))\
+        .filter(JournalLine.client_id == client_id, JournalLine.date < day_range(day, day)[1])
+    if snapshot:
+        q = q.filter(JournalLine.date >= day_range(snapshot.date, snapshot.date)[1])
+    return (snapshot.balance if snapshot else 0) + (q.scalar() or 0)
+
+
+def aging(as_of=None, client_ids=None, buckets=AGING_BUCKETS):
+    """{client_id: {'balance': x, '0-30': x, ..., '90+': x}} of what each client owes at `as_of` (a date).
+
+    Payments settle the oldest bills first, so the open balance sits on the
+    newest bills; each bill's open part is aged by its date.
+    """
+    as_of = as_of or datetime.now().date()
+    end = datetime.combine(as_of + timedelta(days=1), time.min)
+    labels = [f"{lo + 1 if lo else 0}-{hi}" for lo, hi in zip((0,) + buckets[:-1], buckets)] + [f"{buckets[-1]}+"]
+
+    q = db.session.query(JournalLine.client_id, JournalLine.date, func.sum(JournalLine.debit),
+                         func.sum(JournalLine.credit)).filter(JournalLine.client_id.isnot(None), JournalLine.date < end)
+    if client_ids is not None:
+        q = q.filter(JournalLine.client_id.in_(client_ids))
+    rows = q.group_by(JournalLine.client_id, JournalLine.doc_type, JournalLine.doc_id, JournalLine.date)\
+        .order_by(JournalLine.client_id, JournalLine.date.desc()).all()
+
+    result = {}
+    balances = {}
+    for cid, _, debit, credit in rows:
+        balances[cid] = balances.get(cid, 0) + (debit or 0) - (credit or 0)
+    for cid, day, debit, _ in rows:
+        entry = result.setdefault(cid, dict({'balance': balances[cid]}, **{label: 0 for label in labels}))
+        # newest bills first: each takes what is left of the balance, up to its own amount
+        left = balances[cid] - sum(entry[label] for label in labels)
+        if left <= DRIFT_TOLERANCE or not debit or debit <= 0:
+            continue
+        age = (as_of - day.date()).days
+        label = next((lb for lb, hi in zip(labels, buckets) if age <= hi), labels[-1])
+        entry[label] += min(debit, left)
+    return result
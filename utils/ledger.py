@@ -0,0 +1,101 @@
+"""
+Booking balances per client and material.
+
+The material half of the client ledger lists what a client booked and what
+was dispatched against it, with a running balance per material. Period
+close stores the balances at the close date (`ClientMaterialOpening`), so
+the ledger only has to walk the rows after it.
+"""
+from models import Booking, DirectSale, Entry
+from utils.finance import day_range
+
+
+def booking_material_history(client_id, after=None, until=None, openings=None):
+    """Booking and dispatch rows for a client, oldest first, each with its material's running balance.
+
+    `after` / `until` ('YYYY-MM-DD') keep rows dated after the first and up
+    to the second. Balances start from `openings` ({material: qty}).
+    """
+    def dated(model):
+        q = model.query.filter(model.client_id == client_id, model.is_void == False)
+        if after:
+            q = q.filter(model.date_posted >= day_range(after, after)[1])
+        if until:
+            q = q.filter(model.date_posted < day_range(until, until)[1])
+        return q
+
+    deliveries = Entry.query.filter(Entry.client_id == client_id, Entry.type == 'OUT', Entry.is_void == False)
+    if after:
+        deliveries = deliveries.filter(Entry.date > after)
+    if until:
+        deliveries = deliveries.filter(Entry.date <= until)
+
+    history = []
+    seen_bills = set()
+
+    for b in dated(Booking).order_by(Booking.date_posted.asc()):
+        for item in b.items:
+            history.append({
+                'date': b.date_posted.strftime('%Y-%m-%d') if b.date_posted else (b.created_at[:10] if b.created_at else ''),
+                'material': item.material_name,
+                'qty_added': item.qty,
+                'qty_dispatched': 0,
+                'bill_no': b.manual_bill_no,
+                'nimbus_no': 'Booking',
+                'type': 'Booking'
+            })
+
+    for d in deliveries.order_by(Entry.date.asc(), Entry.time.asc()):
+        # Standalone direct sales ("Cash/Credit & Carry") are not booking deliveries
+        if d.nimbus_no == 'Direct Sale' and d.client_category != 'Booking Delivery':
+            continue
+        history.append({
+            'date': d.date,
+            'material': d.material,
+            'qty_added': 0,
+            'qty_dispatched': d.qty,
+            'bill_no': d.bill_no or d.auto_bill_no,
+            'nimbus_no': d.nimbus_no,
+            'type': 'Dispatch'
+        })
+        if d.bill_no:
+            seen_bills.add(d.bill_no)
+        if d.auto_bill_no:
+            seen_bills.add(d.auto_bill_no)
+
+    # Booking-customer sales whose dispatch entries are missing
+    for s in dated(DirectSale):
+        bill_ref = s.manual_bill_no or s.auto_bill_no
+        if bill_ref in seen_bills or s.category != 'Booking Customer':
+            continue
+        for item in s.items:
+            # Skip non-booked items (Price > 0) in mixed transactions
+            if item.price_at_time > 0:
+                continue
+            history.append({
+                'date': s.date_posted.strftime('%Y-%m-%d') if s.date_posted else '',
+                'material': item.product_name,
+                'qty_added': 0,
+                'qty_dispatched': item.qty,
+                'bill_no': bill_ref,
+                'nimbus_no': 'Direct Sale',
+                'type': 'Dispatch'
+            })
+
+    # Sort by date, then Booking before Dispatch so the balance doesn't dip
+    history.sort(key=lambda x: (x['date'] or '', 2 if x['type'] == 'Dispatch' else 0))
+
+    balances = dict(openings or {})
+    for item in history:
+        mat = item['material']
+        balances[mat] = balances.get(mat, 0) + item['qty_added'] - item['qty_dispatched']
+        item['balance'] = balances[mat]
+    return history
+
+
+def closing_balances(history, openings=None):
+    """{material: balance} after the last row of `history`."""
+    balances = dict(openings or {})
+    for item in history:
+        balances[item['material']] = item['balance']
+    return balances
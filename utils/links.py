@@ -0,0 +1,237 @@
+"""
+Integer client/material links on transaction rows.
+
+Bookings, payments, direct sales and stock entries used to point at their
+client by name (Entry by code or name) and item rows at their material by
+name. Each of them now carries an indexed `client_id` / `material_id` that
+ledgers, balances and dispatch checks join on; the name columns are kept
+for display only.
+
+Ids are filled in on flush for ORM writes. Rows written with bulk inserts,
+and rows from before the columns existed, are picked up by
+`backfill_links`, which works in short id-ordered batches so it can run
+while the app is serving requests.
+"""
+import logging
+
+from sqlalchemy import event, or_, select, update, bindparam
+from sqlalchemy.orm import Session, attributes, object_session
+
+from models import (db, Client, Material, Entry, Booking, BookingItem, Payment, DirectSale, DirectSaleItem,
+                    GRNItem, DeliveryItem)
+from utils.names import name_key
+from utils.stock import MATERIAL_MAP
+
+# model -> (id attribute, code attribute or None, name attribute)
+CLIENT_LINKS = {
+    Entry: ('client_id', 'client_code', 'client'),
+    Booking: ('client_id', None, 'client_name'),
+    Payment: ('client_id', None, 'client_name'),
+    DirectSale: ('client_id', None, 'client_name'),
+}
+
+MATERIAL_LINKS = {
+    Entry: ('material_id', None, 'material'),
+    BookingItem: ('material_id', None, 'material_name'),
+    DirectSaleItem: ('material_id', None, 'product_name'),
+    GRNItem: ('material_id', None, 'mat_name'),
+    DeliveryItem: ('material_id', None, 'product'),
+}
+
+BACKFILL_BATCH = 5000
+
+# {(model, id): {id attribute: value}} for rows whose link was re-resolved in this flush
+RELINKED = 'relinked'
+
+
+class LinkResolver:
+    """Map codes/names to ids: exact code, then exact name, then name_key."""
+
+    def __init__(self, target, rows):
+        self.target = target
+        self.by_code = {}
+        self.by_name = {}
+        self.by_key = {}
+        self.add(rows)
+
+    def add(self, rows):
+        for id_, code, name in rows:
+            if code:
+                self.by_code.setdefault(code, id_)
+            if name:
+                self.by_name.setdefault(name, id_)
+                self.by_key.setdefault(name_key(name), id_)
+
+    @classmethod
+    def load(cls, target, conn=None):
+        """Resolver over the whole client or material directory."""
+        stmt = select(target.id, target.code, target.name)
+        return cls(target, (conn or db.session).execute(stmt))
+
+    @classmethod
+    def for_keys(cls, target, conn, codes, names):
+        """Resolver over just the directory rows matching `codes` / `names`."""
+        codes, names = list(codes), list(names)
+        resolver = cls(target, [])
+        if codes or names:
+            resolver.add(conn.execute(select(target.id, target.code, target.name).where(
+                or_(target.code.in_(codes), target.name.in_(names)))))
+        missing = [name_key(n) for n in names if n not in resolver.by_name and name_key(n)]
+        if missing:
+            resolver.add(conn.execute(select(target.id, target.code, target.name).where(
+                target.name_key.in_(missing))))
+        return resolver
+
+    def resolve(self, code=None, name=None):
+        if code and code in self.by_code:
+            return self.by_code[code]
+        if name:
+            if name in self.by_name:
+                return self.by_name[name]
+            return self.by_key.get(name_key(name))
+        return None
+
+
+def _needs_link(obj, is_new, id_attr, code_attr, name_attr):
+    if is_new:
+        return getattr(obj, id_attr) is None
+    if attributes.get_history(obj, id_attr).has_changes():
+        return False
+    return any(attr and attributes.get_history(obj, attr).has_changes() for attr in (code_attr, name_attr))
+
+
+def _link_pending(session, links, target):
+    conn = session.connection()
+    pending = []
+    for is_new, objs in ((True, session.new), (False, session.dirty)):
+        for obj in objs:
+            spec = links.get(type(obj))
+            if spec and _needs_link(obj, is_new, *spec):
+                pending.append((obj, spec))
+    if not pending:
+        return
+
+    codes = {getattr(o, s[1]) for o, s in pending if s[1] and getattr(o, s[1])}
+    names = {getattr(o, s[2]) for o, s in pending if getattr(o, s[2])}
+    known = []
+    if target is Material:
+        # materials the request already loaded through utils.stock.material_map
+        cached = session.info.get(MATERIAL_MAP, {})
+        known = [(m.id, m.code, m.name) for n, m in cached.items() if m is not None and n in names]
+        names -= {n for _, _, n in known}
+    resolver = LinkResolver.for_keys(target, conn, codes, names)
+    resolver.add(known)
+
+    by_table = {}
+    relinked = session.info.setdefault(RELINKED, {})
+    for obj, (id_attr, code_attr, name_attr) in pending:
+        value = resolver.resolve(getattr(obj, code_attr) if code_attr else None, getattr(obj, name_attr))
+        if obj not in session.new:
+            # setting the committed value wipes the history later after_flush hooks read
+            relinked.setdefault((type(obj), obj.id), {})[id_attr] = getattr(obj, id_attr)
+        attributes.set_committed_value(obj, id_attr, value)
+        by_table.setdefault((type(obj), id_attr), []).append({'_id': obj.id, '_value': value})
+
+    for (model, id_attr), params in by_table.items():
+        table = model.__table__
+        conn.execute(update(table).where(table.c.id == bindparam('_id'))
+                     .values({id_attr: bindparam('_value')}), params)
+
+
+@event.listens_for(Session, 'after_flush')
+def _link_after_flush(session, flush_context):
+    # new/dirty still hold the pre-flush state here, and every row has its id
+    _link_pending(session, CLIENT_LINKS, Client)
+    _link_pending(session, MATERIAL_LINKS, Material)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _forget_relinked(session, flush_context):
+    session.info.pop(RELINKED, None)
+
+
+def was_relinked(obj):
+    """Whether this flush re-resolved one of the row's links from a changed name or code."""
+    return (type(obj), obj.id) in object_session(obj).info.get(RELINKED, {})
+
+
+def previous_value(obj, attr):
+    """`attr` of a flushed row as it was loaded: its history, or the id it had before being re-linked."""
+    history = attributes.get_history(obj, attr)
+    if history.deleted:
+        return history.deleted[0]
+    relinked = object_session(obj).info.get(RELINKED, {}).get((type(obj), obj.id), {})
+    return relinked[attr] if attr in relinked else getattr(obj, attr)
+
+
+def _backfill_table(model, id_attr, code_attr, name_attr, resolver, batch_size):
+    id_col = getattr(model, id_attr)
+    cols = [model.id, getattr(model, name_attr)] + ([getattr(model, code_attr)] if code_attr else [])
+    table = model.__table__
+    stmt = update(table).where(table.c.id == bindparam('_id')).values({id_attr: bindparam('_value')})
+    last_id = 0
+    linked = 0
+    while True:
+        rows = db.session.query(*cols).filter(id_col.is_(None), model.id > last_id)\
+            .order_by(model.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        params = []
+        for row in rows:
+            value = resolver.resolve(row[2] if code_attr else None, row[1])
+            if value is not None:
+                params.append({'_id': row[0], '_value': value})
+        if params:
+            db.session.execute(stmt, params)
+            linked += len(params)
+        db.session.commit()
+    return linked
+
+
+def backfill_links(batch_size=BACKFILL_BATCH):
+    """Fill missing client_id/material_id values from names, one short transaction per batch.
+
+    Rows whose name matches no client/material stay NULL (walk-in customers,
+    suppliers on IN entries) and are checked again on the next run.
+    Returns {table: rows linked}.
+    """
+    result = {}
+    for links, target in ((CLIENT_LINKS, Client), (MATERIAL_LINKS, Material)):
+        resolver = LinkResolver.load(target)
+        for model, spec in links.items():
+            linked = _backfill_table(model, *spec, resolver, batch_size)
+            key = f"{model.__tablename__}.{spec[0]}"
+            result[key] = linked
+            if linked:
+                logging.info(f"Linked {linked} rows of {key}")
+    return result
+
+
+def link_client_rows(client):
+    """Attach unlinked rows carrying this client's name or code to it. Returns {table: rows linked}."""
+    linked = {}
+    for model, (id_attr, code_attr, name_attr) in CLIENT_LINKS.items():
+        match = model.name_key == name_key(client.name)
+        if code_attr:
+            match = or_(match, getattr(model, code_attr) == client.code)
+        linked[model.__tablename__] = model.query.filter(getattr(model, id_attr).is_(None), match)\
+            .update({id_attr: client.id}, synchronize_session=False)
+    return linked
+
+
+def propagate_client_rename(client):
+    """Rewrite the display name/code on every row linked to `client`."""
+    key = name_key(client.name)
+    Entry.query.filter_by(client_id=client.id).update(
+        {'client': client.name, 'client_code': client.code, 'name_key': key}, synchronize_session=False)
+    for model in (Booking, Payment, DirectSale):
+        model.query.filter_by(client_id=client.id).update(
+            {'client_name': client.name, 'name_key': key}, synchronize_session=False)
+
+
+def propagate_material_rename(material):
+    """Rewrite the display name on every row linked to `material`."""
+    for model, (id_attr, _, name_attr) in MATERIAL_LINKS.items():
+        model.query.filter(getattr(model, id_attr) == material.id).update(
+            {name_attr: material.name}, synchronize_session=False)
@@ -0,0 +1,363 @@
+"""
+Scheduled maintenance.
+
+Jobs are registered with `register_job(name, every, description)` and run
+by an in-process scheduler thread (`start_scheduler`) that wakes every TICK
+seconds. Every worker process starts one, but only the holder of the
+'maintenance' `SchedulerLease` row runs jobs: each tick a worker takes the
+lease if it is free or expired, or renews it if it already holds it, in
+one conditional UPDATE. If the leader dies, another worker takes over once
+the lease runs out.
+
+A job is due when its last finished run is older than its cadence: the
+registered default, or `MaintenanceJob.every` if an admin changed it. A job
+that has never run is first due one cadence after the scheduler first saw
+it (`MaintenanceJob.first_run`), so a deploy does not start the archive
+move, the backup and a full rollup check on its first request. A job
+that is still RUNNING (and younger than STALE_AFTER) is not started again,
+whether the other run came from the schedule or from "Run now": the RUNNING
+row is claimed with one INSERT ... WHERE NOT EXISTS under BEGIN IMMEDIATE,
+so two callers cannot both start it. Each run is
+recorded as a `MaintenanceRun` with its status, message and worker; runs
+older than HISTORY_DAYS are pruned.
+
+Built-in jobs: ANALYZE and PRAGMA optimize (both capped by
+`analysis_limit`, so neither reads whole tables), incremental vacuum, the
+stock/finance/journal rollup check with repair, the name key and link
+backfill, the incremental integrity check (report only), the month-end
+balance snapshot, the archive move and the online backup. These are the
+only place full-history scans run on a schedule.
+
+`upgrade_database` runs once per database, from startup (`PRAGMA
+user_version` records that it ran): it turns on incremental auto-vacuum
+with a one-time VACUUM and fills the name keys, links and rollups a
+database from before them lacks, so ledgers that filter on client_id show
+historical rows from the first request.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import text, or_, select, exists, literal
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, MaintenanceJob, MaintenanceRun, SchedulerLease
+
+TICK = 60  # seconds between scheduler wake-ups
+LEASE_SECONDS = 3 * TICK
+STALE_AFTER = timedelta(hours=6)
+HISTORY_DAYS = 90
+ANALYSIS_LIMIT = 1000  # rows sampled per index by ANALYZE / PRAGMA optimize
+
+UPGRADE_VERSION = 1  # PRAGMA user_version once upgrade_database has run
+UPGRADE_POLL = 2  # seconds between checks while another worker upgrades
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+JOBS = {}
+
+_scheduler = {}  # pid -> (thread, stop event)
+
+
+def register_job(name, every, description=''):
+    """Decorator: run `func()` every `every` seconds; its return value is the run's message."""
+    def decorator(func):
+        JOBS[name] = SimpleNamespace(name=name, func=func, every=every, description=description)
+        return func
+    return decorator
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(name='maintenance', holder=None, seconds=LEASE_SECONDS, now=None):
+    """Take or renew the lease `name` for `holder`. Returns True when `holder` holds it now."""
+    holder = holder or worker_id()
+    now = now or datetime.now()
+    table = SchedulerLease.__table__
+    db.session.execute(insert(table).values(name=name, holder=None, expires_at=now).on_conflict_do_nothing())
+    taken = db.session.execute(table.update().where(
+        table.c.name == name, or_(table.c.holder == holder, table.c.expires_at < now, table.c.holder.is_(None)))
+        .values(holder=holder, expires_at=now + timedelta(seconds=seconds))).rowcount
+    db.session.commit()
+    return bool(taken)
+
+
+def release_lease(name='maintenance', holder=None):
+    SchedulerLease.query.filter_by(name=name, holder=holder or worker_id())\
+        .update({'holder': None, 'expires_at': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def job_states(now=None):
+    """[SimpleNamespace] per registered job: cadence, enabled, last run, last finished run, next due time."""
+    now = now or datetime.now()
+    overrides = {j.name: j for j in MaintenanceJob.query}
+    states = []
+    for name, job in sorted(JOBS.items()):
+        override = overrides.get(name)
+        every = override.every if override and override.every else job.every
+        last = MaintenanceRun.query.filter_by(job=name).order_by(MaintenanceRun.started_at.desc()).first()
+        finished = MaintenanceRun.query.filter(MaintenanceRun.job == name, MaintenanceRun.status != 'RUNNING')\
+            .order_by(MaintenanceRun.started_at.desc()).first()
+        running = last is not None and last.status == 'RUNNING' and now - last.started_at < STALE_AFTER
+        if finished:
+            next_due = finished.started_at + timedelta(seconds=every)
+        else:
+            next_due = override.first_run if override and override.first_run else now
+        states.append(SimpleNamespace(name=name, description=job.description, every=every,
+                                      default_every=job.every, enabled=override.enabled if override else True,
+                                      last=last, running=running, next_due=next_due,
+                                      due=not running and next_due <= now))
+    return states
+
+
+def schedule_new_jobs(now=None):
+    """Give each job that has never run a first run one cadence from now. Returns the jobs scheduled."""
+    now = now or datetime.now()
+    overrides = {j.name: j for j in MaintenanceJob.query}
+    ran = {name for (name,) in db.session.query(MaintenanceRun.job).distinct()}
+    scheduled = []
+    for name, job in JOBS.items():
+        override = overrides.get(name)
+        if name in ran or (override and override.first_run):
+            continue
+        if override is None:
+            override = MaintenanceJob(name=name)
+            db.session.add(override)
+        override.first_run = now + timedelta(seconds=override.every or job.every)
+        scheduled.append(name)
+    db.session.commit()
+    return scheduled
+
+
+def _claim_run(name, trigger):
+    """Insert the RUNNING row of `name` unless one is live, in one statement under the write lock.
+
+    The schedule and "Run now" may ask for the same job at once; only one
+    of them gets a row. Returns its id, or None when the job is running.
+    """
+    db.session.commit()
+    runs = MaintenanceRun.__table__
+    now = datetime.now()
+    running = select(runs.c.id).where(runs.c.job == name, runs.c.status == 'RUNNING',
+                                      runs.c.started_at > now - STALE_AFTER)
+    claim = select(literal(name), literal(trigger[:20]), literal('RUNNING'), literal(worker_id()), literal(now))\
+        .where(~exists(running))
+    try:
+        db.session.execute(text('BEGIN IMMEDIATE'))
+        result = db.session.execute(runs.insert().from_select(
+            ['job', 'trigger', 'status', 'worker', 'started_at'], claim))
+        run_id = result.lastrowid if result.rowcount else None
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return run_id
+
+
+def run_job(name, trigger='schedule'):
+    """Run the registered job `name` now and record it. Returns the finished MaintenanceRun.
+
+    Raises ValueError for an unknown job or one that is already running.
+    """
+    job = JOBS.get(name)
+    if job is None:
+        raise ValueError(f"No maintenance job named {name}.")
+    run_id = _claim_run(name, trigger)
+    if run_id is None:
+        raise ValueError(f"Maintenance job {name} is already running.")
+    try:
+        message = job.func()
+        status = 'DONE'
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Maintenance job {name} failed: {str(e)}")
+        message, status = str(e), 'FAILED'
+    return _finish_run(run_id, status, message)
+
+
+def _finish_run(run_id, status, message):
+    MaintenanceRun.query.filter_by(id=run_id).update(
+        {'status': status, 'message': (message or '')[:500], 'finished_at': datetime.now()},
+        synchronize_session=False)
+    db.session.commit()
+    return db.session.get(MaintenanceRun, run_id)
+
+
+def _upgraded():
+    return (db.session.execute(text('PRAGMA user_version')).scalar() or 0) >= UPGRADE_VERSION
+
+
+def upgrade_database():
+    """Bring a database from before the rollups and links up to date, once. Returns True if this call did it.
+
+    Call from startup, before the worker serves requests. Workers starting
+    together take turns through the 'upgrade' run row; one that finds it
+    running waits for it instead of serving ledgers without their links.
+    """
+    from utils.finance import verify_finance
+    from utils.journal import verify_journal
+    from utils.links import backfill_links
+    from utils.names import backfill_name_keys
+    from utils.purge import reclaim_space
+    from utils.stock import verify_stock
+
+    waiting = False
+    while not _upgraded():
+        run_id = _claim_run('upgrade', 'startup')
+        if run_id is None:
+            if not waiting:
+                logging.warning('Waiting for another worker to finish the database upgrade')
+                waiting = True
+            db.session.rollback()
+            time.sleep(UPGRADE_POLL)
+            continue
+        if _upgraded():
+            # another worker finished between the check and the claim
+            _finish_run(run_id, 'DONE', 'already upgraded')
+            return False
+        try:
+            db.session.commit()
+            reclaim_space('full')  # sets auto_vacuum=INCREMENTAL, which only a VACUUM applies
+            keyed = sum(backfill_name_keys().values())
+            linked = sum(backfill_links().values())
+            repaired = {'stock': len(verify_stock(repair=True)), 'finance': len(verify_finance(repair=True)),
+                        'journal': len(verify_journal(repair=True))}
+            db.session.execute(text(f'PRAGMA user_version = {UPGRADE_VERSION}'))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            _finish_run(run_id, 'FAILED', str(e))
+            raise
+        _finish_run(run_id, 'DONE', f'{keyed} name keys, {linked} links filled; '
+                    + ', '.join(f'{name} {n} rebuilt' for name, n in repaired.items()))
+        return True
+    return False
+
+
+def run_due_jobs(now=None):
+    """Run every enabled job that is due, one after another. Returns the runs."""
+    schedule_new_jobs(now)
+    runs = []
+    for state in job_states(now):
+        if state.enabled and state.due:
+            runs.append(run_job(state.name))
+    MaintenanceRun.query.filter(MaintenanceRun.started_at < (now or datetime.now()) - timedelta(days=HISTORY_DAYS))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return runs
+
+
+def tick(now=None):
+    """One scheduler wake-up: run the due jobs if this worker holds the lease. Returns the runs."""
+    if not acquire_lease(now=now):
+        return []
+    return run_due_jobs(now)
+
+
+def start_scheduler(app, interval=TICK):
+    """Start this process's scheduler thread (once per process); the first tick is one interval away."""
+    pid = os.getpid()
+    if pid in _scheduler:
+        return False
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            with app.app_context():
+                try:
+                    tick()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Maintenance scheduler tick failed: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=loop, name='maintenance-scheduler', daemon=True)
+    _scheduler[pid] = (thread, stop)
+    thread.start()
+    return True
+
+
+def stop_scheduler():
+    thread, stop = _scheduler.pop(os.getpid(), (None, None))
+    if thread:
+        stop.set()
+        thread.join()
+
+
+# ---- built-in jobs ----
+
+@register_job('analyze', DAY, 'ANALYZE: refresh the query planner statistics')
+def analyze():
+    db.session.execute(text(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}'))
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    return 'statistics refreshed'
+
+
+@register_job('optimize', HOUR, 'PRAGMA optimize: re-analyze tables whose statistics went stale')
+def optimize():
+    db.session.execute(text(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}'))
+    db.session.execute(text('PRAGMA optimize'))
+    db.session.commit()
+    return 'optimized'
+
+
+@register_job('incremental_vacuum', DAY, 'Give free pages back to the filesystem')
+def incremental_vacuum():
+    from utils.purge import reclaim_space
+    return reclaim_space('incremental')
+
+
+@register_job('rollups', DAY, 'Check stock, finance and journal rollups against their documents and repair drift')
+def rollups():
+    from utils.finance import verify_finance
+    from utils.journal import verify_journal
+    from utils.stock import verify_stock
+    drift = {'stock': len(verify_stock(repair=True)), 'finance': len(verify_finance(repair=True)),
+             'journal': len(verify_journal(repair=True))}
+    return ', '.join(f'{name} {n} repaired' for name, n in drift.items())
+
+
+@register_job('links', DAY, 'Fill missing name keys and client/material links on rows written in bulk')
+def links():
+    from utils.links import backfill_links
+    from utils.names import backfill_name_keys
+    keyed = sum(backfill_name_keys().values())
+    linked = sum(backfill_links().values())
+    return f'{keyed} name keys, {linked} links filled'
+
+
+@register_job('integrity', DAY, 'Check material totals, pending bills and invoices changed since the last check')
+def integrity():
+    from utils.integrity import verify_integrity, summary
+    return summary(verify_integrity(incremental=True, created_by='schedule'))
+
+
+@register_job('month_end_snapshot', DAY, "Snapshot client balances at last month's end")
+def month_end_snapshot():
+    from utils.journal import ensure_month_end_snapshot
+    day = ensure_month_end_snapshot()
+    return f'balances snapshotted at {day}' if day else 'already snapshotted'
+
+
+@register_job('archive', 7 * DAY, 'Move voided and closed-period rows into the archive')
+def archive():
+    from utils.archive import archive_cutoff, archive_rows
+    moved = archive_rows(archive_cutoff())
+    return ', '.join(f'{n} {name}' for name, n in moved.items() if n) or 'nothing to archive'
+
+
+@register_job('backup', DAY, 'Online snapshot of the database and archive')
+def backup():
+    from utils.backup import backup_database
+    result = backup_database()
+    return f"{result['name']}: {sum(result['files'].values()) / 1048576:.1f} MB, integrity ok"
@@ -0,0 +1,74 @@
+"""
+Normalized name keys for case-insensitive matching.
+
+`name_key` casefolds a name and collapses runs of whitespace. Client,
+Material and the transaction tables store it in an indexed `name_key`
+column (for transactions it is the key of the client name), so lookups
+such as "ali  traders" vs "Ali Traders" are an index probe instead of a
+`lower()`/`upper()` scan. The column is kept current on flush; bulk
+writers call `name_key` themselves and `backfill_name_keys` fills rows
+written before the column existed.
+"""
+import logging
+
+from sqlalchemy import event, update, bindparam
+from sqlalchemy.orm import Session
+
+from models import db, Client, Material, Entry, Booking, Payment, DirectSale
+
+# model -> attribute the key is derived from
+NAME_KEY_SOURCES = {
+    Client: 'name',
+    Material: 'name',
+    Entry: 'client',
+    Booking: 'client_name',
+    Payment: 'client_name',
+    DirectSale: 'client_name',
+}
+
+BACKFILL_BATCH = 5000
+
+
+def name_key(name):
+    """'  Ali   TRADERS ' -> 'ali traders'; None for blank names."""
+    if name is None:
+        return None
+    key = ' '.join(str(name).split()).casefold()
+    return key or None
+
+
+@event.listens_for(Session, 'before_flush')
+def _set_name_keys(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        source = NAME_KEY_SOURCES.get(type(obj))
+        if source:
+            key = name_key(getattr(obj, source))
+            if obj.name_key != key:
+                obj.name_key = key
+
+
+def backfill_name_keys(batch_size=BACKFILL_BATCH):
+    """Compute missing name keys in short id-ordered batches. Returns {table: rows keyed}."""
+    result = {}
+    for model, source in NAME_KEY_SOURCES.items():
+        table = model.__table__
+        stmt = update(table).where(table.c.id == bindparam('_id')).values(name_key=bindparam('_key'))
+        source_col = getattr(model, source)
+        last_id = 0
+        keyed = 0
+        while True:
+            rows = db.session.query(model.id, source_col)\
+                .filter(model.name_key.is_(None), source_col.isnot(None), model.id > last_id)\
+                .order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = [{'_id': id_, '_key': name_key(name)} for id_, name in rows if name_key(name)]
+            if params:
+                db.session.execute(stmt, params)
+                keyed += len(params)
+            db.session.commit()
+        result[table.name] = keyed
+        if keyed:
+            logging.info(f"Computed {keyed} name keys for {table.name}")
+    return result
@@ -0,0 +1,113 @@
+"""
+Bulk payment posting.
+
+End-of-day cash reconciliation posts a few hundred payments at once. Rows
+are resolved together (one client directory read, one query for the
+matched clients, one query for all typed bill numbers that did not link),
+inserted with one flush and allocated with `allocate_payment`, the same
+rules `/add_payment` uses. Everything commits in one transaction; rows
+that fail validation are reported and skipped, the rest still post.
+"""
+from sqlalchemy import func, or_
+
+from models import db, Payment, PendingBill
+from utils.allocation import allocate_payment
+from utils.clients import find_clients
+
+
+def unlinked_reasons(rows):
+    """Why a typed bill number did not link, for each (bill_no, client) in `rows`.
+
+    Matches bill or nimbus numbers case-insensitively (1001 also matches
+    #1001), all numbers in one query.
+    """
+    keys = set()
+    for bill_no, _ in rows:
+        keys.add(bill_no.lower())
+        if bill_no.isdigit():
+            keys.add(f"#{bill_no}")
+    matches = {}
+    if keys:
+        for pb in PendingBill.query.filter(or_(func.lower(PendingBill.bill_no).in_(keys),
+                                               func.lower(PendingBill.nimbus_no).in_(keys)))\
+                .order_by(PendingBill.id):
+            for key in {(pb.bill_no or '').lower(), (pb.nimbus_no or '').lower()}:
+                matches.setdefault(key, pb)
+
+    reasons = []
+    for bill_no, client in rows:
+        match = matches.get(bill_no.lower()) or (matches.get(f"#{bill_no}") if bill_no.isdigit() else None)
+        if not match:
+            reasons.append("Bill number not found")
+        elif not client:
+            reasons.append(f"Bill belongs to {match.client_name} (Client not identified)")
+        elif match.client_code != client.code:
+            reasons.append(f"Bill belongs to {match.client_name}")
+        elif match.is_paid:
+            reasons.append("Bill is already paid")
+        else:
+            reasons.append("check number or client")
+    return reasons
+
+
+def _amount(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(str(value or '').replace(',', '').strip())
+
+
+def post_payments(rows):
+    """Post many payments in one transaction and report on each row.
+
+    `rows` are dicts with client_name and/or client_code, amount, method
+    and bill_no. Returns one dict per row, in order: row (1-based), status
+    ('posted' or 'error'), and for posted rows payment_id, client, amount,
+    applied ([{bill_no, amount, paid}]), unapplied and warning.
+    """
+    report = []
+    valid = []
+    for n, row in enumerate(rows, 1):
+        name = str(row.get('client_name') or '').strip()
+        code = str(row.get('client_code') or '').strip()
+        try:
+            amount = _amount(row.get('amount'))
+        except ValueError:
+            amount = None
+        if not (name or code):
+            report.append({'row': n, 'status': 'error', 'error': 'Client is required'})
+        elif amount is None or amount != amount or amount <= 0:
+            report.append({'row': n, 'status': 'error', 'error': f"Invalid amount '{row.get('amount')}'"})
+        else:
+            report.append({'row': n, 'status': 'posted'})
+            valid.append((report[-1], name, code, amount,
+                          str(row.get('method') or '').strip(), str(row.get('bill_no') or '').strip()))
+
+    clients = find_clients([(name, code) for _, name, code, *_ in valid], fuzzy=True)
+    payments = []
+    for result, name, code, amount, method, bill_no in valid:
+        client = clients[(name, code)]
+        payment = Payment(client_name=client.name if client else (name or code),
+                          client_id=client.id if client else None,
+                          amount=amount, method=method, manual_bill_no=bill_no)
+        db.session.add(payment)
+        payments.append((result, payment, client, amount, bill_no))
+    db.session.flush()
+
+    unlinked = []
+    for result, payment, client, amount, bill_no in payments:
+        applied = allocate_payment(payment.id, amount, client.code if client else None, bill_no or None)
+        result.update({'payment_id': payment.id, 'client': payment.client_name,
+                       'client_code': client.code if client else None, 'amount': amount,
+                       'applied': [{'bill_no': b, 'amount': a, 'paid': paid} for b, a, paid in applied],
+                       'unapplied': amount - sum(a for _, a, _ in applied), 'warning': None})
+        if not client:
+            result['warning'] = 'Client not identified'
+        if bill_no and not applied:
+            unlinked.append((result, bill_no, client))
+
+    for (result, bill_no, _), reason in zip(unlinked, unlinked_reasons([(b, c) for _, b, c in unlinked])):
+        link = f"Could not link to Bill '{bill_no}' - {reason}"
+        result['warning'] = f"{result['warning']}; {link}" if result['warning'] else link
+
+    db.session.commit()
+    return report
@@ -0,0 +1,169 @@
+"""
+Set-based import of pending bills.
+
+All pending-bill import endpoints hand their parsed rows to
+`upsert_pending_bills`, which resolves clients with one directory read,
+creates missing clients in one batch and writes the bills with
+INSERT ... ON CONFLICT on (bill_no, client_code).
+"""
+from datetime import datetime
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Client, PendingBill
+from utils.sequences import reserve_codes
+from utils.names import name_key
+from utils.clients import invalidate_clients
+
+PENDING_BILL_UNIQUE_INDEX = 'uq_pending_bill_bill_client'
+MISSING_CODES = ('', 'NA', 'NAN', 'NONE')
+
+
+def _clean(value):
+    if value is None:
+        return ''
+    value = str(value).strip()
+    return '' if value.upper() in MISSING_CODES else value
+
+
+def _has_unique_index():
+    rows = db.session.execute(text("PRAGMA index_list('pending_bill')")).fetchall()
+    return any(r[1] == PENDING_BILL_UNIQUE_INDEX for r in rows)
+
+
+def resolve_clients(rows):
+    """Attach `client_code`/`client_name` of an existing or new Client to each row.
+
+    Rows are matched by code first, then by name_key. Clients
+    that do not exist yet are created in one batch. Returns the number of
+    clients created.
+    """
+    by_code = {}
+    by_name = {}
+    for code, name in db.session.query(Client.code, Client.name):
+        by_code[code] = (code, name)
+        if name:
+            by_name.setdefault(name_key(name), (code, name))
+
+    new_clients = {}
+    for row in rows:
+        code = _clean(row.get('client_code'))
+        name = (row.get('client_name') or '').strip()
+        match = by_code.get(code) if code else None
+        if not match and name:
+            match = by_name.get(name_key(name))
+        if not match:
+            key = code or name_key(name)
+            match = new_clients.get(key)
+            if not match:
+                match = new_clients[key] = [code, name]
+        row['_client'] = match
+
+    needs_code = [c for c in new_clients.values() if not c[0]]
+    for client, code in zip(needs_code, reserve_codes('client', len(needs_code))):
+        client[0] = code
+    if new_clients:
+        db.session.execute(Client.__table__.insert(), [
+            {'code': code, 'name': name or 'Unknown', 'name_key': name_key(name or 'Unknown'),
+             'is_active': True, 'category': 'General',
+             'created_at': datetime.now()}
+            for code, name in new_clients.values()
+        ])
+        invalidate_clients()
+
+    for row in rows:
+        code, name = row.pop('_client')
+        row['client_code'] = code
+        row['client_name'] = name or 'Unknown'
+    return len(new_clients)
+
+
+def upsert_pending_bills(rows, created_by, created_at=None):
+    """Insert or update pending bills keyed on (bill_no, client_code).
+
+    `rows` is a list of dicts with client_code, client_name, bill_no,
+    nimbus_no, amount and reason. Existing unpaid bills get the new amount;
+    nimbus_no and reason are only overwritten when the import has a value;
+    paid bills are left alone (skipped). The caller commits. Returns a dict
+    of counts: rows, inserted, updated, skipped, clients_created.
+    """
+    if not rows:
+        return {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'clients_created': 0}
+
+    created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M')
+    clients_created = resolve_clients(rows)
+
+    values = {}
+    for row in rows:
+        # later rows for the same bill win, like repeated ON CONFLICT updates
+        values[(row.get('bill_no'), row['client_code'])] = {
+            'client_code': row['client_code'],
+            'client_name': row['client_name'],
+            'bill_no': row.get('bill_no'),
+            'nimbus_no': row.get('nimbus_no') or '',
+            'amount': row.get('amount') or 0,
+            'reason': row.get('reason') or '',
+            'created_at': created_at,
+            'created_by': created_by,
+        }
+    values = list(values.values())
+
+    existing = {}
+    bill_nos = list({v['bill_no'] for v in values})
+    for i in range(0, len(bill_nos), 500):
+        for pid, bill_no, code, is_paid in db.session.query(
+                PendingBill.id, PendingBill.bill_no, PendingBill.client_code, PendingBill.is_paid
+        ).filter(PendingBill.bill_no.in_(bill_nos[i:i + 500])):
+            existing.setdefault((bill_no, code), (pid, is_paid))
+    matched = [existing[(v['bill_no'], v['client_code'])] for v in values
+               if (v['bill_no'], v['client_code']) in existing]
+    updated = sum(1 for _, is_paid in matched if not is_paid)
+
+    before = db.session.query(func.count(PendingBill.id)).scalar() or 0
+    table = PendingBill.__table__
+
+    if _has_unique_index():
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['bill_no', 'client_code'],
+            set_={
+                'amount': stmt.excluded.amount,
+                'client_name': stmt.excluded.client_name,
+                'nimbus_no': func.coalesce(func.nullif(stmt.excluded.nimbus_no, ''), table.c.nimbus_no),
+                'reason': func.coalesce(func.nullif(stmt.excluded.reason, ''), table.c.reason),
+            },
+            where=func.coalesce(table.c.is_paid, False) == False)
+        db.session.execute(stmt, values)
+    else:
+        # Legacy databases with duplicate bills cannot carry the unique index;
+        # split inserts from updates with the lookup above instead.
+        inserts = [v for v in values if (v['bill_no'], v['client_code']) not in existing]
+        updates = []
+        for v in values:
+            match = existing.get((v['bill_no'], v['client_code']))
+            if match and not match[1]:
+                update = {'id': match[0], 'amount': v['amount'], 'client_name': v['client_name']}
+                if v['nimbus_no']:
+                    update['nimbus_no'] = v['nimbus_no']
+                if v['reason']:
+                    update['reason'] = v['reason']
+                updates.append(update)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            db.session.bulk_update_mappings(PendingBill, updates)
+
+    inserted = (db.session.query(func.count(PendingBill.id)).scalar() or 0) - before
+    return {'rows': len(rows), 'inserted': inserted, 'updated': updated, 'skipped': len(matched) - updated,
+            'clients_created': clients_created}
+
+
+def import_summary(result):
+    """One line for the import flash message: new, updated and skipped (paid) bills."""
+    summary = f"{result['inserted']} new, {result['updated']} updated"
+    if result['skipped']:
+        summary += f", {result['skipped']} already paid left as they were"
+    if result['clients_created']:
+        summary += f", {result['clients_created']} clients created"
+    return summary
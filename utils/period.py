@@ -0,0 +1,195 @@
+"""
+Period close.
+
+Closing the books through a date locks everything dated on or before it:
+a flush that inserts, edits, voids or deletes a booking, payment, direct
+sale, GRN, delivery or stock entry in a closed period (or moves one into
+it) raises `PeriodClosedError`. Bulk writes that bypass the ORM check
+their dates with `assert_open` first.
+
+`close_period` writes the opening balances the next period starts from:
+client balances as `client_balance_snapshot` rows on the close date, and
+per client and material the booking balance and entry qty as
+`client_material_opening` rows. Material stock needs nothing new; its
+`stock_daily` closing on the close date no longer changes once the period
+is locked. Ledgers read the latest close and walk only the rows after it.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, attributes
+
+from models import (db, Entry, Booking, BookingItem, Payment, DirectSale, DirectSaleItem, GRN, GRNItem,
+                    Delivery, DeliveryItem, PeriodClose, ClientMaterialOpening, StockDaily)
+from utils.finance import day_range
+from utils.journal import take_balance_snapshots
+from utils.ledger import booking_material_history, closing_balances
+from utils.stock import track_old_values
+
+CLOSED_THROUGH = 'closed_through'
+
+# model -> attribute holding its date
+LOCKED_DATES = {
+    Entry: 'date',
+    Booking: 'date_posted',
+    Payment: 'date_posted',
+    DirectSale: 'date_posted',
+    GRN: 'date_posted',
+    Delivery: 'date_posted',
+}
+
+# item model -> relationship to the dated document it belongs to
+LOCKED_ITEMS = {
+    BookingItem: 'booking',
+    DirectSaleItem: 'direct_sale',
+    GRNItem: 'grn',
+    DeliveryItem: 'delivery',
+}
+
+for _model, _attr in LOCKED_DATES.items():
+    track_old_values(_model, (_attr,))
+
+
+class PeriodClosedError(ValueError):
+    """A write touched a date in a closed period."""
+
+
+def closed_through(session=None):
+    """The latest close date ('YYYY-MM-DD'), or None; cached for the rest of the transaction."""
+    session = session or db.session
+    if CLOSED_THROUGH not in session.info:
+        with session.no_autoflush:
+            session.info[CLOSED_THROUGH] = session.query(func.max(PeriodClose.close_date)).scalar()
+    return session.info[CLOSED_THROUGH]
+
+
+def assert_open(*days, session=None):
+    """Raise PeriodClosedError if any of `days` ('YYYY-MM-DD' or datetime) falls in a closed period."""
+    closed = closed_through(session)
+    for day in days:
+        day = _day(day)
+        if closed and day and day <= closed:
+            raise PeriodClosedError(f"{day} is in a closed period (books closed through {closed}).")
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    return value[:10] if value else None
+
+
+def _dates(obj, attr, current=True, old=True):
+    days = []
+    if current:
+        days.append(getattr(obj, attr))
+    if old:
+        history = attributes.get_history(obj, attr)
+        days.extend(history.deleted or history.unchanged)
+    return days
+
+
+def _touched_days(session):
+    days = []
+    for objs, current, old in ((session.new, True, False), (session.dirty, True, True), (session.deleted, False, True)):
+        for obj in objs:
+            if type(obj) not in LOCKED_DATES and type(obj) not in LOCKED_ITEMS:
+                continue
+            if objs is session.dirty and not session.is_modified(obj):
+                continue
+            if type(obj) in LOCKED_ITEMS:
+                # an item counts as a change to its document, whatever happens to the item
+                parent = getattr(obj, LOCKED_ITEMS[type(obj)])
+                if parent is not None:
+                    days.extend(_dates(parent, LOCKED_DATES[type(parent)]))
+            else:
+                days.extend(_dates(obj, LOCKED_DATES[type(obj)], current, old))
+    return days
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_closed_period(session, flush_context, instances):
+    days = _touched_days(session)
+    if days:
+        assert_open(*days, session=session)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _reset_transaction_state(session, *args):
+    session.info.pop(CLOSED_THROUGH, None)
+
+
+def latest_close(day=None):
+    """The last PeriodClose on or before `day` (any if None), or None."""
+    q = PeriodClose.query
+    if day:
+        q = q.filter(PeriodClose.close_date <= day)
+    return q.order_by(PeriodClose.close_date.desc()).first()
+
+
+def material_openings(client_id, close_date):
+    """{material: ClientMaterialOpening} for the client at a close date."""
+    if not close_date:
+        return {}
+    return {o.material: o for o in ClientMaterialOpening.query.filter_by(client_id=client_id, close_date=close_date)}
+
+
+def stock_opening(material_id, close_date):
+    """A material's stock at the end of `close_date`, from its last stock_daily row."""
+    return db.session.query(StockDaily.closing).filter(
+        StockDaily.material_id == material_id, StockDaily.date <= close_date)\
+        .order_by(StockDaily.date.desc()).limit(1).scalar() or 0
+
+
+def close_period(day, closed_by=None):
+    """Close the books through `day` ('YYYY-MM-DD') and write the openings of the next period.
+
+    Periods close in order: `day` must be before today and after the last
+    close. Commits and returns the new PeriodClose.
+    """
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError('Close date must be YYYY-MM-DD.')
+    if day >= datetime.now().strftime('%Y-%m-%d'):
+        raise ValueError('Only past days can be closed.')
+    prev = closed_through()
+    if prev and day <= prev:
+        raise PeriodClosedError(f"Books are already closed through {prev}.")
+
+    take_balance_snapshots(day)
+
+    openings = {}
+    if prev:
+        for o in ClientMaterialOpening.query.filter_by(close_date=prev):
+            openings[(o.client_id, o.material)] = [o.balance, o.qty]
+
+    entry_qty = db.session.query(Entry.client_id, Entry.material, func.sum(Entry.qty))\
+        .filter(Entry.client_id.isnot(None), Entry.date <= day)
+    if prev:
+        entry_qty = entry_qty.filter(Entry.date > prev)
+    for cid, material, qty in entry_qty.group_by(Entry.client_id, Entry.material):
+        openings.setdefault((cid, material or ''), [0, 0])[1] += qty or 0
+
+    # booking balances follow the ledger's own rules, so walk each active client's period once
+    client_ids = {cid for cid, _ in openings}
+    for model in (Booking, DirectSale):
+        q = db.session.query(model.client_id).filter(model.client_id.isnot(None),
+                                                      model.date_posted < day_range(day, day)[1])
+        if prev:
+            q = q.filter(model.date_posted >= day_range(prev, prev)[1])
+        client_ids.update(cid for (cid,) in q.distinct())
+    for cid in client_ids:
+        start = {m: bal for (c, m), (bal, _) in openings.items() if c == cid}
+        history = booking_material_history(cid, after=prev, until=day, openings=start)
+        for material, balance in closing_balances(history, start).items():
+            openings.setdefault((cid, material or ''), [0, 0])[0] = balance
+
+    rows = [{'close_date': day, 'client_id': cid, 'material': material, 'balance': bal, 'qty': qty}
+            for (cid, material), (bal, qty) in openings.items() if bal or qty]
+    if rows:
+        db.session.execute(ClientMaterialOpening.__table__.insert(), rows)
+    close = PeriodClose(close_date=day, closed_by=closed_by)
+    db.session.add(close)
+    db.session.commit()
+    return close
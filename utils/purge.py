@@ -0,0 +1,174 @@
+"""
+Batched data wipe.
+
+The settings page wipe deletes whole datasets (all clients, all OUT
+entries, ...). Doing that as one DELETE per table holds SQLite's write lock
+for the whole wipe, so `purge` walks each table in id order and deletes
+`chunk_size` rows per short transaction, pausing between chunks so other
+writers get the lock. It runs as a background job (`utils.jobs`) whose
+done/total count is the number of rows deleted so far.
+
+Entries are deleted through `delete_entries` chunk by chunk, so stock
+stays right at every commit. The client journal is append-only: once a
+dataset's documents are gone, `reverse_deleted` posts the lines that net
+theirs to zero instead of deleting them. Archived rows of a wiped dataset (see
+`utils.archive`) go with it, in one statement per table at the end of its
+step.
+
+The chunked DELETEs bypass the period lock's flush check, so a wipe that
+would remove documents dated in a closed period is refused up front
+(`assert_open` over `purge_dates`).
+
+Afterwards the freed pages can be given back to the filesystem:
+'incremental' runs `PRAGMA incremental_vacuum` in small steps (only
+possible once the database uses auto_vacuum=INCREMENTAL). 'full' runs a
+VACUUM, which also switches the database to incremental auto-vacuum, but
+holds the whole database for as long as it runs; it is only run from the
+CLI (`flask vacuum`) and the startup upgrade, never by the wipe job.
+"""
+import time
+
+from sqlalchemy import text, true, func
+
+from models import (db, Client, PendingBill, PaymentAllocation, Entry, StockDaily, Material, DirectSale,
+                    DirectSaleItem, Payment, Booking, BookingItem, FinanceDaily, BackgroundJob)
+from utils.archive import count_archived, purge_archived, archived_dates
+from utils.clients import invalidate_clients
+from utils.journal import reverse_deleted
+from utils.period import LOCKED_DATES, assert_open
+from utils.stock import delete_entries
+
+CHUNK_SIZE = 500
+PAUSE = 0.02  # seconds between chunks, so waiting writers get in
+VACUUM_STEP = 500  # pages per incremental_vacuum
+
+# dataset -> (model, condition) in the order they are deleted; children before parents
+PURGE_TARGETS = {
+    'clients': [(Client, None)],
+    'pending_bills': [(PaymentAllocation, None), (PendingBill, None)],
+    'dispatching': [(Entry, Entry.type == 'OUT')],
+    'receiving': [(Entry, Entry.type == 'IN')],
+    'materials': [(StockDaily, None), (Material, None)],
+    'direct_sales': [(DirectSaleItem, None), (DirectSale, None), (FinanceDaily, FinanceDaily.kind == 'sale')],
+    'payments': [(PaymentAllocation, None), (Payment, None), (FinanceDaily, FinanceDaily.kind == 'payment')],
+    'bookings': [(BookingItem, None), (Booking, None), (FinanceDaily, FinanceDaily.kind == 'booking')],
+}
+
+# dataset -> journal doc_type whose lines are reversed once its documents are gone
+JOURNAL_REVERSALS = {'direct_sales': 'sale', 'payments': 'payment', 'bookings': 'booking'}
+
+TARGET_LABELS = {
+    'clients': 'Clients', 'pending_bills': 'Pending Bills', 'dispatching': 'Dispatching Entries',
+    'receiving': 'Receiving Entries', 'materials': 'Materials', 'direct_sales': 'Direct Sales',
+    'payments': 'Payments', 'bookings': 'Bookings',
+}
+
+
+def purge_plan(targets):
+    """[(model, condition)] for `targets`, in PURGE_TARGETS order."""
+    return [step for name, steps in PURGE_TARGETS.items() if name in targets for step in steps]
+
+
+def purge_size(targets):
+    """Rows the purge of `targets` will delete."""
+    return sum(model.query.filter(condition if condition is not None else true()).count()
+               + count_archived(model, condition)
+               for model, condition in purge_plan(targets))
+
+
+def purge_dates(targets):
+    """(first, last) 'YYYY-MM-DD' among the dated documents the purge of `targets` deletes, archived ones included."""
+    days = []
+    for model, condition in purge_plan(targets):
+        attr = LOCKED_DATES.get(model)
+        if attr is None:
+            continue
+        column = getattr(model, attr)
+        days += db.session.query(func.min(column), func.max(column))\
+            .filter(condition if condition is not None else true()).one()
+        days += archived_dates(model, attr, condition)
+    days = [str(day)[:10] for day in days if day]
+    return (min(days), max(days)) if days else (None, None)
+
+
+def delete_in_chunks(model, condition=None, chunk_size=CHUNK_SIZE, pause=PAUSE, progress=None):
+    """Delete the rows of `model` matching `condition`, `chunk_size` ids per transaction. Returns rows deleted.
+
+    `progress(n)` is called with the running total inside each chunk's
+    transaction, before it commits.
+    """
+    condition = condition if condition is not None else true()
+    table = model.__table__
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = [i for (i,) in db.session.query(model.id).filter(condition, model.id > last_id)
+               .order_by(model.id).limit(chunk_size)]
+        if not ids:
+            return deleted
+        if model is Entry:
+            delete_entries(Entry.query.filter(Entry.id.in_(ids)))
+        else:
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        deleted += len(ids)
+        last_id = ids[-1]
+        if progress:
+            progress(deleted)
+        db.session.commit()
+        if pause:
+            time.sleep(pause)
+
+
+def reclaim_space(mode):
+    """Give freed pages back: 'incremental' or 'full'. Returns a short report."""
+    if mode == 'full':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+            conn.execute(text('VACUUM'))
+        return 'vacuumed'
+    if mode == 'incremental':
+        if db.session.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+            return 'incremental vacuum unavailable (run a full VACUUM once to enable it)'
+        freed = 0
+        while True:
+            free = db.session.execute(text('PRAGMA freelist_count')).scalar() or 0
+            if not free:
+                break
+            db.session.execute(text(f'PRAGMA incremental_vacuum({VACUUM_STEP})'))
+            db.session.commit()
+            freed += min(free, VACUUM_STEP)
+            time.sleep(PAUSE)
+        return f'{freed} pages reclaimed'
+    return ''
+
+
+def purge(job_id, targets, reclaim=None, chunk_size=CHUNK_SIZE):
+    """Job body: wipe `targets` in chunks, then reclaim space. Returns the job message."""
+    if reclaim == 'full':
+        raise ValueError('A full VACUUM blocks the whole database; run it from the command line (flask vacuum).')
+    assert_open(purge_dates(targets)[0])
+    done = [0]
+
+    def progress(n):
+        BackgroundJob.query.filter_by(id=job_id).update({'done': done[0] + n}, synchronize_session=False)
+
+    for model, condition in purge_plan(targets):
+        done[0] += delete_in_chunks(model, condition, chunk_size, progress=progress)
+        done[0] += purge_archived(model, condition)
+        progress(0)
+        db.session.commit()
+        if model is Client:
+            invalidate_clients()
+            db.session.commit()
+
+    reversed_lines = 0
+    for target, doc_type in JOURNAL_REVERSALS.items():
+        if target in targets:
+            reversed_lines += reverse_deleted(doc_type)
+            db.session.commit()
+
+    message = f"Data Wiped: {', '.join(TARGET_LABELS[t] for t in PURGE_TARGETS if t in targets)} ({done[0]} rows)"
+    if reversed_lines:
+        message += f", {reversed_lines} journal lines reversed"
+    reclaimed = reclaim_space(reclaim)
+    return f"{message}; {reclaimed}" if reclaimed else message
@@ -0,0 +1,187 @@
+"""
+Reconciliation engine used by the Data Lab module.
+
+Everything here works on plain dicts/lists so partitions can be shipped to
+worker processes; database access stays in the blueprint.
+"""
+import hashlib
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from difflib import SequenceMatcher, get_close_matches
+
+
+def name_score(a, b):
+    if not a or not b:
+        return 0
+    return int(SequenceMatcher(None, str(a).lower(), str(b).lower()).ratio() * 100)
+
+
+def fingerprint(rows):
+    """Stable hash of a bill's rows, used to detect changes between uploads."""
+    payload = repr(sorted(sorted(r.items()) for r in rows))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def classify_bill(bill, fin_rows, inv_rows):
+    """Classify one bill into GREEN/YELLOW/RED outcomes (one per source row)."""
+    outcomes = []
+    if inv_rows:
+        for inv in inv_rows:
+            if fin_rows:
+                # match against first finance row
+                fin_client = fin_rows[0]['client']
+                score = name_score(fin_client, inv['client'])
+                status = 'GREEN' if score >= 90 else 'YELLOW'
+                outcomes.append({'bill_no': bill, 'fin_client': fin_client, 'inv_client': inv['client'],
+                                 'inv_material': inv['material'], 'inv_qty': inv['qty'],
+                                 'status': status, 'match_score': score})
+            else:
+                # RED: waiting - exists in dispatch but not in finance
+                outcomes.append({'bill_no': bill, 'fin_client': None, 'inv_client': inv['client'],
+                                 'inv_material': inv['material'], 'inv_qty': inv['qty'],
+                                 'status': 'RED', 'match_score': 0})
+    else:
+        # RED entry (finance only)
+        for fin in fin_rows:
+            outcomes.append({'bill_no': bill, 'fin_client': fin['client'], 'inv_client': None,
+                             'inv_material': None, 'inv_qty': 0, 'status': 'RED', 'match_score': 0})
+    return outcomes
+
+
+UNBILLED_PREFIX = '~'  # ReconBillState keys of unbilled dispatch groups: the prefix and a hash, never a real bill
+
+
+def unbilled_key(date, client, material):
+    """ReconBillState key of the unbilled dispatch rows of one date, client and material."""
+    payload = repr((date or '', client or '', material or ''))
+    return UNBILLED_PREFIX + hashlib.sha1(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def group_unbilled(unbilled):
+    """{unbilled_key: rows}, so an upload only re-classifies the groups whose rows changed."""
+    groups = {}
+    for r in unbilled:
+        groups.setdefault(unbilled_key(r.get('date'), r['client'], r['material']), []).append(r)
+    return groups
+
+
+def classify_unbilled(unbilled):
+    # BLUE: unbilled dispatch
+    return [{'bill_no': '', 'fin_client': None, 'inv_client': r['client'], 'inv_material': r['material'],
+             'inv_qty': r['qty'], 'inv_date': r.get('date') or None, 'status': 'BLUE', 'match_score': 0}
+            for r in unbilled]
+
+
+class ClientMatcher:
+    """Fuzzy lookup of client codes by name.
+
+    `directory` maps lower-cased client names to codes. Candidates are
+    narrowed through a word index (rarest shared word first) before
+    difflib scoring, so each lookup compares against a handful of names
+    instead of the whole directory.
+    """
+
+    def __init__(self, directory, max_candidates=50):
+        self.directory = directory or {}
+        self.max_candidates = max_candidates
+        self.index = {}
+        self.memo = {}
+        for name in self.directory:
+            for word in set(name.split()):
+                self.index.setdefault(word, []).append(name)
+
+    def suggest(self, name, cutoff=0.8):
+        if not name or not self.directory:
+            return None
+        key = str(name).lower()
+        if key in self.directory:
+            return self.directory[key]
+        if key in self.memo:
+            return self.memo[key]
+
+        words = sorted((w for w in set(key.split()) if w in self.index), key=lambda w: len(self.index[w]))
+        candidates = []
+        seen = set()
+        for word in words:
+            postings = self.index[word]
+            if candidates and len(candidates) + len(postings) > self.max_candidates:
+                break
+            for n in postings[:self.max_candidates]:
+                if n not in seen:
+                    seen.add(n)
+                    candidates.append(n)
+
+        match = get_close_matches(key, candidates, n=1, cutoff=cutoff)
+        self.memo[key] = self.directory[match[0]] if match else None
+        return self.memo[key]
+
+
+def reconcile_partition(items, known=None, directory=None):
+    """Fingerprint and classify a list of (bill, fin_rows, inv_rows).
+
+    Bills whose fingerprints equal `known[bill]` are skipped. Returns
+    ({bill: (fin_hash, inv_hash)}, outcomes) for the bills that changed.
+    """
+    known = known or {}
+    matcher = ClientMatcher(directory) if directory else None
+    changed = {}
+    outcomes = []
+    for bill, fin_rows, inv_rows in items:
+        hashes = (fingerprint(fin_rows), fingerprint(inv_rows))
+        if known.get(bill) == hashes:
+            continue
+        changed[bill] = hashes
+        bill_outcomes = classify_bill(bill, fin_rows, inv_rows)
+        if matcher:
+            for o in bill_outcomes:
+                if o['status'] != 'GREEN':
+                    o['suggested_code'] = matcher.suggest(o['inv_client'] or o['fin_client'])
+        outcomes.extend(bill_outcomes)
+    return changed, outcomes
+
+
+def partition_bills(fin_by_bill, inv_by_bill, parts, known=None):
+    """Split bills into `parts` buckets by a process-independent hash of bill_no."""
+    known = known or {}
+    buckets = [([], {}) for _ in range(parts)]
+    for bill in set(fin_by_bill) | set(inv_by_bill):
+        items, bucket_known = buckets[zlib.crc32(bill.encode('utf-8')) % parts]
+        items.append((bill, fin_by_bill.get(bill, []), inv_by_bill.get(bill, [])))
+        if bill in known:
+            bucket_known[bill] = known[bill]
+    return [b for b in buckets if b[0]]
+
+
+def reconcile_parallel(fin_by_bill, inv_by_bill, known=None, directory=None, workers=None,
+                       chunks_per_worker=4, progress=None):
+    """Run `reconcile_partition` across a process pool and merge the results.
+
+    `progress(done, total)` is called in the parent as partitions complete.
+    """
+    workers = workers or os.cpu_count() or 1
+    partitions = partition_bills(fin_by_bill, inv_by_bill, workers * chunks_per_worker, known)
+    changed = {}
+    outcomes = []
+    if not partitions:
+        return changed, outcomes
+
+    if workers == 1:
+        for i, (items, bucket_known) in enumerate(partitions):
+            part_changed, part_outcomes = reconcile_partition(items, bucket_known, directory)
+            changed.update(part_changed)
+            outcomes.extend(part_outcomes)
+            if progress:
+                progress(i + 1, len(partitions))
+        return changed, outcomes
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(reconcile_partition, items, bucket_known, directory)
+                   for items, bucket_known in partitions]
+        for done, future in enumerate(as_completed(futures), start=1):
+            part_changed, part_outcomes = future.result()
+            changed.update(part_changed)
+            outcomes.extend(part_outcomes)
+            if progress:
+                progress(done, len(partitions))
+    return changed, outcomes
@@ -0,0 +1,236 @@
+"""
+Direct sale posting.
+
+`record_direct_sale` is the whole of a counter sale: the client's booking
+balance is used up first (those lines are booking deliveries at price 0),
+the rest is sold at the given rate after a stock check, and the sale, its
+items, the OUT entries, the invoice and the pending bill are written in
+the caller's transaction. The HTML form (`/add_direct_sale`) and the JSON
+API (`/api/v1/direct_sales`) both go through it, so they split and
+validate the same way.
+"""
+from datetime import datetime
+
+from models import db, Settings, Invoice, PendingBill, DirectSale, DirectSaleItem, Entry
+from utils.clients import find_client
+from utils.dispatch import booking_balances
+from utils.sequences import next_bill_no
+from utils.stock import material_map
+
+
+class SaleRejected(ValueError):
+    """The sale cannot be posted as entered; the message is shown to the user as is."""
+
+
+def split_items(client, items):
+    """Split (material, qty, rate) lines into booking deliveries and sales.
+
+    Each material draws on what is left of the client's bookings first.
+    Returns ([{product_name, qty, price_at_time, is_booking}], sale amount).
+    """
+    remaining = {}
+    if client:
+        materials = {name: m.id for name, m in material_map([mat for mat, _, _ in items]).items() if m}
+        balances = booking_balances({(client.id, mid) for mid in materials.values()})
+        for name, mid in materials.items():
+            booked, dispatched = balances.get((client.id, mid), (0, 0))
+            remaining[name] = max(0, booked - dispatched)
+
+    processed = []
+    amount = 0
+    for mat, qty, rate in items:
+        balance = remaining.get(mat, 0)
+        qty_booking = min(qty, balance) if balance > 0 else 0
+        qty_sale = qty - qty_booking
+        if qty_booking > 0:
+            remaining[mat] -= qty_booking
+            processed.append({'product_name': mat, 'qty': qty_booking, 'price_at_time': 0, 'is_booking': True})
+        if qty_sale > 0:
+            processed.append({'product_name': mat, 'qty': qty_sale, 'price_at_time': rate, 'is_booking': False})
+            amount += qty_sale * rate
+    return processed, amount
+
+
+def check_stock(processed, allow_negative=False):
+    """Raise ValueError if the sold (non-booked) qty of a material is more than its stock."""
+    settings = Settings.query.first()
+    if allow_negative or (settings.allow_global_negative_stock if settings else False):
+        return
+    # Aggregate required quantities first to prevent cumulative overrun
+    required = {}
+    for item in processed:
+        if not item['is_booking']:
+            required[item['product_name']] = required.get(item['product_name'], 0) + item['qty']
+    for mat, mat_obj in material_map(required).items():
+        available = (mat_obj.total or 0) if mat_obj else None
+        if available is not None and available < required[mat]:
+            raise ValueError(f"Insufficient stock for {mat}. Available: {available}, Required: {required[mat]} (Non-booked). Enable 'Allow Negative Stock' or global setting to bypass.")
+
+
+def sale_category(processed, amount, paid_amount, category_input=''):
+    all_booking = all(item['is_booking'] for item in processed)
+    any_booking = any(item['is_booking'] for item in processed)
+    if all_booking:
+        return "Booking Delivery"
+    if any_booking:
+        return "Mixed Transaction"
+    if category_input == 'Cash' or paid_amount >= amount:
+        return "Cash"
+    return "Credit Customer"
+
+
+def record_direct_sale(client_name, items, paid_amount=0, manual_bill_no='', category_input='',
+                       allow_negative_stock=False, create_invoice=False, track_as_cash=False,
+                       manual_client_name='', photo_path=None, username=None):
+    """Post a direct sale of `items` ([(material, qty, rate)]) without committing.
+
+    Raises SaleRejected or ValueError when the sale cannot be posted.
+    Returns {'sale', 'invoice', 'pending_bill_no', 'bill_ref', 'items'}.
+    """
+    # Find client by code or name, falling back to the closest match
+    client = find_client(client_name, fuzzy=True)
+    if client:
+        client_name = client.name
+
+    processed, amount = split_items(client, items)
+    check_stock(processed, allow_negative_stock)
+    category = sale_category(processed, amount, paid_amount, category_input)
+
+    # Validation: Unbilled Cash Sale must be fully paid
+    if category == 'Cash' and paid_amount < amount:
+        raise SaleRejected('Cash Sale must be fully paid. Transaction not complete.')
+
+    # Handle Cash category (Manual overrides)
+    if category.lower() == 'cash' and manual_client_name:
+        client_name = manual_client_name
+
+    pending_amount = max(0.0, amount - paid_amount)
+
+    # Handle invoice creation
+    inv = None
+    invoice_no = None
+    if create_invoice:
+        if manual_bill_no:
+            invoice_no = manual_bill_no
+            is_manual = True
+        else:
+            # Invoice without manual bill no
+            settings = Settings.query.first()
+            invoice_no = next_bill_no(settings.invoice_prefix if settings and settings.invoice_prefix else 'INV-')
+            is_manual = False
+
+        existing_global = Invoice.query.filter_by(invoice_no=invoice_no).first()
+        if existing_global and is_manual:
+            if client and existing_global.client_code != client.code:
+                raise SaleRejected(f'Invoice number "{invoice_no}" is already used by another client.')
+
+        inv = Invoice.query.filter_by(invoice_no=invoice_no, client_code=(client.code if client else None)).first()
+        status = 'PAID' if pending_amount <= 0 else ('PARTIAL' if paid_amount > 0 else 'OPEN')
+
+        if inv:
+            inv.client_name = client.name if client else client_name
+            inv.total_amount = amount
+            inv.balance = pending_amount
+            inv.is_cash = track_as_cash
+            inv.status = status
+            inv.date = datetime.now().date()
+        else:
+            inv = Invoice(client_code=(client.code if client else None),
+                          client_name=client.name if client else client_name,
+                          invoice_no=invoice_no,
+                          is_manual=is_manual,
+                          date=datetime.now().date(),
+                          total_amount=amount,
+                          balance=pending_amount,
+                          status=status,
+                          is_cash=track_as_cash,
+                          created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
+                          created_by=username)
+            db.session.add(inv)
+            db.session.flush()
+
+    sale = DirectSale(client_name=client_name,
+                      client_id=(client.id if client else None),
+                      amount=amount,
+                      paid_amount=paid_amount,
+                      manual_bill_no=manual_bill_no,
+                      photo_path=photo_path,
+                      category=category)
+    db.session.add(sale)
+    db.session.flush()
+
+    # Determine bill number for pending bill
+    pending_bill_no = manual_bill_no if manual_bill_no else (invoice_no if create_invoice else None)
+
+    # Auto-add to PendingBill if it has a manual bill no or is a tracked credit sale
+    # OR if it's an unregistered cash sale (to avoid orphan entries)
+    # UNBILLED cash sales are given a dummy bill number to show up in ledgers
+    if (manual_bill_no or (create_invoice and invoice_no)) or (pending_amount > 0) or (category.lower() in ['cash', 'booking delivery', 'mixed transaction']):
+        client_code = client.code if client else None
+
+        # If no bill exists for a cash sale, use a placeholder
+        if not pending_bill_no:
+            pending_bill_no = f"CSH-{sale.id}" if category.lower() == 'cash' else f"DS-{sale.id}"
+
+        existing_pb = PendingBill.query.filter_by(bill_no=pending_bill_no, client_code=client_code).first()
+        if not existing_pb:
+            # If amount is 0 (e.g. booking dispatch), keep as Unpaid so it appears in pending lists for tracking.
+            # Only mark as Paid if it was a real transaction (amount > 0) that was fully paid.
+            db.session.add(PendingBill(
+                client_code=client_code,
+                client_name=(client.name if client else client_name),
+                bill_no=pending_bill_no,
+                amount=pending_amount,
+                reason=f"Direct Sale: {items[0][0] if items else ''}",
+                is_cash=(category.lower() == 'cash') or track_as_cash,
+                is_manual=bool(manual_bill_no),
+                is_paid=(pending_amount <= 0 and amount > 0),
+                created_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
+                created_by=username
+            ))
+
+    if inv:
+        sale.invoice_id = inv.id
+
+    # Create DirectSaleItems and Entries
+    now = datetime.now()
+    ledger_bill_ref = manual_bill_no if manual_bill_no else (inv.invoice_no if inv else "UNBILLED-" + str(sale.id))
+    for item in processed:
+        db.session.add(DirectSaleItem(sale_id=sale.id,
+                                      product_name=item['product_name'],
+                                      qty=item['qty'],
+                                      price_at_time=item['price_at_time']))
+
+        # Determine category per item for mixed transactions
+        item_category = category
+        if item['is_booking']:
+            item_category = 'Booking Delivery'
+        elif category == 'Mixed Transaction':
+            item_category = 'Cash' if paid_amount >= amount else 'Credit Customer'
+        elif category == 'Booking Delivery':  # Fallback if main cat is Booking but this item isn't
+            item_category = 'Credit Customer'
+
+        db.session.add(Entry(date=now.strftime('%Y-%m-%d'),
+                             time=now.strftime('%H:%M:%S'),
+                             type='OUT',
+                             material=item['product_name'],
+                             client=client_name,
+                             client_code=(client.code if client else None),
+                             client_id=(client.id if client else None),
+                             qty=item['qty'],
+                             bill_no=ledger_bill_ref,
+                             nimbus_no='Direct Sale',
+                             created_by=username,
+                             client_category=item_category))
+
+    if manual_bill_no:
+        bill_ref = manual_bill_no
+    elif inv:
+        bill_ref = inv.invoice_no
+    elif sale.auto_bill_no:
+        bill_ref = sale.auto_bill_no
+    else:
+        bill_ref = f"CSH-{sale.id}" if category.lower() == 'cash' else f"DS-{sale.id}"
+
+    return {'sale': sale, 'invoice': inv, 'pending_bill_no': pending_bill_no, 'bill_ref': bill_ref,
+            'items': processed}
@@ -0,0 +1,122 @@
+"""
+Sequences for auto-generated client/material codes and bill numbers.
+
+Each series keeps its last issued number in a `code_sequence` row. A block
+of N codes is reserved with one `UPDATE ... RETURNING`, which takes SQLite's
+write lock, so concurrent requests and import loops never mint the same
+code or rescan the client/material tables. The reservation belongs to the
+caller's transaction: a rollback hands the numbers back.
+"""
+from sqlalchemy import text
+
+from models import db, Client, Material, Settings
+
+BILL_COUNTER_START = 1000
+
+# series name -> (prefix, zero padding, model owning the codes)
+SERIES = {
+    'client': ('tmpc-', 6, Client),
+    'material': ('tmpm-', 5, Material),
+}
+
+
+def _existing_max(series):
+    prefix, _, model = SERIES[series]
+    table = model.__table__.name
+    return db.session.execute(
+        text(f"SELECT max(CAST(substr(code, :start) AS INTEGER)) FROM {table} WHERE code LIKE :pattern"),
+        {'start': len(prefix) + 1, 'pattern': prefix + '%'}
+    ).scalar() or 0
+
+
+def _seed(series):
+    """Create the sequence row from the highest code already in use."""
+    db.session.execute(
+        text("INSERT OR IGNORE INTO code_sequence (name, value) VALUES (:name, :value)"),
+        {'name': series, 'value': _existing_max(series)})
+
+
+def _bump(series, n):
+    return db.session.execute(
+        text("UPDATE code_sequence SET value = value + :n WHERE name = :name RETURNING value"),
+        {'n': n, 'name': series}).scalar()
+
+
+def reserve_codes(series, n=1):
+    """Reserve `n` consecutive codes of a series and return them as strings."""
+    if n <= 0:
+        return []
+    prefix, width, model = SERIES[series]
+
+    last = _bump(series, n)
+    if last is None:
+        _seed(series)
+        last = _bump(series, n)
+    codes = [f"{prefix}{num:0{width}d}" for num in range(last - n + 1, last + 1)]
+
+    # A code typed in by hand may sit ahead of the sequence; skip past it once.
+    taken = db.session.query(model.code).filter(model.code.in_(codes)).first()
+    if taken:
+        db.session.execute(
+            text("UPDATE code_sequence SET value = max(value, :value) WHERE name = :name"),
+            {'value': _existing_max(series), 'name': series})
+        last = _bump(series, n)
+        codes = [f"{prefix}{num:0{width}d}" for num in range(last - n + 1, last + 1)]
+    return codes
+
+
+def generate_client_code():
+    """Generate next client code in format tmpc-000001"""
+    return reserve_codes('client')[0]
+
+
+def generate_material_code():
+    """Generate next material code in format tmpm-00001"""
+    return reserve_codes('material')[0]
+
+
+def _bill_prefix(prefix=None):
+    if prefix is not None:
+        return prefix
+    settings = Settings.query.first()
+    return (settings.bill_prefix if settings and settings.bill_prefix is not None else '#')
+
+
+def _seed_bill_counter(prefix):
+    """Start a prefix's counter where the single pre-prefix counter left off."""
+    db.session.execute(text(
+        "INSERT OR IGNORE INTO bill_counter (prefix, count) VALUES (:prefix, "
+        "coalesce((SELECT max(count) FROM bill_counter WHERE prefix IS NULL), :start))"),
+        {'prefix': prefix, 'start': BILL_COUNTER_START})
+
+
+def reserve_bill_numbers(n=1, prefix=None):
+    """Reserve `n` consecutive bill numbers for `prefix` (default Settings.bill_prefix).
+
+    One `UPDATE ... RETURNING` per call regardless of `n`, so bulk posting
+    can take a whole block and concurrent workers never get the same number.
+    """
+    if n <= 0:
+        return []
+    prefix = _bill_prefix(prefix)
+    bump = text("UPDATE bill_counter SET count = count + :n WHERE prefix = :prefix RETURNING count")
+    end = db.session.execute(bump, {'n': n, 'prefix': prefix}).scalar()
+    if end is None:
+        _seed_bill_counter(prefix)
+        end = db.session.execute(bump, {'n': n, 'prefix': prefix}).scalar()
+    return [f"{prefix}{num}" for num in range(end - n, end)]
+
+
+def next_bill_no(prefix=None):
+    return reserve_bill_numbers(1, prefix)[0]
+
+
+def peek_bill_no(prefix=None):
+    """The number the next reservation would return, without reserving it."""
+    prefix = _bill_prefix(prefix)
+    count = db.session.execute(
+        text("SELECT count FROM bill_counter WHERE prefix = :prefix"), {'prefix': prefix}).scalar()
+    if count is None:
+        count = db.session.execute(
+            text("SELECT max(count) FROM bill_counter WHERE prefix IS NULL")).scalar() or BILL_COUNTER_START
+    return f"{prefix}{count}"
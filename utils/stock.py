@@ -0,0 +1,341 @@
+"""
+Stock movements and request-scoped material lookups.
+
+Stock entries are the only thing that moves stock: an IN entry adds its
+qty to the material, an OUT entry takes it away, and a voided or deleted
+entry gives its effect back. A flush hook turns every Entry insert, edit,
+void and delete into a delta on `Material.total` (plus the lifetime
+`total_in` / `total_out` counters), so views never touch those columns
+themselves and dashboards can read them instead of summing Entry.
+
+Deltas are queued per material for the whole transaction and written on
+commit as a single `UPDATE material SET total = total + CASE id ... END`,
+so a 20-line sale costs one material read and one update. The same deltas,
+keyed by entry date, keep `stock_daily`: the day's in/out is bumped and the
+running closing figure is rolled forward from that day only, so a
+back-dated edit touches the days after it and nothing before. Bulk deletes
+go through `delete_entries`, bulk voids through `void_entries`, bulk
+inserts through `post_entry_rows`.
+`stock_as_of` reads the stock at the end of any day from stock_daily.
+`verify_stock` recomputes the figures from Entry to detect (and repair)
+drift. Materials are fetched through `material_map`, which loads every
+name it is asked for with one query and keeps the result for the rest of
+the transaction. Both the map and the queued deltas are dropped on commit
+or rollback.
+"""
+import logging
+
+from sqlalchemy import event, case, func, update, bindparam, text
+from sqlalchemy.orm import Session, attributes
+
+from models import db, Material, Entry, StockDaily
+from utils.names import name_key
+
+MATERIAL_MAP = 'material_map'
+STOCK_DELTAS = 'stock_deltas'
+DAILY_DELTAS = 'stock_daily_deltas'
+
+# attributes of an entry that decide its effect on stock
+ENTRY_STOCK_FIELDS = ('type', 'qty', 'material', 'material_id', 'is_void', 'date')
+
+DRIFT_TOLERANCE = 1e-6
+
+
+def material_map(names):
+    """{name: Material or None} for `names`, loading only names not seen in this transaction.
+
+    Names are matched exactly first, then by name_key ("opc  cement" finds "OPC Cement").
+    """
+    cache = db.session.info.setdefault(MATERIAL_MAP, {})
+    missing = {n for n in names if n and n not in cache}
+    if missing:
+        with db.session.no_autoflush:
+            for material in Material.query.filter(Material.name.in_(missing)):
+                cache.setdefault(material.name, material)
+            keys = {name_key(n): n for n in missing if n not in cache and name_key(n)}
+            if keys:
+                for material in Material.query.filter(Material.name_key.in_(list(keys))):
+                    for name in missing:
+                        if name not in cache and name_key(name) == material.name_key:
+                            cache[name] = material
+        for name in missing:
+            cache.setdefault(name, None)
+    return {n: cache[n] for n in names if n}
+
+
+def get_material(name):
+    return material_map([name]).get(name) if name else None
+
+
+def entry_movement(type_, qty, is_void=False):
+    """(qty in, qty out) an entry contributes to its material's stock."""
+    if is_void or not qty:
+        return 0, 0
+    if type_ == 'IN':
+        return qty, 0
+    if type_ == 'OUT':
+        return 0, qty
+    return 0, 0
+
+
+def queue_movement(material_id, day, qty_in=0, qty_out=0):
+    """Add a movement dated `day` to the material's totals when the transaction commits."""
+    if material_id is None or not (qty_in or qty_out):
+        return
+    for key, deltas in ((material_id, db.session.info.setdefault(STOCK_DELTAS, {})),
+                        ((material_id, day or ''), db.session.info.setdefault(DAILY_DELTAS, {}))):
+        current = deltas.get(key, (0, 0))
+        deltas[key] = (current[0] + qty_in, current[1] + qty_out)
+
+
+def pending_stock_delta(material):
+    """Net stock change already queued for `material` in this transaction."""
+    if material is None:
+        return 0
+    qty_in, qty_out = db.session.info.get(STOCK_DELTAS, {}).get(material.id, (0, 0))
+    return qty_in - qty_out
+
+
+def _queue_entries(rows, sign=1):
+    """Queue (material_id, material name, date, qty in, qty out) rows; names resolve when the id is unknown."""
+    rows = list(rows)
+    names = material_map([name for mid, name, _, _, _ in rows if mid is None and name])
+    for mid, name, day, qty_in, qty_out in rows:
+        if mid is None:
+            material = names.get(name) if name else None
+            mid = material.id if material else None
+        queue_movement(mid, day, sign * (qty_in or 0), sign * (qty_out or 0))
+
+
+def post_entry_rows(rows, sign=1):
+    """Queue stock for Entry rows written as dicts (bulk inserts); sign=-1 reverses them."""
+    movements = []
+    for row in rows:
+        qty_in, qty_out = entry_movement(row.get('type'), row.get('qty'), row.get('is_void'))
+        if qty_in or qty_out:
+            movements.append((row.get('material_id'), row.get('material'), row.get('date'), qty_in, qty_out))
+    _queue_entries(movements, sign)
+
+
+def entry_movements(query, entry=Entry):
+    """[(material_id, material, date, qty in, qty out)] of the live entries selected by `query`, grouped.
+
+    `entry` is the entity `query` selects when it is not Entry itself (an alias).
+    """
+    return query.with_entities(
+        entry.material_id, entry.material, entry.date,
+        func.sum(case((entry.type == 'IN', entry.qty), else_=0)),
+        func.sum(case((entry.type == 'OUT', entry.qty), else_=0)),
+    ).filter(entry.is_void == False).group_by(entry.material_id, entry.material, entry.date).all()
+
+
+def delete_entries(query):
+    """Bulk-delete the entries selected by `query`, giving their stock back. Returns rows deleted."""
+    _queue_entries(entry_movements(query), sign=-1)
+    return query.delete(synchronize_session=False)
+
+
+def void_entries(query):
+    """Bulk-void the live entries selected by `query`, giving their stock back. Returns rows voided."""
+    _queue_entries(entry_movements(query), sign=-1)
+    return query.filter(Entry.is_void == False).update({'is_void': True}, synchronize_session=False)
+
+
+def _entry_state(obj, old=False):
+    """(material_id, material, date, qty in, qty out) for an entry as it is now, or as it was loaded."""
+    values = {}
+    changed = set()
+    for attr in ENTRY_STOCK_FIELDS:
+        history = attributes.get_history(obj, attr)
+        if history.has_changes():
+            changed.add(attr)
+        values[attr] = history.deleted[0] if old and history.deleted else getattr(obj, attr)
+    material_id = values['material_id']
+    if not old and 'material' in changed and 'material_id' not in changed:
+        # renamed to another material: the id is relinked after the flush, go by name
+        material_id = None
+    qty_in, qty_out = entry_movement(values['type'], values['qty'], values['is_void'])
+    return material_id, values['material'], values['date'], qty_in, qty_out
+
+
+def track_old_values(model, fields):
+    """Make `fields` of `model` keep their loaded value in history even when set while expired.
+
+    Without this, changing e.g. `qty` on an entry that was expired by a commit
+    records no old value, and the flush hooks could not reverse it.
+    """
+    for field in fields:
+        event.listen(getattr(model, field), 'set', _noop_set, active_history=True)
+
+
+def _noop_set(target, value, oldvalue, initiator):
+    pass
+
+
+track_old_values(Entry, ENTRY_STOCK_FIELDS)
+
+
+def _stock_changed(obj):
+    return any(attributes.get_history(obj, attr).has_changes() for attr in ENTRY_STOCK_FIELDS)
+
+
+@event.listens_for(Session, 'before_flush')
+def _post_entry_movements(session, flush_context, instances):
+    posted, reversed_ = [], []
+    for obj in session.new:
+        if isinstance(obj, Entry):
+            posted.append(_entry_state(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Entry) and _stock_changed(obj):
+            reversed_.append(_entry_state(obj, old=True))
+            posted.append(_entry_state(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Entry):
+            reversed_.append(_entry_state(obj, old=True))
+    if posted or reversed_:
+        _queue_entries(reversed_, sign=-1)
+        _queue_entries(posted)
+
+
+def apply_stock_deltas(session):
+    # flush first: it may queue more movements, and an ORM write to a
+    # material must not land after (and over) this update
+    session.flush()
+    deltas = {mid: d for mid, d in session.info.pop(STOCK_DELTAS, {}).items() if d[0] or d[1]}
+    daily = {key: d for key, d in session.info.pop(DAILY_DELTAS, {}).items() if d[0] or d[1]}
+    if deltas:
+        table = Material.__table__
+        qty_in = {mid: d[0] for mid, d in deltas.items()}
+        qty_out = {mid: d[1] for mid, d in deltas.items()}
+        session.execute(update(table).where(table.c.id.in_(list(deltas))).values(
+            total=func.coalesce(table.c.total, 0)
+            + case(qty_in, value=table.c.id, else_=0) - case(qty_out, value=table.c.id, else_=0),
+            total_in=func.coalesce(table.c.total_in, 0) + case(qty_in, value=table.c.id, else_=0),
+            total_out=func.coalesce(table.c.total_out, 0) + case(qty_out, value=table.c.id, else_=0)))
+    if daily:
+        _apply_daily(session, daily)
+
+
+def _apply_daily(session, daily):
+    """Fold {(material_id, date): (in, out)} into stock_daily, rolling closings forward from each date."""
+    params = [{'mid': mid, 'day': day, 'qty_in': d[0], 'qty_out': d[1], 'net': d[0] - d[1]}
+              for (mid, day), d in sorted(daily.items())]
+    # a new day starts from the closing of the day before it; the nets below then land on it
+    session.execute(text(
+        "INSERT OR IGNORE INTO stock_daily (material_id, date, qty_in, qty_out, closing) "
+        "SELECT :mid, :day, 0, 0, coalesce((SELECT closing FROM stock_daily "
+        "WHERE material_id = :mid AND date < :day ORDER BY date DESC LIMIT 1), 0)"), params)
+    session.execute(text(
+        "UPDATE stock_daily SET qty_in = qty_in + :qty_in, qty_out = qty_out + :qty_out "
+        "WHERE material_id = :mid AND date = :day"), params)
+    session.execute(text(
+        "UPDATE stock_daily SET closing = closing + :net WHERE material_id = :mid AND date >= :day"), params)
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_on_commit(session):
+    apply_stock_deltas(session)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _reset_transaction_state(session, *args):
+    session.info.pop(MATERIAL_MAP, None)
+    session.info.pop(STOCK_DELTAS, None)
+    session.info.pop(DAILY_DELTAS, None)
+
+
+def _expected_daily():
+    """{material_id: [(date, in, out, closing), ...]} rebuilt from non-void entries, archived ones included."""
+    from utils.archive import with_archive
+    entry = with_archive(Entry)
+    sums = db.session.query(
+        entry.material_id, entry.material, entry.date,
+        func.sum(case((entry.type == 'IN', entry.qty), else_=0)),
+        func.sum(case((entry.type == 'OUT', entry.qty), else_=0)),
+    ).filter(entry.is_void == False).group_by(entry.material_id, entry.material, entry.date).all()
+
+    names = material_map([name for mid, name, _, _, _ in sums if mid is None and name])
+    by_day = {}
+    for mid, name, day, qty_in, qty_out in sums:
+        if mid is None:
+            material = names.get(name) if name else None
+            mid = material.id if material else None
+        if mid is not None and (qty_in or qty_out):
+            got = by_day.get((mid, day or ''), (0, 0))
+            by_day[(mid, day or '')] = (got[0] + (qty_in or 0), got[1] + (qty_out or 0))
+
+    expected = {}
+    for (mid, day), (qty_in, qty_out) in sorted(by_day.items()):
+        rows = expected.setdefault(mid, [])
+        closing = (rows[-1][3] if rows else 0) + qty_in - qty_out
+        rows.append((day, qty_in, qty_out, closing))
+    return expected
+
+
+def _off(have, want):
+    return have is None or abs(have - want) > DRIFT_TOLERANCE
+
+
+def stock_as_of(day):
+    """[(material name, day's in, day's out, closing)] at the end of `day`, one row per material.
+
+    Reads each material's last stock_daily row on or before `day` through the
+    (material_id, date) index; its in/out count only when it is dated `day`.
+    """
+    latest = db.select(StockDaily.id).where(StockDaily.material_id == Material.id, StockDaily.date <= day)\
+        .order_by(StockDaily.date.desc()).limit(1).correlate(Material).scalar_subquery()
+    rows = db.session.query(Material.name, StockDaily.date, StockDaily.qty_in, StockDaily.qty_out, StockDaily.closing)\
+        .outerjoin(StockDaily, StockDaily.id == latest).order_by(Material.name)
+    result = []
+    for name, row_day, qty_in, qty_out, closing in rows:
+        same_day = row_day == day
+        result.append((name, (qty_in or 0) if same_day else 0, (qty_out or 0) if same_day else 0, closing or 0))
+    return result
+
+
+def verify_stock(repair=False):
+    """Compare material totals and stock_daily with the non-void entries they come from.
+
+    Returns one dict per material whose total, total_in, total_out or daily
+    rows are off; with repair=True those materials are rewritten from Entry
+    and committed.
+    """
+    expected = _expected_daily()
+    stored = {}
+    for mid, day, qty_in, qty_out, closing in db.session.query(
+            StockDaily.material_id, StockDaily.date, StockDaily.qty_in, StockDaily.qty_out, StockDaily.closing):
+        stored.setdefault(mid, {})[day] = (qty_in, qty_out, closing)
+
+    drift = []
+    for mid, name, total, total_in, total_out in db.session.query(
+            Material.id, Material.name, Material.total, Material.total_in, Material.total_out).order_by(Material.name):
+        days = expected.get(mid, [])
+        qty_in = sum(d[1] for d in days)
+        qty_out = sum(d[2] for d in days)
+        have_days = stored.get(mid, {})
+        # days that net to nothing may or may not have a row; only the figures matter
+        days_off = sum(1 for day, d_in, d_out, closing in days
+                       if any(_off(h, w) for h, w in zip(have_days.get(day, (None,) * 3), (d_in, d_out, closing))))
+        want_days = {d[0] for d in days}
+        days_off += sum(1 for day, row in have_days.items() if day not in want_days and (row[0] or row[1]))
+        if days_off or any(_off(h, w) for h, w in zip((total, total_in, total_out), (qty_in - qty_out, qty_in, qty_out))):
+            drift.append({'id': mid, 'name': name, 'total': total, 'expected': qty_in - qty_out,
+                          'total_in': total_in, 'total_out': total_out,
+                          'expected_in': qty_in, 'expected_out': qty_out, 'days_off': days_off})
+
+    if repair and drift:
+        table = Material.__table__
+        db.session.execute(update(table).where(table.c.id == bindparam('_id')).values(
+            total=bindparam('_total'), total_in=bindparam('_in'), total_out=bindparam('_out')),
+            [{'_id': d['id'], '_total': d['expected'], '_in': d['expected_in'], '_out': d['expected_out']}
+             for d in drift])
+        ids = [d['id'] for d in drift]
+        StockDaily.query.filter(StockDaily.material_id.in_(ids)).delete(synchronize_session=False)
+        rows = [{'material_id': mid, 'date': day, 'qty_in': qty_in, 'qty_out': qty_out, 'closing': closing}
+                for mid in ids for day, qty_in, qty_out, closing in expected.get(mid, [])]
+        if rows:
+            db.session.execute(StockDaily.__table__.insert(), rows)
+        db.session.commit()
+        logging.warning(f"Repaired stock totals for {len(drift)} materials")
+    return drift
@@ -0,0 +1,175 @@
+"""
+Bulk void.
+
+Voids every live document of one kind matched by a selection: ids, a date
+range, the import job that created them (stock entries) or a bill number
+pattern (`*` and `?` wildcards). The effects are the ones
+`void_transaction` has for a single document, done with one statement per
+table instead of one per row:
+
+- entries give their stock back through `void_entries` (one material update
+  on commit);
+- a direct sale voids the entries and pending bills under its bill refs
+  (DS-/CSH-/UNBILLED-<id>, manual and auto bill numbers), a booking the
+  pending bills under BK-<id> and its manual bill;
+- payments give back what they paid off their bills (`reverse_allocations`),
+  and pending bills voided with a document hand what payments paid on them
+  back to those payments (`release_bills`);
+- voiding the entries of an import job also voids the pending bills that
+  import created.
+
+The selection runs as a subquery in each statement, so nothing is loaded
+row by row. Bookings, payments and sales are voided with UPDATEs the
+finance and journal flush hooks do not see, so the rollup and journal of
+the clients involved are re-derived in the same transaction. With
+dry_run=True nothing is written and the returned preview shows what would
+change.
+"""
+from sqlalchemy import select, func, literal, cast, union, or_, String
+
+from models import db, Entry, DirectSale, Booking, Payment, PendingBill, PaymentAllocation
+from utils.allocation import reverse_allocations, release_bills
+from utils.finance import day_range, refresh_finance_daily
+from utils.journal import refresh_journal
+from utils.period import assert_open
+from utils.stock import entry_movements, void_entries
+
+VOID_MODELS = {'Entry': Entry, 'DirectSale': DirectSale, 'Booking': Booking, 'Payment': Payment}
+
+BILL_COLUMNS = {
+    Entry: ('bill_no',),
+    DirectSale: ('manual_bill_no', 'auto_bill_no'),
+    Booking: ('manual_bill_no',),
+    Payment: ('manual_bill_no',),
+}
+
+# generated bill refs a document's pending bills and entries are filed under
+GENERATED_REFS = {
+    DirectSale: ('DS-', 'CSH-', 'UNBILLED-'),
+    Booking: ('BK-',),
+}
+
+
+def select_documents(doc_type, ids=None, date_from=None, date_to=None, import_job_id=None, bill_pattern=None):
+    """Query of the live documents of `doc_type` matching every given criterion."""
+    model = VOID_MODELS.get(doc_type)
+    if model is None:
+        raise ValueError(f"Cannot bulk void {doc_type}.")
+    if not (ids or date_from or date_to or import_job_id or bill_pattern):
+        raise ValueError('Choose ids, a date range, an import job or a bill pattern.')
+    if import_job_id and model is not Entry:
+        raise ValueError('Only stock entries are tagged with the import that created them.')
+
+    q = model.query.filter(func.coalesce(model.is_void, False) == False)
+    if ids:
+        q = q.filter(model.id.in_(ids))
+    if model is Entry:
+        if date_from:
+            q = q.filter(Entry.date >= date_from)
+        if date_to:
+            q = q.filter(Entry.date <= date_to)
+    else:
+        if date_from:
+            q = q.filter(model.date_posted >= day_range(date_from, date_from)[0])
+        if date_to:
+            q = q.filter(model.date_posted < day_range(date_to, date_to)[1])
+    if import_job_id:
+        q = q.filter(Entry.import_job_id == import_job_id)
+    if bill_pattern:
+        like = bill_pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        like = like.replace('*', '%').replace('?', '_')
+        q = q.filter(or_(*(getattr(model, col).like(like, escape='\\') for col in BILL_COLUMNS[model])))
+    return q
+
+
+def _bill_refs(model, doc_ids):
+    """Select of the bill refs the selected sales or bookings file their entries and pending bills under."""
+    selects = [select(literal(prefix) + cast(model.id, String)).where(model.id.in_(doc_ids))
+               for prefix in GENERATED_REFS[model]]
+    selects += [select(getattr(model, col)).where(model.id.in_(doc_ids), getattr(model, col).isnot(None),
+                                                   getattr(model, col) != '')
+                for col in BILL_COLUMNS[model]]
+    return union(*selects)
+
+
+def _effects(model, q, import_job_id=None):
+    """(entries query or None, pending-bill condition or None) the void of `q` carries with it."""
+    doc_ids = q.with_entities(model.id)
+    if model is Entry:
+        return q, (PendingBill.import_job_id == import_job_id if import_job_id else None)
+    if model is Payment:
+        return None, None
+    refs = _bill_refs(model, doc_ids.subquery().select())
+    entries = Entry.query.filter(Entry.bill_no.in_(refs)) if model is DirectSale else None
+    return entries, PendingBill.bill_no.in_(refs)
+
+
+def bulk_void(doc_type, dry_run=True, **selection):
+    """Void the documents matched by `selection` (see select_documents) and everything they carry.
+
+    Returns a preview dict of the effect; with dry_run=False the void is
+    written and committed.
+    """
+    model = VOID_MODELS.get(doc_type)
+    q = select_documents(doc_type, **selection)
+    entries, bills = _effects(model, q, selection.get('import_job_id'))
+    doc_ids = q.with_entities(model.id).subquery().select()
+
+    preview = {'doc_type': doc_type, 'documents': q.count(), 'amount': 0, 'clients': 0,
+               'entries': 0, 'stock': [], 'pending_bills': 0, 'pending_amount': 0,
+               'allocations': 0, 'allocated_amount': 0, 'released_allocations': 0, 'released_amount': 0,
+               'applied': False}
+    date_col = Entry.date if model is Entry else model.date_posted
+    first, last = q.with_entities(func.min(date_col), func.max(date_col)).one()
+    preview['first_date'], preview['last_date'] = (str(first)[:10] if first else None, str(last)[:10] if last else None)
+    if model is not Entry:
+        preview['amount'] = q.with_entities(func.sum(model.amount)).scalar() or 0
+        client_ids = {cid for (cid,) in q.with_entities(model.client_id).distinct()}
+        preview['clients'] = len(client_ids)
+
+    movements = entry_movements(entries) if entries is not None else []
+    if entries is not None:
+        preview['entries'] = entries.filter(Entry.is_void == False).count()
+        stock = {}
+        for _, material, day, qty_in, qty_out in movements:
+            change = stock.setdefault(material or '', [0, 0])
+            change[0] += qty_in or 0
+            change[1] += qty_out or 0
+        preview['stock'] = [{'material': m, 'qty_in': i, 'qty_out': o, 'stock_change': o - i}
+                            for m, (i, o) in sorted(stock.items())]
+        days = [day for _, _, day, _, _ in movements if day]
+        if days:
+            preview['first_date'] = min([preview['first_date'] or days[0]] + days)
+    if bills is not None:
+        live = PendingBill.query.filter(bills, func.coalesce(PendingBill.is_void, False) == False)
+        preview['pending_bills'] = live.count()
+        preview['pending_amount'] = live.with_entities(func.sum(PendingBill.amount)).scalar() or 0
+        released = PaymentAllocation.query.filter(
+            PaymentAllocation.pending_bill_id.in_(select(PendingBill.id).where(bills)),
+            PaymentAllocation.is_void == False)
+        preview['released_allocations'] = released.count()
+        preview['released_amount'] = released.with_entities(func.sum(PaymentAllocation.amount)).scalar() or 0
+    if model is Payment:
+        allocs = PaymentAllocation.query.filter(PaymentAllocation.payment_id.in_(doc_ids),
+                                                PaymentAllocation.is_void == False)
+        preview['allocations'] = allocs.count()
+        preview['allocated_amount'] = allocs.with_entities(func.sum(PaymentAllocation.amount)).scalar() or 0
+
+    if dry_run or not preview['documents']:
+        return preview
+
+    assert_open(preview['first_date'])
+    if model is Payment:
+        reverse_allocations(doc_ids)
+    if entries is not None:
+        void_entries(entries)
+    if bills is not None:
+        release_bills(select(PendingBill.id).where(bills))
+        PendingBill.query.filter(bills).update({'is_void': True}, synchronize_session=False)
+    if model is not Entry:
+        q.update({'is_void': True}, synchronize_session=False)
+        refresh_finance_daily(client_ids)
+        refresh_journal(client_ids)
+    db.session.commit()
+    preview['applied'] = True
+    return preview